@@ -18,7 +18,7 @@ calico.calcollections
 
 Collection classes and utils.
 """
-
+from collections import OrderedDict
 import logging
 
 _log = logging.getLogger(__name__)
@@ -182,3 +182,66 @@ class MultiDict(object):
     def __nonzero__(self):
         """Implement bool(<multidict>). True if we have some entries."""
         return bool(self._index)
+
+
+class LRUCache(object):
+    """
+    Bounded mapping that evicts the least-recently-used entry once it is
+    full.
+
+    Counts hits, misses and evictions, for use in diagnostics.
+    """
+
+    def __init__(self, max_size):
+        """Constructor.
+
+        :param int max_size: Maximum number of entries to hold.  If zero, the
+               cache stores nothing.
+        """
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        """
+        :return: the value for the given key, marking it as most-recently
+                 used, or default if the key is not present.
+        """
+        try:
+            value = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        # Re-insert to move the entry to the most-recently-used end.
+        self._entries[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """Stores the value, evicting the least-recently-used entries if
+        the cache is full."""
+        if self.max_size <= 0:
+            return
+        self._entries.pop(key, None)
+        self._entries[key] = value
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        """Removes all entries; the counters are left untouched."""
+        self._entries.clear()
+
+    def __contains__(self, key):
+        """Implements the 'in' operator.  Doesn't affect the LRU order."""
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __str__(self):
+        return ("LRUCache<size=%s/%s,hits=%s,misses=%s,evictions=%s>" %
+                (len(self._entries), self.max_size, self.hits, self.misses,
+                 self.evictions))
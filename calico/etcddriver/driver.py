@@ -50,7 +50,6 @@ import time
 from urlparse import urlparse
 
 from ijson.backends import yajl2 as ijson
-from urllib3 import HTTPConnectionPool, HTTPSConnectionPool
 import urllib3.exceptions
 import httplib
 
@@ -63,13 +62,19 @@ from calico.etcddriver.protocol import (
     MSG_KEY_VALUE, MessageWriter, MSG_TYPE_STATUS, MSG_KEY_STATUS,
     MSG_KEY_KEY_FILE, MSG_KEY_CERT_FILE, MSG_KEY_CA_FILE, WriteFailed,
     SocketClosed)
-from calico.etcdutils import ACTION_MAPPING
+from calico.etcdutils import (
+    ACTION_MAPPING, POOL_SNAPSHOT, POOL_WATCH, close_idle_connections,
+    connection_factory
+)
 from calico.common import complete_logging
 from calico.monotonic import monotonic_time
 from calico.datamodel_v1 import (
     READY_KEY, CONFIG_DIR, dir_for_per_host_config, VERSION_DIR,
     ROOT_DIR)
 from calico.etcddriver.hwm import HighWaterTracker
+from calico.etcddriver.lag import (
+    EventLagTracker, CATCHUP_GROW_QUEUE, CATCHUP_PARTIAL_RESYNC
+)
 
 _log = logging.getLogger(__name__)
 
@@ -78,6 +83,12 @@ _log = logging.getLogger(__name__)
 # general, Felix and the resync thread process much more quickly than the
 # watcher can read from etcd so this is defensive.
 WATCHER_QUEUE_SIZE = 20000
+# Limit to which we'll grow the queue if the resync thread falls behind the
+# watcher.  Growing the queue allows the watcher to keep up with etcd, which
+# only keeps a limited window of event history.
+MAX_WATCHER_QUEUE_SIZE = WATCHER_QUEUE_SIZE * 16
+# How often, in seconds, to check whether we're falling behind the watcher.
+LAG_CHECK_INTERVAL = 1
 
 # Threshold in seconds for detecting watcher tight looping on exception.
 REQ_TIGHT_LOOP_THRESH = 0.2
@@ -112,6 +123,9 @@ class EtcdDriver(object):
         self._first_resync = True
         self._resync_http_pool = None
         self._cluster_id = None
+        # Source of our etcd connection pools, created once we know the TLS
+        # config.
+        self._conn_factory = None
 
         # Resync thread stats.
         self._snap_keys_processed = RateStat("snapshot keys processed")
@@ -124,6 +138,14 @@ class EtcdDriver(object):
         ]
         self._last_resync_stat_log_time = monotonic_time()
 
+        # Tracks how far we're behind the watcher.  Owned by resync thread.
+        self._lag_tracker = EventLagTracker(MAX_WATCHER_QUEUE_SIZE)
+        # Maps from subtree to the etcd index of the partial resync that we
+        # did for that subtree.  Watcher events in the subtree with indexes
+        # at or below that index are already reflected in our state.
+        # Owned by resync thread.
+        self._partial_resync_idxs = {}
+
         # Set by the reader thread once the init message has been received
         # from Felix.
         self._init_received = Event()
@@ -227,6 +249,11 @@ class EtcdDriver(object):
         self._etcd_key_file = msg[MSG_KEY_KEY_FILE]
         self._etcd_cert_file = msg[MSG_KEY_CERT_FILE]
         self._etcd_ca_file = msg[MSG_KEY_CA_FILE]
+        self._conn_factory = connection_factory(
+            key_file=self._etcd_key_file,
+            cert_file=self._etcd_cert_file,
+            ca_file=self._etcd_ca_file
+        )
         self._hostname = msg[MSG_KEY_HOSTNAME]
         self._init_received.set()
 
@@ -262,10 +289,14 @@ class EtcdDriver(object):
             _log.info("Stop event not set, starting new resync...")
             self._reset_resync_thread_stats()
             loop_start = monotonic_time()
+            resp = None
             try:
-                # Start with a fresh HTTP pool just in case it got into a bad
-                # state.
-                self._resync_http_pool = self.get_etcd_connection()
+                # Look up the pool again in case we've switched to a
+                # different etcd URL.  We keep using the same pool for a
+                # given URL so that its connections survive the resync.
+                self._resync_http_pool = self.get_etcd_connection(
+                    POOL_SNAPSHOT
+                )
                 # Before we get to the snapshot, Felix needs the configuration.
                 self._send_status(STATUS_WAIT_FOR_READY)
                 self._wait_for_ready()
@@ -280,6 +311,9 @@ class EtcdDriver(object):
                 # Incrementally process the snapshot, merging in events from
                 # the queue.
                 self._process_snapshot_and_events(resp, snapshot_index)
+                # Fully read, so the connection can be reused.
+                resp.release_conn()
+                resp = None
                 # We're now in-sync.  Tell Felix.
                 self._send_status(STATUS_IN_SYNC)
                 # Then switch to processing events only.
@@ -314,10 +348,25 @@ class EtcdDriver(object):
                 self.stop()
                 raise
             finally:
+                if resp is not None:
+                    # We abandoned the snapshot part way through.
+                    self._discard_snapshot_response(resp)
                 self._first_resync = False
                 self._resync_requested = False
         _log.info("Stop event set, exiting resync loop.")
 
+    def _discard_snapshot_response(self, resp):
+        """
+        Releases a snapshot response that we stopped reading part way
+        through.  The rest of the response may still be on its way over
+        the connection so, rather than let the pool reuse the connection,
+        we close the pool's idle connections.  The pool reconnects on
+        demand.
+        """
+        _log.info("Discarding partially-read snapshot response")
+        resp.release_conn()
+        close_idle_connections(self._resync_http_pool)
+
     def _rotate_etcd_url(self):
         """
         Rotate the in use etcd URL if more than one is configured,
@@ -502,6 +551,7 @@ class EtcdDriver(object):
         :param etcd_response: file-like object representing the etcd response.
         :param snapshot_index: the etcd index of the response.
         """
+        self._hwms.start_generation(snapshot_index)
         self._hwms.start_tracking_deletions()
         parse_snapshot(etcd_response,
                        callback=partial(self._handle_etcd_node,
@@ -567,8 +617,123 @@ class EtcdDriver(object):
         while not self._stop_event.is_set():
             self._handle_next_watcher_event(resync_in_progress=False)
             self._msg_writer.flush()
+            self._maybe_catch_up_with_watcher()
         self._check_stop_event()
 
+    def _maybe_catch_up_with_watcher(self):
+        """
+        Periodically checks whether we're falling behind the watcher and, if
+        so, either grows the watcher queue or does a partial resync of the
+        subtrees that are generating the most events.
+        """
+        queue = self._watcher_queue
+        if (queue is None or
+                self._lag_tracker.window_age() < LAG_CHECK_INTERVAL):
+            return
+        action, subtrees = self._lag_tracker.decide(queue.qsize(),
+                                                    queue.maxsize)
+        if action == CATCHUP_GROW_QUEUE:
+            self._resize_watcher_queue(min(queue.maxsize * 2,
+                                           MAX_WATCHER_QUEUE_SIZE))
+        elif action == CATCHUP_PARTIAL_RESYNC:
+            self._partial_resync(subtrees)
+        elif (queue.maxsize > WATCHER_QUEUE_SIZE and
+                queue.qsize() < WATCHER_QUEUE_SIZE // 2):
+            _log.info("Caught up with watcher, shrinking queue.")
+            self._resize_watcher_queue(WATCHER_QUEUE_SIZE)
+
+    def _resize_watcher_queue(self, maxsize):
+        """
+        Changes the capacity of the watcher queue in place, waking the
+        watcher thread if it is blocked on a full queue.
+        """
+        queue = self._watcher_queue
+        _log.info("Resizing watcher queue from %s to %s", queue.maxsize,
+                  maxsize)
+        with queue.mutex:
+            queue.maxsize = maxsize
+            queue.not_full.notify_all()
+
+    def _partial_resync(self, subtrees):
+        """
+        Reloads the given subtrees from etcd, sending Felix updates for any
+        keys that changed and deletions for any keys that have gone.
+
+        Subsequent watcher events in the subtrees that predate the partial
+        snapshot are then discarded by _handle_next_watcher_event().
+
+        :raises ResyncRequired if the snapshot contains an error response.
+        """
+        for subtree in subtrees:
+            self._check_stop_event()
+            _log.info("Doing partial resync of %s", subtree)
+            resp = self._etcd_request(self._resync_http_pool,
+                                      subtree,
+                                      recursive=True,
+                                      timeout=120,
+                                      preload_content=False)
+            snapshot_index = int(resp.getheader("x-etcd-index", 1))
+            self._hwms.start_generation(snapshot_index, prefix=subtree)
+            if resp.status == 404:
+                # Subtree no longer exists, all its keys will be swept below.
+                _log.info("Subtree %s no longer exists", subtree)
+                resp.release_conn()
+            else:
+                try:
+                    parse_snapshot(
+                        resp,
+                        callback=partial(self._handle_partial_node,
+                                         snapshot_index=snapshot_index)
+                    )
+                except:
+                    self._discard_snapshot_response(resp)
+                    raise
+                resp.release_conn()
+            self._partial_resync_idxs[subtree] = snapshot_index
+            deleted_keys = self._hwms.remove_old_keys(snapshot_index,
+                                                      prefix=subtree)
+            for ev_key in deleted_keys:
+                self._on_key_updated(ev_key, None)
+            _log.info("Partial resync of %s at index %s complete, found %d "
+                      "deleted keys", subtree, snapshot_index,
+                      len(deleted_keys))
+
+    def _handle_partial_node(self, snap_mod, snap_key, snap_value,
+                             snapshot_index=None):
+        """
+        Callback for use with parse_snapshot during a partial resync.
+
+        Unlike _handle_etcd_node(), doesn't interleave watcher events.
+
+        :param snap_mod: Modified index of the key.
+        :param snap_key: The key itself.
+        :param snap_value: The value attached to the key.
+        :param snapshot_index: Index of the snapshot as a whole.
+        """
+        assert snapshot_index is not None
+        self._snap_keys_processed.store_occurence()
+        old_hwm = self._hwms.update_hwm(snap_key, snapshot_index)
+        if snap_mod > old_hwm:
+            self._on_key_updated(snap_key, snap_value)
+
+    def _covered_by_partial_resync(self, ev_mod, ev_key):
+        """
+        Checks whether a watcher event is already reflected by a partial
+        resync.  Expires partial resyncs that are older than the event.
+
+        :returns True if the event should be discarded.
+        """
+        covered = False
+        for subtree, snap_idx in self._partial_resync_idxs.items():
+            if ev_mod > snap_idx:
+                # Events arrive in order so all subsequent events will be
+                # newer than the partial snapshot too.
+                _log.debug("Caught up with partial resync of %s", subtree)
+                del self._partial_resync_idxs[subtree]
+            elif ev_key == subtree or ev_key.startswith(subtree + "/"):
+                covered = True
+        return covered
+
     def _scan_for_deletions(self, snapshot_index):
         """
         Scans the high-water mark cache for keys that haven't been seen since
@@ -617,6 +782,13 @@ class EtcdDriver(object):
             raise WatcherDied()
         self._event_keys_processed.store_occurence()
         ev_mod, ev_key, ev_val = event
+        if (self._partial_resync_idxs and
+                self._covered_by_partial_resync(ev_mod, ev_key)):
+            _log.debug("Skipping event for %s, covered by partial resync",
+                       ev_key)
+            self._lag_tracker.on_event_skipped()
+            return
+        self._lag_tracker.on_event_processed(ev_key)
         if ev_val is not None:
             # Normal update.
             self._hwms.update_hwm(ev_key, ev_mod)
@@ -676,25 +848,21 @@ class EtcdDriver(object):
             self._watcher_stop_event.set()
             self._watcher_stop_event = None
 
-    def get_etcd_connection(self):
+    def get_etcd_connection(self, use):
+        """
+        :param use: One of the etcdutils POOL_* constants, determines the
+               size of the pool.
+        :returns the connection pool for the given use, for the current etcd
+                 URL.
+        """
         with self._etcd_url_lock:
             port = self._etcd_url_parts.port or 2379
-            if self._etcd_url_parts.scheme == "https":
-                _log.debug("Getting new HTTPS connection to %s:%s",
-                           self._etcd_url_parts.hostname, port)
-                pool = HTTPSConnectionPool(self._etcd_url_parts.hostname,
-                                           port,
-                                           key_file=self._etcd_key_file,
-                                           cert_file=self._etcd_cert_file,
-                                           ca_certs=self._etcd_ca_file,
-                                           maxsize=1)
-            else:
-                _log.debug("Getting new HTTP connection to %s:%s",
-                           self._etcd_url_parts.hostname, port)
-                pool = HTTPConnectionPool(self._etcd_url_parts.hostname,
-                                          port,
-                                          maxsize=1)
-            return pool
+            _log.debug("Getting %s connection pool for %s:%s", use,
+                       self._etcd_url_parts.hostname, port)
+            return self._conn_factory.get_pool(use,
+                                               self._etcd_url_parts.scheme,
+                                               self._etcd_url_parts.hostname,
+                                               port)
 
     def _on_key_updated(self, key, value):
         """
@@ -749,6 +917,8 @@ class EtcdDriver(object):
             for stat in self._resync_stats:
                 _log.info("STAT: Resync thread %s", stat)
                 stat.reset()
+            _log.info("STAT: Resync thread %s", self._lag_tracker)
+            _log.info("STAT: %s", self._conn_factory)
             self._last_resync_stat_log_time = now
 
     def watch_etcd(self, next_index, event_queue, stop_event):
@@ -781,8 +951,8 @@ class EtcdDriver(object):
         try:
             while not self._stop_event.is_set() and not stop_event.is_set():
                 if not http:
-                    _log.info("No HTTP pool, creating one...")
-                    http = self.get_etcd_connection()
+                    _log.info("No HTTP pool, looking one up...")
+                    http = self.get_etcd_connection(POOL_WATCH)
                 req_start_time = monotonic_time()
                 if req_end_time is not None:
                     # Calculate the time since the end of the previous request,
@@ -792,6 +962,7 @@ class EtcdDriver(object):
                     non_req_time = req_start_time - req_end_time
                     non_req_time_stat.store_reading(non_req_time * 1000)
                 _log.debug("Waiting on etcd index %s", next_index)
+                resp = None
                 try:
                     try:
                         resp = self._etcd_request(http,
@@ -815,8 +986,11 @@ class EtcdDriver(object):
                     _log.debug("Watch read timed out, restarting watch at "
                                "index %s", next_index)
                     # Workaround urllib3 bug #718.  After a ReadTimeout, the
-                    # connection is incorrectly recycled.
-                    http = None
+                    # connection is incorrectly recycled.  Close it but keep
+                    # the pool.
+                    if resp is not None:
+                        resp.release_conn()
+                    close_idle_connections(http)
                     continue
                 except (urllib3.exceptions.HTTPError,
                         httplib.HTTPException,
@@ -838,8 +1012,8 @@ class EtcdDriver(object):
                     # If available, connect to a different etcd URL in case
                     # only the previous one has failed.
                     self._rotate_etcd_url()
-                    # Workaround urllib3 bug #718.  After a ReadTimeout, the
-                    # connection is incorrectly recycled.
+                    # Look up the pool for the (possibly new) URL.  urllib3
+                    # has already discarded the failed connection.
                     http = None
                     continue
                 # If we get to this point, we've got an etcd response to
@@ -23,11 +23,14 @@ key when processing a snapshot and event stream in parallel.
 import logging
 import re
 import string
+from collections import Counter
 
 from datrie import Trie
 import datrie
 import urllib
 
+from calico.datamodel_v1 import VERSION_DIR
+
 _log = logging.getLogger(__name__)
 
 # The trie implementation that we use requires us to specify the character set
@@ -40,6 +43,16 @@ TRIE_CHARS = string.ascii_letters + string.digits + TRIE_SYMBOLS + "%"
 # Regex that matches chars that are allowed in the trie.
 TRIE_CHARS_MATCH = re.compile(r'^[%s]+$' % re.escape(TRIE_CHARS))
 
+# Number of path segments in the VERSION_DIR prefix.
+VERSION_DIR_DEPTH = VERSION_DIR.count("/")
+# Number of path segments below VERSION_DIR that identify a subtree (for
+# partial resyncs), keyed on the first segment below VERSION_DIR.  For
+# example, /calico/v1/host/<hostname> and /calico/v1/policy/profile/<id>.
+SUBTREE_DEPTHS = {
+    "policy": 3,
+}
+DEFAULT_SUBTREE_DEPTH = 2
+
 
 class HighWaterTracker(object):
     """
@@ -50,6 +63,8 @@ class HighWaterTracker(object):
 
     Starting with a resync, while also merging events from our watch on etcd:
 
+    * Call start_generation() with the snapshot's etcd index so that the
+      tracker can count the keys that the snapshot touches.
     * Call start_tracking_deletions() to enable resolution between events
       and the snapshot.
     * Repeatedly call update_hwm() and store_deletion(), feeding in the
@@ -66,8 +81,16 @@ class HighWaterTracker(object):
     * feed in events with update_hwm() and store_deletion().
 
     At any point, if a new resync is required restart from
-    "Call start_tracking_deletions()..."
+    "Call start_generation()..."
 
+    A partial resync of a single subtree follows the same pattern but passes
+    the subtree as the prefix to start_generation() and remove_old_keys().
+
+    To keep remove_old_keys() cheap, the tracker keeps, per subtree (as
+    defined by subtree_for_key()), the total number of keys and the number
+    of keys that have been touched since the start of the subtree's current
+    generation.  Subtrees where every key has been touched can't contain any
+    old keys so they are skipped by the sweep.
     """
     def __init__(self):
         # We use a trie to track the highest etcd index at which we've seen
@@ -83,6 +106,50 @@ class HighWaterTracker(object):
         # _deletion_hwms trie for events that come after the deletion.
         self._latest_deletion = None
 
+        # Etcd index at the start of the current generation, as passed to
+        # start_generation().  Overridden per-subtree by partial resyncs.
+        self._generation = None
+        self._generation_by_subtree = {}
+        # Number of keys in each subtree.
+        self._key_counts = Counter()
+        # Number of keys in each subtree whose HWM is at or above the
+        # subtree's generation.  May undercount (which only costs a walk of
+        # the subtree in remove_old_keys()) but never overcounts.
+        self._touched_counts = Counter()
+
+    def start_generation(self, hwm_limit, prefix=None):
+        """
+        Starts a new generation, resetting the counts of touched keys.  A
+        subsequent call to remove_old_keys() with the same hwm_limit only
+        needs to scan subtrees that contain untouched keys.
+
+        :param hwm_limit: etcd index of the snapshot.
+        :param prefix: If specified, the subtree that is being resynced.
+               Must be a subtree as returned by subtree_for_key().
+        """
+        _log.info("Starting generation %s for %s", hwm_limit, prefix or "/")
+        if prefix is None:
+            self._generation = hwm_limit
+            self._generation_by_subtree = {}
+            self._touched_counts = Counter()
+        else:
+            assert prefix == subtree_for_key(prefix), \
+                "Generation prefix must be a subtree"
+            self._generation_by_subtree[prefix] = hwm_limit
+            self._touched_counts.pop(prefix, None)
+
+    def _generation_for(self, subtree):
+        return self._generation_by_subtree.get(subtree, self._generation)
+
+    def _on_key_removed(self, subtree, old_hwm):
+        """Updates the per-subtree counts when a key is removed."""
+        self._key_counts[subtree] -= 1
+        if self._key_counts[subtree] <= 0:
+            del self._key_counts[subtree]
+        generation = self._generation_for(subtree)
+        if generation is not None and old_hwm >= generation:
+            self._touched_counts[subtree] -= 1
+
     def start_tracking_deletions(self):
         """
         Starts tracking which subtrees have been deleted so that update_hwm
@@ -117,6 +184,7 @@ class HighWaterTracker(object):
                 was deleted) or None if it did not previously exist.
         """
         _log.debug("Updating HWM for %s to %s", key, new_mod_idx)
+        subtree = subtree_for_key(key)
         key = encode_key(key)
         if (self._deletion_hwms is not None and
                 # Optimization: avoid expensive lookup if this update comes
@@ -136,6 +204,13 @@ class HighWaterTracker(object):
             _log.debug("Key %s HWM updated to %s, previous %s",
                        key, new_mod_idx, old_hwm)
             self._hwms[key] = new_mod_idx
+            if old_hwm is None:
+                self._key_counts[subtree] += 1
+            generation = self._generation_for(subtree)
+            if (generation is not None and
+                    new_mod_idx >= generation and
+                    (old_hwm is None or old_hwm < generation)):
+                self._touched_counts[subtree] += 1
         return old_hwm
 
     def store_deletion(self, key, deletion_mod_idx):
@@ -152,36 +227,99 @@ class HighWaterTracker(object):
             self._deletion_hwms[key] = deletion_mod_idx
         deleted_keys = []
         for child_key, child_mod in self._hwms.items(key):
+            if child_mod > deletion_mod_idx:
+                # The child was loaded by a (partial) snapshot that was taken
+                # after this deletion so it has been recreated since.
+                _log.debug("Key %s recreated at %s, skipping", child_key,
+                           child_mod)
+                continue
             del self._hwms[child_key]
-            deleted_keys.append(decode_key(child_key))
+            decoded_key = decode_key(child_key)
+            self._on_key_removed(subtree_for_key(decoded_key), child_mod)
+            deleted_keys.append(decoded_key)
         _log.debug("Found %s keys deleted under %s", len(deleted_keys), key)
         return deleted_keys
 
-    def remove_old_keys(self, hwm_limit):
+    def remove_old_keys(self, hwm_limit, prefix=None):
         """
         Deletes and returns all keys that have HWMs less than hwm_limit.
+
+        Only walks the subtrees that contain keys that haven't been touched
+        since start_generation(hwm_limit) so the cost is proportional to the
+        size of the subtrees that contain deletions rather than to the total
+        number of keys.
+
+        :param prefix: If specified, only keys in the subtree rooted at
+               the given prefix are considered.  Used after a partial resync
+               of that subtree.
         :return: list of keys that were deleted.
         """
         assert not self._deletion_hwms, \
             "Delete tracking incompatible with remove_old_keys()"
-        _log.info("Removing keys that are older than %s", hwm_limit)
-        old_keys = []
+        _log.info("Removing keys under %s that are older than %s",
+                  prefix or "/", hwm_limit)
+        if prefix is None:
+            subtrees = self._key_counts.keys()
+        else:
+            assert prefix == subtree_for_key(prefix), \
+                "remove_old_keys() prefix must be a subtree"
+            subtrees = [prefix]
+        old_keys = set()
+        subtrees_scanned = 0
+        for subtree in subtrees:
+            if (self._generation_for(subtree) == hwm_limit and
+                    self._touched_counts[subtree] ==
+                    self._key_counts[subtree]):
+                # Every key in the subtree was seen in this generation.
+                continue
+            subtrees_scanned += 1
+            old_keys.update(self._find_old_keys(hwm_limit, subtree))
+        deleted_keys = []
+        for old_key in old_keys:
+            old_hwm = self._hwms.pop(old_key)
+            decoded_key = decode_key(old_key)
+            self._on_key_removed(subtree_for_key(decoded_key), old_hwm)
+            deleted_keys.append(decoded_key)
+        _log.info("Deleted %s old keys after scanning %s/%s subtrees",
+                  len(deleted_keys), subtrees_scanned, len(subtrees))
+        return deleted_keys
+
+    def _find_old_keys(self, hwm_limit, subtree):
+        """
+        Generator: yields the encoded keys in the given subtree that have
+        HWMs less than hwm_limit.
+        """
+        enc_prefix = encode_key(subtree)
         state = datrie.State(self._hwms)
-        state.walk(u"")
+        if not state.walk(enc_prefix):
+            return
         it = datrie.Iterator(state)
         while it.next():
-            value = it.data()
-            if value < hwm_limit:
-                old_keys.append(it.key())
-        for old_key in old_keys:
-            del self._hwms[old_key]
-        _log.info("Deleted %s old keys", len(old_keys))
-        return map(decode_key, old_keys)
+            if it.data() < hwm_limit:
+                # The iterator returns keys relative to the prefix.
+                yield enc_prefix + it.key()
 
     def __len__(self):
         return len(self._hwms)
 
 
+def subtree_for_key(key):
+    """
+    Returns the subtree that the given key belongs to, as used for
+    partial resyncs.  For example, endpoint keys map to the directory of
+    their host: /calico/v1/host/<hostname>.
+
+    Keys that are shallower than the subtree depth are their own subtree.
+    """
+    parts = key.strip("/").split("/")
+    if len(parts) > VERSION_DIR_DEPTH:
+        depth = SUBTREE_DEPTHS.get(parts[VERSION_DIR_DEPTH],
+                                   DEFAULT_SUBTREE_DEPTH)
+    else:
+        depth = DEFAULT_SUBTREE_DEPTH
+    return "/" + "/".join(parts[:VERSION_DIR_DEPTH + depth])
+
+
 def encode_key(key):
     """
     Encode an etcd key for use in the trie.
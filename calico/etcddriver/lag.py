@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+calico.etcddriver.lag
+~~~~~~~~~~~~~~~~~~~~~
+
+The EventLagTracker monitors how far the resync thread is behind the watcher
+thread and decides how the driver should catch up.
+"""
+
+import logging
+from collections import Counter
+
+from calico.etcddriver.hwm import subtree_for_key
+from calico.monotonic import monotonic_time
+
+_log = logging.getLogger(__name__)
+
+# Actions returned by EventLagTracker.decide().
+CATCHUP_CONTINUE = "continue"
+CATCHUP_GROW_QUEUE = "grow-queue"
+CATCHUP_PARTIAL_RESYNC = "partial-resync"
+
+# Fraction of the watcher queue that must be occupied before we consider
+# doing anything other than continuing to drain the queue.
+LAG_HIGH_WATER_FRACTION = 0.5
+# Minimum fraction of the events in the last window that the hottest subtrees
+# must account for to make a partial resync worthwhile.
+HOT_SUBTREE_FRACTION = 0.5
+# Maximum number of subtrees to resync in one go.
+MAX_PARTIAL_RESYNC_SUBTREES = 3
+
+
+class EventLagTracker(object):
+    """
+    Tracks the rate at which events arrive from the watcher, the rate at
+    which the resync thread drains them and the number of events processed
+    per subtree.
+
+    Owned by the resync thread.  The arrival rate is inferred from the
+    change in queue length over each window so that the watcher thread
+    doesn't need to share any state with us.
+    """
+    def __init__(self, max_queue_size):
+        self.max_queue_size = max_queue_size
+
+        # Stats for the current window.
+        self._window_start = monotonic_time()
+        self._window_start_qsize = 0
+        self._events_processed = 0
+        self._subtree_counts = Counter()
+
+        # Results from the last completed window, exposed for logging.
+        self.arrival_rate = 0.0
+        self.drain_rate = 0.0
+        self.queue_len = 0
+        self.hot_subtrees = []
+
+        # Running totals of the decisions that we've made.
+        self.queue_grows = 0
+        self.partial_resyncs = 0
+        self.events_skipped = 0
+
+    def on_event_processed(self, key):
+        """
+        Records that the resync thread processed an event for the given key.
+        """
+        self._events_processed += 1
+        self._subtree_counts[subtree_for_key(key)] += 1
+
+    def on_event_skipped(self):
+        """
+        Records that the resync thread discarded an event because it was
+        already covered by a partial resync.
+
+        Skipped events count towards the drain rate but not towards the
+        subtree counts, otherwise we'd keep resyncing the same subtree.
+        """
+        self._events_processed += 1
+        self.events_skipped += 1
+
+    def window_age(self):
+        return monotonic_time() - self._window_start
+
+    def end_window(self, qsize):
+        """
+        Closes the current window, calculating the rates and hottest subtrees
+        from it and starts a new window.
+
+        :param qsize: current length of the watcher queue.
+        """
+        now = monotonic_time()
+        elapsed = now - self._window_start
+        arrived = self._events_processed + qsize - self._window_start_qsize
+        if elapsed > 0:
+            self.drain_rate = self._events_processed / elapsed
+            self.arrival_rate = max(arrived, 0) / elapsed
+        self.queue_len = qsize
+        self.hot_subtrees = []
+        if self._subtree_counts:
+            total = sum(self._subtree_counts.itervalues())
+            hottest = self._subtree_counts.most_common(
+                MAX_PARTIAL_RESYNC_SUBTREES
+            )
+            hot_count = sum(c for _, c in hottest)
+            if hot_count >= total * HOT_SUBTREE_FRACTION:
+                self.hot_subtrees = [s for s, _ in hottest]
+        self._window_start = now
+        self._window_start_qsize = qsize
+        self._events_processed = 0
+        self._subtree_counts = Counter()
+
+    def decide(self, qsize, maxsize):
+        """
+        Closes the current window and decides how to catch up with the
+        watcher.
+
+        :param qsize: current length of the watcher queue.
+        :param maxsize: current capacity of the watcher queue.
+        :returns: tuple of one of the CATCHUP_* constants and the list of
+                  subtrees to resync (empty unless the action is
+                  CATCHUP_PARTIAL_RESYNC).
+        """
+        self.end_window(qsize)
+        if qsize < maxsize * LAG_HIGH_WATER_FRACTION:
+            # Plenty of headroom.
+            return CATCHUP_CONTINUE, []
+        if self.drain_rate > self.arrival_rate:
+            # We're behind but catching up.
+            _log.info("Watcher queue is %s/%s but draining at %.1f/s vs "
+                      "arrival at %.1f/s; continuing.", qsize, maxsize,
+                      self.drain_rate, self.arrival_rate)
+            return CATCHUP_CONTINUE, []
+        if maxsize < self.max_queue_size:
+            # Falling behind; give the watcher more space so that it can keep
+            # up with etcd rather than losing its place in etcd's event
+            # history.
+            _log.warning("Watcher queue is %s/%s and falling behind (%.1f/s "
+                         "in vs %.1f/s out); growing queue.", qsize, maxsize,
+                         self.arrival_rate, self.drain_rate)
+            self.queue_grows += 1
+            return CATCHUP_GROW_QUEUE, []
+        if self.hot_subtrees:
+            _log.warning("Watcher queue is full and falling behind; most "
+                         "events are in %s, doing a partial resync.",
+                         self.hot_subtrees)
+            self.partial_resyncs += 1
+            return CATCHUP_PARTIAL_RESYNC, self.hot_subtrees
+        _log.warning("Watcher queue is full and events are spread across "
+                     "the keyspace; continuing to drain.")
+        return CATCHUP_CONTINUE, []
+
+    def __str__(self):
+        return ("event lag: queue length %s, arrival rate %.1f/s, drain rate "
+                "%.1f/s, hot subtrees %s, queue grows %s, partial resyncs %s, "
+                "events skipped %s" % (self.queue_len, self.arrival_rate,
+                                       self.drain_rate, self.hot_subtrees,
+                                       self.queue_grows, self.partial_resyncs,
+                                       self.events_skipped))
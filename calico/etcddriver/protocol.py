@@ -18,11 +18,15 @@ calico.etcddriver.protocol
 
 Protocol constants for Felix <-> Driver protocol.
 """
+import errno
+import fcntl
 import logging
 import socket
-import errno
-from io import BytesIO
+import struct
+import termios
+
 import msgpack
+import msgpack.fallback
 import select
 
 _log = logging.getLogger(__name__)
@@ -67,6 +71,12 @@ MSG_KEY_VALUE = "v"
 
 FLUSH_THRESHOLD = 200
 
+# Initial and maximum size of the MessageReader's receive buffer.  The buffer
+# doubles in size each time a read fills it so that, under load, we make
+# fewer, larger reads.
+READ_BUF_INITIAL_SIZE = 16384
+READ_BUF_MAX_SIZE = 4 * 1024 * 1024
+
 
 class SocketClosed(Exception):
     """The socket was unexpectedly closed by the other end."""
@@ -82,11 +92,13 @@ class MessageWriter(object):
     """
     Wrapper around a socket used to write protocol messages.
 
-    Supports buffering a number of messages for subsequent flush().
+    Supports buffering a number of messages for subsequent flush().  Messages
+    are packed straight into the Packer's internal buffer, which is then sent
+    with a single sendall().
     """
     def __init__(self, sck):
         self._sck = sck
-        self._buf = BytesIO()
+        self._packer = msgpack.Packer(autoreset=False)
         self._updates_pending = 0
 
     def send_message(self, msg_type, fields=None, flush=True):
@@ -104,7 +116,7 @@ class MessageWriter(object):
         msg = {MSG_KEY_TYPE: msg_type}
         if fields:
             msg.update(fields)
-        self._buf.write(msgpack.dumps(msg))
+        self._packer.pack(msg)
         if flush:
             self.flush()
         else:
@@ -120,21 +132,40 @@ class MessageWriter(object):
         Flushes the write buffer to the socket immediately.
         """
         _log.debug("Flushing the buffer to the socket")
-        buf_contents = self._buf.getvalue()
+        buf_contents = self._packer.bytes()
         if buf_contents:
             try:
                 self._sck.sendall(buf_contents)
             except socket.error as e:
                 _log.exception("Failed to write to socket")
                 raise WriteFailed(e)
-            self._buf = BytesIO()
+            self._packer.reset()
         self._updates_pending = 0
 
 
 class MessageReader(object):
-    def __init__(self, sck):
+    """
+    Wrapper around a socket used to read protocol messages.
+
+    Reads into a reusable buffer, which grows (up to max_buf_size) while
+    reads keep filling it.  After a read that filled the buffer, we check
+    for pending data with a cheap FIONREAD ioctl rather than a select(),
+    which, under gevent, costs a trip through the hub.
+    """
+    def __init__(self, sck, max_buf_size=READ_BUF_MAX_SIZE):
         self._sck = sck
         self._unpacker = msgpack.Unpacker()
+        # The C Unpacker copies the data that it's fed into its own buffer.
+        # The pure-Python fallback (used under PyPy or if MSGPACK_PUREPYTHON
+        # is set) may hold on to what it's fed, so it must be given a copy.
+        self._feed_copy = isinstance(self._unpacker,
+                                     msgpack.fallback.Unpacker)
+        self._max_buf_size = max_buf_size
+        self._buf = bytearray(min(READ_BUF_INITIAL_SIZE, max_buf_size))
+        self._view = memoryview(self._buf)
+        # Set if the last read filled the buffer, implying that there may
+        # be more data waiting in the socket.
+        self._last_read_filled_buf = False
 
     def new_messages(self, timeout=1):
         """
@@ -150,12 +181,14 @@ class MessageReader(object):
         :raises SocketClosed if the socket is closed.
         :raises socket.error if an unexpected socket error occurs.
         """
-        if timeout is not None:
+        if (timeout is not None and
+                not (self._last_read_filled_buf and self._bytes_pending())):
             read_ready, _, _ = select.select([self._sck], [], [], timeout)
             if not read_ready:
                 return
+        buf_size = len(self._buf)
         try:
-            data = self._sck.recv(16384)
+            num_bytes = self._sck.recv_into(self._view, buf_size)
         except socket.error as e:
             if e.errno in (errno.EAGAIN,
                            errno.EWOULDBLOCK,
@@ -165,15 +198,41 @@ class MessageReader(object):
             else:
                 _log.error("Failed to read from socket: %r", e)
                 raise
-        if not data:
+        if not num_bytes:
             # No data indicates an orderly shutdown of the socket,
             # which shouldn't happen.
             _log.error("Socket closed by other end.")
             raise SocketClosed()
         # Feed the data into the Unpacker, if it has enough data it will then
-        # generate some messages.
-        self._unpacker.feed(data)
+        # generate some messages.  We reuse our buffer on the next read so
+        # the Unpacker must not keep a reference to it.
+        if self._feed_copy:
+            self._unpacker.feed(self._view[:num_bytes].tobytes())
+        else:
+            self._unpacker.feed(self._view[:num_bytes])
+        self._last_read_filled_buf = num_bytes == buf_size
+        if self._last_read_filled_buf and buf_size < self._max_buf_size:
+            self._grow_buffer(min(buf_size * 2, self._max_buf_size))
         for msg in self._unpacker:
             _log.debug("Unpacked message: %s", msg)
             # coverage.py doesn't fully support yield statements.
             yield msg[MSG_KEY_TYPE], msg  # pragma: nocover
+
+    def _bytes_pending(self):
+        """
+        :returns the number of bytes waiting to be read from the socket.
+        """
+        try:
+            result = fcntl.ioctl(self._sck.fileno(), termios.FIONREAD,
+                                 "\0\0\0\0")
+        except (IOError, TypeError, ValueError):
+            # Not a real socket, fall back to select().
+            _log.debug("FIONREAD not supported, falling back to select.")
+            return 0
+        return struct.unpack("i", result)[0]
+
+    def _grow_buffer(self, new_size):
+        _log.debug("Growing read buffer from %s to %s", len(self._buf),
+                   new_size)
+        self._buf = bytearray(new_size)
+        self._view = memoryview(self._buf)
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+calico.etcddriver.test.bench_protocol
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Throughput benchmark for the Felix/etcddriver protocol over a socketpair.
+
+Simulates the driver sending a snapshot's worth of update messages to Felix
+and compares the MessageReader with a fixed 16KB buffer (the old behaviour)
+against the default adaptive buffer.
+
+Run with: python -m calico.etcddriver.test.bench_protocol [num_messages]
+"""
+import select
+import socket
+import sys
+import threading
+import time
+
+from mock import patch
+
+from calico.etcddriver.protocol import (
+    MessageReader, MessageWriter, MSG_TYPE_UPDATE, MSG_KEY_KEY,
+    MSG_KEY_VALUE, READ_BUF_MAX_SIZE
+)
+
+ENDPOINT_KEY = "/calico/v1/host/host%s/workload/openstack/wl%s/endpoint/ep%s"
+ENDPOINT_VALUE = ('{"state": "active", "name": "tap1234", '
+                  '"mac": "01:23:45:67:89:ab", "profile_ids": ["prof1"], '
+                  '"ipv4_nets": ["10.0.0.%s/32"], "ipv6_nets": []}')
+
+
+def _write_messages(sck, num_messages):
+    writer = MessageWriter(sck)
+    for ii in xrange(num_messages):
+        writer.send_message(
+            MSG_TYPE_UPDATE,
+            {
+                MSG_KEY_KEY: ENDPOINT_KEY % (ii % 100, ii, ii),
+                MSG_KEY_VALUE: ENDPOINT_VALUE % (ii % 256),
+            },
+            flush=False
+        )
+    writer.flush()
+
+
+def run(num_messages, max_buf_size):
+    """
+    Sends num_messages over a socketpair and reads them back.
+
+    :returns tuple of elapsed time and number of select() calls.
+    """
+    write_sck, read_sck = socket.socketpair()
+    try:
+        reader = MessageReader(read_sck, max_buf_size=max_buf_size)
+        writer_thread = threading.Thread(target=_write_messages,
+                                         args=(write_sck, num_messages))
+        received = 0
+        with patch("select.select", wraps=select.select) as m_select:
+            start = time.time()
+            writer_thread.start()
+            while received < num_messages:
+                for _ in reader.new_messages(timeout=1):
+                    received += 1
+            elapsed = time.time() - start
+        writer_thread.join()
+        return elapsed, m_select.call_count
+    finally:
+        write_sck.close()
+        read_sck.close()
+
+
+def main(argv):
+    num_messages = int(argv[1]) if len(argv) > 1 else 200000
+    for name, max_buf_size in [("fixed 16KB buffer", 16384),
+                               ("adaptive buffer", READ_BUF_MAX_SIZE)]:
+        elapsed, selects = run(num_messages, max_buf_size)
+        print "%-20s %8d msgs in %.3fs: %10.0f msgs/s, %6d selects" % (
+            name, num_messages, elapsed, num_messages / elapsed, selects
+        )
+
+
+if __name__ == "__main__":
+    main(sys.argv)
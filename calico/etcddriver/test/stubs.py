@@ -366,6 +366,7 @@ class MockResponse(object):
         self.status = status
         self._data_or_exc = data_or_exc
         self.headers = headers or {}
+        self.released = False
 
     @property
     def data(self):
@@ -379,6 +380,9 @@ class MockResponse(object):
     def read(self, *args):
         return self._data_or_exc.read(*args)
 
+    def release_conn(self):
+        self.released = True
+
     def getheader(self, header, default=None):
         _log.debug("Asked for header %s", header)
         return self.headers.get(header.lower(), default)
\ No newline at end of file
@@ -21,7 +21,7 @@ Tests for the etcd driver module.
 import json
 import threading
 import traceback
-from Queue import Empty
+from Queue import Empty, Queue
 
 from StringIO import StringIO
 from httplib import HTTPException
@@ -34,10 +34,14 @@ from mock import Mock, patch, call
 from urllib3 import HTTPConnectionPool
 from urllib3.exceptions import TimeoutError, HTTPError, ReadTimeoutError
 from calico.datamodel_v1 import READY_KEY, CONFIG_DIR, VERSION_DIR
+from calico.etcdutils import POOL_SNAPSHOT, POOL_WATCH
 from calico.etcddriver import driver
 from calico.etcddriver.driver import (
     EtcdDriver, DriverShutdown, ResyncRequired, WatcherDied, ijson
 )
+from calico.etcddriver.lag import (
+    CATCHUP_CONTINUE, CATCHUP_GROW_QUEUE, CATCHUP_PARTIAL_RESYNC
+)
 from calico.etcddriver.protocol import *
 from calico.etcddriver.test.stubs import (
     StubMessageReader, StubMessageWriter, StubEtcd,
@@ -821,6 +825,37 @@ class TestDriver(TestCase):
                   preload_content=True)]
         )
 
+    def test_get_etcd_connection_reuses_pools(self):
+        self.driver._handle_init({
+            MSG_KEY_ETCD_URLS: ["http://etcd1:4001/", "http://etcd2:4001/"],
+            MSG_KEY_HOSTNAME: "ourhost",
+            MSG_KEY_KEY_FILE: None,
+            MSG_KEY_CERT_FILE: None,
+            MSG_KEY_CA_FILE: None
+        })
+        watch_pool = self.driver.get_etcd_connection(POOL_WATCH)
+        snap_pool = self.driver.get_etcd_connection(POOL_SNAPSHOT)
+        self.assertFalse(watch_pool is snap_pool)
+        self.assertTrue(self.driver.get_etcd_connection(POOL_WATCH) is
+                        watch_pool)
+        # Rotating the URL switches pool; rotating back gets the old pool
+        # back.
+        self.driver._rotate_etcd_url()
+        other_pool = self.driver.get_etcd_connection(POOL_WATCH)
+        self.assertNotEqual(other_pool.host, watch_pool.host)
+        self.driver._rotate_etcd_url()
+        self.assertTrue(self.driver.get_etcd_connection(POOL_WATCH) is
+                        watch_pool)
+
+    @patch("calico.etcddriver.driver.close_idle_connections", autospec=True)
+    def test_discard_snapshot_response(self, m_close_idle):
+        self.driver._resync_http_pool = Mock()
+        resp = Mock()
+        self.driver._discard_snapshot_response(resp)
+        self.assertEqual(resp.release_conn.mock_calls, [call()])
+        self.assertEqual(m_close_idle.mock_calls,
+                         [call(self.driver._resync_http_pool)])
+
     def test_issue_etcd_request_recursive_watch(self):
         # Initialise the etcd URL.
         self.driver._handle_init({
@@ -1012,6 +1047,108 @@ class TestDriver(TestCase):
         # And send it's normal shutdown signal.
         self.assertEqual(m_queue.put.mock_calls, [call(None)])
 
+    def test_catch_up_grows_and_shrinks_queue(self):
+        self.driver._watcher_queue = Queue(maxsize=driver.WATCHER_QUEUE_SIZE)
+        with patch.object(self.driver, "_lag_tracker") as m_tracker:
+            m_tracker.window_age.return_value = 10
+            m_tracker.decide.return_value = (CATCHUP_GROW_QUEUE, [])
+            self.driver._maybe_catch_up_with_watcher()
+            self.assertEqual(self.driver._watcher_queue.maxsize,
+                             driver.WATCHER_QUEUE_SIZE * 2)
+            m_tracker.decide.return_value = (CATCHUP_CONTINUE, [])
+            self.driver._maybe_catch_up_with_watcher()
+            self.assertEqual(self.driver._watcher_queue.maxsize,
+                             driver.WATCHER_QUEUE_SIZE)
+
+    def test_catch_up_too_soon(self):
+        self.driver._watcher_queue = Queue(maxsize=driver.WATCHER_QUEUE_SIZE)
+        with patch.object(self.driver, "_lag_tracker") as m_tracker:
+            m_tracker.window_age.return_value = 0
+            self.driver._maybe_catch_up_with_watcher()
+            self.assertFalse(m_tracker.decide.called)
+
+    def test_catch_up_partial_resync(self):
+        self.driver._watcher_queue = Queue(maxsize=driver.WATCHER_QUEUE_SIZE)
+        with patch.object(self.driver, "_lag_tracker") as m_tracker:
+            with patch.object(self.driver, "_partial_resync") as m_resync:
+                m_tracker.window_age.return_value = 10
+                m_tracker.decide.return_value = (CATCHUP_PARTIAL_RESYNC,
+                                                 ["/calico/v1/host/h1"])
+                self.driver._maybe_catch_up_with_watcher()
+        self.assertEqual(m_resync.mock_calls,
+                         [call(["/calico/v1/host/h1"])])
+
+    def test_partial_resync(self):
+        hwms = self.driver._hwms
+        hwms.update_hwm("/calico/v1/host/h1/a", 5)
+        hwms.update_hwm("/calico/v1/host/h1/b", 5)
+        hwms.update_hwm("/calico/v1/host/h2/c", 5)
+        m_resp = Mock()
+        m_resp.status = 200
+        m_resp.getheader.return_value = "20"
+
+        def parse(resp, callback):
+            callback(5, "/calico/v1/host/h1/a", "a")  # Unchanged.
+            callback(12, "/calico/v1/host/h1/d", "d")  # New.
+
+        with patch.object(self.driver, "_etcd_request") as m_req:
+            with patch("calico.etcddriver.driver.parse_snapshot") as m_parse:
+                m_req.return_value = m_resp
+                m_parse.side_effect = parse
+                self.driver._partial_resync(["/calico/v1/host/h1"])
+        self.assertEqual(m_req.mock_calls[0],
+                         call(None, "/calico/v1/host/h1", recursive=True,
+                              timeout=120, preload_content=False))
+        self.assertEqual(self.msg_writer.next_msg(),
+                         (MSG_TYPE_UPDATE, {
+                             MSG_KEY_KEY: "/calico/v1/host/h1/d",
+                             MSG_KEY_VALUE: "d",
+                         }))
+        self.assertEqual(self.msg_writer.next_msg(),
+                         (MSG_TYPE_UPDATE, {
+                             MSG_KEY_KEY: "/calico/v1/host/h1/b",
+                             MSG_KEY_VALUE: None,
+                         }))
+        self.assertTrue(self.msg_writer.queue.empty())
+        self.assertEqual(self.driver._partial_resync_idxs,
+                         {"/calico/v1/host/h1": 20})
+
+        # Stale events from the watcher queue for the subtree are discarded
+        # until we see an event newer than the partial snapshot.
+        self.driver._watcher_queue = Queue()
+        for event in [(15, "/calico/v1/host/h1/a", "stale"),
+                      (16, "/calico/v1/host/h2/c", "c2"),
+                      (21, "/calico/v1/host/h1/a", "a2")]:
+            self.driver._watcher_queue.put(event)
+            self.driver._handle_next_watcher_event(False)
+        self.assertEqual(self.msg_writer.next_msg(),
+                         (MSG_TYPE_UPDATE, {
+                             MSG_KEY_KEY: "/calico/v1/host/h2/c",
+                             MSG_KEY_VALUE: "c2",
+                         }))
+        self.assertEqual(self.msg_writer.next_msg(),
+                         (MSG_TYPE_UPDATE, {
+                             MSG_KEY_KEY: "/calico/v1/host/h1/a",
+                             MSG_KEY_VALUE: "a2",
+                         }))
+        self.assertEqual(self.driver._partial_resync_idxs, {})
+        self.assertEqual(self.driver._lag_tracker.events_skipped, 1)
+
+    def test_partial_resync_subtree_gone(self):
+        self.driver._hwms.update_hwm("/calico/v1/host/h1/a", 5)
+        m_resp = Mock()
+        m_resp.status = 404
+        m_resp.getheader.return_value = "20"
+        with patch.object(self.driver, "_etcd_request") as m_req:
+            m_req.return_value = m_resp
+            self.driver._partial_resync(["/calico/v1/host/h1"])
+        self.assertEqual(self.msg_writer.next_msg(),
+                         (MSG_TYPE_UPDATE, {
+                             MSG_KEY_KEY: "/calico/v1/host/h1/a",
+                             MSG_KEY_VALUE: None,
+                         }))
+        self.assertEqual(len(self.driver._hwms), 0)
+
 
 def dump_all_thread_stacks():
     print >> sys.stderr, "\n*** STACKTRACE - START ***\n"
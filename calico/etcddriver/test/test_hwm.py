@@ -126,6 +126,92 @@ class TestHighWaterTracker(TestCase):
         self.assertEqual(old_hwm, None)
         self.assertEqual(len(self.hwm), 6)
 
+    def test_remove_old_keys_in_subtree(self):
+        self.hwm.update_hwm("/calico/v1/host/a/k1", 9)
+        self.hwm.update_hwm("/calico/v1/host/a/k2", 9)
+        self.hwm.update_hwm("/calico/v1/host/ab/k1", 9)
+        self.hwm.update_hwm("/calico/v1/host/b/k1", 9)
+        # Partial resync of host a sees only k1.
+        self.hwm.update_hwm("/calico/v1/host/a/k1", 10)
+        old_keys = self.hwm.remove_old_keys(10, prefix="/calico/v1/host/a")
+        self.assertEqual(old_keys, ["/calico/v1/host/a/k2"])
+        # Keys outside the subtree, including ones that share a string
+        # prefix, are untouched.
+        self.assertEqual(len(self.hwm), 3)
+        self.assertEqual(self.hwm.update_hwm("/calico/v1/host/ab/k1", 11), 9)
+
+    def test_remove_old_keys_missing_subtree(self):
+        self.hwm.update_hwm("/calico/v1/host/a/k1", 9)
+        self.assertEqual(
+            self.hwm.remove_old_keys(10, prefix="/calico/v1/host/b"),
+            []
+        )
+        self.assertEqual(len(self.hwm), 1)
+
+    def test_deletion_skips_recreated_keys(self):
+        self.hwm.update_hwm("/calico/v1/host/a/k1", 9)
+        # Loaded by a partial resync at index 20.
+        self.hwm.update_hwm("/calico/v1/host/a/k2", 20)
+        # An older directory deletion shouldn't remove the newer key.
+        deleted_keys = self.hwm.store_deletion("/calico/v1/host", 15)
+        self.assertEqual(deleted_keys, ["/calico/v1/host/a/k1"])
+        self.assertEqual(len(self.hwm), 1)
+
+    def test_remove_old_keys_skips_touched_subtrees(self):
+        for host in ("h1", "h2", "h3"):
+            for ep in ("e1", "e2"):
+                self.hwm.update_hwm("/calico/v1/host/%s/%s" % (host, ep), 9)
+        # Snapshot at index 10 sees everything except h2/e2.  h3/e1 is
+        # deleted by an event and h3/e3 is created by one.
+        self.hwm.start_generation(10)
+        self.hwm.start_tracking_deletions()
+        self.hwm.update_hwm("/calico/v1/host/h1/e1", 10)
+        self.hwm.update_hwm("/calico/v1/host/h1/e2", 10)
+        self.hwm.update_hwm("/calico/v1/host/h2/e1", 10)
+        self.hwm.update_hwm("/calico/v1/host/h3/e2", 10)
+        self.hwm.store_deletion("/calico/v1/host/h3/e1", 11)
+        self.hwm.update_hwm("/calico/v1/host/h3/e3", 12)
+        self.hwm.stop_tracking_deletions()
+        with patch.object(self.hwm, "_find_old_keys",
+                          wraps=self.hwm._find_old_keys) as m_find:
+            old_keys = self.hwm.remove_old_keys(10)
+        self.assertEqual(old_keys, ["/calico/v1/host/h2/e2"])
+        self.assertEqual(m_find.mock_calls, [call(10, "/calico/v1/host/h2")])
+        self.assertEqual(len(self.hwm), 5)
+        # All subtrees are now fully touched.
+        with patch.object(self.hwm, "_find_old_keys") as m_find:
+            self.assertEqual(self.hwm.remove_old_keys(10), [])
+        self.assertFalse(m_find.called)
+
+    def test_remove_old_keys_partial_generation(self):
+        self.hwm.update_hwm("/calico/v1/host/h1/e1", 9)
+        self.hwm.update_hwm("/calico/v1/host/h1/e2", 9)
+        self.hwm.update_hwm("/calico/v1/host/h2/e1", 9)
+        self.hwm.start_generation(20, prefix="/calico/v1/host/h1")
+        self.hwm.update_hwm("/calico/v1/host/h1/e1", 20)
+        self.hwm.update_hwm("/calico/v1/host/h1/e2", 20)
+        with patch.object(self.hwm, "_find_old_keys") as m_find:
+            old_keys = self.hwm.remove_old_keys(20,
+                                                prefix="/calico/v1/host/h1")
+        self.assertEqual(old_keys, [])
+        self.assertFalse(m_find.called)
+
+
+class TestSubtreeForKey(TestCase):
+    def test_subtree_for_key(self):
+        self.assertEqual(
+            hwm.subtree_for_key("/calico/v1/host/h1/workload/o/w/endpoint/e"),
+            "/calico/v1/host/h1"
+        )
+        self.assertEqual(
+            hwm.subtree_for_key("/calico/v1/policy/profile/p1/rules"),
+            "/calico/v1/policy/profile/p1"
+        )
+        self.assertEqual(hwm.subtree_for_key("/calico/v1/Ready"),
+                         "/calico/v1/Ready")
+        self.assertEqual(hwm.subtree_for_key("/calico/v1/config/Foo/"),
+                         "/calico/v1/config/Foo")
+
 
 class TestKeyEncoding(TestCase):
     def test_encode_key(self):
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+test_lag
+~~~~~~~~
+
+Tests for the watcher lag tracker.
+"""
+
+import logging
+from unittest import TestCase
+from mock import patch
+from calico.etcddriver.lag import (
+    EventLagTracker, CATCHUP_CONTINUE, CATCHUP_GROW_QUEUE,
+    CATCHUP_PARTIAL_RESYNC
+)
+
+_log = logging.getLogger(__name__)
+
+
+class TestEventLagTracker(TestCase):
+    def setUp(self):
+        self._time_patch = patch("calico.etcddriver.lag.monotonic_time",
+                                 autospec=True)
+        self.m_time = self._time_patch.start()
+        self.m_time.return_value = 100
+        self.tracker = EventLagTracker(400)
+
+    def tearDown(self):
+        self._time_patch.stop()
+
+    def process(self, key, count):
+        for _ in xrange(count):
+            self.tracker.on_event_processed(key)
+
+    def test_plenty_of_headroom(self):
+        self.process("/calico/v1/host/h1/workload/o/w/endpoint/e", 10)
+        self.m_time.return_value = 101
+        self.assertEqual(self.tracker.decide(10, 100), (CATCHUP_CONTINUE, []))
+        self.assertEqual(self.tracker.drain_rate, 10.0)
+        self.assertEqual(self.tracker.arrival_rate, 20.0)
+
+    def test_draining(self):
+        self.tracker.end_window(90)
+        self.process("/calico/v1/host/h1/workload/o/w/endpoint/e", 20)
+        self.m_time.return_value = 101
+        # 20 processed, 10 arrived.
+        self.assertEqual(self.tracker.decide(80, 100), (CATCHUP_CONTINUE, []))
+
+    def test_falling_behind_grows_queue(self):
+        self.tracker.end_window(50)
+        self.process("/calico/v1/host/h1/workload/o/w/endpoint/e", 10)
+        self.m_time.return_value = 101
+        self.assertEqual(self.tracker.decide(90, 100),
+                         (CATCHUP_GROW_QUEUE, []))
+        self.assertEqual(self.tracker.queue_grows, 1)
+
+    def test_max_size_hot_subtree(self):
+        self.tracker.end_window(300)
+        self.process("/calico/v1/host/h1/workload/o/w/endpoint/e", 90)
+        self.process("/calico/v1/host/h2/workload/o/w/endpoint/e", 1)
+        self.process("/calico/v1/host/h3/workload/o/w/endpoint/e", 1)
+        self.process("/calico/v1/host/h4/workload/o/w/endpoint/e", 1)
+        self.m_time.return_value = 101
+        action, subtrees = self.tracker.decide(390, 400)
+        self.assertEqual(action, CATCHUP_PARTIAL_RESYNC)
+        self.assertEqual(subtrees[0], "/calico/v1/host/h1")
+        self.assertEqual(len(subtrees), 3)
+        self.assertEqual(self.tracker.partial_resyncs, 1)
+
+    def test_max_size_events_spread_out(self):
+        self.tracker.end_window(300)
+        for ii in xrange(10):
+            self.process("/calico/v1/host/h%s/workload/o/w/endpoint/e" % ii,
+                         1)
+        self.m_time.return_value = 101
+        self.assertEqual(self.tracker.decide(390, 400),
+                         (CATCHUP_CONTINUE, []))
+
+    def test_skipped_events_not_hot(self):
+        self.tracker.end_window(300)
+        for _ in xrange(10):
+            self.tracker.on_event_skipped()
+        self.m_time.return_value = 101
+        self.assertEqual(self.tracker.decide(395, 400),
+                         (CATCHUP_CONTINUE, []))
+        self.assertEqual(self.tracker.events_skipped, 10)
+        self.assertEqual(self.tracker.drain_rate, 10.0)
+        self.assertTrue("events skipped 10" in str(self.tracker))
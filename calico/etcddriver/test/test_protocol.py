@@ -20,11 +20,13 @@ Tests for Felix/etcddriver protocol read/write function.
 """
 
 import logging
+import select
 import socket
 from unittest import TestCase
 import errno
 from mock import Mock, call, patch
 import msgpack
+import msgpack.fallback
 from calico.etcddriver.protocol import (
     MessageWriter, STATUS_RESYNC, MSG_KEY_STATUS, MSG_TYPE_STATUS,
     MSG_KEY_TYPE, STATUS_IN_SYNC, MessageReader,
@@ -139,6 +141,23 @@ class TestMessageWriter(TestCase):
             self.fail("Unexpected message: %s" % msg)
 
 
+def recv_into_returning(chunks):
+    """
+    Returns a side effect for a mock socket's recv_into() that copies the
+    given chunks into the buffer in turn.  Exceptions in the list are raised.
+    """
+    chunks = iter(chunks)
+
+    def recv_into(buf, nbytes):
+        chunk = next(chunks)
+        if isinstance(chunk, BaseException):
+            raise chunk
+        assert len(chunk) <= nbytes
+        buf[:len(chunk)] = chunk
+        return len(chunk)
+    return recv_into
+
+
 class TestMessageReader(TestCase):
     def setUp(self):
         self.sck = Mock(spec=socket.socket)
@@ -152,18 +171,17 @@ class TestMessageReader(TestCase):
         ])
         exp_msg = {MSG_KEY_TYPE: MSG_TYPE_STATUS,
                    MSG_KEY_STATUS: STATUS_RESYNC}
-        self.sck.recv.return_value = msgpack.dumps(exp_msg)
+        self.sck.recv_into.side_effect = recv_into_returning(
+            [msgpack.dumps(exp_msg)] * 2
+        )
         for _ in xrange(2):
             msg_gen = self.reader.new_messages(timeout=1)
             msg_type, msg = next(msg_gen)
             self.assertEqual(msg_type, MSG_TYPE_STATUS)
             self.assertEqual(msg, exp_msg)
         self.assertEqual(
-            self.sck.recv.mock_calls,
-            [
-                call(16384),
-                call(16384),
-            ]
+            [c[1][1] for c in self.sck.recv_into.mock_calls],
+            [16384, 16384]
         )
 
     @patch("select.select", autospec=True)
@@ -174,7 +192,7 @@ class TestMessageReader(TestCase):
         ])
         exp_msg = {MSG_KEY_TYPE: MSG_TYPE_STATUS}
         msg_bytes = msgpack.dumps(exp_msg)
-        self.sck.recv.side_effect = iter([
+        self.sck.recv_into.side_effect = recv_into_returning([
             msg_bytes[:len(msg_bytes)/2],
             msg_bytes[len(msg_bytes)/2:],
         ])
@@ -183,6 +201,37 @@ class TestMessageReader(TestCase):
         self.assertEqual(next(self.reader.new_messages(timeout=None)),
                          (MSG_TYPE_STATUS, exp_msg))
 
+    @patch("select.select", autospec=True)
+    def test_partial_read_fallback_unpacker(self, m_select):
+        fed = []
+
+        class RecordingUnpacker(msgpack.fallback.Unpacker):
+            # Like the fallback in msgpack 0.4, keep what we're fed.
+            def feed(self, next_bytes):
+                fed.append(next_bytes)
+                super(RecordingUnpacker, self).feed(next_bytes)
+
+        with patch("msgpack.Unpacker", RecordingUnpacker):
+            reader = MessageReader(self.sck)
+        m_select.side_effect = iter([
+            ([self.sck], [], []),
+            ([self.sck], [], []),
+        ])
+        exp_msg = {MSG_KEY_TYPE: MSG_TYPE_STATUS,
+                   MSG_KEY_STATUS: STATUS_RESYNC}
+        msg_bytes = msgpack.dumps(exp_msg)
+        self.sck.recv_into.side_effect = recv_into_returning([
+            msg_bytes[:len(msg_bytes)/2],
+            msg_bytes[len(msg_bytes)/2:],
+        ])
+        self.assertRaises(StopIteration, next,
+                          reader.new_messages(timeout=None))
+        self.assertEqual(next(reader.new_messages(timeout=None)),
+                         (MSG_TYPE_STATUS, exp_msg))
+        # The fallback was given copies, unaffected by later reads.
+        self.assertEqual([type(b) for b in fed], [bytes, bytes])
+        self.assertEqual("".join(fed), msg_bytes)
+
     @patch("select.select", autospec=True)
     def test_retryable_error(self, m_select):
         m_select.side_effect = iter([
@@ -198,7 +247,9 @@ class TestMessageReader(TestCase):
             errors.append(err)
         exp_msg = {MSG_KEY_TYPE: MSG_TYPE_STATUS,
                    MSG_KEY_STATUS: STATUS_RESYNC}
-        self.sck.recv.side_effect = iter(errors + [msgpack.dumps(exp_msg)])
+        self.sck.recv_into.side_effect = recv_into_returning(
+            errors + [msgpack.dumps(exp_msg)]
+        )
         for _ in errors:
             msg_gen = self.reader.new_messages(timeout=1)
             self.assertRaises(StopIteration, next, msg_gen)
@@ -214,7 +265,7 @@ class TestMessageReader(TestCase):
         ])
         err = socket.error()
         err.errno = errno.E2BIG
-        self.sck.recv.side_effect = err
+        self.sck.recv_into.side_effect = err
         msg_gen = self.reader.new_messages(timeout=1)
         self.assertRaises(socket.error, next, msg_gen)
 
@@ -225,10 +276,61 @@ class TestMessageReader(TestCase):
         ])
         msg_gen = self.reader.new_messages(timeout=1)
         self.assertRaises(StopIteration, next, msg_gen)
-        self.assertFalse(self.sck.recv.called)
+        self.assertFalse(self.sck.recv_into.called)
 
     @patch("select.select", autospec=True)
     def test_shutdown(self, m_select):
-        self.sck.recv.return_value = ""
+        self.sck.recv_into.return_value = 0
         msg_gen = self.reader.new_messages(timeout=None)
         self.assertRaises(SocketClosed, next, msg_gen)
+
+
+class TestMessageReaderSocketPair(TestCase):
+    """
+    Tests of the reader's buffer management over a real socket pair.
+    """
+    def setUp(self):
+        self.write_sck, self.read_sck = socket.socketpair()
+        self.writer = MessageWriter(self.write_sck)
+        self.reader = MessageReader(self.read_sck, max_buf_size=65536)
+
+    def tearDown(self):
+        self.write_sck.close()
+        self.read_sck.close()
+
+    def read_all(self, count):
+        msgs = []
+        while len(msgs) < count:
+            msgs.extend(self.reader.new_messages(timeout=1))
+        return msgs
+
+    def test_buffer_grows_and_skips_select(self):
+        value = "x" * 100
+        for ii in xrange(1000):
+            self.writer.send_message(MSG_TYPE_STATUS,
+                                     {MSG_KEY_STATUS: value},
+                                     flush=False)
+        self.writer.flush()
+        with patch("select.select", wraps=select.select) as m_select:
+            msgs = self.read_all(1000)
+        self.assertEqual(len(msgs), 1000)
+        self.assertEqual(msgs[-1], (MSG_TYPE_STATUS,
+                                    {MSG_KEY_TYPE: MSG_TYPE_STATUS,
+                                     MSG_KEY_STATUS: value}))
+        self.assertEqual(len(self.reader._buf), 65536)
+        # Only the first read (and any read after a short one) needs a
+        # select.
+        self.assertTrue(m_select.call_count < 4)
+
+    def test_no_data_after_full_read(self):
+        # Exactly fill the initial buffer, the reader should then see that
+        # there's no more data rather than blocking in recv_into().
+        msg = {MSG_KEY_TYPE: MSG_TYPE_STATUS, MSG_KEY_STATUS: ""}
+        msg[MSG_KEY_STATUS] = "a" * (16384 - len(msgpack.dumps(msg)) - 2)
+        data = msgpack.dumps(msg)
+        self.assertEqual(len(data), 16384)
+        self.write_sck.sendall(data)
+        self.assertEqual(list(self.reader.new_messages(timeout=1)),
+                         [(MSG_TYPE_STATUS, msg)])
+        self.assertTrue(self.reader._last_read_filled_buf)
+        self.assertEqual(list(self.reader.new_messages(timeout=0.01)), [])
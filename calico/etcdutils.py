@@ -5,17 +5,26 @@ from collections import namedtuple
 import functools
 import json
 import logging
+import operator
 import re
 import etcd
 import os
+from Queue import Empty
+import socket
 from socket import timeout as SocketTimeout
+import ssl
+from threading import Lock
 import time
 from types import StringTypes
 
-from urllib3 import Timeout
+from urllib3 import (
+    Timeout, HTTPConnectionPool, HTTPSConnectionPool, PoolManager
+)
+from urllib3.connection import HTTPConnection
 from urllib3.exceptions import ReadTimeoutError
 from calico.logutils import logging_exceptions
 from calico.datamodel_v1 import READY_KEY
+from calico.stats import RateStat
 
 _log = logging.getLogger(__name__)
 
@@ -35,12 +44,56 @@ ACTION_MAPPING = {
 
 DEFAULT_TIMEOUT = 5
 
+# Uses of etcd connections, each of which gets its own pools.
+POOL_WATCH = "watch"
+POOL_SNAPSHOT = "snapshot"
+POOL_STATUS = "status"
+
+# Number of connections to keep open to each etcd server, by use.
+POOL_SIZES = {
+    # One long-poll at a time.
+    POOL_WATCH: 1,
+    # The snapshot is streamed; partial resyncs read while it is open.
+    POOL_SNAPSHOT: 2,
+    # Reads and writes are serialised by the owning actor.
+    POOL_STATUS: 1,
+}
+
+# TCP keepalive settings for etcd connections.  Keepalives stop idle
+# connections, such as a watch that is waiting for an event, from being
+# dropped by firewalls and detect a dead etcd server between requests.
+KEEPALIVE_IDLE_SECS = 60
+KEEPALIVE_INTERVAL_SECS = 15
+KEEPALIVE_COUNT = 4
+
 
 class PathDispatcher(object):
+    """
+    Dispatches etcd events to handlers registered against path patterns.
+
+    Paths are registered into a trie, which is compiled on first use into
+    tables of routes, grouped by key length and by the positions of the
+    fixed (non-capture) segments.  Each table maps the fixed segments of a
+    key to its handlers so that dispatching an event needs only one split
+    of the key and a dict lookup per table of the right length.
+    """
     def __init__(self):
         self.handler_root = {}
+        # Lazily compiled from handler_root, maps number of key segments to
+        # list of (fixed segment getter, {fixed segments: route}) tuples.
+        self._routes_by_len = None
 
     def register(self, path, on_set=None, on_del=None):
+        """
+        Registers handlers for a path pattern.
+
+        Path segments of the form "<name>" capture the corresponding
+        segment of the key.  Handlers are called as
+        handler(response, **captures), with each captured segment passed
+        as a keyword argument named after its capture.  If a capture and a
+        fixed segment are registered at the same position, the capture
+        wins.
+        """
         _log.info("Registering path %s set=%s del=%s", path, on_set, on_del)
         parts = path.strip("/").split("/")
         node = self.handler_root
@@ -58,6 +111,7 @@ class PathDispatcher(object):
             node["set"] = on_set
         if on_del:
             node["delete"] = on_del
+        self._routes_by_len = None
 
     def handle_event(self, response):
         """
@@ -67,39 +121,262 @@ class PathDispatcher(object):
                the etcd driver socket.
         """
         _log.debug("etcd event %s for key %s", response.action, response.key)
+        if self._routes_by_len is None:
+            self._compile()
         key_parts = response.key.strip("/").split("/")
-        self._handle(key_parts, response, self.handler_root, {})
-
-    def _handle(self, key_parts, response, handler_node, captures):
-        while key_parts:
-            next_part = key_parts.pop(0)
-            if "capture" in handler_node:
-                capture_name, handler_node = handler_node["capture"]
-                captures[capture_name] = next_part
-            elif next_part in handler_node:
-                handler_node = handler_node[next_part]
-            else:
-                _log.debug("No matching sub-handler for %s", response.key)
-                return
-        # We've reached the end of the key.
+        for get_fixed, routes in self._routes_by_len.get(len(key_parts), ()):
+            route = routes.get(get_fixed(key_parts))
+            if route is not None:
+                break
+        else:
+            _log.debug("No matching sub-handler for %s", response.key)
+            return
+        get_captures, capture_names, handlers = route
         action = ACTION_MAPPING.get(response.action)
-        if action in handler_node:
-            _log.debug("Found handler for event %s for %s, captures: %s",
-                       action, response.key, captures)
-            handler_node[action](response, **captures)
+        handler = handlers.get(action)
+        if handler is not None:
+            handler(response,
+                    **dict(zip(capture_names, get_captures(key_parts))))
         else:
-            _log.debug("No handler for event %s on %s. Handler node %s.",
-                       action, response.key, handler_node)
+            _log.debug("No handler for event %s on %s. Handlers %s.",
+                       action, response.key, handlers)
+
+    def _compile(self):
+        """
+        Compiles the trie of registered paths into self._routes_by_len.
+
+        Since captures take precedence over fixed segments, the routes
+        that we generate are mutually exclusive and can be checked in any
+        order.
+        """
+        tables = {}
+        for pattern, capture_names, handlers in self._walk_trie(
+                self.handler_root, [], []):
+            fixed_idxs = tuple(i for i, p in enumerate(pattern)
+                               if p is not None)
+            capture_idxs = tuple(i for i, p in enumerate(pattern)
+                                 if p is None)
+            get_fixed = _tuple_getter(fixed_idxs)
+            table_key = (len(pattern), fixed_idxs)
+            if table_key not in tables:
+                tables[table_key] = (get_fixed, {})
+            _, routes = tables[table_key]
+            routes[get_fixed(pattern)] = (_tuple_getter(capture_idxs),
+                                          capture_names, handlers)
+        self._routes_by_len = {}
+        for (num_parts, _), table in sorted(tables.iteritems()):
+            self._routes_by_len.setdefault(num_parts, []).append(table)
+
+    def _walk_trie(self, node, pattern, capture_names):
+        """
+        Generates (pattern, capture names, handlers) for each reachable node
+        in the trie that has handlers.  Captures are represented by None in
+        the pattern; their names are listed in path order.
+        """
+        handlers = dict((a, node[a]) for a in ("set", "delete") if a in node)
+        if handlers:
+            yield tuple(pattern), tuple(capture_names), handlers
+        if "capture" in node:
+            # Capture takes precedence, any fixed segments at this level are
+            # unreachable.
+            name, child = node["capture"]
+            children = [(None, [name], child)]
+        else:
+            children = [(p, [], c) for p, c in node.iteritems()
+                        if p not in ("set", "delete")]
+        for part, names, child in children:
+            for result in self._walk_trie(child, pattern + [part],
+                                          capture_names + names):
+                yield result
+
+
+def _tuple_getter(idxs):
+    """
+    :returns a function that extracts a tuple of the items at the given
+             indexes from a sequence.
+    """
+    if len(idxs) > 1:
+        return operator.itemgetter(*idxs)
+    elif idxs:
+        idx = idxs[0]
+        return lambda seq: (seq[idx],)
+    else:
+        return lambda seq: ()
 
 
 EtcdEvent = namedtuple("EtcdEvent", ["action", "key", "value"])
 
 
+def keepalive_socket_options():
+    """
+    :returns the socket options for etcd connections: urllib3's defaults
+             plus TCP keepalive.
+    """
+    options = list(HTTPConnection.default_socket_options)
+    options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+    for name, value in [("TCP_KEEPIDLE", KEEPALIVE_IDLE_SECS),
+                        ("TCP_KEEPINTVL", KEEPALIVE_INTERVAL_SECS),
+                        ("TCP_KEEPCNT", KEEPALIVE_COUNT)]:
+        if hasattr(socket, name):  # Linux only.
+            options.append((socket.IPPROTO_TCP, getattr(socket, name), value))
+    return options
+
+
+class EtcdConnectionFactory(object):
+    """
+    Creates the urllib3 connection pools that we use to talk to etcd.
+
+    Pools are cached by use and server so that, after an error, a
+    component gets its pool back (along with any connections that are
+    still open) rather than paying for a new TCP and TLS handshake.  Every
+    pool uses TCP keepalive and counts the connections that it makes.
+    """
+    def __init__(self, key_file=None, cert_file=None, ca_file=None):
+        self.key_file = key_file
+        self.cert_file = cert_file
+        self.ca_file = ca_file
+        self.socket_options = keepalive_socket_options()
+        self.handshakes = RateStat("etcd handshakes")
+        self._pools = {}
+        self._lock = Lock()
+
+    def get_pool(self, use, scheme, host, port):
+        """
+        :returns the (possibly cached) connection pool for the given use
+                 and server.
+        """
+        key = (use, scheme, host, port)
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool is None:
+                _log.info("Creating %s pool of %s %s connections to %s:%s",
+                          use, POOL_SIZES[use], scheme, host, port)
+                if scheme == "https":
+                    pool = HTTPSConnectionPool(host, port,
+                                               key_file=self.key_file,
+                                               cert_file=self.cert_file,
+                                               ca_certs=self.ca_file,
+                                               maxsize=POOL_SIZES[use],
+                                               socket_options=
+                                               self.socket_options)
+                else:
+                    pool = HTTPConnectionPool(host, port,
+                                              maxsize=POOL_SIZES[use],
+                                              socket_options=
+                                              self.socket_options)
+                self._count_handshakes(pool)
+                self._pools[key] = pool
+        return pool
+
+    def pool_manager(self, use):
+        """
+        :returns a new PoolManager, for use by a python-etcd client, that
+                 opens connections in the same way as get_pool().
+        """
+        kw = {}
+        # As for python-etcd, the key may be in the cert file.
+        if self.cert_file:
+            kw["cert_file"] = self.cert_file
+        if self.key_file:
+            kw["key_file"] = self.key_file
+        if self.ca_file:
+            kw["ca_certs"] = self.ca_file
+            kw["cert_reqs"] = ssl.CERT_REQUIRED
+        manager = PoolManager(num_pools=10,
+                              maxsize=POOL_SIZES[use],
+                              socket_options=self.socket_options,
+                              **kw)
+        # PoolManager creates its pools on demand.
+        new_pool = manager._new_pool
+
+        def counting_new_pool(*args, **kwargs):
+            pool = new_pool(*args, **kwargs)
+            self._count_handshakes(pool)
+            return pool
+        manager._new_pool = counting_new_pool
+        return manager
+
+    def _count_handshakes(self, pool):
+        """
+        Hooks the given pool so that we count each time one of its
+        connections connects, which costs a TCP handshake (and a TLS
+        handshake for HTTPS).  Connections reconnect on demand after
+        they've been closed so we count connects rather than new
+        connections.
+        """
+        base_cls = pool.ConnectionCls
+        factory = self
+
+        class CountingConnection(base_cls):
+            def connect(self):
+                with factory._lock:
+                    factory.handshakes.store_occurence()
+                return base_cls.connect(self)
+        pool.ConnectionCls = CountingConnection
+
+    @property
+    def handshakes_per_hour(self):
+        return self.handshakes.rate * 3600
+
+    def __str__(self):
+        return "%s (%.1f per hour)" % (self.handshakes,
+                                       self.handshakes_per_hour)
+
+
+def close_idle_connections(pool):
+    """
+    Closes the idle connections in the given pool (or in all the pools of
+    the given PoolManager) but leaves the pool usable; it reconnects on
+    demand.
+
+    Works around urllib3 bug #718: after a read timeout, the connection is
+    returned to the pool with the rest of the response still to come.
+    """
+    if isinstance(pool, PoolManager):
+        for key in pool.pools.keys():
+            child = pool.pools.get(key)
+            if child is not None:
+                close_idle_connections(child)
+        return
+    conns = []
+    try:
+        while True:
+            conns.append(pool.pool.get(block=False))
+    except (Empty, AttributeError):
+        # Empty or, if the pool has been closed, pool.pool is None.
+        pass
+    for conn in conns:
+        if conn is not None:
+            conn.close()
+        pool.pool.put(conn, block=False)
+
+
+_connection_factories = {}
+_connection_factories_lock = Lock()
+
+
+def connection_factory(key_file=None, cert_file=None, ca_file=None):
+    """
+    :returns the EtcdConnectionFactory, shared by the whole process, for the
+             given TLS settings.
+    """
+    key = (key_file, cert_file, ca_file)
+    with _connection_factories_lock:
+        if key not in _connection_factories:
+            _connection_factories[key] = EtcdConnectionFactory(*key)
+        return _connection_factories[key]
+
+
 class EtcdClientOwner(object):
     """
     Base class for objects that own an etcd Client.  Supports
     reconnecting, optionally copying the cluster ID.
+
+    The client's connections come from a PoolManager that is kept across
+    reconnects so that reconnecting doesn't discard open connections.
     """
+    # Use of the client's connections, which determines the pool size.
+    pool_use = POOL_STATUS
 
     def __init__(self,
                  etcd_addrs,
@@ -140,6 +417,10 @@ class EtcdClientOwner(object):
         self.etcd_cert = etcd_cert
         self.etcd_ca = etcd_ca
         self.client = None
+        self._conn_factory = connection_factory(key_file=etcd_key,
+                                                cert_file=etcd_cert,
+                                                ca_file=etcd_ca)
+        self._http = None
         self.reconnect()
 
     def reconnect(self, copy_cluster_id=True):
@@ -185,12 +466,19 @@ class EtcdClientOwner(object):
                 allow_reconnect=True
             )
 
+        # Reuse our connections rather than the new client's empty pools.
+        if self._http is None:
+            self._http = self._conn_factory.pool_manager(self.pool_use)
+        self.client.http = self._http
+        _log.info("STAT: %s", self._conn_factory)
+
 
 class EtcdWatcher(EtcdClientOwner):
     """
     Helper class for managing an etcd watch session.  Maintains the
     etcd polling index and handles expected exceptions.
     """
+    pool_use = POOL_WATCH
 
     def __init__(self,
                  etcd_addrs,
@@ -340,11 +628,12 @@ class EtcdWatcher(EtcdClientOwner):
                 if isinstance(e.cause, (ReadTimeoutError, SocketTimeout)):
                     # This is expected when we're doing a poll and nothing
                     # happened. socket timeout doesn't seem to be caught by
-                    # urllib3 1.7.1.  Simply reconnect.
+                    # urllib3 1.7.1.
                     _log.debug("Read from etcd timed out (%r), retrying.", e)
-                    # Force a reconnect to ensure urllib3 doesn't recycle the
+                    # Make sure urllib3 doesn't recycle the timed-out
                     # connection.  (We were seeing this with urllib3 1.7.1.)
-                    self.reconnect()
+                    # There's no need to reconnect the client.
+                    close_idle_connections(self.client.http)
                 else:
                     # We don't log out the stack trace here because it can
                     # spam the logs heavily if the requests keep failing.
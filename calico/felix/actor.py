@@ -26,12 +26,14 @@ When an actor_message-decorated method is called from another greenlet
 the method call is wrapped up as a Message object and put on the
 queue.
 
-Note: callers must specify the async=True/False argument when calling
-a actor_message-decorated method.  If async=True is passed, the method
-returns an AsyncResult.  If async=False is passed, the method blocks
-until the result is available and returns it as-is. As a convenience,
-Actors may call their own decorated methods without passing async=...;
-such calls are treated as normal, synchronous method calls.
+Note: callers must specify the async=True/False argument (or nowait=True)
+when calling a actor_message-decorated method.  If async=True is passed, the
+method returns an AsyncResult.  If async=False is passed, the method blocks
+until the result is available and returns it as-is.  If nowait=True is
+passed, the message is sent without allocating a result and the method
+returns None.  As a convenience, Actors may call their own decorated methods
+without passing async=...; such calls are treated as normal, synchronous
+method calls.
 
 Each time it is scheduled, the main loop of the Actor
 
@@ -72,6 +74,20 @@ the beginning.  To make use of that function, an Actor must:
   ensuring, of course, that it did not leave any resources
   partially-modified.
 
+If the actor can tell which message caused the failure, it may raise
+RetryWithoutMessage instead.  The framework then reports the given result
+to that message and re-runs the rest of the batch in one go, rather than
+bisecting the batch.
+
+Coalescing
+~~~~~~~~~~
+
+Messages where only the latest call matters (for example, updates that
+carry the complete new state of an object) may be declared with
+@actor_message(coalesce_key=...).  A call that has the same key as an
+earlier call that is still on the queue supersedes it: the earlier call is
+dropped and both callers get the result of the later one.
+
 Thread safety
 ~~~~~~~~~~~~~
 
@@ -96,6 +112,10 @@ an exception, it terminates the process on the assumption that
 an unhandled exception implies a bug and may leave the system in an
 inconsistent state.
 
+Messages sent with nowait=True have no AsyncResult so any exception that
+they raise is passed straight to _on_unhandled_exception(), which also
+terminates the process.
+
 """
 import collections
 import functools
@@ -146,6 +166,9 @@ class Actor(object):
 
     def __init__(self, qualifier=None):
         self._event_queue = collections.deque()
+        # Map from coalesce key to the most recent message with that key that
+        # is still on the queue.  See actor_message(coalesce_key=...).
+        self._coalescable_msgs = {}
 
         # Set to True when the main loop is actively processing the input
         # queue or has been scheduled to do so.  Set to False when the loop
@@ -160,6 +183,9 @@ class Actor(object):
         self.greenlet = gevent.Greenlet(self._loop)
         self._op_count = 0
         self._current_msg = None
+        # Name of the message being processed (or "<finish batch>"); purely
+        # for logging.
+        self._current_msg_name = None
         self.started = False
 
         # Message being processed; purely for logging.
@@ -241,9 +267,10 @@ class Actor(object):
         """
         Main greenlet loop, repeatedly runs _step().  Doesn't return normally.
         """
-        actor_storage.class_name = self.__class__.__name__
-        actor_storage.name = self.name
-        actor_storage.msg_id = None
+        # Greenlet-local attributes are relatively expensive to set so we
+        # only store a reference to ourselves; the per-message state lives
+        # on the actor.
+        actor_storage.actor = self
 
         try:
             while True:
@@ -271,7 +298,7 @@ class Actor(object):
             # back to True.
             assert self._scheduled, ("Switched to %s from %s but _scheduled "
                                      "set to False." % (self, caller))
-        msg = self._event_queue.popleft()
+        msg = self._pop_msg()
 
         batch = [msg]
         batches = []
@@ -282,7 +309,7 @@ class Actor(object):
             while self._event_queue:
                 # We're the only ones getting from the queue so this should
                 # never fail.
-                msg = self._event_queue.popleft()
+                msg = self._pop_msg()
                 if msg.needs_own_batch:
                     if batch:
                         batches.append(batch)
@@ -310,8 +337,7 @@ class Actor(object):
                            msg, msg.recipient, msg.caller,
                            len(self._event_queue))
                 self._current_msg = msg
-                actor_storage.msg_id = msg.msg_id
-                actor_storage.msg_name = msg.name
+                self._current_msg_name = msg.name
                 try:
                     # Actually execute the per-message method and record its
                     # result.
@@ -325,12 +351,11 @@ class Actor(object):
                     _stats.increment("Messages executed OK")
                 finally:
                     self._current_msg = None
-                    actor_storage.msg_id = None
-                    actor_storage.msg_name = None
+                    self._current_msg_name = None
             try:
                 # Give subclass a chance to post-process the batch.
                 _log.debug("Finishing message batch of length %s", len(batch))
-                actor_storage.msg_name = "<finish batch>"
+                self._current_msg_name = "<finish batch>"
                 self._finish_msg_batch(batch, results)
             except SplitBatchAndRetry:
                 # The subclass couldn't process the batch as is (probably
@@ -342,6 +367,19 @@ class Actor(object):
                 num_splits += 1  # For diags.
                 _stats.increment("Split batches")
                 continue
+            except RetryWithoutMessage as e:
+                # The subclass knows which message caused the failure.
+                # Report the failure to that message only and retry the
+                # rest of the batch as one.
+                _log.warn("Dropping message %s from batch and retrying.",
+                          batch[e.msg_index])
+                self.__publish_results([batch[e.msg_index]], [e.result])
+                rest = batch[:e.msg_index] + batch[e.msg_index + 1:]
+                if rest:
+                    batches[:0] = [rest]
+                num_splits += 1  # For diags.
+                _stats.increment("Batches retried without a message")
+                continue
             except BaseException as e:
                 # Most-likely a bug.  Report failure to all callers.
                 _log.exception("_finish_msg_batch failed.")
@@ -350,23 +388,57 @@ class Actor(object):
             else:
                 _log.debug("Finished message batch successfully")
             finally:
-                actor_storage.msg_name = None
+                self._current_msg_name = None
 
             # Batch complete and finalized, set all the results.
-            assert len(batch) == len(results)
-            for msg, (result, exc) in zip(batch, results):
-                for future in msg.results:
-                    if exc is not None:
-                        future.set_exception(exc)
-                    else:
-                        future.set(result)
-                    _stats.increment("Messages completed")
-
+            self.__publish_results(batch, results)
             _stats.increment("Batches processed")
         if num_splits > 0:
             _log.warn("Split batches complete. Number of splits: %s",
                       num_splits)
 
+    @staticmethod
+    def __publish_results(batch, results):
+        """
+        Sets the results of the given messages.
+
+        :param list[Message] batch: messages to report results to.
+        :param list[ResultOrExc] results: results, one per message.
+        """
+        assert len(batch) == len(results)
+        for msg, (result, exc) in zip(batch, results):
+            if exc is not None and not msg.results:
+                # Sent with nowait=True so there's no-one to report the
+                # exception to.
+                _on_unhandled_exception(msg, exc)
+            for future in msg.results:
+                if exc is not None:
+                    future.set_exception(exc)
+                else:
+                    future.set(result)
+                _stats.increment("Messages completed")
+
+    def _pop_msg(self):
+        """
+        Pops the next message from the queue, discarding any messages that
+        were superseded by a later message with the same coalesce key.
+
+        The queue must be non-empty.  Since a superseded message is always
+        followed by the message that superseded it, this always returns a
+        message.
+        """
+        while True:
+            msg = self._event_queue.popleft()
+            if msg.coalesce_key is None:
+                return msg
+            if not msg.superseded:
+                # Once the message is off the queue, later messages can no
+                # longer be coalesced with it.
+                del self._coalescable_msgs[msg.coalesce_key]
+                return msg
+            _log.debug("Discarding message %s, coalesced into a later "
+                       "message.", msg)
+
     @staticmethod
     def __split_batch(current_batch, remaining_batches):
         """
@@ -466,6 +538,22 @@ class SplitBatchAndRetry(Exception):
     pass
 
 
+class RetryWithoutMessage(Exception):
+    """
+    Exception that may be raised by _finish_msg_batch() when it knows which
+    message of the batch caused a failure.  The framework reports the given
+    result to that message and re-runs the remaining messages as one batch.
+    """
+    def __init__(self, msg_index, result):
+        """
+        :param int msg_index: index of the failed message in the batch.
+        :param ResultOrExc result: the result to report to the message.
+        """
+        super(RetryWithoutMessage, self).__init__(msg_index, result)
+        self.msg_index = msg_index
+        self.result = result
+
+
 def wait_and_check(async_results):
     for r in async_results:
         r.get()
@@ -480,7 +568,7 @@ class Message(object):
     Message passed to an actor.
     """
     __slots__ = ("msg_id", "method", "results", "caller", "name",
-                 "needs_own_batch", "recipient")
+                 "needs_own_batch", "recipient", "coalesce_key", "superseded")
 
     def __init__(self, msg_id,  method, results, caller_path, recipient,
                  needs_own_batch):
@@ -491,14 +579,50 @@ class Message(object):
         self.name = method.func.__name__
         self.needs_own_batch = needs_own_batch
         self.recipient = recipient
+        self.coalesce_key = None
+        self.superseded = False
+        _stats.increment("Messages created")
+
+    def __str__(self):
+        data = ("%s (%s)" % (self.msg_id, self.name))
+        return data
+
+
+class NowaitMessage(object):
+    """
+    Message passed to an actor by a nowait=True call.
+
+    Slimmed-down version of Message: it has no results (unless it was
+    coalesced with an earlier message that had some) and its ID is only
+    formatted if it is logged.
+    """
+    __slots__ = ("msg_idx", "method", "results", "caller", "name",
+                 "needs_own_batch", "recipient", "coalesce_key", "superseded")
+
+    def __init__(self, msg_idx, method, caller_path, recipient,
+                 needs_own_batch):
+        self.msg_idx = msg_idx
+        self.method = method
+        # No-one is waiting for the result.
+        self.results = ()
+        self.caller = caller_path
+        self.name = method.func.__name__
+        self.needs_own_batch = needs_own_batch
+        self.recipient = recipient
+        self.coalesce_key = None
+        self.superseded = False
         _stats.increment("Messages created")
 
+    @property
+    def msg_id(self):
+        return "M%016x" % self.msg_idx
+
     def __str__(self):
         data = ("%s (%s)" % (self.msg_id, self.name))
         return data
 
 
-def actor_message(needs_own_batch=False):
+def actor_message(needs_own_batch=False, coalesce_key=None):
     """
     Decorator: turns a method into an Actor message.
 
@@ -508,6 +632,8 @@ def actor_message(needs_own_batch=False):
     waiting for the result.
 
     If async=True is passed, the wrapped method returns an AsyncResult.
+    If nowait=True is passed, the wrapped method returns None; any
+    exception raised by the message is passed to _on_unhandled_exception().
     Otherwise, it blocks and returns the result (or raises the exception)
     as-is.
 
@@ -517,9 +643,19 @@ def actor_message(needs_own_batch=False):
 
     :param bool needs_own_batch: True if this message should be processed
         in its own batch.
+    :param coalesce_key: Optional function, called with the arguments of
+        each queued call (excluding self).  If a queued call returns the
+        same key as an earlier call that is still on the queue, the
+        earlier call is dropped and its callers receive the result of the
+        later call instead.  Only suitable for messages where the latest
+        call for a given key supersedes the earlier ones.
     """
     def decorator(fn):
         method_name = fn.__name__
+        coalesced_stat = "Messages coalesced: %s" % method_name
+        # Cache of stat names, indexed by (call type, caller, recipient
+        # class).  Avoids formatting the name on every call.
+        stat_names = {}
 
         @functools.wraps(fn)
         def queue_fn(self, *args, **kwargs):
@@ -535,10 +671,16 @@ def actor_message(needs_own_batch=False):
                 calling_file = os.path.basename(calling_file)
                 calling_path = "%s:%s:%s" % (calling_file, line_no, func)
                 try:
-                    caller_name = "%s.%s" % (actor_storage.class_name,
-                                             actor_storage.msg_name)
-                    caller = "%s (processing %s)" % (actor_storage.name,
-                                                     actor_storage.msg_id)
+                    current_actor = actor_storage.actor
+                    caller_name = "%s.%s" % (
+                        current_actor.__class__.__name__,
+                        current_actor._current_msg_name
+                    )
+                    current_msg = current_actor._current_msg
+                    caller = "%s (processing %s)" % (
+                        current_actor.name,
+                        current_msg and current_msg.msg_id
+                    )
                 except AttributeError:
                     caller_name = calling_path
                     caller = calling_path
@@ -546,8 +688,9 @@ def actor_message(needs_own_batch=False):
             # Figure out our arguments.
             async_set = "async" in kwargs
             async = kwargs.pop("async", False)
+            nowait = kwargs.pop("nowait", False)
             on_same_greenlet = (self.greenlet == gevent.getcurrent())
-            if on_same_greenlet and not async:
+            if on_same_greenlet and not (async or nowait):
                 # Bypass the queue if we're already on the same greenlet, or we
                 # would deadlock by waiting for ourselves.
                 return fn(self, *args, **kwargs)
@@ -556,43 +699,75 @@ def actor_message(needs_own_batch=False):
                 # WARNING: only use stable values in the stat name.
                 # For example, Actor.name can be different for every actor,
                 # resulting in leak if we use that.
-                _stats.increment(
-                    "%s message %s --[%s]-> %s" %
-                    ("ASYNC" if async else "BLOCKING",
-                     caller_name,
-                     method_name,
-                     self.__class__.__name__)
-                )
+                call_type = ("NOWAIT" if nowait else
+                             "ASYNC" if async else
+                             "BLOCKING")
+                stat_key = (call_type, caller_name, self.__class__)
+                stat_name = stat_names.get(stat_key)
+                if stat_name is None:
+                    stat_name = "%s message %s --[%s]-> %s" % (
+                        call_type,
+                        caller_name,
+                        method_name,
+                        self.__class__.__name__
+                    )
+                    stat_names[stat_key] = stat_name
+                _stats.increment(stat_name)
 
             # async must be specified, unless on the same actor.
-            assert async_set, "Cross-actor event calls must specify async arg."
+            assert async_set or nowait, ("Cross-actor event calls must "
+                                         "specify async or nowait arg.")
+            assert not (async_set and nowait), ("async and nowait are "
+                                                "mutually exclusive.")
 
             # Allocate a message ID.  We rely on there being no yield point
             # here for thread safety.
             global next_message_id
-            msg_id = "M%016x" % next_message_id
+            msg_idx = next_message_id
             if next_message_id == sys.maxint:
                 next_message_id = 0
             else:
                 next_message_id += 1
 
-            if not on_same_greenlet and not async:
-                _stats.increment("Blocking calls started")
-                _log.debug("BLOCKING CALL: [%s] %s -> %s", msg_id,
-                           calling_path, method_name)
-
-            # OK, so build the message and put it on the queue.
             partial = functools.partial(fn, self, *args, **kwargs)
-            result = TrackedAsyncResult((calling_path, caller,
-                                         self.name, method_name))
-            msg = Message(msg_id, partial, [result], caller, self.name,
-                          needs_own_batch=needs_own_batch)
-
+            if nowait:
+                # Fire-and-forget, skip the result tracking.
+                result = None
+                msg = NowaitMessage(msg_idx, partial, caller, self.name,
+                                    needs_own_batch=needs_own_batch)
+            else:
+                msg_id = "M%016x" % msg_idx
+                if not on_same_greenlet and not async:
+                    _stats.increment("Blocking calls started")
+                    _log.debug("BLOCKING CALL: [%s] %s -> %s", msg_id,
+                               calling_path, method_name)
+                result = TrackedAsyncResult((calling_path, caller,
+                                             self.name, method_name))
+                msg = Message(msg_id, partial, [result], caller, self.name,
+                              needs_own_batch=needs_own_batch)
+
+            if coalesce_key is not None:
+                # We rely on there being no yield point between here and
+                # putting the message on the queue.
+                key = (method_name, coalesce_key(*args, **kwargs))
+                msg.coalesce_key = key
+                old_msg = self._coalescable_msgs.get(key)
+                if old_msg is not None:
+                    _log.debug("Coalescing message %s into %s", old_msg, msg)
+                    old_msg.superseded = True
+                    if old_msg.results:
+                        msg.results = (list(old_msg.results) +
+                                       list(msg.results))
+                    _stats.increment("Messages coalesced")
+                    _stats.increment(coalesced_stat)
+                self._coalescable_msgs[key] = msg
+
+            # OK, so put the message on the queue.
             _log.debug("Message %s sent by %s to %s, queue length %d",
                        msg, caller, self.name, len(self._event_queue))
             self._event_queue.append(msg)
             self.maybe_schedule(caller)
-            if async:
+            if async or nowait:
                 return result
             else:
                 blocking_result = None
@@ -714,6 +889,22 @@ class TrackedAsyncResult(AsyncResult):
         return result
 
 
+def _on_unhandled_exception(msg, exception):
+    """
+    Called from the actor's greenlet when a message that was sent with
+    nowait=True fails.  Since no-one is waiting for the result, treat it
+    like a leaked exception: log it and die.
+
+    :param NowaitMessage msg: The message that failed.
+    :param exception: The exception that it raised.
+    """
+    _stats.increment("Unhandled nowait exceptions")
+    _log.critical("Message %s to %s from %s failed with exception %r but "
+                  "sender used nowait.  Dying.", msg, msg.recipient,
+                  msg.caller, exception)
+    _exit(1)
+
+
 # Factored out for UTs to stub.
 def _print_to_stderr(msg):
     print >> sys.stderr, msg
@@ -42,6 +42,9 @@ log = logging.getLogger(__name__)
 
 FELIX_IPT_GENERATOR_PLUGIN_NAME = "calico.felix.iptables_generator"
 
+# Supported values of the DataplaneBackend parameter.
+DATAPLANE_BACKENDS = ("iptables", "nftables")
+
 # Convert log level names into python log levels.
 LOGLEVELS = {"none":      None,
              "debug":     logging.DEBUG,
@@ -202,6 +205,13 @@ class Config(object):
         self.add_parameter("IptablesRefreshInterval",
                            "How often to refresh iptables state, in seconds",
                            60, value_is_int=True)
+        self.add_parameter("IptablesMaxTransactionLines",
+                           "Maximum number of lines to pass to a single "
+                           "iptables-restore call.  Larger updates are split "
+                           "into several transactions to limit how long "
+                           "the xtables lock is held.  Set to 0 for no "
+                           "limit.",
+                           10000, value_is_int=True)
         self.add_parameter("MetadataAddr", "Metadata IP address or hostname",
                            "127.0.0.1")
         self.add_parameter("MetadataPort", "Metadata Port",
@@ -249,12 +259,21 @@ class Config(object):
                            "to a value larger than the expected number of "
                            "IP addresses using a single tag.",
                            2**20, value_is_int=True)
+        self.add_parameter("RuleFragmentCacheSize",
+                           "Number of rendered policy rules that Felix caches "
+                           "to avoid regenerating them when a profile "
+                           "changes.  Set to 0 to disable the cache.",
+                           10000, value_is_int=True)
         self.add_parameter("IptablesMarkMask",
                            "Mask that Felix selects its IPTables Mark bits "
                            "from.  Should be a 32 bit hexadecimal number with "
                            "at least 8 bits set, none of which clash with any "
                            "other mark bits in use on the system.",
                            0xff000000, value_is_int=True)
+        self.add_parameter("DataplaneBackend",
+                           "Which dataplane backend to program policy "
+                           "with: \"iptables\" or \"nftables\".",
+                           "iptables")
 
         # The following setting determines which flavour of Iptables Generator
         # plugin is loaded.  Note: this plugin support is currently highly
@@ -324,6 +343,8 @@ class Config(object):
         self.RESYNC_INTERVAL = self.parameters["PeriodicResyncInterval"].value
         self.REFRESH_INTERVAL = \
             self.parameters["IptablesRefreshInterval"].value
+        self.MAX_IPTABLES_TXN_LINES = \
+            self.parameters["IptablesMaxTransactionLines"].value
         self.METADATA_IP = self.parameters["MetadataAddr"].value
         self.METADATA_PORT = self.parameters["MetadataPort"].value
         self.IFACE_PREFIX = self.parameters["InterfacePrefix"].value
@@ -345,10 +366,13 @@ class Config(object):
         self.ENDPOINT_REPORT_DELAY = \
             self.parameters["EndpointReportingDelaySecs"].value
         self.MAX_IPSET_SIZE = self.parameters["MaxIpsetSize"].value
+        self.RULE_FRAGMENT_CACHE_SIZE = \
+            self.parameters["RuleFragmentCacheSize"].value
         self.IPTABLES_GENERATOR_PLUGIN = \
             self.parameters["IptablesGeneratorPlugin"].value
         self.IPTABLES_MARK_MASK =\
             self.parameters["IptablesMarkMask"].value
+        self.DATAPLANE_BACKEND = self.parameters["DataplaneBackend"].value
 
         self._validate_cfg(final=final)
 
@@ -608,6 +632,10 @@ class Config(object):
                 self.parameters["DefaultEndpointToHostAction"]
             )
 
+        if self.DATAPLANE_BACKEND not in DATAPLANE_BACKENDS:
+            raise ConfigException("Invalid field value",
+                                  self.parameters["DataplaneBackend"])
+
         # For non-positive time values of reporting interval we set both
         # interval and ttl to 0 - i.e. status reporting is disabled.
         if self.REPORTING_INTERVAL_SECS <= 0:
@@ -626,10 +654,20 @@ class Config(object):
             log.warning("Endpoint status delay is negative, defaulting to 1.")
             self.ENDPOINT_REPORT_DELAY = 1
 
+        if self.MAX_IPTABLES_TXN_LINES < 0:
+            log.warning("Max iptables transaction size is negative, "
+                        "defaulting to 10000.")
+            self.MAX_IPTABLES_TXN_LINES = 10000
+
         if self.MAX_IPSET_SIZE <= 0:
             log.warning("Max ipset size is non-positive, defaulting to 2^20.")
             self.MAX_IPSET_SIZE = 2**20
 
+        if self.RULE_FRAGMENT_CACHE_SIZE < 0:
+            log.warning("Rule fragment cache size is negative, defaulting "
+                        "to 10000.")
+            self.RULE_FRAGMENT_CACHE_SIZE = 10000
+
         if self.IPTABLES_MARK_MASK <= 0:
             log.warning("Iptables mark mask contains insufficient bits, "
                         "defaulting to 0xff000000")
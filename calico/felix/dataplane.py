@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Metaswitch Networks
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""
+felix.dataplane
+~~~~~~~~~~~~~~~
+
+Selection of the dataplane backend, as configured by the DataplaneBackend
+parameter.  A backend creates the actors that program the dataplane; the
+rest of Felix is the same for all backends.
+"""
+import logging
+
+from calico.felix.dispatch import DispatchChains
+from calico.felix.fiptables import IptablesUpdater
+from calico.felix.ipsets import IpsetManager, Ipset, HOSTS_IPSET_V4
+from calico.felix.masq import MasqueradeManager
+from calico.felix.nftables import (
+    NftablesUpdater, NftablesDispatchChains, NftSet
+)
+
+_log = logging.getLogger(__name__)
+
+
+class DataplaneBackend(object):
+    """
+    Base class for dataplane backends.
+    """
+    name = None
+    updater_cls = None
+    dispatch_chains_cls = None
+    ipset_cls = None
+    # True if the backend uses kernel ipsets, which need the start-of-day
+    # ipset inventory.
+    uses_kernel_ipsets = False
+    # The set of IP addresses of the calico hosts, for IP-in-IP.
+    hosts_ipset_v4 = None
+
+    def create_updater(self, table, config, ip_version):
+        """
+        :returns a new actor to program the chains of the given table.
+        """
+        return self.updater_cls(table, ip_version=ip_version, config=config)
+
+    def create_dispatch_chains(self, config, ip_version, updater):
+        return self.dispatch_chains_cls(config, ip_version, updater)
+
+    def create_ipset_manager(self, ip_type, config):
+        return IpsetManager(ip_type, config, ipset_cls=self.ipset_cls)
+
+    def create_masq_manager(self, ip_type, nat_updater):
+        return MasqueradeManager(ip_type, nat_updater,
+                                 ipset_cls=self.ipset_cls)
+
+
+class IptablesBackend(DataplaneBackend):
+    """
+    The default backend: iptables chains and kernel ipsets.
+    """
+    name = "iptables"
+    updater_cls = IptablesUpdater
+    dispatch_chains_cls = DispatchChains
+    ipset_cls = Ipset
+    uses_kernel_ipsets = True
+    hosts_ipset_v4 = HOSTS_IPSET_V4
+
+
+class NftablesBackend(DataplaneBackend):
+    """
+    nftables backend, see the nftables module.
+    """
+    name = "nftables"
+    updater_cls = NftablesUpdater
+    dispatch_chains_cls = NftablesDispatchChains
+    ipset_cls = NftSet
+    hosts_ipset_v4 = NftSet(HOSTS_IPSET_V4.set_name,
+                            HOSTS_IPSET_V4.temp_set_name,
+                            "inet")
+
+
+BACKENDS = {
+    IptablesBackend.name: IptablesBackend,
+    NftablesBackend.name: NftablesBackend,
+}
+
+
+def load_backend(config):
+    """
+    :returns the DataplaneBackend configured by the DataplaneBackend
+             parameter, which has already been validated.
+    """
+    _log.info("Using the %s dataplane backend", config.DATAPLANE_BACKEND)
+    return BACKENDS[config.DATAPLANE_BACKEND]()
@@ -23,17 +23,31 @@ import re
 import os
 import socket
 import struct
+from collections import defaultdict
 
 from netaddr import IPAddress
 
 from calico import common
 from calico.felix.actor import Actor, actor_message
 from calico.felix import futils
-from calico.felix.futils import FailedSystemCall
+from calico.felix.futils import FailedSystemCall, RECONCILIATION_STATS
 
 # Logger
 _log = logging.getLogger(__name__)
 
+_route_inventory = {}
+"""
+Map from IP type to a dict that maps interface name to the set of IPs
+routed to that interface, as loaded at start of day by
+load_route_inventory().  Each interface's entry is used once, by
+set_routes(), and then replaced with None.
+"""
+_arp_inventory = {}
+"""
+Map from (interface name, IP) to the MAC address of the permanent ARP
+entry for that IP, as loaded at start of day by load_route_inventory().
+"""
+
 
 def configure_global_kernel_config():
     """
@@ -181,6 +195,78 @@ def list_interface_route_ips(ip_type, interface):
     return ips
 
 
+def load_route_inventory(ip_type):
+    """
+    Loads the routes to all interfaces (and, for IPv4, the permanent ARP
+    entries) with a single command so that, after a restart, the first
+    set_routes() call for each interface can calculate its changes
+    without listing the routes for that interface.
+
+    :param ip_type: Type of IP (IPV4 or IPV6)
+    :raises FailedSystemCall
+    """
+    ip_version = futils.IP_TYPE_TO_VERSION[ip_type]
+    ip_cmd = ["ip"] if ip_type == futils.IPV4 else ["ip", "-6"]
+    data = futils.check_call(ip_cmd + ["route", "list"]).stdout
+    ips_by_iface = defaultdict(set)
+    for line in data.split("\n"):
+        # Lines we care about look like this:
+        # "10.11.2.66 dev tap1234 proto static scope link"
+        words = line.split()
+        if ("dev" in words[1:-1] and
+                common.validate_ip_addr(words[0], ip_version)):
+            ips_by_iface[words[words.index("dev") + 1]].add(words[0])
+    _route_inventory[ip_type] = dict(ips_by_iface)
+
+    if ip_type == futils.IPV4:
+        data = futils.check_call(["ip", "neigh", "show",
+                                  "nud", "permanent"]).stdout
+        for line in data.split("\n"):
+            # "10.11.2.66 dev tap1234 lladdr 00:11:22:33:44:55 PERMANENT"
+            words = line.split()
+            if "dev" in words[1:-1] and "lladdr" in words[1:-1]:
+                iface = words[words.index("dev") + 1]
+                mac = words[words.index("lladdr") + 1]
+                _arp_inventory[(iface, words[0])] = mac.lower()
+    _log.info("Loaded %s routes to %s interfaces into inventory",
+              sum(len(ips) for ips in ips_by_iface.itervalues()),
+              len(ips_by_iface))
+
+
+def discard_route_inventory(interface=None):
+    """
+    Discards the route inventory loaded by load_route_inventory(), either
+    for a single interface or, once we're in sync, entirely.
+
+    :param str|NoneType interface: Interface name or None for all
+           interfaces.
+    """
+    if interface is None:
+        _route_inventory.clear()
+        _arp_inventory.clear()
+        return
+    for inventory in _route_inventory.itervalues():
+        if interface in inventory:
+            inventory[interface] = None
+    for iface, ip in _arp_inventory.keys():
+        if iface == interface:
+            del _arp_inventory[(iface, ip)]
+
+
+def _take_inventory_route_ips(ip_type, interface):
+    """
+    :returns the set of IPs routed to the interface according to the route
+             inventory, or None if the inventory isn't loaded or has already
+             been used for this interface.
+    """
+    inventory = _route_inventory.get(ip_type)
+    if inventory is None:
+        return None
+    ips = inventory.get(interface, set())
+    inventory[interface] = None
+    return ips
+
+
 def configure_interface_ipv4(if_name):
     """
     Configure the various proc file system parameters for the interface for
@@ -288,7 +374,11 @@ def set_routes(ip_type, ips, interface, mac=None, reset_arp=False):
     if reset_arp and ip_type != futils.IPV4:
         raise ValueError("reset_arp may only be supplied for IPv4")
 
-    current_ips = list_interface_route_ips(ip_type, interface)
+    current_ips = _take_inventory_route_ips(ip_type, interface)
+    if current_ips is None:
+        current_ips = list_interface_route_ips(ip_type, interface)
+    else:
+        RECONCILIATION_STATS.increment("Route listings avoided")
 
     removed_ips = (current_ips - ips)
     for ip in removed_ips:
@@ -297,6 +387,10 @@ def set_routes(ip_type, ips, interface, mac=None, reset_arp=False):
         add_route(ip_type, ip, interface, mac)
     if reset_arp:
         for ip in (ips & current_ips):
+            if _arp_inventory.pop((interface, ip), None) == mac.lower():
+                # Left behind by a previous run.
+                RECONCILIATION_STATS.increment("ARP updates avoided")
+                continue
             futils.check_call(['arp', '-s', ip, mac, '-i', interface])
 
 
@@ -462,7 +556,8 @@ class InterfaceWatcher(Actor):
                 if (ifname and
                         (msg_type == RTM_DELLINK or operstate != IF_OPER_UP)):
                     # The interface is down; make sure the other actors know
-                    # about it.
+                    # about it.  Its routes may have gone with it.
+                    discard_route_inventory(ifname)
                     self.update_splitter.on_interface_update(ifname,
                                                              iface_up=False)
                     # Remove any record we had of the interface so that, when
@@ -19,7 +19,9 @@ felix.endpoint
 
 Endpoint management.
 """
+import bisect
 from collections import OrderedDict
+import functools
 import logging
 
 from calico.calcollections import MultiDict
@@ -32,6 +34,7 @@ from calico.felix.actor import actor_message
 from calico.felix.futils import FailedSystemCall
 from calico.felix.futils import IPV4, IP_TYPE_TO_VERSION
 from calico.felix.labels import LabelValueIndex, LabelInheritanceIndex
+from calico.felix.policylists import PolicyListManager, policy_list_id
 from calico.felix.refcount import ReferenceManager, RefCountedActor, RefHelper
 from calico.felix.dispatch import DispatchChains
 from calico.felix.profilerules import RulesManager
@@ -39,12 +42,18 @@ from calico.felix.frules import interface_to_suffix
 
 _log = logging.getLogger(__name__)
 
+# Types of iptables update that a LocalEndpoint can have in flight.
+IPT_OP_PROGRAM = "program"
+IPT_OP_REMOVE = "remove"
+IPT_OP_REMOVE_AFTER_FAILURE = "remove-after-failure"
+
 
 class EndpointManager(ReferenceManager):
     def __init__(self, config, ip_type,
                  iptables_updater,
                  dispatch_chains,
                  rules_manager,
+                 policy_list_manager,
                  fip_manager,
                  status_reporter):
         super(EndpointManager, self).__init__(qualifier=ip_type)
@@ -58,6 +67,7 @@ class EndpointManager(ReferenceManager):
         self.iptables_updater = iptables_updater
         self.dispatch_chains = dispatch_chains
         self.rules_mgr = rules_manager
+        self.policy_list_mgr = policy_list_manager
         self.status_reporter = status_reporter
         self.fip_manager = fip_manager
 
@@ -78,13 +88,24 @@ class EndpointManager(ReferenceManager):
         # Tier orders by tier ID.  We use this to look up the order when we're
         # sorting the tiers.
         self.tier_orders = {}
-        # Cache of the current ordering of tier IDs.
-        self.tier_sequence = []
         # And their associated orders.
         self.profile_orders = {}
+        # IDs of the policies in each tier, by tier name.
+        self.pol_ids_by_tier = MultiDict()
+        # Sort key for each policy whose tier and policy orders are both
+        # known.  Orders by tier and then policy order, using the name of the
+        # tier and policy as a tie-breaker if the orders are the same.
+        self.pol_sort_keys = {}
+        # Global ordering of all the policies in pol_sort_keys; a sorted
+        # list of (sort key, policy ID) tuples.  Each endpoint's policies are
+        # a subset of this list, in the same order.
+        self.sorted_pols = []
         # Set of profile IDs to apply to each endpoint ID.
         self.pol_ids_by_ep_id = MultiDict()
         self.endpoints_with_dirty_policy = set()
+        # The tiered policy that we last sent to each endpoint, used to
+        # suppress no-op updates.
+        self._pols_by_tier_by_ep_id = {}
 
         self._data_model_in_sync = False
 
@@ -98,6 +119,7 @@ class EndpointManager(ReferenceManager):
                              self.iptables_updater,
                              self.dispatch_chains,
                              self.rules_mgr,
+                             self.policy_list_mgr,
                              self.fip_manager,
                              self.status_reporter)
 
@@ -123,16 +145,11 @@ class EndpointManager(ReferenceManager):
         else:
             del self.tier_orders[tier]
 
-        new_tier_sequence = sorted(self.tier_orders.iterkeys(),
-                                   key=lambda k: (self.tier_orders[k], k))
-        if self.tier_sequence != new_tier_sequence:
-            _log.info("Sequence of profile tiers changed, refreshing all "
-                      "endpoints")
-            self.tier_sequence = new_tier_sequence
-            self.endpoints_with_dirty_policy.update(
-                self.endpoints_by_id.keys()
-            )
-            self._update_dirty_policy()
+        # Only the endpoints that use a policy that has moved relative to
+        # the other policies need to be refreshed.
+        for pol_id in self.pol_ids_by_tier.iter_values(tier):
+            self._update_pol_sort_key(pol_id)
+        self._update_dirty_policy()
 
     @actor_message()
     def on_prof_labels_set(self, profile_id, labels):
@@ -152,22 +169,64 @@ class EndpointManager(ReferenceManager):
         # via on_policy_match_started and on_policy_match_stopped.
         self.policy_index.on_expression_update(policy_id,
                                                selector_or_none)
+        if selector_or_none is not None:
+            self.pol_ids_by_tier.add(policy_id.tier, policy_id)
+        else:
+            self.pol_ids_by_tier.discard(policy_id.tier, policy_id)
 
         # Before we update the policies, check if the order has changed,
-        # which would mean we need to refresh all endpoints with this policy
+        # which would mean we need to refresh the endpoints with this policy
         # too.
         if order_or_none != self.profile_orders.get(policy_id):
             if order_or_none is not None:
                 self.profile_orders[policy_id] = order_or_none
             else:
                 del self.profile_orders[policy_id]
-            self.endpoints_with_dirty_policy.update(
-                self.policy_index.matches_by_expr_id.iter_values(policy_id)
-            )
+            self._update_pol_sort_key(policy_id)
 
         # Finally, flush any updates to our waiting endpoints.
         self._update_dirty_policy()
 
+    def _update_pol_sort_key(self, pol_id):
+        """
+        Recalculates the sort key of the given policy after a change to its
+        order or the order of its tier, and moves it to its new position in
+        sorted_pols.
+
+        If the policy has moved relative to any other policy, or has been
+        added to or removed from the ordering, marks the endpoints that it
+        applies to as dirty.
+        """
+        old_key = self.pol_sort_keys.pop(pol_id, None)
+        tier_order = self.tier_orders.get(pol_id.tier)
+        pol_order = self.profile_orders.get(pol_id)
+        if tier_order is None or pol_order is None:
+            new_key = None
+        else:
+            new_key = (tier_order, pol_id.tier, pol_order, pol_id.policy_id)
+            self.pol_sort_keys[pol_id] = new_key
+        if new_key == old_key:
+            return
+        old_index = new_index = None
+        if old_key is not None:
+            old_index = bisect.bisect_left(self.sorted_pols,
+                                           (old_key, pol_id))
+            del self.sorted_pols[old_index]
+        if new_key is not None:
+            new_index = bisect.bisect_left(self.sorted_pols,
+                                           (new_key, pol_id))
+            self.sorted_pols.insert(new_index, (new_key, pol_id))
+        if old_index is None or new_index is None or old_index != new_index:
+            # The policy has moved past at least one other policy; its
+            # neighbours are different.
+            _log.debug("Position of policy %s changed", pol_id)
+            self.endpoints_with_dirty_policy.update(
+                self.policy_index.matches_by_expr_id.iter_values(pol_id)
+            )
+        else:
+            _log.debug("Order of policy %s changed but its position didn't",
+                       pol_id)
+
     def on_policy_match_started(self, expr_id, item_id):
         """Called by the label index when a new match is started.
 
@@ -196,6 +255,9 @@ class EndpointManager(ReferenceManager):
         """
         ep = self.endpoints_by_id.get(endpoint_id)
         obj.on_endpoint_update(ep, async=True)
+        # New actor, it needs to be told its policy even if it's the same as
+        # we sent to any previous incarnation.
+        self._pols_by_tier_by_ep_id.pop(endpoint_id, None)
         self._update_tiered_policy(endpoint_id)
 
     @actor_message()
@@ -225,7 +287,11 @@ class EndpointManager(ReferenceManager):
                         nat_maps[ep_id] = nat_map
             self.fip_manager.apply_snapshot(nat_maps, async=True)
 
-    @actor_message()
+    # Only the latest queued update for each endpoint matters.
+    @actor_message(
+        coalesce_key=lambda endpoint_id, endpoint, force_reprogram=False:
+            (endpoint_id, force_reprogram)
+    )
     def on_endpoint_update(self, endpoint_id, endpoint, force_reprogram=False):
         """
         Event to indicate that an endpoint has been updated (including
@@ -238,7 +304,25 @@ class EndpointManager(ReferenceManager):
         if endpoint_id.host != self.config.HOSTNAME:
             _log.debug("Skipping endpoint %s; not on our host.", endpoint_id)
             return
+        self._on_local_endpoint_update(endpoint_id, endpoint,
+                                       force_reprogram=force_reprogram)
+        self._update_dirty_policy()
+
+    @actor_message()
+    def on_local_endpoint_updates(self, updates):
+        """
+        Batched version of on_endpoint_update(), for endpoints that the
+        caller has already checked are on our host.
 
+        :param updates: list of (EndpointId, endpoint dict or None) tuples,
+               in order.
+        """
+        for endpoint_id, endpoint in updates:
+            self._on_local_endpoint_update(endpoint_id, endpoint)
+        self._update_dirty_policy()
+
+    def _on_local_endpoint_update(self, endpoint_id, endpoint,
+                                  force_reprogram=False):
         if self._is_starting_or_live(endpoint_id):
             # Local endpoint thread is running; tell it of the change.
             _log.info("Update for live endpoint %s", endpoint_id)
@@ -258,6 +342,7 @@ class EndpointManager(ReferenceManager):
                 self.local_endpoint_ids.remove(endpoint_id)
                 self._label_inherit_idx.on_item_update(endpoint_id, None, None)
                 assert endpoint_id not in self.pol_ids_by_ep_id
+                self._pols_by_tier_by_ep_id.pop(endpoint_id, None)
         else:
             # Creation or modification
             _log.info("Endpoint %s modified or created", endpoint_id)
@@ -275,8 +360,6 @@ class EndpointManager(ReferenceManager):
                 endpoint.get("profile_ids", [])
             )
 
-        self._update_dirty_policy()
-
     @actor_message()
     def on_interface_update(self, name, iface_up):
         """
@@ -311,33 +394,35 @@ class EndpointManager(ReferenceManager):
 
     def _update_tiered_policy(self, ep_id):
         """
-        Sends an updated list of tiered policy to an endpoint.
+        Sends an updated list of tiered policy to an endpoint, if it has
+        changed since the last update.
 
         Recalculates the list.
         :param ep_id: ID of the endpoint to send an update to.
         """
         _log.debug("Updating policies for %s from %s", ep_id,
                    self.pol_ids_by_ep_id)
-        # Order the profiles by tier and profile order, using the name of the
-        # tier and profile as a tie-breaker if the orders are the same.
-        profiles = []
+        # Pick out the endpoint's entries from the global ordering.  Looking
+        # up the sort keys is equivalent to filtering sorted_pols but it
+        # scales with the number of policies that apply to the endpoint
+        # rather than the total number of policies.
+        pols = []
         for pol_id in self.pol_ids_by_ep_id.iter_values(ep_id):
             try:
-                tier_order = self.tier_orders[pol_id.tier]
+                pols.append((self.pol_sort_keys[pol_id], pol_id))
             except KeyError:
-                _log.warn("Ignoring profile %s because its tier metadata is "
-                          "missing.")
-                continue
-            profile_order = self.profile_orders[pol_id]
-            profiles.append((tier_order, pol_id.tier,
-                             profile_order, pol_id.policy_id,
-                             pol_id))
-        profiles.sort()
+                _log.warn("Ignoring policy %s because its tier metadata is "
+                          "missing.", pol_id)
+        pols.sort()
         # Convert to an ordered dict from tier to list of profiles.
         pols_by_tier = OrderedDict()
-        for _, tier, _, _, pol_id in profiles:
-            pols_by_tier.setdefault(tier, []).append(pol_id)
+        for _, pol_id in pols:
+            pols_by_tier.setdefault(pol_id.tier, []).append(pol_id)
 
+        if self._pols_by_tier_by_ep_id.get(ep_id) == pols_by_tier:
+            _log.debug("Tiered policy for %s unchanged", ep_id)
+            return
+        self._pols_by_tier_by_ep_id[ep_id] = pols_by_tier
         endpoint = self.objects_by_id[ep_id]
         endpoint.on_tiered_policy_update(pols_by_tier, async=True)
 
@@ -345,7 +430,8 @@ class EndpointManager(ReferenceManager):
 class LocalEndpoint(RefCountedActor):
 
     def __init__(self, config, combined_id, ip_type, iptables_updater,
-                 dispatch_chains, rules_manager, fip_manager, status_reporter):
+                 dispatch_chains, rules_manager, policy_list_manager,
+                 fip_manager, status_reporter):
         """
         Controls a single local endpoint.
 
@@ -354,12 +440,14 @@ class LocalEndpoint(RefCountedActor):
         :param iptables_updater: IptablesUpdater to use
         :param dispatch_chains: DispatchChains to use
         :param rules_manager: RulesManager to use
+        :param policy_list_manager: PolicyListManager to use
         :param fip_manager: FloatingIPManager to use
         """
         super(LocalEndpoint, self).__init__(qualifier="%s(%s)" %
                                             (combined_id.endpoint, ip_type))
         assert isinstance(dispatch_chains, DispatchChains)
         assert isinstance(rules_manager, RulesManager)
+        assert isinstance(policy_list_manager, PolicyListManager)
 
         self.config = config
         self.iptables_generator = config.plugins["iptables_generator"]
@@ -377,6 +465,11 @@ class LocalEndpoint(RefCountedActor):
         # Helper for acquiring/releasing profiles.
         self._rules_ref_helper = RefHelper(self, rules_manager,
                                            self._on_profiles_ready)
+        # Helper for acquiring/releasing the policy list that our chains
+        # jump to.  Unlike profiles, we hold on to the policy list until
+        # our chains stop referencing it.
+        self._pol_list_ref_helper = RefHelper(self, policy_list_manager,
+                                              self._on_policy_list_ready)
 
         # List of global policies that we care about.
         self._pol_ids_by_tier = OrderedDict()
@@ -403,6 +496,14 @@ class LocalEndpoint(RefCountedActor):
         # Track the success/failure of our dataplane programming.
         self._chains_programmed = False
         self._iptables_in_sync = False
+        # Set while we're waiting for the IptablesUpdater to call us back.
+        self._iptables_in_flight = False
+        # Set if our last iptables update failed, we wait for another update
+        # before retrying.
+        self._iptables_failed = False
+        # Number of iptables completion callbacks received in the current
+        # batch; reset at the end of each batch.
+        self._ipt_callbacks_in_batch = 0
         self._device_in_sync = False
         self._profile_ids_dirty = False
 
@@ -511,9 +612,22 @@ class LocalEndpoint(RefCountedActor):
             _log.debug("Profile references need updating")
             self._update_profile_references()
 
-        if not self._iptables_in_sync:
-            # Try to update iptables, if successful, will set the
-            # _iptables_in_sync flag.
+        # Batches that only contain iptables callbacks shouldn't retry
+        # failed iptables updates, otherwise we'd spin on a persistent
+        # failure.  Wait for the next update instead.
+        callbacks_only = self._ipt_callbacks_in_batch == len(batch)
+        self._ipt_callbacks_in_batch = 0
+
+        if self._iptables_in_flight:
+            # Only keep one update in flight at a time; the callback will
+            # trigger another batch.
+            _log.debug("Waiting for in-flight iptables update")
+        elif self._iptables_failed and callbacks_only:
+            _log.debug("Previous iptables update failed, waiting for next "
+                       "update.")
+        elif not self._iptables_in_sync:
+            # Try to update iptables, once it's in flight, we'll set the
+            # _iptables_in_sync flag.  The callback clears it on failure.
             _log.debug("iptables is out-of-sync, trying to update it")
             if self._admin_up:
                 _log.info("%s is 'active', (re)programming chains.", self)
@@ -541,12 +655,16 @@ class LocalEndpoint(RefCountedActor):
             _log.debug("Some IPs were removed, cleaning up conntrack")
             self._clean_up_conntrack_entries()
 
-        if self._unreferenced:
+        if self._unreferenced and self._iptables_in_flight:
+            # Wait for our chains to be removed before we clean up.
+            _log.debug("Unreferenced but waiting for iptables update")
+        elif self._unreferenced:
             # Endpoint is being removed, clean up...
             _log.debug("Cleaning up after endpoint unreferenced")
             self.dispatch_chains.on_endpoint_removed(self._iface_name,
                                                      async=True)
             self._rules_ref_helper.discard_all()
+            self._pol_list_ref_helper.discard_all()
             self._notify_cleanup_complete()
             self._cleaned_up = True
         elif not self._added_to_dispatch_chains and self._iface_name:
@@ -556,8 +674,9 @@ class LocalEndpoint(RefCountedActor):
                                                    async=True)
             self._added_to_dispatch_chains = True
 
-        # If changed, report our status back to the datastore.
-        self._maybe_update_status()
+        if not self._iptables_in_flight:
+            # If changed, report our status back to the datastore.
+            self._maybe_update_status()
 
     def _maybe_update_status(self):
         if not self.config.REPORT_ENDPOINT_STATUS:
@@ -719,6 +838,11 @@ class LocalEndpoint(RefCountedActor):
         self._profile_ids_dirty = False
 
     def _update_chains(self):
+        """
+        Queues an update of our chains with the IptablesUpdater.  Doesn't
+        wait for the update to complete; _on_iptables_update_complete() is
+        called once it has been applied.
+        """
         updates, deps = self.iptables_generator.endpoint_updates(
             IP_TYPE_TO_VERSION[self.ip_type],
             self.combined_id.endpoint,
@@ -726,40 +850,89 @@ class LocalEndpoint(RefCountedActor):
             self._mac,
             self.endpoint["profile_ids"],
             self._pol_ids_by_tier)
-        try:
-            self.iptables_updater.rewrite_chains(updates, deps, async=False)
-            self.fip_manager.update_endpoint(
-                self.combined_id,
-                self.endpoint.get(self.nat_key, None),
-                async=True
-            )
-        except FailedSystemCall:
-            _log.exception("Failed to program chains for %s. Removing.", self)
-            try:
-                self.iptables_updater.delete_chains(
-                    self.iptables_generator.endpoint_chain_names(self._suffix),
-                    async=False)
-                self.fip_manager.update_endpoint(self.combined_id, None,
-                                                 async=True)
-            except FailedSystemCall:
-                _log.exception("Failed to remove chains after original "
-                               "failure")
+        # Make sure the policy list that our chains jump to exists.  As with
+        # profiles, we don't need to wait for it.
+        pol_list_id = policy_list_id(self._pol_ids_by_tier,
+                                     self.endpoint["profile_ids"])
+        self._pol_list_ref_helper.acquire_ref(pol_list_id)
+        self._start_iptables_update()
+        self.iptables_updater.rewrite_chains(
+            updates, deps,
+            callback=self._iptables_callback(
+                IPT_OP_PROGRAM, self.endpoint.get(self.nat_key, None),
+                pol_list_id
+            ),
+            nowait=True)
+
+    def _remove_chains(self, op=None):
+        """
+        Queues the removal of our chains.
+
+        :param op: IPT_OP_REMOVE_AFTER_FAILURE if we're cleaning up after a
+               failed update, otherwise IPT_OP_REMOVE.
+        """
+        if op is None:
+            op = IPT_OP_REMOVE
+            self._start_iptables_update()
         else:
-            self._iptables_in_sync = True
-            self._chains_programmed = True
+            self._iptables_in_flight = True
+        self.iptables_updater.delete_chains(
+            self.iptables_generator.endpoint_chain_names(self._suffix),
+            callback=self._iptables_callback(op, None, None),
+            nowait=True)
+
+    def _start_iptables_update(self):
+        # We're about to bring iptables in sync; if anything changes while
+        # the update is in flight, this flag will be cleared again.
+        self._iptables_in_flight = True
+        self._iptables_in_sync = True
+        self._iptables_failed = False
+
+    def _iptables_callback(self, op, nat_maps, pol_list_id):
+        return functools.partial(self._on_iptables_update_complete, op,
+                                 nat_maps, pol_list_id, nowait=True)
 
-    def _remove_chains(self):
-        try:
-            self.iptables_updater.delete_chains(
-                self.iptables_generator.endpoint_chain_names(self._suffix),
-                async=False)
+    @actor_message()
+    def _on_iptables_update_complete(self, op, nat_maps, pol_list_id, error):
+        """
+        Callback from the IptablesUpdater once an update to our chains has
+        been applied (or has failed).
+
+        :param op: One of the IPT_OP_* constants, the type of update.
+        :param nat_maps: the NAT mappings of the endpoint that we
+               programmed, None if we removed our chains.
+        :param pol_list_id: the ID of the policy list that the chains we
+               programmed jump to, None if we removed our chains.
+        :param error: None on success, or the exception that caused the
+               update to fail.
+        """
+        self._iptables_in_flight = False
+        self._ipt_callbacks_in_batch += 1
+        if error is not None:
+            self._iptables_in_sync = False
+            self._iptables_failed = True
+        if op == IPT_OP_PROGRAM:
+            if error is None:
+                self._chains_programmed = True
+                # Our chains no longer reference any other policy list.
+                self._pol_list_ref_helper.replace_all(set([pol_list_id]))
+                self.fip_manager.update_endpoint(self.combined_id, nat_maps,
+                                                 async=True)
+            else:
+                _log.error("Failed to program chains for %s: %r. Removing.",
+                           self, error)
+                self._remove_chains(IPT_OP_REMOVE_AFTER_FAILURE)
+        elif error is None:
+            if op == IPT_OP_REMOVE:
+                self._chains_programmed = False
+            self._pol_list_ref_helper.discard_all()
             self.fip_manager.update_endpoint(self.combined_id, None,
                                              async=True)
-        except FailedSystemCall:
-            _log.exception("Failed to delete chains for %s", self)
+        elif op == IPT_OP_REMOVE:
+            _log.error("Failed to delete chains for %s: %r", self, error)
         else:
-            self._iptables_in_sync = True
-            self._chains_programmed = False
+            _log.error("Failed to remove chains for %s after original "
+                       "failure: %r", self, error)
 
     def _configure_interface(self):
         """
@@ -845,6 +1018,9 @@ class LocalEndpoint(RefCountedActor):
         _log.info("Endpoint %s acquired all required profile references",
                   self.combined_id)
 
+    def _on_policy_list_ready(self):
+        _log.debug("Endpoint %s acquired its policy list", self.combined_id)
+
     def __str__(self):
         return ("LocalEndpoint<%s,id=%s,iface=%s>" %
                 (self.ip_type, self.combined_id,
@@ -35,17 +35,16 @@ import gevent
 from calico import common
 from calico.felix import devices
 from calico.felix import futils
-from calico.felix.fiptables import IptablesUpdater
-from calico.felix.dispatch import DispatchChains
 from calico.felix.profilerules import RulesManager
+from calico.felix.policylists import PolicyListManager
 from calico.felix.frules import install_global_rules, load_nf_conntrack
 from calico.felix.splitter import UpdateSplitter, CleanupManager
 from calico.felix.config import Config
-from calico.felix.futils import IPV4, IPV6
+from calico.felix.dataplane import load_backend
+from calico.felix.futils import IPV4, IPV6, FailedSystemCall
 from calico.felix.devices import InterfaceWatcher
 from calico.felix.endpoint import EndpointManager
-from calico.felix.ipsets import IpsetManager, IpsetActor, HOSTS_IPSET_V4
-from calico.felix.masq import MasqueradeManager
+from calico.felix.ipsets import IpsetActor, IPSET_INVENTORY
 from calico.felix.fipmanager import FloatingIPManager
 from calico.felix.fetcd import EtcdAPI
 
@@ -59,7 +58,8 @@ def _main_greenlet(config):
     """
     try:
         _log.info("Connecting to etcd to get our configuration.")
-        hosts_ipset_v4 = IpsetActor(HOSTS_IPSET_V4)
+        backend = load_backend(config)
+        hosts_ipset_v4 = IpsetActor(backend.hosts_ipset_v4)
 
         etcd_api = EtcdAPI(config, hosts_ipset_v4)
         etcd_api.start()
@@ -72,24 +72,38 @@ def _main_greenlet(config):
         # Calico.
         devices.configure_global_kernel_config()
 
+        # Load the existing ipsets with a single "ipset save" so that the
+        # ipset actors can skip existence checks and update existing sets in
+        # place.
+        if backend.uses_kernel_ipsets:
+            try:
+                IPSET_INVENTORY.refresh()
+            except FailedSystemCall:
+                _log.exception("Failed to load ipset inventory, ipsets will "
+                               "be checked individually.")
+
         _log.info("Main greenlet: Configuration loaded, starting remaining "
                   "actors...")
-        v4_filter_updater = IptablesUpdater("filter", ip_version=4,
-                                            config=config)
-        v4_nat_updater = IptablesUpdater("nat", ip_version=4, config=config)
-        v4_ipset_mgr = IpsetManager(IPV4, config)
-        v4_masq_manager = MasqueradeManager(IPV4, v4_nat_updater)
+        v4_filter_updater = backend.create_updater("filter", config, 4)
+        v4_nat_updater = backend.create_updater("nat", config, 4)
+        v4_ipset_mgr = backend.create_ipset_manager(IPV4, config)
+        v4_masq_manager = backend.create_masq_manager(IPV4, v4_nat_updater)
         v4_rules_manager = RulesManager(config,
                                         4,
                                         v4_filter_updater,
                                         v4_ipset_mgr)
-        v4_dispatch_chains = DispatchChains(config, 4, v4_filter_updater)
+        v4_pol_list_manager = PolicyListManager(config, 4,
+                                                v4_filter_updater)
+        v4_dispatch_chains = backend.create_dispatch_chains(
+            config, 4, v4_filter_updater
+        )
         v4_fip_manager = FloatingIPManager(config, 4, v4_nat_updater)
         v4_ep_manager = EndpointManager(config,
                                         IPV4,
                                         v4_filter_updater,
                                         v4_dispatch_chains,
                                         v4_rules_manager,
+                                        v4_pol_list_manager,
                                         v4_fip_manager,
                                         etcd_api.status_reporter)
 
@@ -103,22 +117,26 @@ def _main_greenlet(config):
 
         v6_enabled = os.path.exists("/proc/sys/net/ipv6")
         if v6_enabled:
-            v6_raw_updater = IptablesUpdater("raw", ip_version=6, config=config)
-            v6_filter_updater = IptablesUpdater("filter", ip_version=6,
-                                                config=config)
-            v6_nat_updater = IptablesUpdater("nat", ip_version=6, config=config)
-            v6_ipset_mgr = IpsetManager(IPV6, config)
+            v6_raw_updater = backend.create_updater("raw", config, 6)
+            v6_filter_updater = backend.create_updater("filter", config, 6)
+            v6_nat_updater = backend.create_updater("nat", config, 6)
+            v6_ipset_mgr = backend.create_ipset_manager(IPV6, config)
             v6_rules_manager = RulesManager(config,
                                             6,
                                             v6_filter_updater,
                                             v6_ipset_mgr)
-            v6_dispatch_chains = DispatchChains(config, 6, v6_filter_updater)
+            v6_pol_list_manager = PolicyListManager(config, 6,
+                                                    v6_filter_updater)
+            v6_dispatch_chains = backend.create_dispatch_chains(
+                config, 6, v6_filter_updater
+            )
             v6_fip_manager = FloatingIPManager(config, 6, v6_nat_updater)
             v6_ep_manager = EndpointManager(config,
                                             IPV6,
                                             v6_filter_updater,
                                             v6_dispatch_chains,
                                             v6_rules_manager,
+                                            v6_pol_list_manager,
                                             v6_fip_manager,
                                             etcd_api.status_reporter)
             cleanup_updaters.append(v6_filter_updater)
@@ -131,9 +149,20 @@ def _main_greenlet(config):
 
         cleanup_mgr = CleanupManager(config, cleanup_updaters, cleanup_ip_mgrs)
         update_splitter_args.append(cleanup_mgr)
-        update_splitter = UpdateSplitter(update_splitter_args)
+        update_splitter = UpdateSplitter(update_splitter_args,
+                                         config.HOSTNAME)
         iface_watcher = InterfaceWatcher(update_splitter)
 
+        # Similarly, load the existing routes so that the endpoints can
+        # calculate their route changes without listing the routes for each
+        # interface.
+        for ip_type in ([IPV4, IPV6] if v6_enabled else [IPV4]):
+            try:
+                devices.load_route_inventory(ip_type)
+            except FailedSystemCall:
+                _log.exception("Failed to load %s route inventory, routes "
+                               "will be checked individually.", ip_type)
+
         _log.info("Starting actors.")
         hosts_ipset_v4.start()
         cleanup_mgr.start()
@@ -143,6 +172,7 @@ def _main_greenlet(config):
         v4_ipset_mgr.start()
         v4_masq_manager.start()
         v4_rules_manager.start()
+        v4_pol_list_manager.start()
         v4_dispatch_chains.start()
         v4_ep_manager.start()
         v4_fip_manager.start()
@@ -153,6 +183,7 @@ def _main_greenlet(config):
             v6_ipset_mgr.start()
             v6_nat_updater.start()
             v6_rules_manager.start()
+            v6_pol_list_manager.start()
             v6_dispatch_chains.start()
             v6_ep_manager.start()
             v6_fip_manager.start()
@@ -168,6 +199,7 @@ def _main_greenlet(config):
             v4_ipset_mgr,
             v4_masq_manager,
             v4_rules_manager,
+            v4_pol_list_manager,
             v4_dispatch_chains,
             v4_ep_manager,
             v4_fip_manager,
@@ -183,6 +215,7 @@ def _main_greenlet(config):
                 v6_nat_updater,
                 v6_ipset_mgr,
                 v6_rules_manager,
+                v6_pol_list_manager,
                 v6_dispatch_chains,
                 v6_ep_manager,
                 v6_fip_manager,
@@ -199,7 +232,8 @@ def _main_greenlet(config):
         # Install the global rules before we start polling for updates.
         _log.info("Installing global rules.")
         install_global_rules(config, v4_filter_updater, v4_nat_updater,
-                             ip_version=4)
+                             ip_version=4,
+                             hosts_ipset=backend.hosts_ipset_v4)
         if v6_enabled:
             install_global_rules(config, v6_filter_updater, v6_nat_updater,
                                  ip_version=6, raw_updater=v6_raw_updater)
@@ -384,6 +384,9 @@ class _FelixEtcdWatcher(gevent.Greenlet):
                 # whole for loop must be inside the try.
                 for msg_type, msg in self._msg_reader.new_messages(timeout=1):
                     self._dispatch_msg_from_driver(msg_type, msg)
+                # The splitter buffers endpoint updates, send them on now
+                # that we've processed this chunk of messages.
+                self._flush_splitter()
             except SocketClosed:
                 _log.critical("The driver process closed its socket, Felix "
                               "must exit.")
@@ -421,8 +424,13 @@ class _FelixEtcdWatcher(gevent.Greenlet):
             # yields for us if the socket would block.)  The sleep must be
             # non-zero to work around gevent issue where we could be
             # immediately rescheduled.
+            self._flush_splitter()
             gevent.sleep(0.000001)
 
+    def _flush_splitter(self):
+        if self.splitter is not None:
+            self.splitter.flush()
+
     def _on_update_from_driver(self, msg):
         """
         Called when the driver sends us a key/value pair update.
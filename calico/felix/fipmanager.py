@@ -17,13 +17,22 @@ felix.fipmanager
 ~~~~~~~~~~~~~~~~
 
 Actor that controls floating IP entries in the nat iptables table.
+
+Endpoints are spread over NUM_FIP_BUCKETS pairs of DNAT/SNAT sub-chains by
+a hash of their ID.  The top-level floating IP chains just jump to the
+non-empty buckets so an update to one endpoint only rewrites that
+endpoint's bucket (and the top-level chains if the bucket becomes empty
+or non-empty).
 """
+import hashlib
 import logging
 from calico.felix.frules import CHAIN_FIP_DNAT, CHAIN_FIP_SNAT
 from calico.felix.actor import Actor, actor_message
 
 _log = logging.getLogger(__name__)
 
+NUM_FIP_BUCKETS = 64
+
 
 class FloatingIPManager(Actor):
     def __init__(self, config, ip_version, iptables_updater):
@@ -31,8 +40,12 @@ class FloatingIPManager(Actor):
         self.config = config
         self.ip_version = ip_version
         self.iptables_updater = iptables_updater
-        self._dirty = False
         self._maps = dict()
+        # Buckets that need to be rewritten at the end of the batch.
+        self._dirty_buckets = set()
+        # Buckets that the top-level chains currently jump to.  The
+        # top-level chains start out empty, see frules.install_global_rules().
+        self._programmed_buckets = set()
 
     @actor_message()
     def apply_snapshot(self, nat_maps):
@@ -43,8 +56,10 @@ class FloatingIPManager(Actor):
         """
 
         _log.info("Applying floating IP NAT map snapshot.")
+        for endpoint_id in set(self._maps) | set(nat_maps):
+            if self._maps.get(endpoint_id) != nat_maps.get(endpoint_id):
+                self._dirty_buckets.add(_bucket(endpoint_id))
         self._maps = dict(nat_maps) # Make a copy.
-        self._dirty = True
 
     @actor_message()
     def update_endpoint(self, endpoint_id, nat_maps):
@@ -63,55 +78,115 @@ class FloatingIPManager(Actor):
         old_entry = self._maps.get(endpoint_id, None)
         if nat_maps and old_entry != nat_maps:
             self._maps[endpoint_id] = nat_maps
-            self._dirty = True
+            self._dirty_buckets.add(_bucket(endpoint_id))
         elif not nat_maps and old_entry:
             self._maps.pop(endpoint_id)
-            self._dirty = True
+            self._dirty_buckets.add(_bucket(endpoint_id))
 
     def _finish_msg_batch(self, _batch, _results):
-        if self._dirty:
-            _log.debug('Floating IP mappings have changed, refreshing.')
+        if self._dirty_buckets:
+            _log.debug('Floating IP mappings have changed in buckets %s, '
+                       'refreshing.', self._dirty_buckets)
             self._reprogram_chains()
-            self._dirty = False
+            self._dirty_buckets = set()
 
     def _reprogram_chains(self):
-        dnat = []
-        snat = []
-        reverse_maps = []
-        # Since we don't use ordered dicts, sort to make sure each call with
-        # the same data results in the same IP being used for the SNAT.
-        for nat_maps in sorted(self._maps.values()):
-            for nat_map in nat_maps:
-                dnat.append('--append %s -d %s -j DNAT --to-destination %s' %
-                            (CHAIN_FIP_DNAT, nat_map['ext_ip'],
-                             nat_map['int_ip']))
-                if not nat_map['int_ip'] in reverse_maps:
-                    # In order for an endpoint to be able to connect to its
-                    # own floating IP, we have to do an SNAT.  Otherwise the
-                    # endpoint would get a packet from outside itself claiming
-                    # to be from itself, and generally drop it as invalid.
-                    #
-                    # If we do not take into account access control lists,
-                    # really any IP that's not assigned to the endpoint should
-                    # work for an SNAT address.  However, to try and make
-                    # things be less confusing, we choose one of the floating
-                    # IPs assigned to the endpoint.  If the endpoint has more
-                    # than one floating IP assigned to it, then connections to
-                    # floating IP #2 from the VM will end up having a source
-                    # of floating IP #1 when they come back to the endpoint.
-                    # In the general case, this should be fine as ACL
-                    # processing happens before the SNAT translation.  It would
-                    # technically be possible to always do a full source/dest
-                    # swap by utilizing packet marking, but doing so would make
-                    # the code much more complicated and create another
-                    # iptables rule per floating IP.
-                    snat.append('--append %s -s %s -d %s -j SNAT '
-                                '--to-source %s' % (CHAIN_FIP_SNAT,
-                                                    nat_map['int_ip'],
-                                                    nat_map['int_ip'],
-                                                    nat_map['ext_ip']))
-                    reverse_maps.append(nat_map['int_ip'])
-
-        self.iptables_updater.rewrite_chains({CHAIN_FIP_DNAT: dnat,
-                                              CHAIN_FIP_SNAT: snat}, {},
-                                             async=True)
+        maps_by_bucket = {}
+        for endpoint_id, nat_maps in self._maps.iteritems():
+            bucket = _bucket(endpoint_id)
+            if bucket in self._dirty_buckets:
+                maps_by_bucket.setdefault(bucket, []).append(nat_maps)
+
+        updates = {}
+        deps = {}
+        for bucket, bucket_maps in maps_by_bucket.iteritems():
+            dnat_chain = _bucket_chain(CHAIN_FIP_DNAT, bucket)
+            snat_chain = _bucket_chain(CHAIN_FIP_SNAT, bucket)
+            updates[dnat_chain], updates[snat_chain] = _bucket_rules(
+                dnat_chain, snat_chain, bucket_maps
+            )
+
+        # Only the top-level chains need to change if a bucket has become
+        # empty or non-empty.
+        buckets = ((self._programmed_buckets - self._dirty_buckets) |
+                   set(maps_by_bucket))
+        if buckets != self._programmed_buckets:
+            for chain in (CHAIN_FIP_DNAT, CHAIN_FIP_SNAT):
+                bucket_chains = [_bucket_chain(chain, b)
+                                 for b in sorted(buckets)]
+                updates[chain] = ['--append %s --jump %s' % (chain, c)
+                                  for c in bucket_chains]
+                deps[chain] = set(bucket_chains)
+
+        if updates:
+            self.iptables_updater.rewrite_chains(updates, deps, async=True)
+        emptied = self._programmed_buckets - buckets
+        if emptied:
+            self.iptables_updater.delete_chains(
+                [_bucket_chain(chain, b)
+                 for b in sorted(emptied)
+                 for chain in (CHAIN_FIP_DNAT, CHAIN_FIP_SNAT)],
+                async=True
+            )
+        self._programmed_buckets = buckets
+
+
+def _bucket_rules(dnat_chain, snat_chain, bucket_maps):
+    """
+    :returns tuple of the DNAT and SNAT chain updates for the given
+             list of the NAT maps of the endpoints in a bucket.
+    """
+    dnat = []
+    snat = []
+    reverse_maps = []
+    # Since we don't use ordered dicts, sort to make sure each call with
+    # the same data results in the same IP being used for the SNAT.
+    for nat_maps in sorted(bucket_maps):
+        for nat_map in nat_maps:
+            dnat.append('--append %s -d %s -j DNAT --to-destination %s' %
+                        (dnat_chain, nat_map['ext_ip'],
+                         nat_map['int_ip']))
+            if not nat_map['int_ip'] in reverse_maps:
+                # In order for an endpoint to be able to connect to its
+                # own floating IP, we have to do an SNAT.  Otherwise the
+                # endpoint would get a packet from outside itself claiming
+                # to be from itself, and generally drop it as invalid.
+                #
+                # If we do not take into account access control lists,
+                # really any IP that's not assigned to the endpoint should
+                # work for an SNAT address.  However, to try and make
+                # things be less confusing, we choose one of the floating
+                # IPs assigned to the endpoint.  If the endpoint has more
+                # than one floating IP assigned to it, then connections to
+                # floating IP #2 from the VM will end up having a source
+                # of floating IP #1 when they come back to the endpoint.
+                # In the general case, this should be fine as ACL
+                # processing happens before the SNAT translation.  It would
+                # technically be possible to always do a full source/dest
+                # swap by utilizing packet marking, but doing so would make
+                # the code much more complicated and create another
+                # iptables rule per floating IP.
+                snat.append('--append %s -s %s -d %s -j SNAT '
+                            '--to-source %s' % (snat_chain,
+                                                nat_map['int_ip'],
+                                                nat_map['int_ip'],
+                                                nat_map['ext_ip']))
+                reverse_maps.append(nat_map['int_ip'])
+    return dnat, snat
+
+
+def _bucket(endpoint_id):
+    """
+    :returns the bucket for the given endpoint.  Stable across restarts so
+             that the chains can be adopted after a restart.
+    """
+    digest = hashlib.sha1(repr(endpoint_id)).hexdigest()
+    return int(digest[:8], 16) % NUM_FIP_BUCKETS
+
+
+def _bucket_chain(chain, bucket):
+    """
+    :returns the name of the sub-chain of the given top-level chain for the
+             given bucket.
+    """
+    return "%s-%02d" % (chain, bucket)
@@ -18,8 +18,9 @@ felix.fiptables
 
 IP tables management functions.
 """
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 import copy
+import hashlib
 import logging
 import random
 import time
@@ -32,16 +33,20 @@ import sys
 
 from calico.felix import futils
 from calico.felix.actor import (
-    Actor, actor_message, ResultOrExc, SplitBatchAndRetry
+    Actor, actor_message, ResultOrExc, SplitBatchAndRetry, RetryWithoutMessage
 )
 from calico.felix.frules import FELIX_PREFIX
-from calico.felix.futils import FailedSystemCall, StatCounter
+from calico.felix.futils import (
+    FailedSystemCall, StatCounter, RECONCILIATION_STATS
+)
+from calico.monotonic import monotonic_time
 
 _log = logging.getLogger(__name__)
 
 _correlators = ("ipt-%s" % ii for ii in itertools.count())
 MAX_IPT_RETRIES = 10
 MAX_IPT_BACKOFF = 0.2
+CHAIN_HASH_PREFIX = "felix-hash:"
 
 
 class IptablesUpdater(Actor):
@@ -68,8 +73,20 @@ class IptablesUpdater(Actor):
     are on the queue in one atomic batch. This is dramatically faster than
     issuing single iptables requests.
 
-    If a request fails, it does a binary chop using the SplitBatchAndRetry
-    mechanism to report the error to the correct request.
+    Since iptables-restore holds the xtables lock for the whole of its
+    input, a batch that would be longer than the configured maximum
+    (for example, a refresh) is split into several transactions.  Chains
+    are ordered so that the chains that a chain requires are written in the
+    same or an earlier transaction.  Such a batch is no longer atomic but,
+    if a later transaction fails, the dataplane is still consistent, if
+    partially updated, and the retry rewrites all the chains.
+
+    If a request fails, it uses the line number that iptables-restore
+    reports to find the chain, and hence the request, that caused the
+    failure.  It reports the error to that request and retries the rest
+    of the batch in one go.  If the failure can't be attributed, for
+    example because the failing line was a stub that we generated, it
+    falls back to a binary chop using the SplitBatchAndRetry mechanism.
 
     Dependency tracking
     ~~~~~~~~~~~~~~~~~~~
@@ -95,6 +112,17 @@ class IptablesUpdater(Actor):
     * If a chain exists only as a stub chain to satisfy a dependency, then it
       is cleaned up when the dependency is removed.
 
+    Graceful restart
+    ~~~~~~~~~~~~~~~~
+
+    The last rule of each non-empty chain that we program carries an extra
+    comment that records a hash of the chain's contents.  (A rule of its
+    own would be evaluated by every packet that falls through the chain.)
+    At start of day, we load those hashes
+    from iptables-save and, until the graceful restart window is over, a
+    rewrite of a chain that is already present with the same contents is
+    recorded without reprogramming the chain.
+
     """
 
     def __init__(self, table, config, ip_version=4):
@@ -102,6 +130,7 @@ class IptablesUpdater(Actor):
                                                         (ip_version, table))
         self.table = table
         self.refresh_interval = config.REFRESH_INTERVAL
+        self.max_txn_lines = config.MAX_IPTABLES_TXN_LINES
         self.iptables_generator = config.plugins["iptables_generator"]
         self.ip_version = ip_version
         if ip_version == 4:
@@ -123,6 +152,12 @@ class IptablesUpdater(Actor):
         """
         Flag that is set after the graceful restart window is over.
         """
+        self._chain_hashes_in_dataplane = {}
+        """
+        Map from chain name to (hash, number of rules) for chains that were
+        left in the dataplane by a previous run.  Only populated during the
+        graceful restart window.
+        """
 
         self._programmed_chain_contents = {}
         """Map from chain name to chain contents, only contains chains that
@@ -150,6 +185,16 @@ class IptablesUpdater(Actor):
         for this batch."""
         self._completion_callbacks = None
         """List of callbacks to issue once the current batch completes."""
+        self._msg_callbacks = None
+        """Map from message to its callback, for the current batch."""
+        self._chain_writers = None
+        """Map from chain name to the message that rewrote that chain in the
+        current batch.  Used to attribute failures."""
+        self._failed_batch_msgs = 0
+        """Number of messages from a failed batch that are still waiting to
+        be retried."""
+        self._failed_batch_restores = 0
+        """Number of restores that we've run since that batch failed."""
 
         # Diagnostic counters.
         self._stats = StatCounter("IPv%s %s iptables updater" %
@@ -176,6 +221,8 @@ class IptablesUpdater(Actor):
                                  self._required_chains,
                                  self._requiring_chains)
         self._completion_callbacks = []
+        self._msg_callbacks = {}
+        self._chain_writers = {}
 
     @actor_message(needs_own_batch=True)
     def _load_chain_names_from_iptables(self):
@@ -184,26 +231,25 @@ class IptablesUpdater(Actor):
 
         Populates self._chains_in_dataplane.
         """
+        self._read_chains_from_iptables()
+
+    def _read_chains_from_iptables(self):
+        """
+        Populates self._chains_in_dataplane (and, during the graceful restart
+        period, the chain hashes) from iptables-save.
+
+        :returns str: the raw iptables-save output, for further parsing.
+        """
         self._stats.increment("Refreshed chain list")
         raw_ipt_output = subprocess.check_output([self._save_cmd, "--table",
                                                   self.table])
         self._chains_in_dataplane = _extract_our_chains(self.table,
                                                         raw_ipt_output)
-
-    def _get_unreferenced_chains(self):
-        """
-        Reads the list of chains in the dataplane which are not referenced.
-
-        :returns list[str]: list of chains currently in the dataplane that
-            are not referenced by other chains.
-        """
-        raw_ipt_output = subprocess.check_output(
-            [self._iptables_cmd,
-             "--wait",  # Wait for the xtables lock.
-             "--list",  # Action to perform.
-             "--numeric",  # Avoid DNS lookups.
-             "--table", self.table])
-        return _extract_our_unreffed_chains(raw_ipt_output)
+        if not self._grace_period_finished:
+            self._chain_hashes_in_dataplane = _extract_chain_hashes(
+                self.table, raw_ipt_output
+            )
+        return raw_ipt_output
 
     @actor_message()
     def rewrite_chains(self, update_calls_by_chain,
@@ -218,7 +264,11 @@ class IptablesUpdater(Actor):
         :param dependent_chains: map from chain name to a set of chains
                that that chain requires to exist. They will be created
                (with a default drop) if they don't exist.
-        :raises FailedSystemCall if a problem occurred.
+        :param callback: Optional callable, called with None once the update
+               has been applied or with the exception if it failed.  If a
+               callback is supplied, failures are only reported to it.
+        :raises FailedSystemCall if a problem occurred and there was no
+                callback.
         """
         # We actually apply the changes in _finish_msg_batch().  Index the
         # changes by table and chain.
@@ -230,9 +280,37 @@ class IptablesUpdater(Actor):
             # TODO: double-check whether this flush is needed.
             updates = ["--flush %s" % chain] + updates
             deps = dependent_chains.get(chain, set())
+            if self._txn.rewrite_is_noop(chain, updates, deps):
+                # Callers tend to rewrite all their chains even if only one
+                # of them has changed; avoid reprogramming the others.
+                _log.debug("Chain %s unchanged, skipping rewrite", chain)
+                self._stats.increment("Unchanged chain rewrites skipped")
+                continue
+            if self._chain_already_in_dataplane(chain, updates):
+                # Left behind by a previous run with the right contents.
+                _log.debug("Chain %s already in dataplane, adopting it",
+                           chain)
+                RECONCILIATION_STATS.increment("iptables chain rewrites "
+                                               "avoided")
+                self._txn.store_existing_chain(chain, updates, deps)
+                continue
             self._txn.store_rewrite_chain(chain, updates, deps)
+            self._chain_writers[chain] = self._current_msg
         if callback:
             self._completion_callbacks.append(callback)
+            self._msg_callbacks[self._current_msg] = callback
+
+    def _chain_already_in_dataplane(self, chain, updates):
+        """
+        :returns True if we're in the graceful restart window and the given
+                 chain was left in the dataplane by a previous run with
+                 exactly the given contents.
+        """
+        if (self._grace_period_finished or self._txn.refresh or
+                chain in self._txn.prog_chains):
+            return False
+        return (self._chain_hashes_in_dataplane.get(chain) ==
+                (_chain_hash(updates), _num_rules(updates)))
 
     # Does direct table manipulation, forbid batching with other messages.
     @actor_message(needs_own_batch=True)
@@ -356,7 +434,9 @@ class IptablesUpdater(Actor):
         """
         Deletes the named chains.
 
-        :raises FailedSystemCall if a problem occurred.
+        :param callback: Optional callable, as for rewrite_chains().
+        :raises FailedSystemCall if a problem occurred and there was no
+                callback.
         """
         # We actually apply the changes in _finish_msg_batch().  Index the
         # changes by table and chain.
@@ -364,8 +444,10 @@ class IptablesUpdater(Actor):
         self._stats.increment("Chain deletes")
         for chain in chain_names:
             self._txn.store_delete(chain)
+            self._chain_writers.pop(chain, None)
         if callback:
             self._completion_callbacks.append(callback)
+            self._msg_callbacks[self._current_msg] = callback
 
     # It's much simpler to do cleanup in its own batch so that it doesn't have
     # to worry about in-flight updates.
@@ -378,8 +460,12 @@ class IptablesUpdater(Actor):
         _log.info("Cleaning up left-over iptables state.")
         self._stats.increment("Cleanups performed")
 
-        # Start with the current state.
-        self._load_chain_names_from_iptables()
+        # Start with the current state.  We read the whole table once and
+        # work out what to delete from the references between chains, rather
+        # than repeatedly listing the table as chains become unreferenced.
+        raw_ipt_output = self._read_chains_from_iptables()
+        all_chains, chain_refs = _extract_chain_graph(self.table,
+                                                      raw_ipt_output)
 
         required_chains = set(self._requiring_chains.keys())
         if not self._grace_period_finished:
@@ -396,39 +482,39 @@ class IptablesUpdater(Actor):
                 self._stub_out_chains(chains_to_stub)
             except NothingToDo:
                 pass
+            # The stubs no longer jump to anything.
+            for chain in chains_to_stub:
+                all_chains.add(chain)
+                chain_refs.pop(chain, None)
             self._grace_period_finished = True
+            self._chain_hashes_in_dataplane = {}
 
         # Now the generic cleanup, look for chains that we're not expecting to
-        # be there and delete them.
-        chains_we_tried_to_delete = set()
-        finished = False
-        while not finished:
-            # Try to delete all the unreferenced chains, we use a loop to
-            # ensure that we then clean up any chains that become unreferenced
-            # when we delete the previous lot.
-            unreferenced_chains = self._get_unreferenced_chains()
-            orphans = (unreferenced_chains -
-                       self._explicitly_prog_chains -
-                       required_chains)
-            if not chains_we_tried_to_delete.issuperset(orphans):
-                _log.info("Cleanup found these unreferenced chains to "
-                          "delete: %s", orphans)
-                self._stats.increment("Orphans found during cleanup",
-                                      by=len(orphans))
-                chains_we_tried_to_delete.update(orphans)
-                self._delete_best_effort(orphans)
-            else:
-                # We've already tried to delete all the chains we found,
-                # give up.
-                _log.info("Cleanup finished, deleted %d chains, failed to "
-                          "delete these chains: %s",
-                          len(chains_we_tried_to_delete) - len(orphans),
-                          orphans)
-                finished = True
+        # be there and delete them.  Anything reachable from a chain that we
+        # don't own (including the kernel chains) or from a chain that we're
+        # expecting has to stay.
+        roots = set(c for c in all_chains if not c.startswith(FELIX_PREFIX))
+        roots |= self._explicitly_prog_chains | required_chains
+        orphans = _unreachable_chains(all_chains, chain_refs, roots)
+        if orphans:
+            _log.info("Cleanup found these unreachable chains to delete: %s",
+                      orphans)
+            self._stats.increment("Orphans found during cleanup",
+                                  by=len(orphans))
+            # Delete chains before the chains they jump to.  All the chains
+            # go in one transaction; _delete_best_effort() only splits it
+            # up if that fails.
+            self._delete_best_effort(
+                list(reversed(_dependency_order(orphans, chain_refs)))
+            )
+            failed = orphans & self._chains_in_dataplane
+            _log.info("Cleanup finished, deleted %d chains, failed to "
+                      "delete these chains: %s",
+                      len(orphans) - len(failed), failed)
 
         # Then some sanity checks:
         expected_chains = self._chains_in_dataplane
-        self._load_chain_names_from_iptables()
+        self._read_chains_from_iptables()
         loaded_chains = self._chains_in_dataplane
         missing_chains = ((self._explicitly_prog_chains | required_chains) -
                           self._chains_in_dataplane)
@@ -479,35 +565,70 @@ class IptablesUpdater(Actor):
             # We use two passes to update the dataplane.  In the first pass,
             # we make any updates, create new chains and replace to-be-deleted
             # chains with stubs (in case we fail to delete them below).
+            chains = ()
+            input_lines = []
+            num_restores = 0
+            committed_chains = set()
             try:
-                input_lines = self._calculate_ipt_modify_input()
+                transactions = self._calculate_ipt_modify_input()
             except NothingToDo:
                 _log.info("%s no updates in this batch.", self)
             else:
-                self._execute_iptables(input_lines)
+                if len(transactions) > 1:
+                    _log.info("%s splitting updates into %s transactions",
+                              self, len(transactions))
+                    self._stats.increment("Batches split into several "
+                                          "transactions")
+                for chains, input_lines in transactions:
+                    num_restores += 1
+                    if self._failed_batch_msgs:
+                        self._failed_batch_restores += 1
+                    self._execute_iptables(input_lines)
+                    # Record progress in case a later transaction fails.
+                    self._chains_in_dataplane.update(chains)
+                    committed_chains.update(chains)
                 _log.info("%s Successfully processed iptables updates.", self)
-                self._chains_in_dataplane.update(self._txn.affected_chains)
         except (IOError, OSError, FailedSystemCall) as e:
             if isinstance(e, FailedSystemCall):
                 rc = e.retcode
             else:
                 rc = "unknown"
+            if committed_chains:
+                # Earlier transactions in the batch committed; our indexes
+                # must reflect what they wrote so that we don't skip a
+                # later rewrite of those chains as a no-op.
+                self._update_indexes_for_chains(committed_chains)
             if len(batch) == 1:
                 # We only executed a single message, report the failure.
                 _log.error("Non-retryable %s failure. RC=%s",
                            self._restore_cmd, rc)
                 self._stats.increment("Messages failed due to iptables "
                                       "error")
-                if self._completion_callbacks:
-                    self._completion_callbacks[0](e)
-                final_result = ResultOrExc(None, e)
-                results[0] = final_result
+                results[0] = self._report_failure(batch[0], e)
+                self._on_msgs_resolved(1)
             else:
+                if not self._failed_batch_msgs:
+                    # First failure, start counting the restores that it
+                    # takes to get the batch through.
+                    self._failed_batch_msgs = len(batch)
+                    self._failed_batch_restores = num_restores
+                culprit = self._find_culprit(batch, chains, input_lines, e)
+                if culprit is None:
+                    _log.error("Non-retryable error from a combined batch, "
+                               "splitting the batch to narrow down culprit.")
+                    self._stats.increment("Split batch due to error")
+                    raise SplitBatchAndRetry()
                 _log.error("Non-retryable error from a combined batch, "
-                           "splitting the batch to narrow down culprit.")
-                self._stats.increment("Split batch due to error")
-                raise SplitBatchAndRetry()
+                           "caused by message %s.  Retrying the rest of "
+                           "the batch without it.", batch[culprit])
+                self._stats.increment("Messages failed due to iptables "
+                                      "error")
+                self._stats.increment("Failures attributed to a message")
+                result = self._report_failure(batch[culprit], e)
+                self._on_msgs_resolved(1)
+                raise RetryWithoutMessage(culprit, result)
         else:
+            self._on_msgs_resolved(len(batch))
             # Modify succeeded, update our indexes for next time.
             self._update_indexes()
             # Make a best effort to delete the chains we no longer want.
@@ -532,12 +653,84 @@ class IptablesUpdater(Actor):
                 except FailedSystemCall:
                     _log.error("Failed to refresh inserted/removed rules")
         finally:
+            # Whether or not the batch succeeded, the hashes that we loaded
+            # for the chains that it touched can no longer be trusted.
+            for chain in self._txn.affected_chains:
+                self._chain_hashes_in_dataplane.pop(chain, None)
             self._reset_batched_work()
             self._stats.increment("Batches finished")
 
         end = time.time()
         _log.debug("Batch time: %.2f %s", end - start, len(batch))
 
+    def _report_failure(self, msg, exc):
+        """
+        Reports a failure to the callback of the given message, if it has
+        one.
+
+        :returns ResultOrExc to use as the message's result.
+        """
+        callback = self._msg_callbacks.get(msg)
+        if callback:
+            # The caller asked to be told about the outcome; the callback
+            # owns the error so that callers using nowait=True don't bring
+            # down the process.
+            callback(exc)
+            return ResultOrExc(None, None)
+        return ResultOrExc(None, exc)
+
+    def _find_culprit(self, batch, txn_chains, input_lines, exc):
+        """
+        Attributes a failed iptables-restore to a message in the batch.
+
+        :param txn_chains: the chains written by the failed transaction.
+        :returns the index of the message whose chain rewrite contains the
+                 line that iptables-restore failed on or None if the
+                 failure can't be attributed to a single message.
+        """
+        if not isinstance(exc, FailedSystemCall):
+            return None
+        chain = _parse_ipt_restore_failed_chain(input_lines, exc.stderr)
+        if chain is not None:
+            if chain not in self._txn.updates:
+                # Stubs and deletions are generated by us, not by a message.
+                return None
+            msg = self._chain_writers.get(chain)
+        elif _parse_ipt_restore_error(input_lines, exc.stderr)[0]:
+            # A COMMIT failure that persisted through all our retries.  The
+            # kernel only reports rules that it rejects at the COMMIT line
+            # so, if the transaction's chains were all written by the same
+            # message, then it's the likely culprit.
+            msgs = set(self._chain_writers.get(c) for c in txn_chains
+                       if c in self._txn.updates)
+            if len(msgs) != 1:
+                return None
+            msg = msgs.pop()
+        else:
+            return None
+        for ii, batch_msg in enumerate(batch):
+            if batch_msg is msg:
+                return ii
+        return None
+
+    def _on_msgs_resolved(self, num_msgs):
+        """
+        Called when messages have either succeeded or failed for good.
+        Records the number of restores that it took to resolve a failed
+        batch, once all of its messages are resolved.
+        """
+        if not self._failed_batch_msgs:
+            return
+        self._failed_batch_msgs -= num_msgs
+        if self._failed_batch_msgs <= 0:
+            _log.info("Resolved failed batch after %s restores",
+                      self._failed_batch_restores)
+            self._stats.increment("Failed batches resolved")
+            self._stats.increment("Restores to resolve failed batches",
+                                  by=self._failed_batch_restores)
+            self._failed_batch_msgs = 0
+            self._failed_batch_restores = 0
+
     def _delete_best_effort(self, chains):
         """
         Try to delete all the chains in the input list. Any errors are silently
@@ -600,11 +793,43 @@ class IptablesUpdater(Actor):
         self._required_chains = self._txn.required_chns
         self._requiring_chains = self._txn.requiring_chns
 
+    def _update_indexes_for_chains(self, chains):
+        """
+        Called after a batch fails part way through, once some of its
+        transactions have committed.  Updates the indices for the given
+        chains, which those transactions wrote, with the values calculated
+        by the _Transaction.
+        """
+        for chain in chains:
+            contents = self._txn.prog_chains.get(chain)
+            if contents is None:
+                # Stub, or a stub of a chain that we were about to delete.
+                self._programmed_chain_contents.pop(chain, None)
+            else:
+                self._programmed_chain_contents[chain] = contents
+            old_deps = self._required_chains.get(chain, set())
+            new_deps = self._txn.required_chns.get(chain, set())
+            for dependency in old_deps - new_deps:
+                self._requiring_chains[dependency].discard(chain)
+                if not self._requiring_chains[dependency]:
+                    del self._requiring_chains[dependency]
+            for dependency in new_deps - old_deps:
+                self._requiring_chains[dependency].add(chain)
+            if new_deps:
+                self._required_chains[chain] = set(new_deps)
+            else:
+                self._required_chains.pop(chain, None)
+
     def _calculate_ipt_modify_input(self):
         """
         Calculate the input for phase 1 of a batch, where we only modify and
         create chains.
 
+        Usually, the whole batch is one transaction.  If that would have more
+        than self.max_txn_lines lines, the chains are split across several
+        transactions, in dependency order.
+
+        :returns list of (chains, input_lines) tuples, one per transaction.
         :raises NothingToDo: if the batch requires no modify operations.
         """
         # Valid input looks like this.
@@ -617,10 +842,9 @@ class IptablesUpdater(Actor):
         # COMMIT
         #
         # The chains are created if they don't exist.
-        input_lines = []
-        # Track the chains that we decide we need to touch so that we can
-        # prepend the appropriate iptables header for each chain.
-        modified_chains = set()
+        # Map from each chain that we decide we need to touch to its lines so
+        # that we can prepend the appropriate iptables header for each chain.
+        lines_by_chain = OrderedDict()
         # Generate rules to stub out chains.  We stub chains out if they're
         # referenced by another chain but they're not present for some reason.
         for chain in self._txn.chains_to_stub_out:
@@ -633,29 +857,61 @@ class IptablesUpdater(Actor):
                 #   we couldn't because it was still referenced), implying
                 #   that we now know the state of that chain and we should not
                 #   wait for the end of graceful restart to clean it up.
-                modified_chains.add(chain)
-                input_lines.extend(self._stub_drop_rules(chain))
+                lines_by_chain[chain] = self._stub_drop_rules(chain)
 
         # Generate rules to stub out chains that we're about to delete, just
         # in case the delete fails later on.  Stubbing it out also stops it
         # from referencing other chains, accidentally keeping them alive.
         for chain in self._txn.chains_to_delete:
-            modified_chains.add(chain)
-            input_lines.extend(self._stub_drop_rules(chain))
+            lines_by_chain[chain] = self._stub_drop_rules(chain)
 
         # Now add the actual chain updates.
         for chain, chain_updates in self._txn.updates.iteritems():
-            modified_chains.add(chain)
-            input_lines.extend(chain_updates)
-
-        # Finally, prepend the input with instructions that do an idempotent
-        # create-and-flush operation for the chains that we need to create or
-        # rewrite.
-        input_lines[:0] = [":%s -" % chain for chain in modified_chains]
+            lines_by_chain[chain] = _add_chain_hash(chain_updates)
 
-        if not input_lines:
+        if not lines_by_chain:
             raise NothingToDo
-        return ["*%s" % self.table] + input_lines + ["COMMIT"]
+        num_lines = sum(len(l) + 1 for l in lines_by_chain.itervalues()) + 2
+        if not self.max_txn_lines or num_lines <= self.max_txn_lines:
+            return [self._restore_input(lines_by_chain.keys(),
+                                        lines_by_chain.values())]
+
+        # Too big for one transaction.  Write the chains that others
+        # require first so that jumps to them never fail.
+        transactions = []
+        chains = []
+        num_lines = 2
+        for chain in _dependency_order(lines_by_chain,
+                                       self._txn.required_chns):
+            chain_lines = len(lines_by_chain[chain]) + 1
+            if chains and num_lines + chain_lines > self.max_txn_lines:
+                transactions.append(self._restore_input(
+                    chains, [lines_by_chain[c] for c in chains]
+                ))
+                chains = []
+                num_lines = 2
+            chains.append(chain)
+            num_lines += chain_lines
+        transactions.append(self._restore_input(
+            chains, [lines_by_chain[c] for c in chains]
+        ))
+        return transactions
+
+    def _restore_input(self, chains, chain_lines):
+        """
+        :param chains: the chains to write.
+        :param chain_lines: list of the lists of lines for each chain.
+        :returns tuple: the chains and the iptables-restore input that
+                 writes them.
+        """
+        # Start with instructions that do an idempotent create-and-flush
+        # operation for the chains that we need to create or rewrite.
+        input_lines = ["*%s" % self.table]
+        input_lines.extend(":%s -" % chain for chain in chains)
+        for lines in chain_lines:
+            input_lines.extend(lines)
+        input_lines.append("COMMIT")
+        return list(chains), input_lines
 
     def _calculate_ipt_delete_input(self, chains):
         """
@@ -699,64 +955,90 @@ class IptablesUpdater(Actor):
     def _execute_iptables(self, input_lines, fail_log_level=logging.ERROR):
         """
         Runs ip(6)tables-restore with the given input.  Retries iff
-        the COMMIT fails.
+        the COMMIT fails, up to MAX_IPT_RETRIES attempts in total.
 
         :raises FailedSystemCall: if the command fails on a non-commit
-            line or if it repeatedly fails and retries are exhausted.
+            line or if the COMMIT fails on every attempt.
         """
         backoff = 0.01
         num_tries = 0
         success = False
-        while not success:
-            input_str = "\n".join(input_lines) + "\n"
-            _log.debug("%s input:\n%s", self._restore_cmd, input_str)
-
-            # Run iptables-restore in noflush mode so that it doesn't
-            # blow away all the tables we're not touching.
-            cmd = [self._restore_cmd, "--noflush", "--verbose"]
-            try:
-                futils.check_call(cmd, input_str=input_str)
-            except FailedSystemCall as e:
-                # Parse the output to determine if error is retryable.
-                retryable, detail = _parse_ipt_restore_error(input_lines,
-                                                             e.stderr)
-                num_tries += 1
-                if retryable:
-                    if num_tries < MAX_IPT_RETRIES:
-                        _log.info("%s failed with retryable error. Retry in "
-                                  "%.2fs", self._iptables_cmd, backoff)
-                        self._stats.increment("iptables commit failure "
-                                              "(retryable)")
-                        gevent.sleep(backoff)
-                        if backoff > MAX_IPT_BACKOFF:
-                            backoff = MAX_IPT_BACKOFF
-                        backoff *= (1.5 + random.random())
-                        continue
+        txn_start = monotonic_time()
+        call_start = txn_start
+        try:
+            while not success:
+                input_str = "\n".join(input_lines) + "\n"
+                _log.debug("%s input:\n%s", self._restore_cmd, input_str)
+
+                # Run iptables-restore in noflush mode so that it doesn't
+                # blow away all the tables we're not touching.
+                cmd = [self._restore_cmd, "--noflush", "--verbose"]
+                call_start = monotonic_time()
+                try:
+                    futils.check_call(cmd, input_str=input_str)
+                except FailedSystemCall as e:
+                    # Parse the output to determine if error is retryable.
+                    retryable, detail = _parse_ipt_restore_error(input_lines,
+                                                                 e.stderr)
+                    num_tries += 1
+                    if retryable:
+                        if num_tries < MAX_IPT_RETRIES:
+                            _log.info("%s failed with retryable error. "
+                                      "Retry in %.2fs", self._iptables_cmd,
+                                      backoff)
+                            self._stats.increment("iptables commit failure "
+                                                  "(retryable)")
+                            gevent.sleep(backoff)
+                            if backoff > MAX_IPT_BACKOFF:
+                                backoff = MAX_IPT_BACKOFF
+                            backoff *= (1.5 + random.random())
+                            continue
+                        else:
+                            _log.log(
+                                fail_log_level,
+                                "Failed to run %s.  Out of retries: %s.\n"
+                                "Output:\n%s\n"
+                                "Error:\n%s\n"
+                                "Input was:\n%s",
+                                self._restore_cmd, detail, e.stdout, e.stderr,
+                                input_str)
+                            self._stats.increment("iptables commit failure "
+                                                  "(out of retries)")
                     else:
                         _log.log(
                             fail_log_level,
-                            "Failed to run %s.  Out of retries: %s.\n"
+                            "%s failed with non-retryable error: %s.\n"
                             "Output:\n%s\n"
                             "Error:\n%s\n"
                             "Input was:\n%s",
                             self._restore_cmd, detail, e.stdout, e.stderr,
                             input_str)
-                        self._stats.increment("iptables commit failure "
-                                              "(out of retries)")
+                        self._stats.increment("iptables non-retryable failure")
+                    raise
                 else:
-                    _log.log(
-                        fail_log_level,
-                        "%s failed with non-retryable error: %s.\n"
-                        "Output:\n%s\n"
-                        "Error:\n%s\n"
-                        "Input was:\n%s",
-                        self._restore_cmd, detail, e.stdout, e.stderr,
-                        input_str)
-                    self._stats.increment("iptables non-retryable failure")
-                raise
-            else:
-                self._stats.increment("iptables success")
-                success = True
+                    self._stats.increment("iptables success")
+                    success = True
+        finally:
+            # iptables-restore holds the xtables lock for the whole of the
+            # last attempt; earlier attempts failed to commit because
+            # another process held the lock.
+            self._record_txn_times(call_start - txn_start,
+                                   monotonic_time() - call_start)
+
+    def _record_txn_times(self, wait_time, hold_time):
+        """
+        Records how long a transaction waited for other users of the xtables
+        lock and how long it then held the lock for.
+        """
+        _log.debug("%s transaction waited %.3fs and held the lock for %.3fs",
+                   self._restore_cmd, wait_time, hold_time)
+        wait_ms = int(wait_time * 1000)
+        hold_ms = int(hold_time * 1000)
+        self._stats.increment("Transactions")
+        self._stats.increment("Total lock wait time (ms)", by=wait_ms)
+        self._stats.increment("Total lock hold time (ms)", by=hold_ms)
+        self._stats.record_max("Max lock wait time (ms)", wait_ms)
+        self._stats.record_max("Max lock hold time (ms)", hold_ms)
 
     def _stub_drop_rules(self, chain):
         """
@@ -850,6 +1132,30 @@ class _Transaction(object):
         self.prog_chains[chain] = updates
         self._invalidate_cache()
 
+    def store_existing_chain(self, chain, updates, dependencies):
+        """
+        Records that the given chain is already present in the dataplane
+        with the given contents, updating the per-batch indexes as
+        required without reprogramming the chain.
+        """
+        _log.debug("Storing existing chain %s", chain)
+        self._update_deps(chain, dependencies)
+        self.explicit_deletes.discard(chain)
+        self.prog_chains[chain] = updates
+        self._invalidate_cache()
+
+    def rewrite_is_noop(self, chain, updates, dependencies):
+        """
+        :returns True if the given chain is already programmed with exactly
+                 the given contents and dependencies, so rewriting it would
+                 have no effect.  Always False if a refresh is pending.
+        """
+        if self.refresh:
+            return False
+        old_updates = self.prog_chains.get(chain)
+        return (old_updates == updates and
+                self.required_chns.get(chain, set()) == dependencies)
+
     def store_refresh(self):
         """
         Records that we should refresh all chains as part of this transaction.
@@ -969,30 +1275,163 @@ def _extract_our_chains(table, raw_ipt_save_output):
     return chains
 
 
-def _extract_our_unreffed_chains(raw_ipt_output):
+def _chain_hash(updates):
+    """
+    :returns a short, stable hash of the given chain updates.
+    """
+    contents = "\n".join(updates)
+    if isinstance(contents, unicode):
+        contents = contents.encode("utf-8")
+    return hashlib.sha256(contents).hexdigest()[:16]
+
+
+def _num_rules(updates):
+    """
+    :returns the number of rules that the given chain updates append.
+    """
+    return sum(1 for u in updates if not u.startswith("--flush"))
+
+
+def _add_chain_hash(updates):
+    """
+    Records the hash of the given chain updates in a comment on the last
+    rule of the chain, so that a later run can adopt the chain.
+
+    The comment goes on an existing rule rather than in a rule of its own
+    because every packet that falls through a chain evaluates each of its
+    rules; a comment match is only evaluated by packets that match the
+    rest of the last rule, and it always matches.  Empty chains have no
+    rule to carry the hash; they're cheap to reprogram.
+
+    :returns a copy of the updates with the hash added.
     """
-    Parses the output from "ip(6)tables --list" to find the set of
-    felix-programmed chains that are not referenced.
+    if not updates or not updates[-1].startswith("--append "):
+        return list(updates)
+    return updates[:-1] + ['%s --match comment --comment "%s%s"' % (
+        updates[-1], CHAIN_HASH_PREFIX, _chain_hash(updates)
+    )]
+
+
+def _dependency_order(chains, required_chains):
+    """
+    Orders the given chains so that each chain comes after any of the
+    given chains that it jumps to.  Dependencies outside the given chains
+    are ignored; they're either already in the dataplane or get stubbed out.
+
+    :param chains: iterable of chain names.
+    :param required_chains: dict mapping chain name to the set of chains
+           that it jumps to.
+    :returns list of the chains, dependencies first.
+    """
+    chains = set(chains)
+    ordered = []
+    done = set()
+    for root in sorted(chains):
+        if root in done:
+            continue
+        # Iterative depth-first search; "visiting" guards against loops,
+        # which iptables would reject anyway.
+        visiting = set([root])
+        stack = [(root, iter(sorted(required_chains.get(root, ()))))]
+        while stack:
+            chain, deps = stack[-1]
+            for dep in deps:
+                if dep in chains and dep not in done and dep not in visiting:
+                    visiting.add(dep)
+                    stack.append(
+                        (dep, iter(sorted(required_chains.get(dep, ()))))
+                    )
+                    break
+            else:
+                stack.pop()
+                visiting.discard(chain)
+                done.add(chain)
+                ordered.append(chain)
+    return ordered
+
+
+def _extract_chain_hashes(table, raw_ipt_save_output):
+    """
+    Parses the output from iptables-save to extract the hashes that we
+    recorded in our chains.
+
+    :returns dict mapping chain name to a tuple of the hash and the number
+             of rules up to and including the rule that carries the hash.
+             Chains with rules after that rule are omitted.
+    """
+    hashes = {}
+    num_rules_by_chain = defaultdict(lambda: 0)
+    current_table = None
+    for line in raw_ipt_save_output.splitlines():
+        line = line.strip()
+        if line.startswith("*"):
+            current_table = line[1:]
+            continue
+        m = re.match(r'^(?:-A|--append) (\S+) (.*)$', line)
+        if current_table != table or not m:
+            continue
+        chain = m.group(1)
+        if not chain.startswith(FELIX_PREFIX):
+            continue
+        num_rules_by_chain[chain] += 1
+        hash_match = re.search(r'(?:-m|--match) comment --comment "?%s'
+                               r'([0-9a-f]+)"?(?: |$)' % CHAIN_HASH_PREFIX,
+                               m.group(2))
+        if hash_match:
+            hashes[chain] = (hash_match.group(1), num_rules_by_chain[chain])
+        else:
+            hashes.pop(chain, None)
+    return hashes
+
+
+def _extract_chain_graph(table, raw_ipt_save_output):
+    """
+    Parses the output from iptables-save to extract all the chains in the
+    given table and the jumps between them.
+
+    :returns tuple: the set of chain names and a dict mapping chain name to
+             the set of chains that it jumps to.
     """
     chains = set()
-    last_line = None
-    for line in raw_ipt_output.splitlines():
-        # Look for lines that look like this after a blank line.
-        # Chain ufw-user-output (1 references)
-        if ((not last_line or not last_line.strip()) and
-                line.startswith("Chain")):
-            if "policy" in line:
-                _log.debug("Skipping root-level chain")
-                continue
-            m = re.match(r'^Chain ([^ ]+) \((\d+).+\)', line)
-            assert m, "Regex failed to match Chain line %r" % line
-            chain_name = m.group(1)
-            ref_count = int(m.group(2))
-            _log.debug("Found chain %s, ref count %s", chain_name, ref_count)
-            if chain_name.startswith(FELIX_PREFIX) and ref_count == 0:
-                chains.add(chain_name)
-        last_line = line
-    return chains
+    refs = defaultdict(set)
+    current_table = None
+    for line in raw_ipt_save_output.splitlines():
+        line = line.strip()
+        if line.startswith("*"):
+            current_table = line[1:]
+        elif current_table != table:
+            continue
+        elif line.startswith(":"):
+            chains.add(line[1:].split(" ")[0])
+        else:
+            m = re.match(r'^(?:-A|--append|-I|--insert) (\S+) .*'
+                         r'(?:-j|--jump|-g|--goto) (\S+)', line)
+            if m:
+                refs[m.group(1)].add(m.group(2))
+    # Targets such as ACCEPT and DROP aren't chains.
+    return chains, dict((chain, targets & chains)
+                        for chain, targets in refs.iteritems())
+
+
+def _unreachable_chains(chains, chain_refs, roots):
+    """
+    :param chains: set of all the chains in the table.
+    :param chain_refs: dict mapping chain name to the set of chains that it
+           jumps to.
+    :param roots: chains that must be kept.
+    :returns set: the felix chains that can't be reached from any of the
+             roots.
+    """
+    reachable = set()
+    to_visit = [c for c in roots if c in chains]
+    while to_visit:
+        chain = to_visit.pop()
+        if chain in reachable:
+            continue
+        reachable.add(chain)
+        to_visit.extend(chain_refs.get(chain, ()))
+    return set(c for c in chains
+               if c.startswith(FELIX_PREFIX) and c not in reachable)
 
 
 def _parse_ipt_restore_error(input_lines, err):
@@ -1014,7 +1453,7 @@ def _parse_ipt_restore_error(input_lines, err):
         _log.debug("ip(6)tables-restore failure on line %s", line_number)
         line_index = line_number - 1
         offending_line = input_lines[line_index]
-        if offending_line.strip == "COMMIT":
+        if offending_line.strip() == "COMMIT":
             return True, "COMMIT failed; likely concurrent access."
         else:
             return False, "Line %s failed: %s" % (line_number, offending_line)
@@ -1022,6 +1461,32 @@ def _parse_ipt_restore_error(input_lines, err):
         return False, "ip(6)tables-restore failed with output: %s" % err
 
 
+def _parse_ipt_restore_failed_chain(input_lines, err):
+    """
+    Parses the stderr output from an iptables-restore call to find the
+    chain that the failing line belongs to.
+
+    :param input_lines: list of lines of input that we passed to
+        iptables-restore.
+    :param str err: captures stderr from iptables-restore.
+    :return str: the name of the chain or None if the output doesn't
+        identify a line that belongs to a chain.
+    """
+    match = re.search(r"line (\d+) failed", err)
+    if not match:
+        return None
+    line_index = int(match.group(1)) - 1
+    if not 0 <= line_index < len(input_lines):
+        return None
+    words = input_lines[line_index].split()
+    if words and words[0].startswith(":"):
+        # Chain header, ":chain -".
+        return words[0][1:]
+    if len(words) > 1 and words[0] in ("--append", "-A", "--flush", "-F"):
+        return words[1]
+    return None
+
+
 class NothingToDo(Exception):
     pass
 
@@ -205,7 +205,7 @@ def load_nf_conntrack():
 
 
 def install_global_rules(config, filter_updater, nat_updater, ip_version,
-                         raw_updater=None):
+                         raw_updater=None, hosts_ipset=None):
     """
     Set up global iptables rules. These are rules that do not change with
     endpoint, and are expected never to change (such as the rules that send all
@@ -215,6 +215,9 @@ def install_global_rules(config, filter_updater, nat_updater, ip_version,
 
     - ensures that all the required global tables are present;
     - applies any changes required.
+
+    :param hosts_ipset: the IPv4 ipset of Calico host IPs, defaults to
+           HOSTS_IPSET_V4.
     """
 
     # The interface matching string; for example, if interfaces start "tap"
@@ -295,8 +298,9 @@ def install_global_rules(config, filter_updater, nat_updater, ip_version,
     # Now the filter table. This needs to have felix-FORWARD and felix-INPUT
     # chains, which we must create before adding any rules that send to them.
     if ip_version == 4 and config.IP_IN_IP_ENABLED:
-        hosts_set_name = HOSTS_IPSET_V4.set_name
-        HOSTS_IPSET_V4.ensure_exists()
+        hosts_ipset = hosts_ipset or HOSTS_IPSET_V4
+        hosts_set_name = hosts_ipset.set_name
+        hosts_ipset.ensure_exists()
     else:
         hosts_set_name = None
 
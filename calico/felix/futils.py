@@ -21,12 +21,14 @@ felix.futils
 
 Felix utilities.
 """
+import binascii
 import collections
 import functools
 import hashlib
 import inspect
 import logging
 import os
+import socket
 from types import StringTypes
 import types
 import gc
@@ -57,6 +59,8 @@ IPV6 = "IPv6"
 IP_TYPES = [IPV4, IPV6]
 IP_VERSIONS = [4, 6]
 IP_TYPE_TO_VERSION = {IPV4: 4, IPV6: 6}
+_FAMILY_BY_IP_TYPE = {IPV4: socket.AF_INET, IPV6: socket.AF_INET6}
+_HEX_DIGITS_BY_IP_TYPE = {IPV4: 8, IPV6: 32}
 
 SHORTENED_PREFIX = "_"
 
@@ -373,6 +377,32 @@ def net_to_ip(net_or_ip):
     return net_or_ip.split("/")[0]
 
 
+def ip_to_int(ip_type, ip):
+    """
+    Packs an IP address into an integer, which takes much less memory than
+    the string.
+
+    :param ip_type: IP type (IPV4 or IPV6)
+    :param str ip: The IP address.
+    :returns: int or long.
+    """
+    return int(binascii.hexlify(socket.inet_pton(_FAMILY_BY_IP_TYPE[ip_type],
+                                                 ip)), 16)
+
+
+def int_to_ip(ip_type, ip_int):
+    """
+    Reverses ip_to_int().
+
+    :param ip_type: IP type (IPV4 or IPV6)
+    :param int|long ip_int: The packed IP address.
+    :returns: The IP address as a string.
+    """
+    packed = binascii.unhexlify("%0*x" % (_HEX_DIGITS_BY_IP_TYPE[ip_type],
+                                          ip_int))
+    return socket.inet_ntop(_FAMILY_BY_IP_TYPE[ip_type], packed)
+
+
 def uniquely_shorten(string, length):
     """
     Take a string and deterministically shorten it to at most length
@@ -409,12 +439,26 @@ class StatCounter(object):
     def increment(self, stat, by=1):
         self.stats[stat] += by
 
+    def record_max(self, stat, value):
+        """
+        Records value as the stat if it's larger than the current value.
+        """
+        if value > self.stats[stat]:
+            self.stats[stat] = value
+
     def _dump(self, log):
         stats_copy = self.stats.items()
         for name, stat in sorted(stats_copy):
             log.info("%s: %s", name, stat)
 
 
+RECONCILIATION_STATS = StatCounter("Start-of-day reconciliation")
+"""
+Counts the dataplane operations that we avoided after a restart by
+reconciling with the state left behind by the previous run.
+"""
+
+
 def register_process_statistics():
     """
     Called once to register a stats handler for process-specific information.
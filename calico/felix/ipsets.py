@@ -20,13 +20,17 @@ felix.ipsets
 IP sets management functions.
 """
 
-from collections import defaultdict
+from collections import defaultdict, namedtuple
 from itertools import chain
+import hashlib
 import logging
+import socket
 
 from calico.felix import futils
 from calico.calcollections import SetDelta
-from calico.felix.futils import IPV4, IPV6, FailedSystemCall
+from calico.felix.futils import (
+    IPV4, IPV6, FailedSystemCall, RECONCILIATION_STATS
+)
 from calico.felix.actor import actor_message, Actor
 from calico.felix.labels import LabelValueIndex, LabelInheritanceIndex
 from calico.felix.refcount import ReferenceManager, RefCountedActor
@@ -44,22 +48,61 @@ DUMMY_PROFILE = "dummy"
 # "felix-tmp-v4" prefix.
 MAX_NAME_LENGTH = 16
 
+# Tag and selector ipsets are list:set "aliases" that contain a single
+# shared hash:ip ipset.  Tags and selectors with identical members share
+# the same hash:ip ipset.  The ":" in the name stems can't appear in a tag
+# ID or selector ID so they can't clash with the names of other ipsets.
+ALIAS_PFX = "l:"
+SHARED_PFX = "s:"
+# Size of the alias list:sets; they normally contain one member.
+ALIAS_IPSET_SIZE = 8
+# Modulus of the multiset hashes of ipset contents.
+CONTENT_HASH_MODULUS = 2 ** 128
+
+
+class NetSetId(namedtuple("NetSetId", ["ipset_type", "members"])):
+    """
+    ID of an ipset with fixed contents.  The iptables generator uses these
+    to collapse runs of rules that differ only in their CIDR (and port) into
+    a single rule that matches on the ipset.
+
+    :ivar str ipset_type: "hash:net" or "hash:net,port".
+    :ivar frozenset members: the entries of the ipset.
+    """
+    __slots__ = ()
+
+    @property
+    def unique_id(self):
+        """
+        Returns a string which is very likely to be unique to this set.
+        """
+        h = hashlib.sha256()
+        h.update(self.ipset_type)
+        for member in sorted(self.members):
+            h.update(" " + member)
+        return "n" + h.hexdigest()
+
 
 class IpsetManager(ReferenceManager):
     # Using a larger batch delay here significantly reduces CPU usage when
     # we're under heavy churn.
     batch_delay = 0.05
 
-    def __init__(self, ip_type, config):
+    def __init__(self, ip_type, config, ipset_cls=None):
         """
         Manages all the ipsets for tags for either IPv4 or IPv6.
 
         :param ip_type: IP type (IPV4 or IPV6)
+        :param ipset_cls: class used to program the ipsets, defaults to
+               Ipset.  Tags and selectors only share sets if it supports
+               list:set ipsets.
         """
         super(IpsetManager, self).__init__(qualifier=ip_type)
 
         self.ip_type = ip_type
         self._config = config
+        self._ipset_cls = ipset_cls or Ipset
+        self._share_ipsets = self._ipset_cls.supports_list_sets
 
         # State.
         # Tag IDs indexed by profile IDs
@@ -92,8 +135,45 @@ class IpsetManager(ReferenceManager):
         # values.
         self._datamodel_in_sync = False
 
+        # Shared hash:ip ipsets.  Each tag/selector AliasIpsetActor contains
+        # one SharedIpsetActor; aliases with identical members share one.
+        self._shared_by_alias = {}
+        self._aliases_by_shared = defaultdict(set)
+        # Content hash of each shared ipset, as programmed, and an index
+        # from content hash to a shared ipset with those contents.
+        self._hash_by_shared = {}
+        self._shared_by_hash = {}
+        # Shared ipsets that exist in the dataplane and so can be added to
+        # an alias.
+        self._ready_shared = set()
+        # The shared ipset that we last asked each alias to contain.
+        self._told_by_alias = {}
+        # Shared ipsets that each alias may contain in the dataplane.  A
+        # shared ipset can't be deleted while an alias still contains it.
+        self._pointed_by_alias = defaultdict(set)
+        self._pointers_by_shared = defaultdict(set)
+        # Aliases that have been started but not yet given a shared ipset.
+        self._unplaced_aliases = set()
+        self._next_shared_id = 0
+        # Names of the ipsets that existed when we first allocated a shared
+        # ipset name, only loaded if the IPSET_INVENTORY can't tell us.
+        self._existing_ipset_names = None
+
     def _create(self, tag_id_or_sel):
-        if isinstance(tag_id_or_sel, SelectorExpression):
+        if isinstance(tag_id_or_sel, NetSetId):
+            _log.debug("Creating %s ipset with %s members",
+                       tag_id_or_sel.ipset_type, len(tag_id_or_sel.members))
+            ipset_name = futils.uniquely_shorten(tag_id_or_sel.unique_id,
+                                                 MAX_NAME_LENGTH)
+            # Fixed contents so there's nothing to share.
+            return RefCountedIpsetActor(
+                ipset_name,
+                self.ip_type,
+                max_elem=self._config.MAX_IPSET_SIZE,
+                ipset_type=tag_id_or_sel.ipset_type,
+                ipset_cls=self._ipset_cls
+            )
+        elif isinstance(tag_id_or_sel, SelectorExpression):
             _log.debug("Creating ipset for expression %s", tag_id_or_sel)
             sel = tag_id_or_sel
             self._label_index.on_expression_update(sel, sel)
@@ -105,12 +185,15 @@ class IpsetManager(ReferenceManager):
             _log.debug("Creating ipset for tag %s", tag_id_or_sel)
             ipset_name = futils.uniquely_shorten(tag_id_or_sel,
                                                  MAX_NAME_LENGTH)
-        active_ipset = RefCountedIpsetActor(
-            ipset_name,
-            self.ip_type,
-            max_elem=self._config.MAX_IPSET_SIZE
-        )
-        return active_ipset
+        if not self._share_ipsets:
+            # The ipsets hold packed IPs, see TagMembershipIndex.
+            return RefCountedIpsetActor(
+                ipset_name,
+                self.ip_type,
+                max_elem=self._config.MAX_IPSET_SIZE,
+                ipset_cls=self._ipset_cls
+            )
+        return AliasIpsetActor(ipset_name, self.ip_type)
 
     def _maybe_start(self, obj_id):
         if self._datamodel_in_sync:
@@ -122,24 +205,68 @@ class IpsetManager(ReferenceManager):
 
     def _on_object_started(self, tag_id, active_ipset):
         _log.debug("RefCountedIpsetActor actor for %s started", tag_id)
-        # Fill the ipset in with its members, this will trigger its first
-        # programming, after which it will call us back to tell us it is ready.
-        # We can't use self._dirty_tags to defer this in case the set becomes
-        # unreferenced before _finish_msg_batch() is called.
         assert self._is_starting_or_live(tag_id)
         assert self._datamodel_in_sync
         active_ipset = self.objects_by_id[tag_id]
-        members = self.tag_membership_index.members(tag_id)
-        active_ipset.replace_members(members, async=True)
+        if isinstance(tag_id, NetSetId):
+            # Fixed contents, not derived from the endpoints.  Fill the
+            # ipset in with its members, this will trigger its first
+            # programming, after which it will call us back to tell us it
+            # is ready.
+            active_ipset.replace_members(tag_id.members, async=True)
+        elif not self._share_ipsets:
+            active_ipset.replace_members(
+                self.tag_membership_index.members(tag_id), async=True
+            )
+        else:
+            # Defer choosing the shared ipset to _finish_msg_batch(), when
+            # the content hashes of the shared ipsets are up to date.  The
+            # alias becomes ready once it has been programmed to contain
+            # its shared ipset.
+            self._unplaced_aliases.add(active_ipset)
 
     def _update_dirty_active_ipsets(self):
         """
-        Updates the members of any live TagIpsets that are dirty.
+        Updates the members of any shared ipsets whose aliases are dirty,
+        splitting off copies for aliases whose members diverge from the
+        other aliases of the same shared ipset.  Then gives any newly
+        started aliases a shared ipset.
 
-        Clears the index of dirty TagIpsets as a side-effect.
+        Clears the index of dirty tags as a side-effect.
         """
         tag_index = self.tag_membership_index
         ips_added, ips_removed = tag_index.get_and_reset_changes_by_tag()
+        if not self._share_ipsets:
+            self._update_unshared_ipsets(ips_added, ips_removed)
+            return
+        dirty_shared = set()
+        for tag_id in chain(ips_added, ips_removed):
+            alias = self.objects_by_id.get(tag_id)
+            shared = self._shared_by_alias.get(alias)
+            if shared is not None:
+                assert self._datamodel_in_sync
+                dirty_shared.add(shared)
+        num_updates = 0
+        for shared in dirty_shared:
+            if self._update_shared(shared, ips_added, ips_removed):
+                num_updates += 1
+            self._maybe_yield()
+        if num_updates > 0:
+            _log.info("Sent %s updates to shared ipsets", num_updates)
+        for alias in self._unplaced_aliases:
+            if self._is_live_alias(alias):
+                content_hash = tag_index.content_hash(alias._id)
+                shared = (self._find_shared(content_hash, alias._id) or
+                          self._create_shared(content_hash, alias._id))
+                self._set_alias_target(alias, shared)
+            self._maybe_yield()
+        self._unplaced_aliases.clear()
+
+    def _update_unshared_ipsets(self, ips_added, ips_removed):
+        """
+        Applies the changes directly to the ipsets of the tags and
+        selectors, used when the ipsets can't be shared.
+        """
         num_updates = 0
         for tag_id, removed_ips in ips_removed.iteritems():
             if self._is_starting_or_live(tag_id):
@@ -158,6 +285,219 @@ class IpsetManager(ReferenceManager):
         if num_updates > 0:
             _log.info("Sent %s updates to updated tags", num_updates)
 
+    def _update_shared(self, shared, ips_added, ips_removed):
+        """
+        Brings the given shared ipset and its aliases up to date after
+        some of the aliases' members changed.
+
+        If all the aliases still have the same members, the changes are
+        applied to the shared ipset (or, if another shared ipset already
+        has the new members, the aliases are moved to that one).
+        Otherwise, the aliases whose members are unchanged stay put and
+        the others are moved to a shared ipset with the right members,
+        leaving the shared ipset untouched until they've moved.
+
+        :returns True if the shared ipset was updated.
+        """
+        tag_index = self.tag_membership_index
+        old_hash = self._hash_by_shared[shared]
+        aliases_by_hash = defaultdict(list)
+        for alias in self._aliases_by_shared[shared]:
+            if self._is_live_alias(alias):
+                content_hash = tag_index.content_hash(alias._id)
+                aliases_by_hash[content_hash].append(alias)
+        if len(aliases_by_hash) == 1:
+            new_hash, aliases = aliases_by_hash.items()[0]
+            if new_hash == old_hash:
+                _log.debug("Members of %s reverted to their old values",
+                           shared)
+                return False
+            other = self._find_shared(new_hash, aliases[0]._id)
+            if other is not None:
+                _log.info("Members of %s now match %s, merging",
+                          shared, other)
+                for alias in aliases:
+                    self._set_alias_target(alias, other)
+                return False
+            # All the aliases had the same members before and after so the
+            # changes of any one of them are the changes to the shared set.
+            tag_id = next(a._id for a in aliases
+                          if a._id in ips_added or a._id in ips_removed)
+            if tag_id in ips_removed:
+                shared.remove_members(ips_removed[tag_id], async=True)
+            if tag_id in ips_added:
+                shared.add_members(ips_added[tag_id], async=True)
+            self._set_shared_hash(shared, new_hash)
+            return True
+        for new_hash, aliases in aliases_by_hash.iteritems():
+            if new_hash == old_hash:
+                continue
+            _log.info("Members of %s aliases of %s diverged, moving them",
+                      len(aliases), shared)
+            target = (self._find_shared(new_hash, aliases[0]._id) or
+                      self._create_shared(new_hash, aliases[0]._id))
+            for alias in aliases:
+                self._set_alias_target(alias, target)
+        return False
+
+    def _is_live_alias(self, alias):
+        return self.objects_by_id.get(alias._id) is alias
+
+    def _find_shared(self, content_hash, tag_id):
+        """
+        :returns an existing shared ipset with the same members as the
+                 given tag or selector, or None.
+        """
+        shared = self._shared_by_hash.get(content_hash)
+        if shared is None:
+            return None
+        tag_index = self.tag_membership_index
+        for alias in self._aliases_by_shared[shared]:
+            if (self._is_live_alias(alias) and
+                    tag_index.content_hash(alias._id) == content_hash):
+                # Guard against hash collisions.
+                if (set(tag_index.members(alias._id)) ==
+                        set(tag_index.members(tag_id))):
+                    return shared
+                break
+        return None
+
+    def _create_shared(self, content_hash, tag_id):
+        """
+        Creates and starts a new shared ipset holding the current members
+        of the given tag or selector.
+        """
+        name_stem = self._allocate_shared_name_stem()
+        shared = SharedIpsetActor(self, name_stem, self.ip_type,
+                                  max_elem=self._config.MAX_IPSET_SIZE)
+        _log.info("Creating shared ipset %s", shared)
+        shared.start()
+        self._set_shared_hash(shared, content_hash)
+        shared.replace_members(self.tag_membership_index.members(tag_id),
+                               async=True)
+        return shared
+
+    def _allocate_shared_name_stem(self):
+        """
+        Allocates a name stem for a new shared ipset, skipping any names
+        that already exist in the dataplane.  After a restart, the previous
+        run's alias ipsets and iptables rules still refer to its shared
+        ipsets until they're repointed, so we mustn't change the members of
+        those ipsets under their feet.
+        """
+        while True:
+            name_stem = SHARED_PFX + str(self._next_shared_id)
+            self._next_shared_id += 1
+            name = tag_to_ipset_name(self.ip_type, name_stem)
+            exists = IPSET_INVENTORY.exists(name)
+            if exists is None:
+                if self._existing_ipset_names is None:
+                    self._existing_ipset_names = set(list_ipset_names())
+                exists = name in self._existing_ipset_names
+            if not exists:
+                return name_stem
+            _log.debug("Shared ipset %s already exists, skipping", name)
+
+    def _set_shared_hash(self, shared, content_hash):
+        old_hash = self._hash_by_shared.get(shared)
+        if self._shared_by_hash.get(old_hash) is shared:
+            del self._shared_by_hash[old_hash]
+        self._hash_by_shared[shared] = content_hash
+        self._shared_by_hash.setdefault(content_hash, shared)
+
+    def _set_alias_target(self, alias, shared):
+        """
+        Moves the given alias to the given shared ipset.  The alias is
+        reprogrammed immediately if the shared ipset is ready, otherwise
+        when the shared ipset reports that it is ready.
+        """
+        old_shared = self._shared_by_alias.get(alias)
+        if old_shared is shared:
+            return
+        self._shared_by_alias[alias] = shared
+        self._aliases_by_shared[shared].add(alias)
+        if old_shared is not None:
+            self._remove_alias_from_shared(alias, old_shared)
+        if shared in self._ready_shared:
+            self._point_alias(alias, shared)
+
+    def _point_alias(self, alias, shared):
+        self._told_by_alias[alias] = shared
+        self._pointed_by_alias[alias].add(shared)
+        self._pointers_by_shared[shared].add(alias)
+        alias.replace_members([shared.ipset_name], async=True)
+
+    def _remove_alias_from_shared(self, alias, shared):
+        aliases = self._aliases_by_shared[shared]
+        aliases.discard(alias)
+        if not aliases:
+            # Nothing left to verify the contents against, stop sharing it.
+            del self._aliases_by_shared[shared]
+            content_hash = self._hash_by_shared[shared]
+            if self._shared_by_hash.get(content_hash) is shared:
+                del self._shared_by_hash[content_hash]
+            self._maybe_discard_shared(shared)
+
+    def _maybe_discard_shared(self, shared):
+        """
+        Deletes the given shared ipset if it has no aliases and no alias
+        may contain it in the dataplane.
+        """
+        if (shared in self._aliases_by_shared or
+                shared in self._pointers_by_shared or
+                shared not in self._hash_by_shared):
+            return
+        _log.info("Shared ipset %s no longer used, deleting it", shared)
+        del self._hash_by_shared[shared]
+        self._ready_shared.discard(shared)
+        shared.on_unreferenced(async=True)
+
+    @actor_message()
+    def on_shared_ipset_ready(self, shared):
+        """
+        Called by a SharedIpsetActor once it has been programmed for the
+        first time.  Points any waiting aliases at it.
+        """
+        if shared not in self._hash_by_shared:
+            _log.debug("Shared ipset %s already discarded", shared)
+            return
+        self._ready_shared.add(shared)
+        for alias in self._aliases_by_shared.get(shared, ()):
+            if (self._is_live_alias(alias) and
+                    self._told_by_alias.get(alias) is not shared):
+                self._point_alias(alias, shared)
+
+    @actor_message()
+    def on_alias_programmed(self, alias, members):
+        """
+        Called by an AliasIpsetActor after it updates the dataplane.
+
+        :param AliasIpsetActor alias: The alias.
+        :param frozenset members: names of the shared ipsets that the
+               alias now contains; empty once the alias has been deleted.
+        """
+        live = self._is_live_alias(alias)
+        told = self._told_by_alias.get(alias) if live else None
+        pointed = self._pointed_by_alias.get(alias, set())
+        for shared in list(pointed):
+            if shared.ipset_name in members or shared is told:
+                continue
+            pointed.discard(shared)
+            pointers = self._pointers_by_shared[shared]
+            pointers.discard(alias)
+            if not pointers:
+                del self._pointers_by_shared[shared]
+                self._maybe_discard_shared(shared)
+        if not pointed:
+            self._pointed_by_alias.pop(alias, None)
+        if not live:
+            _log.debug("Alias %s no longer live, detaching it", alias)
+            self._told_by_alias.pop(alias, None)
+            self._unplaced_aliases.discard(alias)
+            shared = self._shared_by_alias.pop(alias, None)
+            if shared is not None:
+                self._remove_alias_from_shared(alias, shared)
+
     @property
     def nets_key(self):
         nets = "ipv4_nets" if self.ip_type == IPV4 else "ipv6_nets"
@@ -176,7 +516,10 @@ class IpsetManager(ReferenceManager):
         Clean up left-over ipsets that existed at start-of-day.
         """
         _log.info("Cleaning up left-over ipsets.")
-        all_ipsets = list_ipset_names()
+        # By now, the ipsets have been reconciled with the start-of-day
+        # inventory; free any members that weren't used.
+        IPSET_INVENTORY.discard_members()
+        all_ipsets = self._ipset_cls.list_names(self.ip_type)
         # only clean up our own rubbish.
         pfx = IPSET_PREFIX[self.ip_type]
         tmppfx = IPSET_TMP_PREFIX[self.ip_type]
@@ -188,7 +531,8 @@ class IpsetManager(ReferenceManager):
         # objects, chain them together.
         stopping_ipsets = chain.from_iterable(
             self.stopping_objects_by_id.itervalues())
-        for ipset in chain(live_ipsets, stopping_ipsets):
+        shared_ipsets = self._hash_by_shared.iterkeys()
+        for ipset in chain(live_ipsets, stopping_ipsets, shared_ipsets):
             # Ask the ipset for all the names it may use and whitelist.
             whitelist.update(ipset.owned_ipset_names())
         _log.debug("Whitelisted ipsets: %s", whitelist)
@@ -196,10 +540,12 @@ class IpsetManager(ReferenceManager):
         _log.debug("Deleting ipsets: %s", ipsets_to_delete)
         # Delete the ipsets before we return.  We can't queue these up since
         # that could conflict if someone increffed one of the ones we're about
-        # to delete.
-        for ipset_name in ipsets_to_delete:
+        # to delete.  Aliases go first since the kernel won't delete a shared
+        # ipset that is still in an alias.
+        for ipset_name in sorted(ipsets_to_delete,
+                                 key=lambda n: ALIAS_PFX not in n):
             try:
-                futils.check_call(["ipset", "destroy", ipset_name])
+                self._ipset_cls.destroy_named(self.ip_type, ipset_name)
             except FailedSystemCall:
                 _log.exception("Failed to clean up dead ipset %s, will "
                                "retry on next cleanup.", ipset_name)
@@ -268,6 +614,20 @@ class IpsetManager(ReferenceManager):
             information or None to indicate deletion.
 
         """
+        self._on_endpoint_update(endpoint_id, endpoint)
+
+    @actor_message()
+    def on_endpoint_updates(self, updates):
+        """
+        Batched version of on_endpoint_update().
+
+        :param updates: list of (EndpointId, endpoint dict or None) tuples,
+               in order.
+        """
+        for endpoint_id, endpoint in updates:
+            self._on_endpoint_update(endpoint_id, endpoint)
+
+    def _on_endpoint_update(self, endpoint_id, endpoint):
         endpoint_data = self._endpoint_data_from_dict(endpoint_id, endpoint)
         if endpoint and endpoint_data != EMPTY_ENDPOINT_DATA:
             # This endpoint makes a contribution to the IP addresses, we need
@@ -335,7 +695,8 @@ class IpsetManager(ReferenceManager):
             if nets_list:
                 # Optimization: only return an object if this endpoint makes
                 # some contribution to the IP addresses.
-                ips = map(futils.net_to_ip, nets_list)
+                ips = [futils.ip_to_int(self.ip_type, futils.net_to_ip(n))
+                       for n in nets_list]
                 return EndpointData(profile_ids, ips)
             else:
                 _log.debug("Endpoint makes no contribution, "
@@ -461,20 +822,34 @@ class IpsetManager(ReferenceManager):
 
 
 class TagMembershipIndex(object):
-    """Indexes tag memberships to allow efficient calculation of changes."""
+    """
+    Indexes tag memberships to allow efficient calculation of changes.
+
+    To keep occupancy down when there are many endpoints and tags, IP
+    addresses are stored as packed integers (see futils.ip_to_int()) and
+    each (profile ID, endpoint ID) owner is interned as a small integer.
+    """
     def __init__(self):
         # Main index.  Since an IP address can be assigned to multiple
         # endpoints, we need to track which endpoints reference an IP.  When
         # we find the set of endpoints with an IP is empty, we remove the
         # ip from the tag.
-        # ip_owners_by_tag[tag][ip] = set([(profile_id, combined_id),
-        #                                  (profile_id, combined_id2), ...]) |
-        #                             (profile_id, combined_id)
-        # Here "combined_id" is an EndpointId object.
-        self.ip_owners_by_tag = defaultdict(lambda: defaultdict(lambda: None))
+        # ip_owners_by_tag[tag][ip] = set([owner, owner2, ...]) | owner
+        # Here "owner" is the interned ID of a (profile_id, combined_id)
+        # tuple, where "combined_id" is an EndpointId object.
+        self.ip_owners_by_tag = defaultdict(dict)
+        # Owner interning.  Each owner is reference counted by the number of
+        # (tag, IP) entries that it appears in.
+        self._owner_ids = {}
+        self._owners_by_id = {}
+        self._owner_ref_counts = {}
+        self._free_owner_ids = []
         # IPs added and removed since the last reset.
         self.ips_added_by_tag = defaultdict(set)
         self.ips_removed_by_tag = defaultdict(set)
+        # Incremental multiset hash of the IPs in each tag, the sum of the
+        # hashes of its IPs.  Tags with equal members have equal hashes.
+        self.content_hash_by_tag = {}
 
     def add_mapping(self, tag_id, profile_id, endpoint_id, ip_address):
         """
@@ -485,21 +860,22 @@ class TagMembershipIndex(object):
         :param str tag_id: Tag ID
         :param str profile_id: Profile ID
         :param EndpointId endpoint_id: ID of the endpoint
-        :param str ip_address: IP address to add
+        :param int|long ip_address: IP address to add, as a packed integer.
         """
-        if not self.ip_owners_by_tag[tag_id][ip_address]:
+        ip_owners = self.ip_owners_by_tag[tag_id]
+        owners = ip_owners.get(ip_address)
+        new_owner = self._intern_owner(profile_id, endpoint_id)
+        if owners is None:
+            ip_owners[ip_address] = new_owner
             self._on_ip_added(ip_address, tag_id)
-        owners = self.ip_owners_by_tag[tag_id][ip_address]
-        new_mapping = (profile_id, endpoint_id)
-        if not owners:
-            self.ip_owners_by_tag[tag_id][ip_address] = new_mapping
+        elif owners == new_owner or (isinstance(owners, set) and
+                                     new_owner in owners):
+            _log.debug("Mapping already present")
+            self._release_owner(new_owner)
         elif isinstance(owners, set):
-            owners.add(new_mapping)
+            owners.add(new_owner)
         else:
-            self.ip_owners_by_tag[tag_id][ip_address] = set([
-                owners,
-                new_mapping
-            ])
+            ip_owners[ip_address] = set([owners, new_owner])
 
     def remove_mapping(self, tag_id, profile_id, endpoint_id, ip_address):
         """
@@ -510,16 +886,22 @@ class TagMembershipIndex(object):
         :param str tag_id: Tag ID
         :param str profile_id: Profile ID
         :param EndpointId endpoint_id: ID of the endpoint
-        :param str ip_address: IP address to remove
+        :param int|long ip_address: IP address to remove, as a packed
+               integer.
         """
-        owners = self.ip_owners_by_tag[tag_id][ip_address]
         removed_mapping = (profile_id, endpoint_id)
-        if owners == removed_mapping:
+        removed_owner = self._owner_ids.get(removed_mapping)
+        assert removed_owner is not None, (
+            "Removing mapping %s that isn't in the index" % (removed_mapping,)
+        )
+        ip_owners = self.ip_owners_by_tag[tag_id]
+        owners = ip_owners.get(ip_address)
+        if owners == removed_owner:
             # This was the sole owner of the IP in the tag, remove it.
             _log.debug("%s was sole owner of IP %s, IP no longer in tag",
                        removed_mapping, ip_address)
-            del self.ip_owners_by_tag[tag_id][ip_address]
-            if not self.ip_owners_by_tag[tag_id]:
+            del ip_owners[ip_address]
+            if not ip_owners:
                 _log.debug("Tag %s now empty, removing", tag_id)
                 del self.ip_owners_by_tag[tag_id]
             self._on_ip_removed(ip_address, tag_id)
@@ -530,16 +912,56 @@ class TagMembershipIndex(object):
             )
             assert len(owners) > 1, ("ip_owners_by_tag entry should never "
                                      "be a set with <=1 entry")
-            assert removed_mapping in owners, (
+            assert removed_owner in owners, (
                 "Owners set for IP %s should contain %s" %
                 (ip_address, removed_mapping)
             )
             _log.debug("Tag %s still contains IP %s", tag_id, ip_address)
-            owners.remove(removed_mapping)
+            owners.remove(removed_owner)
             if len(owners) == 1:
                 _log.debug("IP %s now only has one owner, replacing set with "
-                           "single tuple", ip_address)
-                self.ip_owners_by_tag[tag_id][ip_address] = owners.pop()
+                           "single owner", ip_address)
+                ip_owners[ip_address] = owners.pop()
+        self._release_owner(removed_owner)
+
+    def owners(self, tag_id, ip_address):
+        """
+        :returns set of (profile_id, endpoint_id) tuples that put the given
+                 IP in the tag.
+        """
+        owners = self.ip_owners_by_tag.get(tag_id, {}).get(ip_address)
+        if owners is None:
+            return set()
+        if not isinstance(owners, set):
+            owners = [owners]
+        return set(self._owners_by_id[o] for o in owners)
+
+    def _intern_owner(self, profile_id, endpoint_id):
+        """
+        :returns the interned ID of the (profile_id, endpoint_id) owner,
+                 taking a reference on it.
+        """
+        mapping = (profile_id, endpoint_id)
+        owner = self._owner_ids.get(mapping)
+        if owner is None:
+            # Reuse IDs so that they stay small.
+            if self._free_owner_ids:
+                owner = self._free_owner_ids.pop()
+            else:
+                owner = len(self._owner_ids)
+            self._owner_ids[mapping] = owner
+            self._owners_by_id[owner] = mapping
+            self._owner_ref_counts[owner] = 1
+        else:
+            self._owner_ref_counts[owner] += 1
+        return owner
+
+    def _release_owner(self, owner):
+        self._owner_ref_counts[owner] -= 1
+        if not self._owner_ref_counts[owner]:
+            del self._owner_ref_counts[owner]
+            del self._owner_ids[self._owners_by_id.pop(owner)]
+            self._free_owner_ids.append(owner)
 
     def _on_ip_added(self, ip_address, tag_id):
         """
@@ -549,6 +971,10 @@ class TagMembershipIndex(object):
         addition following a removal cleans up the removal.
         """
         _log.debug("IP %s added to tag %s", ip_address, tag_id)
+        self.content_hash_by_tag[tag_id] = (
+            (self.content_hash_by_tag.get(tag_id, 0) +
+             _member_hash(ip_address)) % CONTENT_HASH_MODULUS
+        )
         # Track the addition.
         self.ips_added_by_tag[tag_id].add(ip_address)
         # The addition invalidates any previous removal; clean that up.
@@ -565,6 +991,14 @@ class TagMembershipIndex(object):
         removal following an addition cleans up the addition.
         """
         _log.debug("IP %s removed from tag %s", ip_address, tag_id)
+        if tag_id in self.ip_owners_by_tag:
+            self.content_hash_by_tag[tag_id] = (
+                (self.content_hash_by_tag[tag_id] -
+                 _member_hash(ip_address)) % CONTENT_HASH_MODULUS
+            )
+        else:
+            # Tag is now empty.
+            self.content_hash_by_tag.pop(tag_id, None)
         # Track the removal.
         self.ips_removed_by_tag[tag_id].add(ip_address)
         # The addition invalidates any previous addition; clean that up.
@@ -574,9 +1008,20 @@ class TagMembershipIndex(object):
             del self.ips_added_by_tag[tag_id]
 
     def members(self, tag_id):
+        """
+        :returns list of the IPs in the tag, as packed integers.
+        """
         members = self.ip_owners_by_tag.get(tag_id, {}).keys()
         return members
 
+    def content_hash(self, tag_id):
+        """
+        :returns a hash of the members of the tag; tags with the same
+                 members have the same hash.  The hash of an empty tag
+                 is 0.
+        """
+        return self.content_hash_by_tag.get(tag_id, 0)
+
     def get_and_reset_changes_by_tag(self):
         """ Get the deltas accumulated since the last reset.
         :return: tuple of two dicts.  The first contains the added IPs by tag,
@@ -588,6 +1033,10 @@ class TagMembershipIndex(object):
         return added_and_removed
 
 
+def _member_hash(ip_address):
+    return int(hashlib.md5("%x" % ip_address).hexdigest(), 16)
+
+
 class EndpointData(object):
     """
     Space-efficient read-only 'struct' to hold only the endpoint data
@@ -598,7 +1047,8 @@ class EndpointData(object):
     def __init__(self, profile_ids, ip_addresses):
         """
         :param sequence profile_ids: The profile IDs for the endpoint.
-        :param sequence ip_addresses: IP addresses for the endpoint.
+        :param sequence ip_addresses: IP addresses for the endpoint, packed
+               by futils.ip_to_int().
         """
         # Note: profile IDs are ordered in the data model but the ipsets
         # code doesn't care about the ordering so it's safe to sort these here
@@ -615,7 +1065,7 @@ class EndpointData(object):
 
     @property
     def ip_addresses(self):
-        """:returns set[str]: IP addresses."""
+        """:returns set[int|long]: packed IP addresses."""
         # Generate set on demand to keep occupancy down.  250B overhead for a
         # set vs 64 for a tuple.
         return set(self._ip_addresses)
@@ -663,6 +1113,8 @@ class IpsetActor(Actor):
         self.changes = None
 
         self._force_reprogram = True
+        # Set until we first sync to the dataplane.
+        self._first_sync = True
         self.stopped = False
 
     @property
@@ -728,9 +1180,13 @@ class IpsetActor(Actor):
                        self._ipset.max_elem)
             return
 
-        if not self._force_reprogram:
-            # Just an incremental update, try to apply it as a delta.
-            if not self.changes.empty:
+        if not self._force_reprogram and not self.changes.empty:
+            if not self._ipset.supports_deltas:
+                _log.debug("%s doesn't support deltas, rewriting it",
+                           self.name)
+                self._force_reprogram = True
+            else:
+                # Just an incremental update, try to apply it as a delta.
                 _log.debug("Normal update, attempting to apply as a delta:"
                            "added=%s, removed=%s", self.changes.added_entries,
                            self.changes.removed_entries)
@@ -747,6 +1203,33 @@ class IpsetActor(Actor):
         # as a whole.  Either way, apply the changes to the members set.
         self.changes.apply_and_reset()
 
+        if self._force_reprogram and self._first_sync:
+            # After a restart, the set may already exist with most of the
+            # right members; if so, update it in place rather than
+            # rewriting it.
+            existing_members = self._ipset.take_existing_members()
+            if existing_members is not None:
+                added = self.members - existing_members
+                removed = existing_members - self.members
+                _log.info("Reconciling existing ipset %s: %d to add, %d "
+                          "to remove", self.ipset_name, len(added),
+                          len(removed))
+                try:
+                    if added or removed:
+                        self._ipset.apply_changes(added, removed)
+                except FailedSystemCall as e:
+                    _log.error("Failed to reconcile ipset %s, doing a full "
+                               "rewrite RC=%s, err=%s",
+                               self.name, e.retcode, e.stderr)
+                else:
+                    self._force_reprogram = False
+                    RECONCILIATION_STATS.increment("ipset rewrites avoided")
+                    RECONCILIATION_STATS.increment(
+                        "ipset entries not rewritten",
+                        by=len(existing_members) - len(removed)
+                    )
+        self._first_sync = False
+
         if self._force_reprogram:
             # Initial update or post-failure, completely replace the ipset's
             # contents with an atomic swap.
@@ -759,22 +1242,28 @@ class IpsetActor(Actor):
 
 class RefCountedIpsetActor(IpsetActor, RefCountedActor):
     """
-    Specialised, RefCountedActor managing a single ipset for a tag or
-    selector.
+    Specialised, RefCountedActor managing a single ipset for a tag,
+    selector or NetSetId.
     """
 
-    def __init__(self, name_stem, ip_type, max_elem=DEFAULT_IPSET_SIZE):
+    def __init__(self, name_stem, ip_type, max_elem=DEFAULT_IPSET_SIZE,
+                 ipset_type="hash:ip", ipset_cls=None):
         """
         :param str name_stem: ipset name suffix. The name of the ipset is
                derived from this value.
         :param ip_type: One of the constants, futils.IPV4 or futils.IPV6
+        :param str ipset_type: The ipset type, for example "hash:ip".
+        :param ipset_cls: class used to program the ipset, defaults to
+               Ipset.
         """
         self.name_stem = name_stem
         suffix = tag_to_ipset_name(ip_type, name_stem)
         tmpname = tag_to_ipset_name(ip_type, name_stem, tmp=True)
         family = "inet" if ip_type == IPV4 else "inet6"
         # Helper class, used to do atomic rewrites of ipsets.
-        ipset = Ipset(suffix, tmpname, family, "hash:ip", max_elem=max_elem)
+        ipset_cls = ipset_cls or Ipset
+        ipset = ipset_cls(suffix, tmpname, family, ipset_type,
+                          max_elem=max_elem)
         super(RefCountedIpsetActor, self).__init__(ipset, qualifier=suffix)
 
         # Notified ready?
@@ -803,10 +1292,105 @@ class RefCountedIpsetActor(IpsetActor, RefCountedActor):
         return self.__class__.__name__ + "<%s,%s>" % (self._id, self.name)
 
 
+class AliasIpsetActor(RefCountedIpsetActor):
+    """
+    RefCountedIpsetActor for a tag or selector.  Manages a list:set ipset
+    that contains the SharedIpsetActor ipset that holds the members so that
+    tags and selectors with the same members can share a hash:ip ipset.
+
+    Reports the contents of its ipset to the IpsetManager after each
+    change so that the manager knows when shared ipsets can be deleted.
+    """
+
+    def __init__(self, name_stem, ip_type):
+        super(AliasIpsetActor, self).__init__(ALIAS_PFX + name_stem,
+                                              ip_type,
+                                              max_elem=ALIAS_IPSET_SIZE,
+                                              ipset_type="list:set")
+        self._reported_members = None
+
+    @actor_message()
+    def on_unreferenced(self):
+        self.stopped = True
+        try:
+            self._ipset.delete()
+        finally:
+            self._manager.on_alias_programmed(self, frozenset(), async=True)
+            self._notify_cleanup_complete()
+
+    def _finish_msg_batch(self, batch, results):
+        super(AliasIpsetActor, self)._finish_msg_batch(batch, results)
+        if (not self.stopped and self.members is not None and
+                self.members != self._reported_members):
+            self._reported_members = frozenset(self.members)
+            self._manager.on_alias_programmed(self, self._reported_members,
+                                              async=True)
+
+
+class SharedIpsetActor(IpsetActor):
+    """
+    Actor managing a hash:ip ipset that holds the members of one or more
+    tags/selectors with identical members.  Owned by the IpsetManager,
+    which adds it to the AliasIpsetActors of those tags/selectors.
+
+    Members are IP addresses packed by futils.ip_to_int().
+    """
+
+    def __init__(self, manager, name_stem, ip_type,
+                 max_elem=DEFAULT_IPSET_SIZE):
+        name = tag_to_ipset_name(ip_type, name_stem)
+        tmpname = tag_to_ipset_name(ip_type, name_stem, tmp=True)
+        ipset = PackedIpset(name, tmpname, ip_type, max_elem=max_elem)
+        super(SharedIpsetActor, self).__init__(ipset, qualifier=name)
+        self._manager = manager
+        self.notified_ready = False
+
+    @actor_message()
+    def on_unreferenced(self):
+        """
+        Called by the manager once no alias contains this ipset.
+        """
+        self.stopped = True
+        self._ipset.delete()
+
+    def _finish_msg_batch(self, batch, results):
+        super(SharedIpsetActor, self)._finish_msg_batch(batch, results)
+        if not self.notified_ready and not self.stopped:
+            self.notified_ready = True
+            self._manager.on_shared_ipset_ready(self, async=True)
+
+    def __str__(self):
+        return self.__class__.__name__ + "<%s>" % self.name
+
+
 class Ipset(object):
     """
     (Synchronous) wrapper around an ipset, supporting atomic rewrites.
     """
+    # list:set ipsets are available, allowing the IpsetManager to share
+    # ipsets between tags and selectors.
+    supports_list_sets = True
+    # Members can be added and removed individually by apply_changes().
+    supports_deltas = True
+
+    @staticmethod
+    def list_names(ip_type):
+        """
+        :returns list of the names of all the ipsets in the dataplane; the
+                 caller filters them by prefix.
+        """
+        return list_ipset_names()
+
+    @staticmethod
+    def destroy_named(ip_type, name):
+        """
+        Destroys the named ipset.
+
+        :raises FailedSystemCall if the ipset can't be destroyed.
+        """
+        futils.check_call(["ipset", "destroy", name])
+        IPSET_INVENTORY.on_destroyed(name)
+
     def __init__(self, ipset_name, temp_ipset_name, ip_family,
                  ipset_type="hash:ip", max_elem=DEFAULT_IPSET_SIZE):
         """
@@ -825,11 +1409,13 @@ class Ipset(object):
         self.max_elem = max_elem
 
     def exists(self, temp_set=False):
+        name = self.temp_set_name if temp_set else self.set_name
+        known = IPSET_INVENTORY.exists(name)
+        if known is not None:
+            RECONCILIATION_STATS.increment("ipset commands avoided")
+            return known
         try:
-            futils.check_call(
-                ["ipset", "list",
-                 self.temp_set_name if temp_set else self.set_name]
-            )
+            futils.check_call(["ipset", "list", name])
         except FailedSystemCall as e:
             if e.retcode == 1 and "does not exist" in e.stderr:
                 return False
@@ -845,8 +1431,14 @@ class Ipset(object):
 
         Leaves the set and its contents untouched if it already exists.
         """
+        if IPSET_INVENTORY.exists(self.set_name):
+            _log.debug("Inventory says ipset %s exists", self.set_name)
+            RECONCILIATION_STATS.increment("ipset commands avoided")
+            return
         input_lines = [self._create_cmd(self.set_name)]
         self._exec_and_commit(input_lines)
+        IPSET_INVENTORY.on_created(self.set_name, self.type,
+                                   self._create_options())
 
     def apply_changes(self, added_entries, removed_entries):
         """
@@ -854,20 +1446,56 @@ class Ipset(object):
 
         :raises FailedSystemCall if the update fails.
         """
-        input_lines = ["del %s %s" % (self.set_name, m)
+        fmt = self._format_member
+        input_lines = ["del %s %s" % (self.set_name, fmt(m))
                        for m in removed_entries]
-        input_lines += ["add %s %s" % (self.set_name, m)
+        input_lines += ["add %s %s" % (self.set_name, fmt(m))
                         for m in added_entries]
         _log.info("Making %d changes to ipset %s",
                   len(input_lines), self.set_name)
         self._exec_and_commit(input_lines)
 
+    def take_existing_members(self):
+        """
+        Returns the members that the ipset had when the IPSET_INVENTORY was
+        loaded, if it exists with matching parameters, and then releases
+        them from the inventory.  Allows an existing set to be updated
+        in place at start of day.
+
+        :returns: set of members in the same form as passed to
+                  replace_members() or None if not known.
+        """
+        members = IPSET_INVENTORY.take_members(self.set_name, self.type,
+                                               self._create_options())
+        if members is None:
+            return None
+        try:
+            return set(self._parse_member(m) for m in members)
+        except ValueError:
+            _log.warning("Failed to parse members of existing ipset %s",
+                         self.set_name)
+            return None
+
     def replace_members(self, members):
         """
         Atomically rewrites the ipset with the new members.
 
         Creates the set if it does not exist.
         """
+        try:
+            self._replace_members(members)
+        except FailedSystemCall:
+            if IPSET_INVENTORY.exists(self.set_name) is None:
+                raise
+            # The inventory may be out of date, forget what it knows about
+            # our sets and retry, checking the dataplane.
+            _log.warning("Failed to rewrite ipset %s, retrying without "
+                         "using the ipset inventory", self.set_name)
+            IPSET_INVENTORY.forget(self.set_name)
+            IPSET_INVENTORY.forget(self.temp_set_name)
+            self._replace_members(members)
+
+    def _replace_members(self, members):
         # We use ipset restore, which processes a batch of ipset updates.
         # The only operation that we're sure is atomic is swapping two ipsets
         # so we build up the complete set of members in a temporary ipset,
@@ -876,8 +1504,12 @@ class Ipset(object):
         assert isinstance(members, (set, frozenset))
         assert len(members) <= self.max_elem
         # Try to destroy the temporary set so that we get to recreate it below,
-        # possibly with new parameters.
-        if futils.call_silent(["ipset", "destroy", self.temp_set_name]) != 0:
+        # possibly with new parameters.  No need if the inventory tells us
+        # that it doesn't exist.
+        if IPSET_INVENTORY.exists(self.temp_set_name) is False:
+            RECONCILIATION_STATS.increment("ipset commands avoided")
+        elif futils.call_silent(["ipset", "destroy",
+                                 self.temp_set_name]) != 0:
             if self.exists(temp_set=True):
                 _log.error("Failed to delete temporary ipset %s.  Subsequent "
                            "commands may fail.",
@@ -901,7 +1533,8 @@ class Ipset(object):
             "flush %s" % self.temp_set_name,
         ]
         # Add all the members to the temporary set,
-        input_lines += ["add %s %s" % (self.temp_set_name, m)
+        fmt = self._format_member
+        input_lines += ["add %s %s" % (self.temp_set_name, fmt(m))
                         for m in members]
         # Then, atomically swap the temporary set into place.
         input_lines.append("swap %s %s" % (self.set_name, self.temp_set_name))
@@ -909,6 +1542,9 @@ class Ipset(object):
         input_lines.append("destroy %s" % self.temp_set_name)
         # COMMIT tells ipset restore to actually execute the changes.
         self._exec_and_commit(input_lines)
+        IPSET_INVENTORY.on_created(self.set_name, self.type,
+                                   self._create_options())
+        IPSET_INVENTORY.on_destroyed(self.temp_set_name)
 
     def _exec_and_commit(self, input_lines):
         """
@@ -919,11 +1555,38 @@ class Ipset(object):
         input_str = "\n".join(input_lines) + "\n"
         futils.check_call(["ipset", "restore"], input_str=input_str)
 
+    def _format_member(self, member):
+        """
+        :returns the member as it should appear in ipset restore input.
+        """
+        return member
+
+    def _parse_member(self, member_str):
+        """
+        Reverses _format_member().
+
+        :raises ValueError if the member can't be parsed.
+        """
+        return member_str
+
+    def _create_options(self):
+        """
+        :returns dict of the options that we create the ipset with, in the
+                 form reported by "ipset save".
+        """
+        if self.type == "list:set":
+            return {"size": str(self.max_elem)}
+        return {"family": self.family, "maxelem": str(self.max_elem)}
+
     def _create_cmd(self, name):
         """
         :returns an ipset restore line to create the given ipset iff it
             doesn't exist.
         """
+        if self.type == "list:set":
+            # list:sets have a size rather than a family and maxelem.
+            return ("create %s list:set size %s --exist" %
+                    (name, self.max_elem))
         return ("create %s %s family %s maxelem %s --exist" %
                 (name, self.type, self.family, self.max_elem))
 
@@ -933,8 +1596,170 @@ class Ipset(object):
         """
         _log.debug("Delete ipsets %s and %s if they exist",
                    self.set_name, self.temp_set_name)
-        futils.call_silent(["ipset", "destroy", self.set_name])
-        futils.call_silent(["ipset", "destroy", self.temp_set_name])
+        for name in (self.set_name, self.temp_set_name):
+            if IPSET_INVENTORY.exists(name) is False:
+                RECONCILIATION_STATS.increment("ipset commands avoided")
+            else:
+                futils.call_silent(["ipset", "destroy", name])
+            IPSET_INVENTORY.on_destroyed(name)
+
+
+class PackedIpset(Ipset):
+    """
+    hash:ip Ipset whose members are IP addresses packed by
+    futils.ip_to_int().  They're only converted back to strings as the
+    ipset restore input is written.
+    """
+    def __init__(self, ipset_name, temp_ipset_name, ip_type,
+                 max_elem=DEFAULT_IPSET_SIZE):
+        family = "inet" if ip_type == IPV4 else "inet6"
+        super(PackedIpset, self).__init__(ipset_name, temp_ipset_name,
+                                          family, "hash:ip",
+                                          max_elem=max_elem)
+        self.ip_type = ip_type
+
+    def _format_member(self, member):
+        return futils.int_to_ip(self.ip_type, member)
+
+    def _parse_member(self, member_str):
+        try:
+            return futils.ip_to_int(self.ip_type, member_str)
+        except socket.error:
+            raise ValueError("Invalid IP %r" % member_str)
+
+
+class IpsetInventory(object):
+    """
+    In-memory model of the ipsets that exist in the dataplane, loaded with
+    a single "ipset save" rather than an "ipset list" per set.
+
+    Until it is loaded, the inventory knows nothing and Ipset objects fall
+    back to querying the dataplane.  Once loaded, the Ipset objects keep it
+    up to date as they create and delete their sets, allowing them to skip
+    existence checks.  It also records the members of each set so that,
+    after a restart, sets can be updated in place by delta rather than
+    rewritten.
+
+    Not safe to refresh while Ipset objects are modifying the dataplane;
+    intended to be refreshed at start of day.
+    """
+    # Options that take a value in "ipset save" output.
+    VALUED_OPTIONS = set(["family", "hashsize", "maxelem", "size",
+                          "timeout", "netmask", "markmask", "range",
+                          "bucketsize", "initval"])
+
+    def __init__(self):
+        self.loaded = False
+        # Options dicts, indexed by name.
+        self._options_by_name = {}
+        # Members as strings, indexed by name; released as they're taken.
+        self._members_by_name = {}
+        # Names that we've been told to forget about since the last refresh.
+        self._unknown_names = set()
+
+    def refresh(self):
+        """
+        Reloads the inventory from the dataplane.
+
+        :raises FailedSystemCall if "ipset save" fails.
+        """
+        _log.info("Loading ipset inventory")
+        data = futils.check_call(["ipset", "save"]).stdout
+        options_by_name = {}
+        members_by_name = defaultdict(set)
+        for line in data.split("\n"):
+            words = line.split()
+            if len(words) >= 3 and words[0] == "create":
+                options = self._parse_options(words[3:])
+                options["type"] = words[2]
+                options_by_name[words[1]] = options
+                members_by_name[words[1]] = set()
+            elif len(words) >= 3 and words[0] == "add":
+                members_by_name[words[1]].add(words[2])
+        self._options_by_name = options_by_name
+        self._members_by_name = dict(members_by_name)
+        self._unknown_names = set()
+        self.loaded = True
+        _log.info("Loaded %s ipsets into inventory", len(options_by_name))
+
+    def _parse_options(self, words):
+        options = {}
+        words = iter(words)
+        for word in words:
+            if word in self.VALUED_OPTIONS:
+                options[word] = next(words, None)
+            else:
+                options[word] = True
+        return options
+
+    def exists(self, name):
+        """
+        :returns True or False if the inventory knows whether the named
+                 ipset exists, None if it doesn't know.
+        """
+        if not self.loaded or name in self._unknown_names:
+            return None
+        return name in self._options_by_name
+
+    def names(self):
+        """
+        :returns set of names of the ipsets or None if not loaded.
+        """
+        if not self.loaded:
+            return None
+        return set(self._options_by_name)
+
+    def take_members(self, name, ipset_type, options):
+        """
+        Removes and returns the members of the named ipset, if it was
+        loaded with the given type and options.  The members can only be
+        taken once.
+
+        :returns set of member strings or None.
+        """
+        members = self._members_by_name.pop(name, None)
+        existing_options = self._options_by_name.get(name)
+        if (members is None or existing_options is None or
+                name in self._unknown_names or
+                existing_options["type"] != ipset_type or
+                any(existing_options.get(k) != v
+                    for k, v in options.iteritems())):
+            return None
+        return members
+
+    def discard_members(self):
+        """
+        Releases the members of any ipsets that haven't been taken.
+        """
+        self._members_by_name = {}
+
+    def on_created(self, name, ipset_type, options):
+        """
+        Records that the named ipset now exists with the given type and
+        options.  Its members are no longer known.
+        """
+        self._members_by_name.pop(name, None)
+        self._unknown_names.discard(name)
+        if self.loaded:
+            self._options_by_name[name] = dict(options, type=ipset_type)
+
+    def on_destroyed(self, name):
+        self._members_by_name.pop(name, None)
+        self._options_by_name.pop(name, None)
+        self._unknown_names.discard(name)
+
+    def forget(self, name):
+        """
+        Marks the named ipset as unknown until it is next created or
+        destroyed, or the inventory is refreshed.
+        """
+        self._members_by_name.pop(name, None)
+        self._options_by_name.pop(name, None)
+        self._unknown_names.add(name)
+
+
+# Inventory of the ipsets in the dataplane, shared by all Ipset objects.
+IPSET_INVENTORY = IpsetInventory()
 
 
 # For IP-in-IP support, a global ipset that contains the IP addresses of all
@@ -967,14 +1792,5 @@ def list_ipset_names():
 
     :returns: List of names of ipsets.
     """
-    data = futils.check_call(["ipset", "list"]).stdout
-    lines = data.split("\n")
-
-    names = []
-
-    for line in lines:
-        words = line.split()
-        if len(words) > 1 and words[0] == "Name:":
-            names.append(words[1])
-
-    return names
+    data = futils.check_call(["ipset", "list", "-name"]).stdout
+    return [line.strip() for line in data.split("\n") if line.strip()]
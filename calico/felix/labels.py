@@ -12,6 +12,7 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import collections
 import logging
 
 from calico.calcollections import MultiDict
@@ -80,6 +81,25 @@ class LinearScanLabelIndex(object):
         self._scan_all_expressions(item_id, new_labels)
         self._store_labels(item_id, new_labels)
 
+    def on_labels_delta(self, item_id, labels, changes):
+        """
+        Called when some of the labels of an item change without the item
+        itself being updated; for example, when the labels that it
+        inherits from a parent change.
+
+        Triggers events for match changes.
+        :param item_id: an opaque (hashable) ID of an item that is already
+               in the index.
+        :param labels: The item's (new) labels, may be the same mapping
+               object that was previously passed in for the item.
+        :param dict changes: dict mapping each label name that changed to
+               a tuple of its old and new values.  A value of None
+               indicates that the label was not present.
+        """
+        _log.debug("Labels for %s changed: %s", item_id, changes)
+        self._scan_all_expressions(item_id, labels)
+        self._store_labels(item_id, labels)
+
     def _scan_all_labels(self, expr_id, expr):
         """
         Check the given expression against all label dicts and emit
@@ -198,6 +218,10 @@ class LabelValueIndex(LinearScanLabelIndex):
         # Mapping from expression ID to any expressions that can't be
         # represented in the way described above.
         self.non_kv_expressions_by_id = {}
+        # Maps from label name to the IDs of the expressions in
+        # non_kv_expressions_by_id that read that label.  Used to limit the
+        # expressions that we re-evaluate when only some labels change.
+        self.non_kv_expr_ids_by_label_name = MultiDict()
 
     def on_labels_update(self, item_id, new_labels):
         """
@@ -248,6 +272,41 @@ class LabelValueIndex(LinearScanLabelIndex):
         # Finally, store the update.
         self._store_labels(item_id, new_labels)
 
+    def on_labels_delta(self, item_id, labels, changes):
+        """
+        Called when some of the labels of an item change without the item
+        itself being updated; for example, when the labels that it
+        inherits from a parent change.
+
+        Only updates the index entries for the changed labels and only
+        re-evaluates the expressions that mention them.
+
+        Triggers events for match changes.
+        :param item_id: an opaque (hashable) ID of an item that is already
+               in the index.
+        :param labels: The item's (new) labels, may be the same mapping
+               object that was previously passed in for the item.
+        :param dict changes: dict mapping each label name that changed to
+               a tuple of its old and new values.  A value of None
+               indicates that the label was not present.
+        """
+        _log.debug("Labels for %s changed: %s", item_id, changes)
+        expr_ids = set()
+        for k, (old_value, new_value) in changes.iteritems():
+            if old_value is not None:
+                k_v = k, old_value
+                self.item_ids_by_key_value.discard(k_v, item_id)
+                expr_ids.update(self.literal_exprs_by_kv.iter_values(k_v))
+            if new_value is not None:
+                k_v = k, new_value
+                self.item_ids_by_key_value.add(k_v, item_id)
+                expr_ids.update(self.literal_exprs_by_kv.iter_values(k_v))
+            expr_ids.update(self.non_kv_expr_ids_by_label_name.iter_values(k))
+        for expr_id in expr_ids:
+            self._update_matches(expr_id, self.expressions_by_id[expr_id],
+                                 item_id, labels)
+        self._store_labels(item_id, labels)
+
     def on_expression_update(self, expr_id, expr):
         """
         Called to update a particular expression.
@@ -281,7 +340,10 @@ class LabelValueIndex(LinearScanLabelIndex):
                 k_v = label_name, value
                 self.literal_exprs_by_kv.discard(k_v, expr_id)
 
-        self.non_kv_expressions_by_id.pop(expr_id, None)
+        if self.non_kv_expressions_by_id.pop(expr_id, None) is not None:
+            for label_name in old_expr.label_names:
+                self.non_kv_expr_ids_by_label_name.discard(label_name,
+                                                           expr_id)
 
         if not expr:
             # Deletion, clean up the matches.
@@ -346,6 +408,8 @@ class LabelValueIndex(LinearScanLabelIndex):
                            expr_id)
                 self._scan_all_labels(expr_id, expr)
             self.non_kv_expressions_by_id[expr_id] = expr
+            for label_name in expr.label_names:
+                self.non_kv_expr_ids_by_label_name.add(label_name, expr_id)
         # Finally, store the update.
         self._store_expression(expr_id, expr)
 
@@ -376,10 +440,69 @@ class LabelValueIndex(LinearScanLabelIndex):
         return min_kv
 
 
+class InheritedLabels(collections.Mapping):
+    """
+    Read-only, layered view of an item's labels over the labels of its
+    parents.
+
+    The item's own labels take precedence, followed by the labels of its
+    parents, with later parents overriding earlier ones.  The parents'
+    labels are looked up on each access so the view reflects any
+    subsequent parent updates without being rebuilt.
+    """
+    __slots__ = ["item_labels", "parent_ids", "labels_by_parent_id"]
+
+    def __init__(self, item_labels, parent_ids, labels_by_parent_id):
+        self.item_labels = item_labels
+        self.parent_ids = parent_ids
+        self.labels_by_parent_id = labels_by_parent_id
+
+    def __getitem__(self, key):
+        try:
+            return self.item_labels[key]
+        except KeyError:
+            pass
+        for parent_id in reversed(self.parent_ids):
+            parent_labels = self.labels_by_parent_id.get(parent_id)
+            if parent_labels and key in parent_labels:
+                return parent_labels[key]
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        keys = set(self.item_labels)
+        for parent_id in self.parent_ids:
+            keys.update(self.labels_by_parent_id.get(parent_id) or ())
+        return iter(keys)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return "InheritedLabels(%r)" % dict(self.iteritems())
+
+
 class LabelInheritanceIndex(object):
     """
     Wraps a LabelIndex, adding the ability for items to inherit labels
     from a list of named parents.
+
+    Items with parents are passed to the LabelIndex as InheritedLabels
+    views so that we never copy the parents' labels.  When a parent's
+    labels change, we calculate which of each child's effective labels
+    changed and pass only those to the LabelIndex as a delta.
     """
     def __init__(self, label_index):
         self.label_index = label_index
@@ -447,12 +570,69 @@ class LabelInheritanceIndex(object):
                 self.labels_by_parent_id[parent_id] = labels_or_none
             else:
                 del self.labels_by_parent_id[parent_id]
-            # Mark all the endpoints with this parent dirty.
-            self._dirty_items.update(
-                self.item_ids_by_parent_id.iter_values(parent_id)
-            )
+            # Calculate and pass on the changes to each child's labels.
+            old_parent_labels = old_parent_labels or {}
+            new_parent_labels = labels_or_none or {}
+            changed_keys = [
+                k for k in set(old_parent_labels).union(new_parent_labels)
+                if old_parent_labels.get(k) != new_parent_labels.get(k)
+            ]
+            _log.debug("Parent %s changed keys: %s", parent_id, changed_keys)
+            for item_id in self.item_ids_by_parent_id.iter_values(parent_id):
+                self._propagate_parent_change(item_id, parent_id,
+                                              old_parent_labels,
+                                              new_parent_labels,
+                                              changed_keys)
         self._flush_updates()
 
+    def _propagate_parent_change(self, item_id, parent_id, old_parent_labels,
+                                 new_parent_labels, changed_keys):
+        """
+        Passes the effect of a parent's label change on the given item to
+        the wrapped label index.
+        """
+        try:
+            item_labels = self.labels_by_item_id[item_id]
+        except KeyError:
+            # Item has no labels so it's not in the label index.
+            return
+        parent_ids = self.parent_ids_by_item_id[item_id]
+        changes = {}
+        for k in changed_keys:
+            if k in item_labels:
+                # Per-item labels override the parents'.
+                continue
+            old_value = self._inherited_value(k, parent_ids, parent_id,
+                                              old_parent_labels)
+            new_value = self._inherited_value(k, parent_ids, parent_id,
+                                              new_parent_labels)
+            if old_value != new_value:
+                changes[k] = (old_value, new_value)
+        if changes:
+            self.label_index.on_labels_delta(
+                item_id,
+                InheritedLabels(item_labels, parent_ids,
+                                self.labels_by_parent_id),
+                changes
+            )
+
+    def _inherited_value(self, key, parent_ids, changed_parent_id,
+                         changed_parent_labels):
+        """
+        :returns: the value of the given label that an item with the given
+                  parents would inherit, assuming that the labels of
+                  changed_parent_id are changed_parent_labels, or None if
+                  the label is not present.
+        """
+        for parent_id in reversed(parent_ids):
+            if parent_id == changed_parent_id:
+                parent_labels = changed_parent_labels
+            else:
+                parent_labels = self.labels_by_parent_id.get(parent_id)
+            if parent_labels and key in parent_labels:
+                return parent_labels[key]
+        return None
+
     def _flush_updates(self):
         _log.debug("Flushing updates...")
         for item_id in self._dirty_items:
@@ -471,23 +651,14 @@ class LabelInheritanceIndex(object):
             _log.debug("Flushing deletion of %s", item_id)
             self.label_index.on_labels_update(item_id, None)
         else:
-            # May need to combine labels with parents.
-            _log.debug("Combining labels for %s", item_id)
-            combined_labels = {}
-            parent_ids = self.parent_ids_by_item_id.get(item_id, [])
+            parent_ids = self.parent_ids_by_item_id.get(item_id)
             _log.debug("Item %s has parents %s", item_id, parent_ids)
-            for parent_id in parent_ids:
-                parent_labels = self.labels_by_parent_id.get(parent_id)
-                _log.debug("Parent %s has labels %s", parent_id, parent_labels)
-                if parent_labels:
-                    combined_labels.update(parent_labels)
-            if combined_labels:
-                # Some contribution from parent, need to combine.
-                _log.debug("Combined labels: %s", combined_labels)
-                combined_labels.update(item_labels)
+            if parent_ids:
+                # Layer the item's labels over its parents'.  The view
+                # tracks subsequent parent updates.
+                combined_labels = InheritedLabels(item_labels, parent_ids,
+                                                  self.labels_by_parent_id)
             else:
-                # Parent makes no contribution, just use the per-item dict.
-                _log.debug("No parent labels, using item's dict %s",
-                           combined_labels)
+                # No parents, just use the per-item dict.
                 combined_labels = item_labels
             self.label_index.on_labels_update(item_id, combined_labels)
\ No newline at end of file
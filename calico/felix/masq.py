@@ -18,7 +18,7 @@ MASQ_RULE_FRAGMENT = ("POSTROUTING "
                                              ALL_POOLS_SET_NAME))
 
 class MasqueradeManager(Actor):
-    def __init__(self, ip_type, iptables_mgr):
+    def __init__(self, ip_type, iptables_mgr, ipset_cls=None):
         super(MasqueradeManager, self).__init__(qualifier=str(ip_type))
         assert ip_type in (IPV4, IPV6)
         assert iptables_mgr.table == "nat"
@@ -26,14 +26,15 @@ class MasqueradeManager(Actor):
         self.pools_by_id = {}
         self._iptables_mgr = iptables_mgr
         ip_family = "inet" if ip_type == IPV4 else "inet6"
-        self._all_pools_ipset = Ipset(ALL_POOLS_SET_NAME,
-                                      ALL_POOLS_SET_NAME + "-tmp",
-                                      ip_family,
-                                      "hash:net")
-        self._masq_pools_ipset = Ipset(MASQ_POOLS_SET_NAME,
-                                       MASQ_POOLS_SET_NAME + "-tmp",
-                                       ip_family,
-                                       "hash:net")
+        ipset_cls = ipset_cls or Ipset
+        self._all_pools_ipset = ipset_cls(ALL_POOLS_SET_NAME,
+                                          ALL_POOLS_SET_NAME + "-tmp",
+                                          ip_family,
+                                          "hash:net")
+        self._masq_pools_ipset = ipset_cls(MASQ_POOLS_SET_NAME,
+                                           MASQ_POOLS_SET_NAME + "-tmp",
+                                           ip_family,
+                                           "hash:net")
         self._dirty = False
 
     @actor_message()
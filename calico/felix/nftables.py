@@ -0,0 +1,998 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2015 Metaswitch Networks
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""
+felix.nftables
+~~~~~~~~~~~~~~
+
+nftables dataplane backend.
+
+Felix's chains, ipsets and dispatch chains are programmed into one nftables
+table per IP version.  The rest of Felix still generates iptables rule
+fragments; the NftablesUpdater translates them into nftables rules (see
+translate_fragment()).  Each batch of updates is applied with a single
+"nft -f" run, which the kernel applies as one atomic transaction.
+
+Only the iptables options that Felix generates are translated.
+"""
+from collections import defaultdict, namedtuple
+import logging
+import random
+import re
+import shlex
+import sys
+import time
+
+import gevent
+
+from calico.calcollections import LRUCache
+from calico.felix import futils
+from calico.felix.actor import (
+    Actor, actor_message, ResultOrExc, SplitBatchAndRetry
+)
+from calico.felix.dispatch import DispatchChains
+from calico.felix.frules import (
+    CHAIN_TO_ENDPOINT, CHAIN_FROM_ENDPOINT, CHAIN_TO_PREFIX,
+    CHAIN_FROM_PREFIX, FELIX_PREFIX, interface_to_suffix
+)
+from calico.felix.futils import FailedSystemCall, IPV4, IPV6, StatCounter
+from calico.felix.ipsets import DEFAULT_IPSET_SIZE
+
+_log = logging.getLogger(__name__)
+
+NFT_TABLE = "calico"
+NFT_FAMILIES = {4: "ip", 6: "ip6"}
+# "nft -f" applies the whole file as one transaction.
+NFT_RESTORE_CMD = ["nft", "-f", "/dev/stdin"]
+
+# The kernel's iptables chains that Felix inserts rules into become nft base
+# chains, hooked in with the same type and priority as the iptables table.
+# Indexed by (iptables table, chain); values are (type, hook, priority).
+BASE_CHAINS = {
+    ("filter", "INPUT"): ("filter", "input", 0),
+    ("filter", "FORWARD"): ("filter", "forward", 0),
+    ("filter", "OUTPUT"): ("filter", "output", 0),
+    ("nat", "PREROUTING"): ("nat", "prerouting", -100),
+    ("nat", "INPUT"): ("nat", "input", 100),
+    ("nat", "OUTPUT"): ("nat", "output", -100),
+    ("nat", "POSTROUTING"): ("nat", "postrouting", 100),
+    ("raw", "PREROUTING"): ("filter", "prerouting", -300),
+    ("raw", "OUTPUT"): ("filter", "output", -300),
+}
+
+# Rules of a chain that is required but hasn't been programmed.
+STUB_RULES = ['drop comment "WARNING Missing chain"']
+
+# Number of translated rule fragments to cache per updater.  Chains are
+# typically rewritten with mostly the same rules.
+TRANSLATION_CACHE_SIZE = 10000
+
+# Maximum number of set elements per "add element" command.
+MAX_ELEMENTS_PER_CMD = 1000
+
+_VERDICTS = {"ACCEPT": "accept", "DROP": "drop", "RETURN": "return"}
+# iptables protocol names that nft spells differently.
+_PROTOCOL_NAMES = {"icmpv6": "ipv6-icmp"}
+_PORT_PROTOCOLS = frozenset(["tcp", "udp", "sctp", "dccp", "udplite"])
+# Match modules whose options we translate.  The module names themselves
+# don't need translating, except for rpfilter, which has no options of its
+# own in Felix's rules.
+_MATCH_MODULES = frozenset(["set", "mark", "conntrack", "comment",
+                            "multiport", "icmp", "icmp6", "mac", "addrtype",
+                            "tcp", "udp"])
+_TARGET_RE = re.compile(r'\b(?:jump|goto) ([^\s,}]+)')
+_CHAIN_RE = re.compile(r'^\s*chain (\S+) \{', re.MULTILINE)
+_SET_RE = re.compile(r'^\s*set (\S+) \{', re.MULTILINE)
+
+
+class UnsupportedRule(ValueError):
+    """
+    Raised if an iptables rule fragment can't be translated to nftables.
+    """
+    pass
+
+
+class VerdictMapRule(namedtuple("VerdictMapRule",
+                                ["chain", "key", "chains_by_iface"])):
+    """
+    A rule, for the NftablesUpdater only, that looks up the packet's
+    interface in an nft verdict map and jumps to the chain for that
+    interface with a goto.  Used in place of the dispatch chain tree.
+
+    :ivar str chain: the iptables chain that the rule belongs to.
+    :ivar str key: "iifname" or "oifname".
+    :ivar tuple chains_by_iface: sorted tuple of (interface name, iptables
+          chain name) pairs.
+    """
+    __slots__ = ()
+
+
+def nft_chain_name(table, chain):
+    """
+    :returns the name of the nft chain for the given iptables chain.  The
+             chains of all the iptables tables share one nft table so
+             chains outside the filter table are prefixed with their table.
+    """
+    if table == "filter":
+        return chain
+    return "%s-%s" % (table, chain)
+
+
+def translate_fragment(fragment, table, ip_version):
+    """
+    Translates an iptables rule fragment, as passed to the IptablesUpdater,
+    into an nftables rule.
+
+    :param fragment: "--append <chain> <rule spec>" or, for rules that are
+           inserted into a kernel chain, "<chain> <rule spec>".  May also
+           be a VerdictMapRule.
+    :param str table: the iptables table, "filter", "nat" or "raw".
+    :param int ip_version: 4 or 6.
+    :returns tuple: iptables chain name and the text of the nft rule.
+    :raises UnsupportedRule if the fragment uses an option that we don't
+            know how to translate.
+    """
+    if isinstance(fragment, VerdictMapRule):
+        entries = ", ".join('"%s" : goto %s' % (iface,
+                                                 nft_chain_name(table, chain))
+                            for iface, chain in fragment.chains_by_iface)
+        return fragment.chain, "%s vmap { %s }" % (fragment.key, entries)
+    try:
+        words = shlex.split(fragment)
+    except ValueError as e:
+        raise UnsupportedRule("Failed to parse %r: %s" % (fragment, e))
+    if words and words[0] in ("--append", "-A"):
+        words = words[1:]
+    if not words or words[0].startswith("-"):
+        raise UnsupportedRule("No chain in %r" % fragment)
+    return words[0], _translate_rule_spec(words[1:], table, ip_version,
+                                          fragment)
+
+
+def _translate_rule_spec(words, table, ip_version, fragment):
+    ip_kw = "ip" if ip_version == 4 else "ip6"
+    matches = []
+    statements = []
+    comment = None
+    protocol = None
+    # Target that takes its parameters from a later option.
+    pending_target = None
+    negate = False
+    num_words = len(words)
+    ii = 0
+
+    def arg():
+        if ii >= num_words:
+            raise UnsupportedRule("Missing argument in %r" % fragment)
+        return words[ii]
+
+    while ii < num_words:
+        word = words[ii]
+        ii += 1
+        if word == "!":
+            negate = True
+            continue
+        op = "!= " if negate else ""
+        negated = negate
+        negate = False
+
+        if word in ("--match", "-m"):
+            module = arg()
+            ii += 1
+            if module == "rpfilter":
+                invert = ii < num_words and words[ii] == "--invert"
+                if invert:
+                    ii += 1
+                matches.append("fib saddr . iif oif %s" %
+                               ("missing" if invert else "exists"))
+            elif module not in _MATCH_MODULES:
+                raise UnsupportedRule("Unsupported match %r in %r" %
+                                      (module, fragment))
+        elif word in ("--protocol", "-p"):
+            protocol = arg().lower()
+            ii += 1
+            protocol = _PROTOCOL_NAMES.get(protocol, protocol)
+            matches.append("meta l4proto %s%s" % (op, protocol))
+        elif word in ("--source", "--src", "-s"):
+            matches.append("%s saddr %s%s" % (ip_kw, op, arg()))
+            ii += 1
+        elif word in ("--destination", "--dst", "-d"):
+            matches.append("%s daddr %s%s" % (ip_kw, op, arg()))
+            ii += 1
+        elif word in ("--in-interface", "-i"):
+            matches.append('iifname %s"%s"' % (op, arg().replace("+", "*")))
+            ii += 1
+        elif word in ("--out-interface", "-o"):
+            matches.append('oifname %s"%s"' % (op, arg().replace("+", "*")))
+            ii += 1
+        elif word == "--match-set":
+            if ii + 1 >= num_words:
+                raise UnsupportedRule("Missing argument in %r" % fragment)
+            set_name, flags = words[ii], words[ii + 1].split(",")
+            ii += 2
+            addr = "saddr" if flags[0] == "src" else "daddr"
+            if len(flags) == 1:
+                key = "%s %s" % (ip_kw, addr)
+            elif len(flags) == 2:
+                # hash:net,port set, see NftSet.
+                key = "%s %s . meta l4proto . th %sport" % (ip_kw, addr,
+                                                            addr[0])
+            else:
+                raise UnsupportedRule("Unsupported set flags in %r" %
+                                      fragment)
+            matches.append("%s %s@%s" % (key, op, set_name))
+        elif word == "--mark":
+            value, _, mask = arg().partition("/")
+            ii += 1
+            if mask:
+                matches.append("meta mark & %#x %s %#x" %
+                               (int(mask, 0), "!=" if negated else "==",
+                                int(value, 0)))
+            else:
+                matches.append("meta mark %s%#x" % (op, int(value, 0)))
+        elif word in ("--ctstate", "--state"):
+            matches.append("ct state %s%s" % (op, arg().lower()))
+            ii += 1
+        elif word == "--comment":
+            comment = arg()
+            ii += 1
+        elif word in ("--source-ports", "--sports", "--source-port",
+                      "--sport", "--destination-ports", "--dports",
+                      "--destination-port", "--dport"):
+            if protocol not in _PORT_PROTOCOLS:
+                raise UnsupportedRule("Port match without protocol in %r" %
+                                      fragment)
+            ports = arg().replace(":", "-").split(",")
+            ii += 1
+            if len(ports) > 1:
+                ports_str = "{ %s }" % ", ".join(ports)
+            else:
+                ports_str = ports[0]
+            direction = "sport" if "-s" in word[:4] else "dport"
+            matches.append("%s %s %s%s" % (protocol, direction, op,
+                                           ports_str))
+        elif word in ("--icmp-type", "--icmpv6-type"):
+            icmp_kw = "icmp" if word == "--icmp-type" else "icmpv6"
+            icmp_type, _, icmp_code = arg().partition("/")
+            ii += 1
+            matches.append("%s type %s%s" % (icmp_kw, op, icmp_type))
+            if icmp_code:
+                if negated:
+                    raise UnsupportedRule("Negated ICMP code in %r" %
+                                          fragment)
+                matches.append("%s code %s" % (icmp_kw, icmp_code))
+        elif word == "--mac-source":
+            matches.append("ether saddr %s%s" % (op, arg().lower()))
+            ii += 1
+        elif word in ("--src-type", "--dst-type"):
+            addr_type = arg().lower()
+            ii += 1
+            addr = "saddr" if word == "--src-type" else "daddr"
+            if ii < num_words and words[ii] == "--limit-iface-out":
+                ii += 1
+                addr += " . oif"
+            elif ii < num_words and words[ii] == "--limit-iface-in":
+                ii += 1
+                addr += " . iif"
+            matches.append("fib %s type %s%s" % (addr, op, addr_type))
+        elif word in ("--jump", "-j"):
+            target = arg()
+            ii += 1
+            if target in _VERDICTS:
+                statements.append(_VERDICTS[target])
+            elif target == "MASQUERADE":
+                statements.append("masquerade")
+            elif target in ("MARK", "DNAT", "SNAT"):
+                pending_target = target
+            elif target.isupper():
+                # Our chains are all prefixed "felix-" so this is an
+                # iptables target, such as LOG, that we don't support.
+                raise UnsupportedRule("Unsupported target %r in %r" %
+                                      (target, fragment))
+            else:
+                statements.append("jump %s" % nft_chain_name(table, target))
+        elif word in ("--goto", "-g"):
+            statements.append("goto %s" % nft_chain_name(table, arg()))
+            ii += 1
+        elif word == "--set-mark" and pending_target == "MARK":
+            value, _, mask = arg().partition("/")
+            ii += 1
+            mask = int(mask, 0) if mask else 0xffffffff
+            statements.append("meta mark set meta mark & %#x | %#x" %
+                              (~mask & 0xffffffff, int(value, 0)))
+            pending_target = None
+        elif word == "--to-destination" and pending_target == "DNAT":
+            statements.append("dnat to %s" % arg())
+            ii += 1
+            pending_target = None
+        elif word == "--to-source" and pending_target == "SNAT":
+            statements.append("snat to %s" % arg())
+            ii += 1
+            pending_target = None
+        else:
+            raise UnsupportedRule("Can't translate %r in %r" %
+                                  (word, fragment))
+
+    if pending_target is not None:
+        raise UnsupportedRule("Missing parameters for %s in %r" %
+                              (pending_target, fragment))
+    rule = " ".join(matches + statements)
+    if comment is not None:
+        rule += ' comment "%s"' % comment.replace('"', "'")
+    return rule
+
+
+def _rule_targets(rule):
+    """
+    :returns set of names of the nft chains that the given nft rule jumps
+             to.
+    """
+    return set(_TARGET_RE.findall(rule))
+
+
+def _execute_nft(lines):
+    """
+    Applies the given "nft -f" input as a single transaction.
+
+    :raises FailedSystemCall if nft fails; none of the input is applied.
+    """
+    input_str = "\n".join(lines) + "\n"
+    _log.debug("nft input:\n%s", input_str)
+    futils.check_call(NFT_RESTORE_CMD, input_str=input_str)
+
+
+def _list_table(family):
+    """
+    :returns the "nft list table" output for our table or None if the
+             table doesn't exist.
+    """
+    try:
+        return futils.check_call(["nft", "list", "table", family,
+                                  NFT_TABLE]).stdout
+    except FailedSystemCall as e:
+        if "No such file or directory" in e.stderr:
+            return None
+        raise
+
+
+class NftablesUpdater(Actor):
+    """
+    Actor that programs the chains of one iptables table into the nftables
+    table for its IP version.  Supports the messages of the IptablesUpdater,
+    taking iptables rule fragments, so that it can be used in its place.
+
+    Each batch is applied as a single "nft -f" transaction.  Since nft
+    applies a transaction atomically, there is no table-level restore or
+    xtables lock.  As for the IptablesUpdater, a failed batch is split to
+    find the culprit.
+
+    Chains that are required by other chains but not programmed are
+    created as stubs that drop all traffic.  Chains are deleted by first
+    stubbing them out and then deleting them in a second, best-effort,
+    transaction; any that fail to delete are retried by cleanup().
+
+    The kernel chains that rules are inserted into (INPUT, POSTROUTING,
+    ...) are base chains in our table, which contain only the rules that
+    we've inserted.
+    """
+
+    def __init__(self, table, config, ip_version=4):
+        super(NftablesUpdater, self).__init__(qualifier="v%d-%s" %
+                                                        (ip_version, table))
+        self.table = table
+        self.ip_version = ip_version
+        self.refresh_interval = config.REFRESH_INTERVAL
+        self._family = NFT_FAMILIES[ip_version]
+        self._base_chains = dict(
+            (nft_chain_name(t, chain), hook)
+            for (t, chain), hook in BASE_CHAINS.iteritems() if t == table
+        )
+
+        self._programmed_chains = {}
+        """Map from nft chain name to the list of nft rules that we've
+        programmed into it."""
+        self._stub_chains = set()
+        """Chains that exist as stubs to satisfy a dependency."""
+        self._required_chains = defaultdict(set)
+        """Map from chain name to the set of names of chains that it
+        depends on."""
+        self._requiring_chains = defaultdict(set)
+        """Inverse of self._required_chains."""
+        self._chains_in_dataplane = set()
+        """Set of our chains that we know are in the dataplane."""
+
+        self._translations = LRUCache(TRANSLATION_CACHE_SIZE)
+
+        self._pending_rewrites = None
+        """Map from chain to (rules, deps) for chains to rewrite in this
+        batch."""
+        self._pending_deletes = None
+        """Chains to delete in this batch."""
+        self._refresh = None
+        """Set if all our chains should be rewritten in this batch."""
+        self._completion_callbacks = None
+
+        self._stats = StatCounter("IPv%s %s nftables updater" %
+                                  (ip_version, table))
+
+        self._reset_batched_work()
+        self._load_chain_names(async=True)
+
+        if self.refresh_interval > 0:
+            _log.info("Periodic nftables refresh enabled, starting "
+                      "resync greenlet")
+            refresh_greenlet = gevent.spawn(self._periodic_refresh)
+            refresh_greenlet.link_exception(self._on_worker_died)
+
+    def _reset_batched_work(self):
+        self._pending_rewrites = {}
+        self._pending_deletes = set()
+        self._refresh = False
+        self._completion_callbacks = []
+
+    def _nft_name(self, chain):
+        return nft_chain_name(self.table, chain)
+
+    def _is_our_chain(self, name):
+        return name.startswith(self._nft_name(FELIX_PREFIX))
+
+    def _translate(self, fragment):
+        """
+        Translates a rule fragment, caching the result.
+
+        :returns tuple: nft chain name and nft rule.
+        :raises UnsupportedRule
+        """
+        if isinstance(fragment, VerdictMapRule):
+            # One-off, don't pollute the cache.
+            chain, rule = translate_fragment(fragment, self.table,
+                                             self.ip_version)
+            return self._nft_name(chain), rule
+        result = self._translations.get(fragment)
+        if result is None:
+            chain, rule = translate_fragment(fragment, self.table,
+                                             self.ip_version)
+            result = self._nft_name(chain), rule
+            self._translations.put(fragment, result)
+        return result
+
+    @actor_message(needs_own_batch=True)
+    def _load_chain_names(self):
+        """
+        Loads the set of our chains that already exist in the dataplane.
+        """
+        self._stats.increment("Refreshed chain list")
+        self._chains_in_dataplane = self._list_our_chains()
+
+    def _list_our_chains(self):
+        output = _list_table(self._family)
+        if output is None:
+            return set()
+        return set(c for c in _CHAIN_RE.findall(output)
+                   if self._is_our_chain(c))
+
+    @actor_message()
+    def rewrite_chains(self, update_calls_by_chain,
+                       dependent_chains, callback=None):
+        """
+        Atomically apply a set of updates to the table.  As for
+        IptablesUpdater.rewrite_chains().
+
+        :param update_calls_by_chain: map from chain name to list of
+               iptables-style update calls or VerdictMapRules.
+        :param dependent_chains: map from chain name to a set of chains
+               that that chain requires to exist.
+        :param callback: Optional callable, called with None once the update
+               has been applied or with the exception if it failed.
+        :raises UnsupportedRule or FailedSystemCall if a problem occurred and
+                there was no callback.
+        """
+        _log.info("nftables update to chains %s",
+                  update_calls_by_chain.keys())
+        self._stats.increment("Chain rewrites")
+        try:
+            rewrites = []
+            for chain, updates in update_calls_by_chain.iteritems():
+                rules = [self._translate(u)[1] for u in updates]
+                deps = set(self._nft_name(c) for c in
+                           dependent_chains.get(chain, ()))
+                for rule in rules:
+                    deps.update(_rule_targets(rule))
+                rewrites.append((self._nft_name(chain), rules, deps))
+        except UnsupportedRule as e:
+            _log.error("Failed to translate update to chains %s: %s",
+                       update_calls_by_chain.keys(), e)
+            self._stats.increment("Untranslatable rewrites")
+            if callback:
+                callback(e)
+                return
+            raise
+        for name, rules, deps in rewrites:
+            if self._rewrite_is_noop(name, rules, deps):
+                _log.debug("Chain %s unchanged, skipping rewrite", name)
+                self._stats.increment("Unchanged chain rewrites skipped")
+                continue
+            self._pending_deletes.discard(name)
+            self._pending_rewrites[name] = (rules, deps)
+        if callback:
+            self._completion_callbacks.append(callback)
+
+    def _rewrite_is_noop(self, name, rules, deps):
+        pending = self._pending_rewrites.get(name)
+        if pending is not None:
+            return pending == (rules, deps)
+        return (name not in self._pending_deletes and
+                self._programmed_chains.get(name) == rules and
+                self._required_chains.get(name, set()) == deps)
+
+    @actor_message()
+    def delete_chains(self, chain_names, callback=None):
+        """
+        Deletes the named chains.
+
+        :param callback: Optional callable, as for rewrite_chains().
+        """
+        _log.info("Deleting chains %s", chain_names)
+        self._stats.increment("Chain deletes")
+        for chain in chain_names:
+            name = self._nft_name(chain)
+            self._pending_rewrites.pop(name, None)
+            self._pending_deletes.add(name)
+        if callback:
+            self._completion_callbacks.append(callback)
+
+    @actor_message(needs_own_batch=True)
+    def ensure_rule_inserted(self, rule_fragment):
+        """
+        Inserts the given rule at the start of a kernel chain, for example
+        "INPUT --jump felix-INPUT".  If the rule was already present, it
+        is moved to the start of the chain.
+        """
+        name, rule = self._translate_inserted_rule(rule_fragment)
+        rules = [r for r in self._base_chain_rules(name) if r != rule]
+        rules.insert(0, rule)
+        self._queue_base_chain_rewrite(name, rules)
+
+    @actor_message(needs_own_batch=True)
+    def ensure_rule_removed(self, rule_fragment):
+        """
+        Removes the given rule from a kernel chain, if present.
+        """
+        name, rule = self._translate_inserted_rule(rule_fragment)
+        rules = [r for r in self._base_chain_rules(name) if r != rule]
+        self._queue_base_chain_rewrite(name, rules)
+
+    def _translate_inserted_rule(self, rule_fragment):
+        name, rule = self._translate(rule_fragment)
+        if name not in self._base_chains:
+            raise UnsupportedRule("Can't insert rules into %s in the %s "
+                                  "table" % (name, self.table))
+        return name, rule
+
+    def _base_chain_rules(self, name):
+        pending = self._pending_rewrites.get(name)
+        if pending is not None:
+            return pending[0]
+        return self._programmed_chains.get(name, [])
+
+    def _queue_base_chain_rewrite(self, name, rules):
+        deps = set()
+        for rule in rules:
+            deps.update(_rule_targets(rule))
+        if (name not in self._programmed_chains or
+                not self._rewrite_is_noop(name, rules, deps)):
+            # Always write a base chain that we haven't written yet, which
+            # also removes any rules left over from a previous run.
+            self._pending_rewrites[name] = (rules, deps)
+
+    @actor_message(needs_own_batch=True)
+    def cleanup(self):
+        """
+        Deletes any of our chains that are in the dataplane but no longer
+        required, for example, left behind by a previous run.
+        """
+        _log.info("Cleaning up left-over nftables state.")
+        self._stats.increment("Cleanups performed")
+        in_dataplane = self._list_our_chains()
+        expected = set(c for c in self._programmed_chains
+                       if self._is_our_chain(c)) | self._stub_chains
+        orphans = in_dataplane - expected
+        self._chains_in_dataplane = in_dataplane
+        if orphans:
+            _log.info("Cleanup found these orphaned chains to delete: %s",
+                      orphans)
+            self._stats.increment("Orphans found during cleanup",
+                                  by=len(orphans))
+            self._delete_best_effort(orphans)
+        missing = expected - in_dataplane
+        if missing:
+            _log.error("Chains missing from the dataplane: %s.  Another "
+                       "process may have clobbered our updates.", missing)
+            self.refresh_iptables()
+
+    def _periodic_refresh(self):
+        while True:
+            # Jitter our sleep times by 20%.
+            gevent.sleep(self.refresh_interval * (1 + random.random() * 0.2))
+            self.refresh_iptables(async=True)
+
+    def _on_worker_died(self, watch_greenlet):
+        """
+        Greenlet: spawned by the gevent Hub if the refresh greenlet ever
+        stops, kills the process.
+        """
+        _log.critical("Worker greenlet died: %s; exiting.", watch_greenlet)
+        sys.exit(1)
+
+    @actor_message()
+    def refresh_iptables(self):
+        """
+        Re-apply all our chains to the dataplane.  Named for compatibility
+        with the IptablesUpdater.
+        """
+        _log.info("Refreshing all our chains")
+        self._refresh = True
+
+    def _start_msg_batch(self, batch):
+        self._reset_batched_work()
+        return batch
+
+    def _finish_msg_batch(self, batch, results):
+        start = time.time()
+        try:
+            changes = self._calculate_changes()
+            input_lines = self._calculate_nft_input(*changes[:2])
+            if input_lines:
+                _execute_nft(input_lines)
+                self._stats.increment("nft transactions")
+        except (IOError, OSError, FailedSystemCall) as e:
+            if len(batch) == 1:
+                _log.error("Non-retryable nft failure: %r", e)
+                self._stats.increment("Messages failed due to nft error")
+                if self._completion_callbacks:
+                    self._completion_callbacks[0](e)
+                    results[0] = ResultOrExc(None, None)
+                else:
+                    results[0] = ResultOrExc(None, e)
+            else:
+                _log.error("Non-retryable error from a combined batch, "
+                           "splitting the batch to narrow down culprit.")
+                self._stats.increment("Split batch due to error")
+                raise SplitBatchAndRetry()
+        else:
+            self._update_indexes(*changes)
+            # The chains to delete are now stubs, try to delete them.  If
+            # that fails, cleanup() will try again.
+            self._delete_best_effort(changes[2])
+            for c in self._completion_callbacks:
+                c(None)
+        finally:
+            self._reset_batched_work()
+            self._stats.increment("Batches finished")
+
+        end = time.time()
+        _log.debug("Batch time: %.2f %s", end - start, len(batch))
+
+    def _calculate_changes(self):
+        """
+        Works out the effect of this batch's rewrites and deletions.
+
+        :returns tuple: (rules_by_chain, stubs, to_delete, candidates):
+
+            * dict mapping chain name to the rules to write to it
+            * set of chains that should now be stubs
+            * set of chains to delete
+            * set of chains whose state was recalculated.
+        """
+        rewrites = self._pending_rewrites
+        deletes = self._pending_deletes
+        changed = set(rewrites) | deletes
+        new_requiring = defaultdict(set)
+        for chain, (_, deps) in rewrites.iteritems():
+            for dep in deps:
+                new_requiring[dep].add(chain)
+        candidates = changed | set(new_requiring)
+        for chain in changed:
+            candidates.update(self._required_chains.get(chain, ()))
+        if self._refresh:
+            candidates.update(self._programmed_chains)
+            candidates.update(self._stub_chains)
+
+        rules_by_chain = {}
+        stubs = set()
+        to_delete = set()
+        for chain in candidates:
+            if chain in rewrites:
+                rules_by_chain[chain] = rewrites[chain][0]
+            elif chain in self._programmed_chains and chain not in deletes:
+                if self._refresh:
+                    rules_by_chain[chain] = self._programmed_chains[chain]
+            elif (new_requiring.get(chain) or
+                  self._requiring_chains.get(chain, set()) - changed):
+                stubs.add(chain)
+                if chain not in self._stub_chains or self._refresh:
+                    rules_by_chain[chain] = STUB_RULES
+            elif (chain in self._programmed_chains or
+                  chain in self._stub_chains or
+                  chain in self._chains_in_dataplane):
+                # Stub it out in case the delete fails.
+                to_delete.add(chain)
+                rules_by_chain[chain] = STUB_RULES
+        return rules_by_chain, stubs, to_delete, candidates
+
+    def _calculate_nft_input(self, rules_by_chain, stubs):
+        """
+        :returns list of "nft -f" input lines that write the given chains
+                 or an empty list if there's nothing to do.
+        """
+        if not rules_by_chain:
+            return []
+        prefix = "%s %s" % (self._family, NFT_TABLE)
+        lines = ["add table %s" % prefix]
+        # Create all the chains before writing any rules since the rules
+        # may jump to them.
+        for chain in sorted(rules_by_chain):
+            if chain in self._base_chains:
+                lines.append("add chain %s %s { type %s hook %s priority %s; "
+                             "policy accept; }" %
+                             ((prefix, chain) + self._base_chains[chain]))
+            else:
+                lines.append("add chain %s %s" % (prefix, chain))
+        for chain in sorted(rules_by_chain):
+            lines.append("flush chain %s %s" % (prefix, chain))
+            lines.extend("add rule %s %s %s" % (prefix, chain, rule)
+                         for rule in rules_by_chain[chain])
+        return lines
+
+    def _update_indexes(self, rules_by_chain, stubs, to_delete, candidates):
+        """
+        Called after successfully processing a batch, updates the indexes
+        to match the dataplane.
+        """
+        for chain, (rules, deps) in self._pending_rewrites.iteritems():
+            self._programmed_chains[chain] = rules
+            self._set_deps(chain, deps)
+        for chain in self._pending_deletes:
+            self._programmed_chains.pop(chain, None)
+            self._set_deps(chain, set())
+        self._stub_chains -= candidates
+        self._stub_chains |= stubs
+        self._chains_in_dataplane.update(rules_by_chain)
+
+    def _set_deps(self, chain, deps):
+        for dep in self._required_chains.pop(chain, ()):
+            requiring = self._requiring_chains[dep]
+            requiring.discard(chain)
+            if not requiring:
+                del self._requiring_chains[dep]
+        if deps:
+            self._required_chains[chain] = set(deps)
+            for dep in deps:
+                self._requiring_chains[dep].add(chain)
+
+    def _delete_best_effort(self, chains):
+        """
+        Tries to delete the given chains, all in one transaction or, if
+        that fails, one at a time.  Errors are logged, not raised.
+        """
+        if not chains:
+            return
+        prefix = "%s %s" % (self._family, NFT_TABLE)
+        chains = sorted(chains)
+        # Flush all the chains first so that they don't hold references to
+        # each other.
+        lines = ["flush chain %s %s" % (prefix, c) for c in chains]
+        lines += ["delete chain %s %s" % (prefix, c) for c in chains]
+        try:
+            _execute_nft(lines)
+        except (IOError, OSError, FailedSystemCall):
+            if len(chains) == 1:
+                _log.error("Failed to delete chain %s, giving up. Maybe "
+                           "it is still referenced?", chains[0])
+                self._stats.increment("Chain delete failures")
+                return
+            _log.warning("Deleting chains %s failed, retrying one at a "
+                         "time", chains)
+            for chain in chains:
+                self._delete_best_effort([chain])
+        else:
+            self._chains_in_dataplane.difference_update(chains)
+
+
+class NftablesDispatchChains(DispatchChains):
+    """
+    DispatchChains for the nftables backend.  Rather than a tree of chains
+    that match on interface prefixes, each dispatch chain looks up the
+    interface in a verdict map, which costs a single lookup per packet
+    however many endpoints there are.
+    """
+
+    def _calculate_update(self, ifaces):
+        """
+        Calculates the update to rewrite our chains, see
+        DispatchChains._calculate_update().  There are no leaf chains; any
+        left over from the superclass are deleted.
+        """
+        updates = {}
+        dependencies = {}
+        for chain, key, prefix, comment in [
+                (CHAIN_FROM_ENDPOINT, "iifname", CHAIN_FROM_PREFIX,
+                 "From unknown endpoint"),
+                (CHAIN_TO_ENDPOINT, "oifname", CHAIN_TO_PREFIX,
+                 "To unknown endpoint")]:
+            chains_by_iface = tuple(sorted(
+                (iface, prefix + interface_to_suffix(self.config, iface))
+                for iface in ifaces
+            ))
+            chain_updates = []
+            if chains_by_iface:
+                # nft doesn't allow an empty map.
+                chain_updates.append(
+                    VerdictMapRule(chain, key, chains_by_iface)
+                )
+            # Interfaces that we don't know about yet get dropped.
+            chain_updates.extend(self.iptables_generator.drop_rules(
+                self.ip_version, chain, None, comment))
+            updates[chain] = chain_updates
+            dependencies[chain] = set(c for _, c in chains_by_iface)
+        return self.programmed_leaf_chains, dependencies, updates, set()
+
+
+class NftSet(object):
+    """
+    (Synchronous) wrapper around an nftables set, with the interface of
+    ipsets.Ipset so that the ipset actors can use it.  The set lives in our
+    nftables table so that our rules can match on it.
+
+    A rewrite is a single transaction so, unlike an ipset, no temporary set
+    is needed; temp_set_name is only kept for the interface.
+
+    Supports the hash:ip, hash:net and hash:net,port ipset types.  Members
+    may be strings in ipset syntax or, for hash:ip sets, IPs packed by
+    futils.ip_to_int().
+    """
+    # nft sets can't contain other sets.
+    supports_list_sets = False
+
+    def __init__(self, ipset_name, temp_ipset_name, ip_family,
+                 ipset_type="hash:ip", max_elem=DEFAULT_IPSET_SIZE):
+        assert ip_family in ("inet", "inet6")
+        if ipset_type not in ("hash:ip", "hash:net", "hash:net,port"):
+            raise ValueError("Unsupported set type %s" % ipset_type)
+        self.set_name = ipset_name
+        self.temp_set_name = temp_ipset_name
+        self.type = ipset_type
+        self.family = ip_family
+        self.max_elem = max_elem
+        self.ip_type = IPV4 if ip_family == "inet" else IPV6
+        self._prefix = "%s %s" % (_nft_family(self.ip_type), NFT_TABLE)
+
+    @staticmethod
+    def list_names(ip_type):
+        """
+        :returns list of the names of the sets in our table.
+        """
+        output = _list_table(_nft_family(ip_type))
+        return _SET_RE.findall(output) if output else []
+
+    @staticmethod
+    def destroy_named(ip_type, name):
+        """
+        Deletes the named set.
+
+        :raises FailedSystemCall if the set can't be deleted.
+        """
+        _execute_nft(["delete set %s %s %s" % (_nft_family(ip_type),
+                                               NFT_TABLE, name)])
+
+    @property
+    def supports_deltas(self):
+        # A hash:net set merges overlapping CIDRs into a single interval,
+        # which can't then be deleted one CIDR at a time; it must be
+        # rewritten instead.
+        return self.type != "hash:net"
+
+    def exists(self, temp_set=False):
+        return self.set_name in self.list_names(self.ip_type)
+
+    def ensure_exists(self):
+        """
+        Creates the set iff it does not exist.
+        """
+        _execute_nft(self._create_cmds())
+
+    def apply_changes(self, added_entries, removed_entries):
+        """
+        Update the set with changes to members.  The set must exist.
+
+        :raises FailedSystemCall if the update fails.
+        """
+        assert self.supports_deltas, "Deltas not supported for %s" % self
+        lines = self._element_cmds("delete", removed_entries)
+        lines += self._element_cmds("add", added_entries)
+        _log.info("Making %d changes to set %s",
+                  len(added_entries) + len(removed_entries), self.set_name)
+        if lines:
+            _execute_nft(lines)
+
+    def take_existing_members(self):
+        """
+        Not supported, sets are always rewritten at start of day.
+        """
+        return None
+
+    def replace_members(self, members):
+        """
+        Atomically rewrites the set with the new members.
+
+        Creates the set if it does not exist.
+        """
+        _log.info("Rewriting set %s with %d members", self.set_name,
+                  len(members))
+        assert len(members) <= self.max_elem
+        lines = self._create_cmds()
+        lines.append("flush set %s %s" % (self._prefix, self.set_name))
+        lines += self._element_cmds("add", members)
+        _execute_nft(lines)
+
+    def delete(self):
+        """
+        Deletes the set.  This is done on a best-effort basis.
+        """
+        try:
+            self.destroy_named(self.ip_type, self.set_name)
+        except FailedSystemCall:
+            _log.debug("Failed to delete set %s, it may not exist",
+                       self.set_name)
+
+    def _create_cmds(self):
+        addr_type = "ipv4_addr" if self.ip_type == IPV4 else "ipv6_addr"
+        if self.type == "hash:ip":
+            decl = "type %s;" % addr_type
+        elif self.type == "hash:net":
+            # CIDRs may overlap, like they can in a hash:net ipset.
+            decl = "type %s; flags interval; auto-merge;" % addr_type
+        else:
+            decl = ("type %s . inet_proto . inet_service; flags interval;" %
+                    addr_type)
+        return ["add table %s" % self._prefix,
+                "add set %s %s { %s }" % (self._prefix, self.set_name, decl)]
+
+    def _element_cmds(self, verb, members):
+        members = [self._format_member(m) for m in members]
+        return ["%s element %s %s { %s }" %
+                (verb, self._prefix, self.set_name,
+                 ", ".join(members[ii:ii + MAX_ELEMENTS_PER_CMD]))
+                for ii in xrange(0, len(members), MAX_ELEMENTS_PER_CMD)]
+
+    def _format_member(self, member):
+        """
+        :returns the member as it should appear in "nft -f" input.
+        """
+        if isinstance(member, (int, long)):
+            return futils.int_to_ip(self.ip_type, member)
+        if self.type == "hash:net,port":
+            # "10.0.0.0/24,tcp:80" becomes "10.0.0.0/24 . tcp . 80".
+            net, _, proto_port = member.partition(",")
+            proto, _, port = proto_port.partition(":")
+            return "%s . %s . %s" % (net, proto, port)
+        return member
+
+    def __str__(self):
+        return self.__class__.__name__ + "<%s>" % self.set_name
+
+
+def _nft_family(ip_type):
+    return NFT_FAMILIES[4 if ip_type == IPV4 else 6]
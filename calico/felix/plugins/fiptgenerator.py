@@ -35,14 +35,19 @@ change significantly, or be removed completely, in future releases.
 
 """
 
+import hashlib
+import json
 import logging
 import re
 import itertools
 
+from calico.calcollections import LRUCache
 from calico.common import KNOWN_RULE_KEYS
 from calico.datamodel_v1 import TieredPolicyId
 from calico.felix import futils
 from calico.felix.fplugin import FelixPlugin
+from calico.felix.ipsets import NetSetId
+from calico.felix.policylists import policy_list_id
 from calico.felix.profilerules import UnsupportedICMPType
 from calico.felix.frules import (CHAIN_TO_ENDPOINT, CHAIN_FROM_ENDPOINT,
                                  CHAIN_TO_PREFIX, CHAIN_FROM_PREFIX,
@@ -51,6 +56,7 @@ from calico.felix.frules import (CHAIN_TO_ENDPOINT, CHAIN_FROM_ENDPOINT,
                                  FELIX_PREFIX, CHAIN_FIP_DNAT, CHAIN_FIP_SNAT)
 
 CHAIN_PROFILE_PREFIX = FELIX_PREFIX + "p-"
+CHAIN_POLICY_LIST_PREFIX = FELIX_PREFIX + "pl-"
 
 _log = logging.getLogger(__name__)
 
@@ -58,6 +64,12 @@ _log = logging.getLogger(__name__)
 # 2 entries.
 MAX_MULTIPORT_ENTRIES = 15
 
+# Minimum length of a run of rules that differ only in their CIDR (and ports)
+# before we collapse the run into a single rule that matches on an ipset.
+# Shorter runs are cheap enough to traverse linearly that they aren't worth an
+# extra ipset.
+MIN_RULES_PER_NET_SET = 4
+
 
 class FelixIptablesGenerator(FelixPlugin):
     """
@@ -72,6 +84,8 @@ class FelixIptablesGenerator(FelixPlugin):
         self.METADATA_PORT = None
         self.IPTABLES_MARK_ACCEPT = None
         self.IPTABLES_MARK_NEXT_TIER = None
+        self.MAX_IPSET_SIZE = None
+        self._fragment_cache = None
 
     def store_and_validate_config(self, config):
         # We don't have any plugin specific parameters, but we need to save
@@ -86,6 +100,19 @@ class FelixIptablesGenerator(FelixPlugin):
         self.DEFAULT_INPUT_CHAIN_ACTION = config.DEFAULT_INPUT_CHAIN_ACTION
         self.IPTABLES_MARK_ACCEPT = config.IPTABLES_MARK_ACCEPT
         self.IPTABLES_MARK_NEXT_TIER = config.IPTABLES_MARK_NEXT_TIER
+        self.MAX_IPSET_SIZE = config.MAX_IPSET_SIZE
+        # Cache of rendered rules.  Profiles are re-rendered in their
+        # entirety whenever they change so most rules are cache hits.
+        self._fragment_cache = LRUCache(config.RULE_FRAGMENT_CACHE_SIZE)
+        futils.register_diags("Rule fragment cache",
+                              self._dump_fragment_cache_stats)
+
+    def _dump_fragment_cache_stats(self, log):
+        log.info("Entries: %s (max %s)", len(self._fragment_cache),
+                 self._fragment_cache.max_size)
+        log.info("Hits: %s", self._fragment_cache.hits)
+        log.info("Misses: %s", self._fragment_cache.misses)
+        log.info("Evictions: %s", self._fragment_cache.evictions)
 
     def raw_rpfilter_failed_chain(self, ip_version):
         """
@@ -373,25 +400,28 @@ class FelixIptablesGenerator(FelixPlugin):
         :param OrderedDict prof_ids_by_tier: ordered dict mapping tier name
                to list of profiles.
 
+        The endpoint chains jump to the chains of the policy list for the
+        given tiers and profiles, which must be programmed separately; see
+        policy_list_updates().
+
         :returns Tuple: updates, deps
         """
 
         to_chain_name = (CHAIN_TO_PREFIX + suffix)
         from_chain_name = (CHAIN_FROM_PREFIX + suffix)
+        pol_list_id = policy_list_id(prof_ids_by_tier, profile_ids)
 
         to_chain, to_deps = self._build_to_or_from_chain(
             ip_version,
             endpoint_id,
-            profile_ids,
-            prof_ids_by_tier,
+            pol_list_id,
             to_chain_name,
             "inbound"
         )
         from_chain, from_deps = self._build_to_or_from_chain(
             ip_version,
             endpoint_id,
-            profile_ids,
-            prof_ids_by_tier,
+            pol_list_id,
             from_chain_name,
             "outbound",
             expected_mac=mac,
@@ -401,6 +431,60 @@ class FelixIptablesGenerator(FelixPlugin):
         deps = {to_chain_name: to_deps, from_chain_name: from_deps}
         return updates, deps
 
+    def policy_list_chain_names(self, pol_list_id):
+        """
+        Returns the set of chains belonging to a given policy list.
+
+        :param pol_list_id: The ID of the policy list, as returned by
+               calico.felix.policylists.policy_list_id().
+        :returns set[string]: the set of chain names
+        """
+        return set([self._policy_list_to_chain_name("inbound", pol_list_id),
+                    self._policy_list_to_chain_name("outbound", pol_list_id)])
+
+    def policy_list_updates(self, pol_list_id):
+        """
+        Generate a set of iptables updates that will program the chains for
+        a policy list.  A policy list's chains hold the tiered policy and
+        profile processing for all the endpoints that have that list of
+        policies and profiles.
+
+        The chains RETURN with the Accept MARK set if the packet was
+        accepted and with it clear if no profile matched.  They DROP
+        packets that are not passed by a tier.
+
+        :param pol_list_id: The ID of the policy list, as returned by
+               calico.felix.policylists.policy_list_id().
+        :returns Tuple: updates, deps
+        """
+        updates = {}
+        deps = {}
+        for direction in ("inbound", "outbound"):
+            chain_name = self._policy_list_to_chain_name(direction,
+                                                         pol_list_id)
+            updates[chain_name], deps[chain_name] = \
+                self._build_policy_list_chain(pol_list_id, chain_name,
+                                              direction)
+        return updates, deps
+
+    def policy_list_digest(self, pol_list_id):
+        """
+        Returns a short, stable digest of the given policy list ID, used
+        to name its chains.
+
+        :param pol_list_id: The ID of the policy list.
+        :returns string: 16 hex characters.
+        """
+        pols_by_tier, profile_ids = pol_list_id
+        # JSON-encode a canonical form so that the digest is the same for
+        # byte and unicode strings and across restarts.
+        canonical = json.dumps([
+            [[tier, ["%s" % p for p in pol_ids]]
+             for tier, pol_ids in pols_by_tier],
+            list(profile_ids)
+        ])
+        return hashlib.sha256(canonical).hexdigest()[:16]
+
     def profile_chain_names(self, profile_id):
         """
         Returns the set of chains belonging to a given profile.  This is used
@@ -413,13 +497,38 @@ class FelixIptablesGenerator(FelixPlugin):
         return set([self._profile_to_chain_name("inbound", profile_id),
                     self._profile_to_chain_name("outbound", profile_id)])
 
+    def profile_net_sets(self, profile, ip_version):
+        """
+        Returns the set of NetSetIds that profile_updates() uses to collapse
+        the profile's rules.  The caller is responsible for making sure that
+        the corresponding ipsets exist before programming the profile.
+
+        :param dict profile: The profile dict or None.
+        :param ip_version: 4 or 6.
+        :returns set[NetSetId]: the IDs of the ipsets required.
+        """
+        net_sets = set()
+        if profile is None:
+            return net_sets
+        for direction in ("inbound", "outbound"):
+            rules = self._rules_for_ip_version(
+                profile.get("%s_rules" % direction, []), ip_version
+            )
+            for _, net_set_match in self._collapse_rules(rules, ip_version):
+                if net_set_match is not None:
+                    net_sets.add(net_set_match[1])
+        return net_sets
+
     def profile_updates(self, profile_id, profile, ip_version, tag_to_ipset,
                         selector_to_ipset, on_allow="ACCEPT", on_deny="DROP",
-                        comment_tag=None):
+                        comment_tag=None, net_set_to_ipset=None):
         """
         Generate a set of iptables updates that will program all of the chains
         needed for a given profile.
 
+        :param dict[NetSetId,str] net_set_to_ipset: dict mapping from
+               the NetSetIds returned by profile_net_sets() to ipset name.
+               If None, runs of similar rules are not collapsed.
         :returns Tuple: updates, deps
         """
 
@@ -439,7 +548,12 @@ class FelixIptablesGenerator(FelixPlugin):
 
             chain_name = self._profile_to_chain_name(direction, profile_id)
             rules_key = "%s_rules" % direction
-            rules = profile.get(rules_key, [])
+            rules = self._rules_for_ip_version(profile.get(rules_key, []),
+                                               ip_version)
+            if net_set_to_ipset is not None:
+                rules = self._collapse_rules(rules, ip_version)
+            else:
+                rules = [(r, None) for r in rules]
 
             fragments = [
                 '--append %(chain)s '
@@ -448,17 +562,20 @@ class FelixIptablesGenerator(FelixPlugin):
                     'mark': self.IPTABLES_MARK_ACCEPT
                 }
             ]
-            for r in rules:
-                rule_version = r.get('ip_version')
-                if rule_version is None or rule_version == ip_version:
-                    fragments.extend(self._rule_to_iptables_fragments(
-                        chain_name,
-                        r,
-                        ip_version,
-                        tag_to_ipset,
-                        selector_to_ipset,
-                        on_allow=on_allow,
-                        on_deny=on_deny))
+            for r, net_set_match in rules:
+                if net_set_match is not None:
+                    dirn, net_set = net_set_match
+                    net_set_match = (dirn, net_set_to_ipset[net_set],
+                                     net_set.ipset_type)
+                fragments.extend(self._rule_to_iptables_fragments(
+                    chain_name,
+                    r,
+                    ip_version,
+                    tag_to_ipset,
+                    selector_to_ipset,
+                    on_allow=on_allow,
+                    on_deny=on_deny,
+                    net_set_match=net_set_match))
 
             # If we get to the end of the chain without a match, we remove the
             # mark again to indicate that the packet wasn't matched.
@@ -508,17 +625,15 @@ class FelixIptablesGenerator(FelixPlugin):
                  if p is not None]
         return [' '.join(parts)]
 
-    def _build_to_or_from_chain(self, ip_version, endpoint_id, profile_ids,
-                                prof_ids_by_tier, chain_name, direction,
-                                expected_mac=None):
+    def _build_to_or_from_chain(self, ip_version, endpoint_id, pol_list_id,
+                                chain_name, direction, expected_mac=None):
         """
         Generate the necessary set of iptables fragments for a to or from
         chain for a given endpoint.
 
         :param ip_version.  Whether this chain is for IPv4 or IPv6 iptables.
         :param endpoint_id: The endpoint's ID.
-        :param profile_ids: The set of profile_ids associated with this
-        endpoint.
+        :param pol_list_id: The ID of the endpoint's policy list.
         :param chain_name: The name of the chain to generate.
         :param direction: One of "inbound" or "outbound".
         :param expected_mac: The expected source MAC address.   If not None
@@ -546,11 +661,50 @@ class FelixIptablesGenerator(FelixPlugin):
                 "--match mac ! --mac-source %s" % expected_mac,
                 "Incorrect source MAC"))
 
+        # Then jump to the (shared) chain for our policies and profiles.  If
+        # it accepted the packet, it RETURNs with Accept MARK==1.
+        pol_list_chain = self._policy_list_to_chain_name(direction,
+                                                         pol_list_id)
+        chain.append("--append %s --jump %s" % (chain_name, pol_list_chain))
+        chain.append(
+            '--append %(chain)s --match mark --mark %(mark)s/%(mark)s '
+            '--match comment --comment "Policy accepted packet" '
+            '--jump RETURN' % {
+                'chain': chain_name,
+                'mark': self.IPTABLES_MARK_ACCEPT
+            }
+        )
+
+        # Default drop rule.
+        chain.extend(
+            self.drop_rules(
+                ip_version,
+                chain_name,
+                None,
+                "Packet did not match any profile (endpoint %s)" % endpoint_id
+            )
+        )
+        return chain, set([pol_list_chain])
+
+    def _build_policy_list_chain(self, pol_list_id, chain_name, direction):
+        """
+        Generate the iptables fragments for one of a policy list's chains.
+
+        :param pol_list_id: The ID of the policy list.
+        :param chain_name: The name of the chain to generate.
+        :param direction: One of "inbound" or "outbound".
+
+        :returns Tuple: chain, deps.   Chain is a list of fragments that can
+        be submitted to iptables to program the requested chain.  Deps is a
+        set containing names of chains that this chain depends on.
+        """
+        prof_ids_by_tier, profile_ids = pol_list_id
+        chain = []
         # Tiered policies come first.
         deps = set()
         # Each tier must either accept the packet outright or pass it to the
         # next tier for further processing.
-        for tier, pol_ids in prof_ids_by_tier.iteritems():
+        for tier, pol_ids in prof_ids_by_tier:
             # Zero the "next-tier packet" mark.  Then process each policy
             # in turn.
             chain.append('--append %(chain)s '
@@ -621,15 +775,6 @@ class FelixIptablesGenerator(FelixPlugin):
                 }
             )
 
-        # Default drop rule.
-        chain.extend(
-            self.drop_rules(
-                ip_version,
-                chain_name,
-                None,
-                "Packet did not match any profile (endpoint %s)" % endpoint_id
-            )
-        )
         return chain, deps
 
     def _profile_to_chain_name(self, inbound_or_outbound, profile_id):
@@ -652,10 +797,112 @@ class FelixIptablesGenerator(FelixPlugin):
         return CHAIN_PROFILE_PREFIX + "%s-%s" % (profile_string,
                                                  inbound_or_outbound[:1])
 
+    def _policy_list_to_chain_name(self, inbound_or_outbound, pol_list_id):
+        """
+        Returns the name of the chain to use for a given policy list (and
+        direction).
+
+        :param inbound_or_outbound: Either "inbound" or "outbound".
+        :param pol_list_id: The ID of the policy list.
+        :returns string: The name of the chain
+        """
+        return CHAIN_POLICY_LIST_PREFIX + "%s-%s" % (
+            self.policy_list_digest(pol_list_id),
+            inbound_or_outbound[:1]
+        )
+
+    def _rules_for_ip_version(self, rules, ip_version):
+        """
+        :returns list[dict]: the rules that apply to the given IP version.
+        """
+        return [r for r in rules
+                if r.get('ip_version') is None or
+                r.get('ip_version') == ip_version]
+
+    def _collapse_rules(self, rules, ip_version):
+        """
+        Collapses runs of rules that differ only in their CIDR (and, for TCP
+        and UDP, their ports) into single rules that match on a "hash:net"
+        or "hash:net,port" ipset.
+
+        Only adjacent rules are collapsed, so the order in which rules are
+        matched is preserved.
+
+        :param list[dict] rules: Rule dicts, already filtered to this IP
+               version.
+        :param ip_version: 4 or 6.
+        :returns list[tuple]: list of (rule, net_set_match) tuples.
+                 net_set_match is None for rules that are used unaltered;
+                 for collapsed rules, it is a tuple of ("src" or "dst",
+                 NetSetId) and the rule has had the CIDR (and ports)
+                 removed.
+        """
+        keyed_rules = [self._net_set_key(r, ip_version) + (r,)
+                       for r in rules]
+        collapsed = []
+        for key, run in itertools.groupby(keyed_rules, lambda kr: kr[0]):
+            run = list(run)
+            members = set()
+            for _, _, rule_members, _ in run:
+                members.update(rule_members or [])
+            if (key is None or
+                    len(run) < MIN_RULES_PER_NET_SET or
+                    len(members) > self.MAX_IPSET_SIZE):
+                collapsed.extend((r, None) for _, _, _, r in run)
+                continue
+            dirn, ipset_type, _ = key
+            shape = run[0][1]
+            _log.debug("Collapsing %s rules into one %s rule",
+                       len(run), ipset_type)
+            collapsed.append((shape,
+                              (dirn, NetSetId(ipset_type,
+                                              frozenset(members)))))
+        return collapsed
+
+    def _net_set_key(self, rule, ip_version):
+        """
+        Works out whether a rule can be collapsed with similar rules.
+
+        :returns tuple: (key, shape, members).  key is None if the rule can't
+                 be collapsed.  Otherwise, adjacent rules with equal keys
+                 can be replaced by the shape rule matching on an ipset
+                 containing all their members.
+        """
+        if set(rule.keys()) - KNOWN_RULE_KEYS:
+            # Let _rule_to_iptables_fragments() report the problem.
+            return None, None, None
+        dirns = [d for d in ("src", "dst")
+                 if rule.get(d + "_net") is not None]
+        if len(dirns) != 1:
+            return None, None, None
+        dirn = dirns[0]
+        net = rule[dirn + "_net"]
+        if (":" in net) != (ip_version == 6) or net.endswith("/0"):
+            # Nets for the other IP version are ignored by
+            # _rule_to_iptables_fragments() and hash:net ipsets can't hold
+            # a /0.
+            return None, None, None
+        shape = dict(rule)
+        del shape[dirn + "_net"]
+        ports = rule.get(dirn + "_ports")
+        proto = rule.get("protocol")
+        if (ports and proto in ("tcp", "udp") and
+                not any(":" in str(p) for p in ports)):
+            # Individual ports can go in the ipset too.  (Ranges would be
+            # expanded to one entry per port.)
+            del shape[dirn + "_ports"]
+            ipset_type = "hash:net,port"
+            members = ["%s,%s:%s" % (net, proto, p) for p in ports]
+        else:
+            ipset_type = "hash:net"
+            members = [net]
+        return (dirn, ipset_type, _freeze_rule(shape)), shape, members
+
     def _rule_to_iptables_fragments(self, chain_name, rule, ip_version,
                                     tag_to_ipset, selector_to_ipset,
                                     on_allow="ACCEPT",
-                                    on_deny="DROP"):
+                                    on_deny="DROP",
+                                    net_set_match=None):
         """
         Convert a rule dict to a list of iptables fragments suitable to use
         with iptables-restore.
@@ -674,9 +921,41 @@ class FelixIptablesGenerator(FelixPlugin):
                traffic.  For example: "ACCEPT" or "RETURN".
         :param str on_deny: iptables action to use when the rule denies
                traffic.  For example: "DROP".
+        :param tuple net_set_match: None or a tuple of ("src" or "dst",
+               ipset name, ipset type) for a rule collapsed by
+               _collapse_rules().
         :return list[str]: iptables --append fragments.
         """
-
+        # The fragments depend only on the rule and the parameters below so
+        # we can reuse the fragments rendered for an identical rule.
+        cache_key = (
+            _freeze_rule(rule),
+            ip_version,
+            chain_name,
+            tuple(tag_to_ipset.get(rule.get(k))
+                  for k in ("src_tag", "dst_tag")),
+            tuple(selector_to_ipset.get(rule.get(k))
+                  for k in ("src_selector", "dst_selector")),
+            on_allow,
+            on_deny,
+            net_set_match,
+        )
+        fragments = self._fragment_cache.get(cache_key)
+        if fragments is None:
+            fragments = tuple(self._build_rule_fragments(
+                chain_name, rule, ip_version, tag_to_ipset, selector_to_ipset,
+                on_allow, on_deny, net_set_match
+            ))
+            self._fragment_cache.put(cache_key, fragments)
+        return list(fragments)
+
+    def _build_rule_fragments(self, chain_name, rule, ip_version,
+                              tag_to_ipset, selector_to_ipset, on_allow,
+                              on_deny, net_set_match):
+        """
+        Uncached implementation of _rule_to_iptables_fragments(), which
+        takes the same parameters.
+        """
         # Check we've not got any unknown fields.
         unknown_keys = set(rule.keys()) - KNOWN_RULE_KEYS
         assert not unknown_keys, "Unknown keys: %s" % ", ".join(unknown_keys)
@@ -706,7 +985,8 @@ class FelixIptablesGenerator(FelixPlugin):
                     tag_to_ipset,
                     selector_to_ipset,
                     on_allow=on_allow,
-                    on_deny=on_deny)
+                    on_deny=on_deny,
+                    net_set_match=net_set_match)
                 fragments.extend(frags)
 
             return fragments
@@ -754,7 +1034,8 @@ class FelixIptablesGenerator(FelixPlugin):
     def _rule_to_iptables_fragments_inner(self, chain_name, rule, ip_version,
                                           tag_to_ipset, selector_to_ipset,
                                           on_allow="ACCEPT",
-                                          on_deny="DROP"):
+                                          on_deny="DROP",
+                                          net_set_match=None):
         """
         Convert a rule dict to iptables fragments suitable to use with
         iptables-restore.
@@ -771,6 +1052,9 @@ class FelixIptablesGenerator(FelixPlugin):
                 traffic. For example: "ACCEPT" or "RETURN".
         :param str on_deny: iptables action to use when the rule denies
                 traffic. For example: "DROP".
+        :param tuple net_set_match: None or a tuple of ("src" or "dst",
+               ipset name, ipset type) for a rule collapsed by
+               _collapse_rules().
         :returns list[str]: list of iptables --append fragments.
         """
 
@@ -798,6 +1082,15 @@ class FelixIptablesGenerator(FelixPlugin):
                 if (":" in ip_or_cidr) == (ip_version == 6):
                     append("--%s" % direction, ip_or_cidr)
 
+            # Collapsed CIDRs (and ports), which map to an ipset.
+            if net_set_match is not None and net_set_match[0] == dirn:
+                _, ipset_name, ipset_type = net_set_match
+                if ipset_type == "hash:net,port":
+                    set_flags = "%s,%s" % (dirn, dirn)
+                else:
+                    set_flags = dirn
+                append("--match set", "--match-set", ipset_name, set_flags)
+
             # Tag, which maps to an ipset.
             tag_key = dirn + "_tag"
             if tag_key in rule and rule[tag_key] is not None:
@@ -883,3 +1176,12 @@ class FelixIptablesGenerator(FelixPlugin):
             if extra_rule:
                 rules.append(extra_rule)
         return rules
+
+
+def _freeze_rule(rule):
+    """
+    :returns tuple: a hashable representation of the rule dict, equal for
+             equal rules.
+    """
+    return tuple(sorted((k, tuple(v) if isinstance(v, list) else v)
+                        for k, v in rule.iteritems()))
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.policylists
+~~~~~~~~~~~~~~~~~
+
+Shared policy list chains.
+
+The policy portion of an endpoint's chains (the jumps to its tiered policies
+and then to its profiles) depends only on the ordered list of policies and
+profiles that apply to the endpoint.  Typically, many endpoints share the
+same list so, rather than giving every endpoint its own copy, we program one
+pair of chains per distinct list and have the endpoint chains jump to it.
+
+The PolicyListManager reference counts the PolicyListChains actors that own
+those chains; LocalEndpoints hold a reference to the list that their chains
+jump to.
+"""
+import functools
+import logging
+import random
+
+import gevent
+
+from calico.felix.actor import actor_message
+from calico.felix.refcount import ReferenceManager, RefCountedActor
+
+_log = logging.getLogger(__name__)
+
+# Backoff for retrying a failed programming of our chains.  Nothing else
+# will reprogram them because their contents never change.
+INITIAL_RETRY_DELAY = 1.0
+MAX_RETRY_DELAY = 30.0
+
+
+def policy_list_id(pol_ids_by_tier, profile_ids):
+    """
+    Calculates the ID of the policy list for an endpoint.
+
+    :param OrderedDict pol_ids_by_tier: ordered dict mapping tier name to
+           list of policy IDs.
+    :param profile_ids: ordered list of profile IDs.
+    :returns: a hashable ID; endpoints with the same tiers, policies and
+              profiles, in the same order, share an ID.
+    """
+    return (tuple((tier, tuple(pol_ids)) for tier, pol_ids in
+                  pol_ids_by_tier.iteritems()),
+            tuple(profile_ids))
+
+
+class PolicyListManager(ReferenceManager):
+    """
+    Actor that manages the life cycle of PolicyListChains objects.
+    Users must ensure that they correctly pair calls to
+    get_and_incref() and decref().
+    """
+    def __init__(self, config, ip_version, iptables_updater):
+        super(PolicyListManager, self).__init__(qualifier="v%d" % ip_version)
+        self.iptables_generator = config.plugins["iptables_generator"]
+        self.ip_version = ip_version
+        self.iptables_updater = iptables_updater
+
+    def _create(self, pol_list_id):
+        return PolicyListChains(self.iptables_generator,
+                                pol_list_id,
+                                self.ip_version,
+                                self.iptables_updater)
+
+    def _on_object_started(self, pol_list_id, pol_list):
+        pol_list.program_chains(async=True)
+
+
+class PolicyListChains(RefCountedActor):
+    """
+    Actor that owns the chains for a single policy list.
+
+    The contents of the chains are determined by the ID so they only need
+    to be programmed once.  If that fails, we retry with backoff.
+    """
+    def __init__(self, iptables_generator, pol_list_id, ip_version,
+                 iptables_updater):
+        super(PolicyListChains, self).__init__(
+            qualifier="%s-v%d" % (
+                iptables_generator.policy_list_digest(pol_list_id),
+                ip_version
+            )
+        )
+        self.iptables_generator = iptables_generator
+        self.id = pol_list_id
+        self.ip_version = ip_version
+        self._iptables_updater = iptables_updater
+        # Set until our chains have been programmed successfully.
+        self._dirty = True
+        self._iptables_in_flight = False
+        self._retry_scheduled = False
+        self._retry_delay = INITIAL_RETRY_DELAY
+        self._dead = False
+
+    @actor_message()
+    def program_chains(self):
+        """
+        Programs our chains and notifies the manager that we're ready.
+        """
+        self._maybe_program_chains()
+        # Due to dependency management in IptablesUpdater, we don't need to
+        # wait for the chains to be programmed before notifying.
+        self._notify_ready()
+
+    def _maybe_program_chains(self):
+        if self._dead or not self._dirty or self._iptables_in_flight:
+            return
+        updates, deps = self.iptables_generator.policy_list_updates(self.id)
+        _log.info("Programming chains %s for policy list %s",
+                  updates.keys(), self.id)
+        self._iptables_in_flight = True
+        self._dirty = False
+        self._iptables_updater.rewrite_chains(
+            updates, deps,
+            callback=functools.partial(self._on_chains_programmed,
+                                       nowait=True),
+            nowait=True)
+
+    @actor_message()
+    def _on_chains_programmed(self, error):
+        self._iptables_in_flight = False
+        if error is None:
+            self._retry_delay = INITIAL_RETRY_DELAY
+            return
+        _log.error("Failed to program chains for policy list %s: %r; "
+                   "retrying in %.1fs", self.id, error, self._retry_delay)
+        self._dirty = True
+        if not self._retry_scheduled and not self._dead:
+            delay = self._retry_delay * (0.9 + random.random() * 0.2)
+            gevent.spawn_later(delay, self._on_retry_timer, async=True)
+            self._retry_scheduled = True
+            self._retry_delay = min(self._retry_delay * 2, MAX_RETRY_DELAY)
+
+    @actor_message()
+    def _on_retry_timer(self):
+        self._retry_scheduled = False
+        self._maybe_program_chains()
+
+    @actor_message()
+    def on_unreferenced(self):
+        """
+        Overrides RefCountedActor:on_unreferenced.
+        """
+        _log.info("%s unreferenced, removing our chains", self)
+        self._dead = True
+        self._iptables_updater.delete_chains(
+            self.iptables_generator.policy_list_chain_names(self.id),
+            callback=functools.partial(self._on_chains_deleted, nowait=True),
+            nowait=True)
+
+    @actor_message()
+    def _on_chains_deleted(self, error):
+        if error is not None:
+            _log.error("Failed to delete chains for policy list %s: %r",
+                       self.id, error)
+        self._notify_cleanup_complete()
@@ -18,10 +18,11 @@ felix.profilerules
 
 ProfileRules actor, handles local profile chains.
 """
+import functools
 import logging
 
 from calico.felix.actor import actor_message
-from calico.felix.futils import FailedSystemCall
+from calico.felix.ipsets import NetSetId
 from calico.felix.refcount import ReferenceManager, RefCountedActor, RefHelper
 from calico.felix.selectors import SelectorExpression
 
@@ -86,7 +87,11 @@ class RulesManager(ReferenceManager):
             self._datamodel_in_sync = True
             self._maybe_start_all()
 
-    @actor_message()
+    # Only the latest queued update for each profile matters.
+    @actor_message(
+        coalesce_key=lambda profile_id, profile, force_reprogram=False:
+            (profile_id, force_reprogram)
+    )
     def on_rules_update(self, profile_id, profile, force_reprogram=False):
         if profile is not None:
             _log.info("Rules for profile %s updated.", profile_id)
@@ -128,7 +133,7 @@ class ProfileRules(RefCountedActor):
         self._pending_profile = None
         # Currently-programmed profile dictionary.
         self._profile = None
-        # The IDs of the tags and selector ipsets it requires.
+        # The IDs of the tag, selector and net set ipsets it requires.
         self._required_ipsets = set()
 
         # State flags.
@@ -136,6 +141,13 @@ class ProfileRules(RefCountedActor):
         self._cleaned_up = False
         self._dead = False
         self._dirty = True
+        self._iptables_in_flight = False
+        # Set if our last iptables update failed, we wait for another update
+        # before retrying.
+        self._iptables_failed = False
+        # Number of iptables completion callbacks received in the current
+        # batch; reset at the end of each batch.
+        self._ipt_callbacks_in_batch = 0
 
     @actor_message()
     def on_profile_update(self, profile, force_reprogram=False):
@@ -170,6 +182,49 @@ class ProfileRules(RefCountedActor):
         # a message batch so _finish_msg_batch() will get called next.
         _log.info("All required ipsets acquired.")
 
+    @actor_message()
+    def _on_iptables_update_complete(self, programmed_ipsets, error):
+        """
+        Callback from the IptablesUpdater once an update or delete of our
+        chains has been applied (or has failed).
+
+        :param set programmed_ipsets: IDs of the tags and selectors that the
+               chains we sent referenced; empty for a delete.
+        :param error: None on success, or the exception that caused the
+               update to fail.
+        """
+        self._iptables_in_flight = False
+        self._ipt_callbacks_in_batch += 1
+        if error is not None:
+            _log.error("Failed to program profile chain %s; error: %r",
+                       self, error)
+            self._iptables_failed = True
+            self._dirty = True
+        elif not self._dead:
+            # Now we've updated iptables, we can tell the RefHelper to
+            # discard the tags we no longer need.  Keep hold of any that
+            # a later profile update has asked for in the meantime.
+            self._ipset_refs.replace_all(programmed_ipsets |
+                                         self._required_ipsets)
+
+    @actor_message()
+    def _on_cleanup_chains_deleted(self, error):
+        """
+        Callback from the IptablesUpdater once the delete of our chains
+        that we issued when we became unreferenced has completed.
+
+        :param error: None on success, or the exception that caused the
+               delete to fail.
+        """
+        self._iptables_in_flight = False
+        if error is not None:
+            _log.error("Failed to delete chains for profile %s; error: %r",
+                       self.id, error)
+        self._ipset_refs.discard_all()
+        self._ipset_refs = None  # Break ref cycle.
+        self._cleaned_up = True
+        self._notify_cleanup_complete()
+
     def _finish_msg_batch(self, batch, results):
         # Due to dependency management in IptablesUpdater, we don't need to
         # worry about programming the dataplane before notifying so do it on
@@ -178,96 +233,116 @@ class ProfileRules(RefCountedActor):
             self._notify_ready()
             self._notified_ready = True
 
+        # Batches that only contain iptables callbacks shouldn't retry a
+        # failed update.
+        callbacks_only = self._ipt_callbacks_in_batch == len(batch)
+        self._ipt_callbacks_in_batch = 0
+
+        if self._iptables_in_flight:
+            # Only keep one update in flight at a time so that its callback
+            # knows which ipsets are still referenced from the dataplane.
+            # The callback will trigger another batch.
+            _log.debug("%s waiting for in-flight iptables update", self)
+            if not self._dead:
+                self._update_ipset_refs()
+            return
+
         if self._dead:
             # Only want to clean up once.  Note: we can get here a second time
             # if we had a pending ipset incref in-flight when we were asked
             # to clean up.
             if not self._cleaned_up:
-                try:
-                    _log.info("%s unreferenced, removing our chains", self)
-                    self._delete_chains()
-                    self._ipset_refs.discard_all()
-                    self._ipset_refs = None  # Break ref cycle.
-                    self._profile = None
-                    self._pending_profile = None
-                finally:
-                    self._cleaned_up = True
-                    self._notify_cleanup_complete()
+                _log.info("%s unreferenced, removing our chains", self)
+                self._profile = None
+                self._pending_profile = None
+                self._delete_chains(self._on_cleanup_chains_deleted)
+            return
+
+        self._update_ipset_refs()
+        if self._iptables_failed and callbacks_only:
+            # Don't spin retrying a failed update; wait for the next
+            # update before trying again.
+            _log.debug("Previous update failed, waiting for next update.")
+        elif (self._dirty and
+                self._ipset_refs.ready and
+                self._pending_profile is not None):
+            _log.info("Ready to program rules for %s", self.id)
+            self._update_chains()
+        elif not self._dirty:
+            _log.debug("No changes to program.")
+        elif self._pending_profile is None:
+            _log.info("Profile is None, removing our chains")
+            self._delete_chains(
+                functools.partial(self._on_iptables_update_complete, set())
+            )
         else:
-            if self._pending_profile != self._profile:
-                _log.debug("Profile data changed, updating ipset references.")
-                # Make sure that all the new tags and selectors are active.
-                # We can't discard unneeded ones until we've updated iptables.
-                new_tags_and_sels = extract_tags_and_selectors_from_profile(
-                    self._pending_profile
-                )
-                for tag_or_sel in new_tags_and_sels:
-                    _log.debug("Requesting ipset for tag %s", tag_or_sel)
-                    # Note: acquire_ref() is a no-op if already acquired.
-                    self._ipset_refs.acquire_ref(tag_or_sel)
-
-                self._dirty = True
-                self._profile = self._pending_profile
-                self._required_ipsets = new_tags_and_sels
-
-            if (self._dirty and
-                    self._ipset_refs.ready and
-                    self._pending_profile is not None):
-                _log.info("Ready to program rules for %s", self.id)
-                try:
-                    self._update_chains()
-                except FailedSystemCall as e:
-                    _log.error("Failed to program profile chain %s; error: %r",
-                               self, e)
-                else:
-                    # Now we've updated iptables, we can tell the RefHelper
-                    # to discard the tags we no longer need.
-                    self._ipset_refs.replace_all(self._required_ipsets)
-                    self._dirty = False
-            elif not self._dirty:
-                _log.debug("No changes to program.")
-            elif self._pending_profile is None:
-                _log.info("Profile is None, removing our chains")
-                try:
-                    self._delete_chains()
-                except FailedSystemCall:
-                    _log.exception("Failed to delete chains for profile %s",
-                                   self.id)
-                else:
-                    self._ipset_refs.discard_all()
-                    self._dirty = False
-            else:
-                assert not self._ipset_refs.ready
-                _log.info("Can't program rules %s yet, waiting on ipsets",
-                          self.id)
+            assert not self._ipset_refs.ready
+            _log.info("Can't program rules %s yet, waiting on ipsets",
+                      self.id)
 
-    def _delete_chains(self):
+    def _update_ipset_refs(self):
+        """
+        Acquires references to the ipsets required by the latest profile.
         """
-        Removes our chains from the dataplane, blocks until complete.
+        if self._pending_profile != self._profile:
+            _log.debug("Profile data changed, updating ipset references.")
+            # Make sure that all the new tags and selectors are active.
+            # We can't discard unneeded ones until we've updated iptables.
+            new_tags_and_sels = extract_tags_and_selectors_from_profile(
+                self._pending_profile
+            )
+            # Plus the ipsets that the generator uses to collapse runs of
+            # similar rules.
+            new_tags_and_sels |= self.iptables_generator.profile_net_sets(
+                self._pending_profile, self.ip_version
+            )
+            for tag_or_sel in new_tags_and_sels:
+                _log.debug("Requesting ipset for tag %s", tag_or_sel)
+                # Note: acquire_ref() is a no-op if already acquired.
+                self._ipset_refs.acquire_ref(tag_or_sel)
+
+            self._dirty = True
+            self._profile = self._pending_profile
+            self._required_ipsets = new_tags_and_sels
+
+    def _delete_chains(self, callback):
         """
-        # Need to block here: have to wait for chains to be deleted
-        # before we can decref our ipsets.
+        Queues the removal of our chains from the dataplane.
+
+        :param callback: actor message to send once the delete completes,
+               it is passed None or the exception if the delete failed.
+        """
+        # Can't decref our ipsets until the chains are gone so the callback
+        # does that.
+        self._start_iptables_update()
         self._iptables_updater.delete_chains(
             self.iptables_generator.profile_chain_names(self.id),
-            async=False)
+            callback=functools.partial(callback, nowait=True),
+            nowait=True)
+
+    def _start_iptables_update(self):
+        self._iptables_in_flight = True
+        self._iptables_failed = False
+        self._dirty = False
 
     def _update_chains(self):
         """
-        Updates the chains in the dataplane.
-
-        Blocks until the update is complete.
+        Queues an update of the chains in the dataplane.  Doesn't wait for
+        the update to complete, _on_iptables_update_complete() is called
+        once the IptablesUpdater has applied it.
 
         On entry, self._pending_profile must not be None.
-
-        :raises FailedSystemCall: if the update fails.
         """
         _log.info("%s Programming iptables with our chains.", self)
         assert self._pending_profile is not None, \
             "_update_chains called with no _pending_profile"
         tag_to_ip_set_name = {}
         sel_to_ip_set_name = {}
+        net_set_to_ip_set_name = {}
         for tag_or_sel, ipset in self._ipset_refs.iteritems():
-            if isinstance(tag_or_sel, SelectorExpression):
+            if isinstance(tag_or_sel, NetSetId):
+                net_set_to_ip_set_name[tag_or_sel] = ipset.ipset_name
+            elif isinstance(tag_or_sel, SelectorExpression):
                 sel_to_ip_set_name[tag_or_sel] = ipset.ipset_name
             else:
                 tag_to_ip_set_name[tag_or_sel] = ipset.ipset_name
@@ -282,12 +357,19 @@ class ProfileRules(RefCountedActor):
             tag_to_ipset=tag_to_ip_set_name,
             selector_to_ipset=sel_to_ip_set_name,
             on_allow="RETURN",
-            comment_tag=self.id)
+            comment_tag=self.id,
+            net_set_to_ipset=net_set_to_ip_set_name)
 
         _log.debug("Queueing programming for rules %s: %s", self.id,
                    updates)
 
-        self._iptables_updater.rewrite_chains(updates, deps, async=False)
+        self._start_iptables_update()
+        callback = functools.partial(self._on_iptables_update_complete,
+                                     self._required_ipsets,
+                                     nowait=True)
+        self._iptables_updater.rewrite_chains(updates, deps,
+                                              callback=callback,
+                                              nowait=True)
 
 
 def extract_tags_and_selectors_from_profile(profile):
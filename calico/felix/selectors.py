@@ -29,8 +29,8 @@ or
 The main entry point is the parse_selector() function, which converts the
 string representation of a selector into an object.
 
-Selector expressions follow this syntax, defined as a grammar in the
-_define_grammar() function:
+Selector expressions follow this syntax, which is parsed by the _Parser
+class:
 
     label == "string_literal"  ->  comparison, e.g. my_label == "foo bar"
     label != "string_literal"   ->  not equal; also matches if label is not
@@ -51,12 +51,10 @@ from base64 import b64encode
 import hashlib
 import logging
 import operator
+import string
 from weakref import WeakValueDictionary
 
-from pyparsing import (QuotedString, Word, Forward, Suppress,
-                       StringEnd, delimitedList, ParseBaseException,
-                       ZeroOrMore, Keyword)
-
+from calico.calcollections import LRUCache
 from calico.datamodel_v1 import LABEL_CHARS
 
 _log = logging.getLogger(__name__)
@@ -74,6 +72,13 @@ class ExprNode(object):
     def collect_reqd_values(self, pr_set):
         pass
 
+    def collect_label_names(self, name_set):
+        """
+        Adds the names of all the labels that this expression reads to
+        name_set.
+        """
+        pass
+
     def collect_str_fragments(self, fragment_list):
         """
         Appends a series of strings to the fragment_list that, when
@@ -132,8 +137,8 @@ class LabelNode(ExprNode):
     """
     __slots__ = ["label_name"]
 
-    def __init__(self, parse_str=None, location=None, tokens=None):
-        [self.label_name] = tokens
+    def __init__(self, label_name):
+        self.label_name = label_name
 
     def evaluate(self, labels):
         try:
@@ -141,6 +146,9 @@ class LabelNode(ExprNode):
         except KeyError:
             return NotPresent()
 
+    def collect_label_names(self, name_set):
+        name_set.add(self.label_name)
+
     def __hash__(self):
         return hash(self.label_name) * 37 + 0x5bce8abd
 
@@ -158,12 +166,15 @@ class HasNode(ExprNode):
     """
     __slots__ = ["label_name"]
 
-    def __init__(self, parse_str=None, location=None, tokens=None):
-        [self.label_name] = tokens
+    def __init__(self, label_name):
+        self.label_name = label_name
 
     def evaluate(self, labels):
         return self.label_name in labels
 
+    def collect_label_names(self, name_set):
+        name_set.add(self.label_name)
+
     def __hash__(self):
         return hash(self.label_name) * 37 + 0x742fe51e
 
@@ -181,8 +192,8 @@ class LiteralNode(ExprNode):
     """
     __slots__ = ["value"]
 
-    def __init__(self, parse_str=None, location=None, tokens=None):
-        [self.value] = tokens
+    def __init__(self, value):
+        self.value = value
 
     def evaluate(self, labels):
         return self.value
@@ -204,8 +215,8 @@ class SetLiteralNode(ExprNode):
     """
     __slots__ = ["value"]
 
-    def __init__(self, parse_str=None, location=None, tokens=None):
-        self.value = frozenset(tokens)
+    def __init__(self, values):
+        self.value = frozenset(values)
 
     def evaluate(self, labels):
         return self.value
@@ -245,13 +256,18 @@ class BaseBinaryOpNode(ExprNode):
     operation = None
     operation_str = None
 
-    def __init__(self, parse_str=None, location=None, tokens=None):
-        self.lhs, self.rhs = tokens
+    def __init__(self, lhs, rhs):
+        self.lhs = lhs
+        self.rhs = rhs
 
     def evaluate(self, labels):
         return self.operation(self.lhs.evaluate(labels),
                               self.rhs.evaluate(labels))
 
+    def collect_label_names(self, name_set):
+        self.lhs.collect_label_names(name_set)
+        self.rhs.collect_label_names(name_set)
+
     def __hash__(self):
         h = hash(self.__class__)
         h = h * 37 + hash(self.lhs)
@@ -275,25 +291,14 @@ class LabelToLiteralEqualityNode(BaseBinaryOpNode):
     """
     Represents the sub-expression label == "value".
 
-    The LHS stores the name of the label directly, the RHS stores the
-    value of the string literal.
+    As an occupancy optimization, rather than storing label and literal
+    AST nodes, the LHS stores the name of the label directly and the RHS
+    stores the value of the string literal.
     """
     __slots__ = []
     operation = operator.eq
     operation_str = "=="
 
-    def __init__(self, parse_str=None, location=None, tokens=None):
-        # As an occupancy optimization, avoid storing the label and value
-        # AST nodes and swap them for the string values.
-        label, literal = tokens
-        key = label.label_name
-        value = literal.value
-        super(LabelToLiteralEqualityNode, self).__init__(
-            parse_str=parse_str,
-            location=location,
-            tokens=[key, value]
-        )
-
     def evaluate(self, labels):
         # Since we store the label name and value directly, we need a
         # customized eval function...
@@ -302,6 +307,9 @@ class LabelToLiteralEqualityNode(BaseBinaryOpNode):
     def collect_reqd_values(self, pr_set):
         pr_set.add((self.lhs, self.rhs))
 
+    def collect_label_names(self, name_set):
+        name_set.add(self.lhs)
+
     def collect_str_fragments(self, fragment_list):
         fragment_list.append(self.lhs)
         fragment_list.append(" == ")
@@ -312,24 +320,13 @@ class LabelInSetLiteralNode(BaseBinaryOpNode):
     """
     Represents the sub-expression label in {"value", "value2" ...}.
 
-    The LHS stores the name of the label directly, the RHS stores the
-    value of the set literal.
+    As an occupancy optimization, rather than storing label and literal
+    AST nodes, the LHS stores the name of the label directly and the RHS
+    stores the frozenset of values.
     """
     __slots__ = []
     operation_str = "in"
 
-    def __init__(self, parse_str=None, location=None, tokens=None):
-        # As an occupancy optimization, avoid storing the label and value
-        # AST nodes and swap them for the string/set values.
-        label, literal = tokens
-        key = label.label_name
-        value = literal.value
-        super(LabelInSetLiteralNode, self).__init__(
-            parse_str=parse_str,
-            location=location,
-            tokens=[key, value]
-        )
-
     def evaluate(self, labels):
         # Since we store the label name and value directly, we need a
         # customized eval function...
@@ -341,6 +338,9 @@ class LabelInSetLiteralNode(BaseBinaryOpNode):
             # express a requirement if there's only one entry in the set.
             pr_set.update(self.rhs)
 
+    def collect_label_names(self, name_set):
+        name_set.add(self.lhs)
+
     def collect_str_fragments(self, fragment_list):
         fragment_list.append(self.lhs)
         fragment_list.append(" in ")
@@ -402,6 +402,10 @@ class BaseListNode(ExprNode):
             child.collect_str_fragments(fragment_list)
         fragment_list.append(")")
 
+    def collect_label_names(self, name_set):
+        for expr in self.exprs:
+            expr.collect_label_names(name_set)
+
 
 class AndNode(BaseListNode):
     """AST node for '&&'."""
@@ -421,14 +425,6 @@ class AndNode(BaseListNode):
             expr.collect_reqd_values(pr_set)
 
 
-def simplify_and_node(parse_str=None, location=None, tokens=None):
-    """Parse action for '&&', creates the relevant AST node."""
-    if len(tokens) == 1:
-        return tokens[0]
-    else:
-        return AndNode(tokens.asList())
-
-
 class OrNode(BaseListNode):
     """AST node for '||'."""
     __slots__ = []
@@ -453,16 +449,6 @@ class OrNode(BaseListNode):
                 pr_set.intersection_update(next_prs)
 
 
-def simplify_or_node(parse_str=None, location=None, tokens=None):
-    """Parse action for '||', creates the relevant AST node."""
-    if len(tokens) == 1:
-        # Only one child in the "or"; simplify to return only the child.
-        return tokens[0]
-    else:
-        # More than one child, generate an or node.
-        return OrNode(tokens.asList())
-
-
 class AllNode(ExprNode):
     """AST node for 'all()' expression."""
     __slots__ = []
@@ -488,8 +474,8 @@ class SelectorExpression(object):
     Top-level expression.  Caches hash and the like for its children.
     """
 
-    __slots__ = ["expr_op", "_hash", "_prereq_values", "_unique_id", "_str",
-                 "__weakref__"]
+    __slots__ = ["expr_op", "_hash", "_prereq_values", "_label_names",
+                 "_unique_id", "_str", "__weakref__"]
 
     def __init__(self, expr_op):
         super(SelectorExpression, self).__init__()
@@ -498,6 +484,7 @@ class SelectorExpression(object):
         self._unique_id = None
         self._str = None
         self._prereq_values = None
+        self._label_names = None
 
     def evaluate(self, labels):
         return self.expr_op.evaluate(labels)
@@ -515,6 +502,22 @@ class SelectorExpression(object):
             self.expr_op.collect_reqd_values(self._prereq_values)
         return self._prereq_values
 
+    @property
+    def label_names(self):
+        """
+        A frozenset of the names of the labels that this selector reads.
+        Changes to labels not in this set can't change whether the selector
+        matches.
+
+        For example, selector a == 'b' && has(c) would return
+        frozenset(["a", "c"]).
+        """
+        if self._label_names is None:
+            names = set()
+            self.expr_op.collect_label_names(names)
+            self._label_names = frozenset(names)
+        return self._label_names
+
     @property
     def unique_id(self):
         """
@@ -552,71 +555,181 @@ class SelectorExpression(object):
         return self.__class__.__name__ + "<%s>" % self.__str__()
 
 
-def _define_grammar():
-    """
-    Creates and returns a copy of the selector grammar.
-
-    Wrapped in a function to avoid polluting the module namespace.
-    """
-    expr = Forward()
-
-    label_name = Word(LABEL_CHARS)
-    label_name.setParseAction(LabelNode)
-
-    string_literal = QuotedString('"') | QuotedString("'")
-    string_literal.setParseAction(LiteralNode)
-
-    set_literal = (Suppress("{") +
-                   delimitedList(QuotedString('"') | QuotedString("'"), ",") +
-                   Suppress("}"))
-    set_literal.setParseAction(SetLiteralNode)
-
-    eq_comparison = label_name + Suppress("==") + string_literal
-    eq_comparison.setParseAction(LabelToLiteralEqualityNode)
+class BadSelector(ValueError):
+    pass
 
-    not_eq_comparison = label_name + Suppress("!=") + string_literal
-    not_eq_comparison.setParseAction(InequalityNode)
 
-    in_comparison = label_name + Suppress(Keyword("in")) + set_literal
-    in_comparison.setParseAction(LabelInSetLiteralNode)
+# Characters that we skip between tokens.
+_WHITESPACE = " \t\n\r"
+_LABEL_CHARS = frozenset(LABEL_CHARS)
+# Characters that may not directly follow a keyword such as "in".
+_KEYWORD_CHARS = frozenset(string.ascii_letters + string.digits + "_$")
+# Escaped whitespace that is converted in string literals.
+_WHITESPACE_ESCAPES = [("\\t", "\t"), ("\\n", "\n"),
+                       ("\\f", "\f"), ("\\r", "\r")]
 
-    not_in = Suppress(Keyword("not") + Keyword("in"))
-    not_in_comparison = label_name + not_in + set_literal
-    not_in_comparison.setParseAction(NotInNode)
 
-    has_check = (Suppress("has(") +
-                 Word(LABEL_CHARS) +
-                 Suppress(")"))
-    has_check.setParseAction(HasNode)
+class _Parser(object):
+    """
+    Recursive-descent parser for the selector syntax.
 
-    comparison = (eq_comparison |
-                  not_eq_comparison |
-                  in_comparison |
-                  not_in_comparison |
-                  has_check)
+    Scans the string directly rather than tokenizing it up front since
+    the tokens depend on context: "in" is a keyword after a label but may
+    also be a label in its own right.
 
-    paren_expr = (Suppress("(") + expr + Suppress(")"))
+    The parser reproduces the behaviour of the pyparsing grammar that it
+    replaced, including its quirks, so that existing selectors produce
+    identical trees and hence the same unique_id.  In particular:
 
-    value = comparison | paren_expr
+    - tabs are expanded to spaces before parsing
+    - escaped whitespace (such as \\t) in string literals is converted but
+      no other escapes are supported
+    - "&&" and "||" chains are not flattened across parentheses.
+    """
+    __slots__ = ["s", "pos"]
 
-    and_expr = value + ZeroOrMore(Suppress("&&") + value)
-    and_expr.setParseAction(simplify_and_node)
+    def __init__(self, expr_str):
+        self.s = expr_str.expandtabs()
+        self.pos = 0
 
-    or_expr = and_expr + ZeroOrMore(Suppress("||") + and_expr)
-    or_expr.setParseAction(simplify_or_node)
+    def parse(self):
+        """
+        :returns: the ExprNode at the root of the parse tree.
+        :raises BadSelector: if the string is not a valid selector.
+        """
+        expr_op = self._parse_or()
+        self._skip_whitespace()
+        if self.pos != len(self.s):
+            self._fail("end of selector")
+        return expr_op
+
+    def _parse_or(self):
+        exprs = [self._parse_and()]
+        while self._accept("||"):
+            exprs.append(self._parse_and())
+        if len(exprs) == 1:
+            return exprs[0]
+        return OrNode(exprs)
+
+    def _parse_and(self):
+        exprs = [self._parse_value()]
+        while self._accept("&&"):
+            exprs.append(self._parse_value())
+        if len(exprs) == 1:
+            return exprs[0]
+        return AndNode(exprs)
+
+    def _parse_value(self):
+        if self._accept("("):
+            expr_op = self._parse_or()
+            self._expect(")")
+            return expr_op
+        if self._accept("has("):
+            label_name = self._parse_label_name()
+            self._expect(")")
+            return HasNode(label_name)
+        label_name = self._parse_label_name()
+        if self._accept("=="):
+            return LabelToLiteralEqualityNode(label_name,
+                                              self._parse_string())
+        if self._accept("!="):
+            return InequalityNode(LabelNode(label_name),
+                                  LiteralNode(self._parse_string()))
+        if self._accept_keyword("in"):
+            return LabelInSetLiteralNode(label_name,
+                                         frozenset(self._parse_set()))
+        if self._accept_keyword("not"):
+            if not self._accept_keyword("in"):
+                self._fail("'in'")
+            return NotInNode(LabelNode(label_name),
+                             SetLiteralNode(self._parse_set()))
+        self._fail("operator")
+
+    def _parse_label_name(self):
+        self._skip_whitespace()
+        s = self.s
+        start = end = self.pos
+        while end < len(s) and s[end] in _LABEL_CHARS:
+            end += 1
+        if end == start:
+            self._fail("label name")
+        self.pos = end
+        return s[start:end]
+
+    def _parse_string(self):
+        self._skip_whitespace()
+        s = self.s
+        quote = s[self.pos:self.pos + 1]
+        if quote not in ("'", '"'):
+            self._fail("string literal")
+        start = self.pos + 1
+        end = start
+        while end < len(s) and s[end] not in (quote, "\n", "\r"):
+            end += 1
+        if end == len(s) or s[end] != quote:
+            self._fail("closing %s" % quote)
+        self.pos = end + 1
+        value = s[start:end]
+        if "\\" in value:
+            for escape, char in _WHITESPACE_ESCAPES:
+                value = value.replace(escape, char)
+        return value
+
+    def _parse_set(self):
+        self._expect("{")
+        values = [self._parse_string()]
+        while self._accept(","):
+            values.append(self._parse_string())
+        self._expect("}")
+        return values
+
+    def _skip_whitespace(self):
+        s = self.s
+        pos = self.pos
+        while pos < len(s) and s[pos] in _WHITESPACE:
+            pos += 1
+        self.pos = pos
+
+    def _accept(self, literal):
+        """
+        Skips whitespace then consumes the given literal if it is next.
 
-    expr << or_expr
+        :returns: True if the literal was consumed.
+        """
+        self._skip_whitespace()
+        if self.s.startswith(literal, self.pos):
+            self.pos += len(literal)
+            return True
+        return False
 
-    grammar = expr + StringEnd()
-    return grammar
+    def _accept_keyword(self, keyword):
+        """
+        As _accept() but only matches whole keywords; "in" doesn't match
+        the start of "inx".
+        """
+        self._skip_whitespace()
+        end = self.pos + len(keyword)
+        if (self.s.startswith(keyword, self.pos) and
+                (end == len(self.s) or self.s[end] not in _KEYWORD_CHARS)):
+            self.pos = end
+            return True
+        return False
 
+    def _expect(self, literal):
+        if not self._accept(literal):
+            self._fail(repr(literal))
 
-class BadSelector(ValueError):
-    pass
+    def _fail(self, expected):
+        _log.debug("Expected %s at position %s of %r", expected, self.pos,
+                   self.s)
+        raise BadSelector(self.s)
 
 
-_grammar = _define_grammar()
-_parse_cache = WeakValueDictionary()
+# Maximum number of parsed selectors that we hold on to.  Selectors that are
+# still in use are also found via _live_selectors.
+PARSE_CACHE_SIZE = 10000
+_parse_cache = LRUCache(PARSE_CACHE_SIZE)
+_live_selectors = WeakValueDictionary()
 
 
 def parse_selector(expr_str):
@@ -630,18 +743,21 @@ def parse_selector(expr_str):
     :return: SelectorExpression object.
     :raises BadSelector if the input is not a valid selector expression.
     """
-    # Thread safety: multiple threads could access the cache dict concurrently.
+    # Thread safety: multiple threads could access the caches concurrently.
     # The worst that can happen is that they both parse the expression and
     # write it back to the cache, which is OK because the two separate
     # SelectorExpressions will behave identically.  Currently, we only
     # parse expressions from the etcd thread so even that shouldn't be an
     # issue.
-    try:
-        expr = _parse_cache[expr_str]
-    except KeyError:
-        _log.debug("Expression %s not found in cache, parsing...", expr_str)
-        expr = _parse_no_cache(expr_str)
-        _parse_cache[expr_str] = expr
+    expr = _parse_cache.get(expr_str)
+    if expr is None:
+        expr = _live_selectors.get(expr_str)
+        if expr is None:
+            _log.debug("Expression %s not found in cache, parsing...",
+                       expr_str)
+            expr = _parse_no_cache(expr_str)
+            _live_selectors[expr_str] = expr
+        _parse_cache.put(expr_str, expr)
     return expr
 
 
@@ -651,11 +767,8 @@ def _parse_no_cache(expr_str):
         expr_op = ALL_OP
     else:
         try:
-            token_list = _grammar.parseString(expr_str)
-        except ParseBaseException:
+            expr_op = _Parser(expr_str).parse()
+        except BadSelector:
             _log.warning("Bad selector %r", expr_str)
             raise BadSelector(expr_str)
-        # Returned value is a list/dict hybrid.  Unpacking it as a list
-        # gets the top-level expression object.
-        [expr_op] = token_list
     return SelectorExpression(expr_op)
@@ -20,15 +20,20 @@ felix.splitter
 Function for fanning our updates to the IPv4 and IPv6 versions of
 the manager classes.
 """
+from collections import OrderedDict
 import logging
 import os
 
 import functools
 import gevent
 
+from calico.felix import devices
 from calico.felix.actor import Actor, actor_message
+from calico.felix.futils import RECONCILIATION_STATS, StatCounter
+from calico.monotonic import monotonic_time
 
 _log = logging.getLogger(__name__)
+_stats = StatCounter("Update splitter")
 
 
 class UpdateSplitter(object):
@@ -38,18 +43,36 @@ class UpdateSplitter(object):
     Historical note: this used to be a fully-fledged Actor but that
     significantly increases the number of messages we send per update.
 
-    Thread safety: this object is accessed from multiple threads,
-    which is safe because it doesn't have any mutable state.
+    Endpoint updates are routed by interest: the managers that implement
+    on_local_endpoint_updates() only hear about endpoints on this host
+    while those that implement on_endpoint_updates() hear about all
+    endpoints.  Consecutive endpoint updates are buffered and sent as
+    one message per manager when flush() is called or when any other
+    update arrives.
+
+    Thread safety: this object is accessed from multiple greenlets.  The
+    only mutable state is the buffer of endpoint updates, which is never
+    accessed across a yield.
     """
-    def __init__(self, managers):
+    def __init__(self, managers, hostname):
         super(UpdateSplitter, self).__init__()
         self.managers = managers
+        self.hostname = hostname
+        # Pending endpoint updates, maps from EndpointId to the latest
+        # endpoint dict or None.
+        self._pending_ep_updates = OrderedDict()
+        # Number of updates received since the last flush, including any
+        # that were superseded.
+        self._num_ep_updates_received = 0
 
         self.in_sync_mgrs = self._managers_with("on_datamodel_in_sync")
         self.rules_upd_mgrs = self._managers_with("on_rules_update")
         self.tags_upd_mgrs = self._managers_with("on_tags_update")
         self.iface_upd_mgrs = self._managers_with("on_interface_update")
-        self.ep_upd_mgrs = self._managers_with("on_endpoint_update")
+        self.ep_upd_mgrs = self._managers_with("on_endpoint_updates")
+        self.local_ep_upd_mgrs = self._managers_with(
+            "on_local_endpoint_updates"
+        )
         self.ipam_upd_mgrs = self._managers_with("on_ipam_pool_updated")
         self.selector_mgrs = self._managers_with("on_policy_selector_update")
         self.tier_data_mgrs = self._managers_with("on_tier_data_update")
@@ -58,12 +81,42 @@ class UpdateSplitter(object):
     def _managers_with(self, method_name):
         return [m for m in self.managers if hasattr(m, method_name)]
 
+    def flush(self):
+        """
+        Sends any buffered endpoint updates to the interested managers.
+        """
+        if not self._pending_ep_updates:
+            return
+        updates = self._pending_ep_updates.items()
+        local_updates = [(ep_id, ep) for (ep_id, ep) in updates
+                         if ep_id.host == self.hostname]
+        self._pending_ep_updates = OrderedDict()
+        num_msgs = 0
+        for mgr in self.ep_upd_mgrs:
+            mgr.on_endpoint_updates(updates, nowait=True)
+            num_msgs += 1
+        if local_updates:
+            for mgr in self.local_ep_upd_mgrs:
+                mgr.on_local_endpoint_updates(local_updates, nowait=True)
+                num_msgs += 1
+        # Previously, we sent every update to every manager.
+        _stats.increment("Endpoint update messages saved",
+                         by=(self._num_ep_updates_received *
+                             (len(self.ep_upd_mgrs) +
+                              len(self.local_ep_upd_mgrs)) - num_msgs))
+        _stats.increment("Endpoint update messages sent", by=num_msgs)
+        self._num_ep_updates_received = 0
+
     def on_datamodel_in_sync(self):
         """
         Called when the data-model is known to be in-sync.
         """
+        self.flush()
+        _log.info("Datamodel in sync, %s endpoint update messages saved "
+                  "by batching and routing so far.",
+                  _stats.stats["Endpoint update messages saved"])
         for mgr in self.in_sync_mgrs:
-            mgr.on_datamodel_in_sync(async=True)
+            mgr.on_datamodel_in_sync(nowait=True)
 
     def on_rules_update(self, profile_id, rules):
         """
@@ -72,9 +125,10 @@ class UpdateSplitter(object):
         :param dict[str,list[dict]] rules: New set of inbound/outbound rules
             or None if the rules have been deleted.
         """
+        self.flush()
         _log.info("Profile update: %s", profile_id)
         for mgr in self.rules_upd_mgrs:
-            mgr.on_rules_update(profile_id, rules, async=True)
+            mgr.on_rules_update(profile_id, rules, nowait=True)
 
     def on_tags_update(self, profile_id, tags):
         """
@@ -83,9 +137,10 @@ class UpdateSplitter(object):
         :param list[str] tags: List of tags for the given profile or None if
             deleted.
         """
+        self.flush()
         _log.info("Tags for profile %s updated", profile_id)
         for mgr in self.tags_upd_mgrs:
-            mgr.on_tags_update(profile_id, tags, async=True)
+            mgr.on_tags_update(profile_id, tags, nowait=True)
 
     def on_prof_labels_set(self, profile_id, labels):
         """
@@ -93,9 +148,10 @@ class UpdateSplitter(object):
         :param str profile_id: ID of the profile.
         :param labels: dict or, None to signify deletion.
         """
+        self.flush()
         _log.info("Profile %s labels updated", profile_id)
         for mgr in self.prof_labels_mgrs:
-            mgr.on_prof_labels_set(profile_id, labels, async=True)
+            mgr.on_prof_labels_set(profile_id, labels, nowait=True)
 
     def on_tier_data_update(self, tier, data_or_none):
         """
@@ -103,9 +159,10 @@ class UpdateSplitter(object):
         :param str tier: name of the tier.
         :param dict|NoneType data_or_none: dict containing its data or None.
         """
+        self.flush()
         _log.info("Data for tier %s updated", tier)
         for mgr in self.tier_data_mgrs:
-            mgr.on_tier_data_update(tier, data_or_none, async=True)
+            mgr.on_tier_data_update(tier, data_or_none, nowait=True)
 
     def on_policy_selector_update(self, policy_id, selector_or_none,
                                   order_or_none):
@@ -114,10 +171,11 @@ class UpdateSplitter(object):
         :param policy_id:
         :param selector_or_none:
         """
+        self.flush()
         _log.info("Selector for profile %s updated", policy_id)
         for mgr in self.selector_mgrs:
             mgr.on_policy_selector_update(policy_id, selector_or_none,
-                                          order_or_none, async=True)
+                                          order_or_none, nowait=True)
 
     def on_interface_update(self, name, iface_up):
         """
@@ -126,21 +184,26 @@ class UpdateSplitter(object):
         :param str name: Interface name
         :param bool iface_up: True if the interface is up, False if notF.
         """
+        self.flush()
         _log.info("Interface %s state changed", name)
         for mgr in self.iface_upd_mgrs:
-            mgr.on_interface_update(name, iface_up, async=True)
+            mgr.on_interface_update(name, iface_up, nowait=True)
 
     def on_endpoint_update(self, endpoint_id, endpoint):
         """
         Process an update to the given endpoint.  endpoint may be None if
-        the endpoint was deleted.
+        the endpoint was deleted.  The update is buffered until the next
+        flush().
 
         :param EndpointId endpoint_id: EndpointId object in question
         :param dict endpoint: Endpoint data dict
         """
         _log.debug("Endpoint update for %s.", endpoint_id)
-        for mgr in self.ep_upd_mgrs:
-            mgr.on_endpoint_update(endpoint_id, endpoint, async=True)
+        # Only the latest update for each endpoint matters but the update
+        # must go to the back of the queue to preserve ordering.
+        self._pending_ep_updates.pop(endpoint_id, None)
+        self._pending_ep_updates[endpoint_id] = endpoint
+        self._num_ep_updates_received += 1
 
     def on_ipam_pool_updated(self, pool_id, pool):
         """
@@ -150,9 +213,10 @@ class UpdateSplitter(object):
         :param pool: Either a dict representing the pool or None for a
                deletion.
         """
+        self.flush()
         _log.info("IPAM pool %s updated", pool_id)
         for mgr in self.ipam_upd_mgrs:
-            mgr.on_ipam_pool_updated(pool_id, pool, async=True)
+            mgr.on_ipam_pool_updated(pool_id, pool, nowait=True)
 
 
 class CleanupManager(Actor):
@@ -163,6 +227,10 @@ class CleanupManager(Actor):
     single one-way flag but making it an Actor lets us re-use
     the UpdateSplitter logic to fan out the on_datamodel_in_sync()
     call.
+
+    Since it sees the whole of the graceful restart, it also reports
+    how long the restart took and how much work was avoided by
+    reconciling with the existing dataplane.
     """
     def __init__(self, config, iptables_updaters, ipsets_mgrs):
         super(CleanupManager, self).__init__()
@@ -170,6 +238,8 @@ class CleanupManager(Actor):
         self.iptables_updaters = iptables_updaters
         self.ipsets_mgrs = ipsets_mgrs
         self._cleanup_done = False
+        self._start_time = monotonic_time()
+        self._in_sync_time = None
 
     @actor_message()
     def on_datamodel_in_sync(self):
@@ -177,6 +247,9 @@ class CleanupManager(Actor):
             # Datamodel in sync for the first time.  Give the managers some
             # time to finish processing, then trigger cleanup.
             self._cleanup_done = True
+            self._in_sync_time = monotonic_time()
+            _log.info("Datamodel in sync %.1fs after start.",
+                      self._in_sync_time - self._start_time)
             _log.info("No cleanup scheduled, scheduling one.")
             gevent.spawn_later(self.config.STARTUP_CLEANUP_DELAY,
                                functools.partial(self._do_cleanup,
@@ -196,6 +269,9 @@ class CleanupManager(Actor):
             _log.info("iptables cleanup complete, moving on to ipsets")
             for ipset_mgr in self.ipsets_mgrs:
                 ipset_mgr.cleanup(async=False)
+            # Routes may have changed since we loaded them.
+            devices.discard_route_inventory()
+            self._report_restart_stats()
 
             # We've cleaned up any unused ipsets and iptables.   Let any
             # plugins know in case they want to take any action.
@@ -208,3 +284,13 @@ class CleanupManager(Actor):
                            "exiting")
             os._exit(1)
             raise  # Keep linter happy.
+
+    def _report_restart_stats(self):
+        now = monotonic_time()
+        _log.info("Graceful restart complete %.1fs after start, datamodel "
+                  "was in sync after %.1fs (cleanup delay %ss).",
+                  now - self._start_time,
+                  self._in_sync_time - self._start_time,
+                  self.config.STARTUP_CLEANUP_DELAY)
+        for name, count in sorted(RECONCILIATION_STATS.stats.items()):
+            _log.info("Start-of-day reconciliation: %s: %s", name, count)
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+calico.felix.test.bench_actor
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Throughput benchmark for actor messages.
+
+Sends messages through a chain of actors, each of which forwards every
+message to the next, and compares fire-and-forget async=True calls (whose
+results are discarded) with nowait=True calls.
+
+Run with: python -m calico.felix.test.bench_actor [num_messages]
+"""
+import sys
+import time
+
+from gevent.event import Event
+
+from calico.felix.actor import Actor, actor_message
+
+CHAIN_LENGTH = 4
+
+
+class ForwardingActor(Actor):
+    # Don't artificially delay batches, we want to measure per-message
+    # overhead.
+    batch_delay = 0
+
+    def __init__(self, next_actor, nowait, qualifier=None):
+        super(ForwardingActor, self).__init__(qualifier=qualifier)
+        self.next_actor = next_actor
+        self.nowait = nowait
+
+    @actor_message()
+    def on_message(self, value):
+        if self.nowait:
+            self.next_actor.on_message(value, nowait=True)
+        else:
+            self.next_actor.on_message(value, async=True)
+
+
+class CountingActor(Actor):
+    batch_delay = 0
+
+    def __init__(self, expected):
+        super(CountingActor, self).__init__()
+        self.expected = expected
+        self.count = 0
+        self.done = Event()
+
+    @actor_message()
+    def on_message(self, value):
+        self.count += 1
+        if self.count == self.expected:
+            self.done.set()
+
+
+def run(num_messages, nowait):
+    """
+    Sends num_messages through a chain of CHAIN_LENGTH actors.
+
+    :returns elapsed time.
+    """
+    actor = CountingActor(num_messages).start()
+    counter = actor
+    for ii in xrange(CHAIN_LENGTH - 1):
+        actor = ForwardingActor(actor, nowait, qualifier=str(ii)).start()
+    start = time.time()
+    for ii in xrange(num_messages):
+        if nowait:
+            actor.on_message(ii, nowait=True)
+        else:
+            actor.on_message(ii, async=True)
+    counter.done.wait()
+    return time.time() - start
+
+
+def main(argv):
+    num_messages = int(argv[1]) if len(argv) > 1 else 100000
+    total = num_messages * CHAIN_LENGTH
+    for name, nowait in [("async=True", False), ("nowait=True", True)]:
+        elapsed = run(num_messages, nowait)
+        print "%-12s %8d msgs through %d actors in %.3fs: %8.0f msgs/s" % (
+            name, num_messages, CHAIN_LENGTH, elapsed, total / elapsed
+        )
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+calico.felix.test.bench_fipmanager
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Rewrite-size benchmark for the floating IP manager.
+
+Programs floating IPs for a host full of NAT'd endpoints and then changes
+the floating IPs of each endpoint in turn, recording how many rules the
+FloatingIPManager asks the IptablesUpdater to write for each change.  For
+comparison, the total number of floating IP rules is what a full rewrite
+of the NAT chains would write.
+
+Run with: python -m calico.felix.test.bench_fipmanager [num_endpoints]
+"""
+import sys
+import time
+
+from calico.felix.fipmanager import FloatingIPManager
+
+
+class RecordingUpdater(object):
+    """
+    Stands in for the IptablesUpdater, counting the rules it's asked to
+    write.
+    """
+    def __init__(self):
+        self.rules_written = 0
+
+    def rewrite_chains(self, updates, deps, async=False):
+        self.rules_written += sum(len(u) for u in updates.itervalues())
+
+    def delete_chains(self, chains, async=False):
+        pass
+
+
+def nat_maps(ii, generation):
+    return [{"int_ip": "10.%d.%d.%d" % (generation, ii // 256, ii % 256),
+             "ext_ip": "172.%d.%d.%d" % (16 + generation, ii // 256,
+                                         ii % 256)}]
+
+
+def main(argv):
+    num_endpoints = int(argv[1]) if len(argv) > 1 else 500
+    updater = RecordingUpdater()
+    manager = FloatingIPManager(None, 4, updater).start()
+    manager.apply_snapshot(
+        dict(("ep%d" % ii, nat_maps(ii, 0)) for ii in xrange(num_endpoints)),
+        async=False
+    )
+    # One DNAT and one SNAT rule per endpoint.
+    total_rules = 2 * num_endpoints
+    updater.rules_written = 0
+    start = time.time()
+    for ii in xrange(num_endpoints):
+        manager.update_endpoint("ep%d" % ii, nat_maps(ii, 1), async=False)
+    elapsed = time.time() - start
+    print "%d endpoints, %d floating IP rules in total" % (num_endpoints,
+                                                           total_rules)
+    print "%.1f rules rewritten per update (%.1f%% of a full rewrite), " \
+          "%d updates in %.4fs" % (
+              float(updater.rules_written) / num_endpoints,
+              100.0 * updater.rules_written / num_endpoints / total_rules,
+              num_endpoints, elapsed)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+calico.felix.test.bench_fiptgenerator
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Rule-count benchmark for profile chain generation.
+
+Generates a profile in the style produced by orchestrators, with hundreds of
+rules that differ only by CIDR or port, and compares the linear chains with
+the chains where runs of similar rules are collapsed into ipset matches.
+A packet that matches none of the rules traverses the whole chain so the
+chain length is the worst-case traversal.  The linear chains are generated
+twice to show the effect of the rule fragment cache.
+
+Run with: python -m calico.felix.test.bench_fiptgenerator [num_rules]
+"""
+import sys
+import time
+
+from calico.felix.test.base import load_config
+
+
+def make_profile(num_rules):
+    """
+    :returns a profile with num_rules inbound rules, made up of blocks of
+             allow rules for web ports from per-subnet CIDRs, interspersed
+             with deny rules and a rule for a tag.
+    """
+    rules = []
+    for ii in xrange(num_rules):
+        block, offset = divmod(ii, 50)
+        if offset < 40:
+            rules.append({"action": "allow",
+                          "protocol": "tcp",
+                          "src_net": "10.%s.%s.0/24" % (block, offset),
+                          "dst_ports": [80, 443]})
+        elif offset < 49:
+            rules.append({"action": "deny",
+                          "src_net": "172.16.%s.%s/32" % (block, offset)})
+        else:
+            rules.append({"action": "allow", "src_tag": "tag%s" % block})
+    return {"inbound_rules": rules, "outbound_rules": []}
+
+
+def run(generator, profile, collapse):
+    """
+    Generates the chains for the profile.
+
+    :returns tuple of elapsed time, number of rules in the inbound chain
+             and number of ipset entries needed.
+    """
+    tag_to_ipset = dict(("tag%s" % ii, "ipset-tag%s" % ii)
+                        for ii in xrange(len(profile["inbound_rules"])))
+    net_set_to_ipset = None
+    num_entries = 0
+    start = time.time()
+    if collapse:
+        net_sets = generator.profile_net_sets(profile, 4)
+        net_set_to_ipset = dict((n, "ipset-%s" % ii)
+                                for ii, n in enumerate(net_sets))
+        num_entries = sum(len(n.members) for n in net_sets)
+    updates, _ = generator.profile_updates("prof", profile, 4, tag_to_ipset,
+                                           {}, on_allow="RETURN",
+                                           net_set_to_ipset=net_set_to_ipset)
+    elapsed = time.time() - start
+    return elapsed, len(updates["felix-p-prof-i"]), num_entries
+
+
+def main(argv):
+    num_rules = int(argv[1]) if len(argv) > 1 else 500
+    generator = load_config("felix_default.cfg").plugins["iptables_generator"]
+    profile = make_profile(num_rules)
+    for name, collapse in [("linear", False), ("re-render", False),
+                           ("collapsed", True)]:
+        elapsed, chain_len, num_entries = run(generator, profile, collapse)
+        print "%-10s %5d rules -> %5d in chain (%6d ipset entries) " \
+              "generated in %.4fs" % (name, num_rules, chain_len,
+                                      num_entries, elapsed)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+calico.felix.test.bench_selectors
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Parse-throughput benchmark for selectors.
+
+Parses a set of distinct selectors, in the style generated by orchestrators,
+with the pyparsing grammar that the selector parser replaced, with the
+parser itself and then through parse_selector() a second time, when the
+parse cache should satisfy every lookup.
+
+Run with: python -m calico.felix.test.bench_selectors [num_selectors]
+"""
+import sys
+import time
+
+from calico.felix import selectors
+from calico.felix.test.test_selectors import _reference_parse
+
+
+def make_selectors(num_selectors):
+    """
+    :returns a list of num_selectors distinct selector strings.
+    """
+    sels = []
+    for ii in xrange(num_selectors):
+        sels.append(
+            "calico/k8s_ns == 'ns-%s' && role in {'frontend', 'backend'} && "
+            "(tier != 'db' || has(allow-db)) && env not in {'dev-%s'}" %
+            (ii, ii % 10)
+        )
+    return sels
+
+
+def run(parse_fn, sels):
+    """
+    :returns the elapsed time to parse all the selectors.
+    """
+    start = time.time()
+    for sel in sels:
+        parse_fn(sel)
+    return time.time() - start
+
+
+def main(argv):
+    num_selectors = int(argv[1]) if len(argv) > 1 else 2000
+    sels = make_selectors(num_selectors)
+    results = [("pyparsing", run(_reference_parse, sels)),
+               ("parser", run(selectors._parse_no_cache, sels))]
+    # Hold references, as the users of the selectors would.
+    held = [selectors.parse_selector(s) for s in sels]
+    results.append(("cached", run(selectors.parse_selector, sels)))
+    for name, elapsed in results:
+        print "%-10s %6d selectors parsed in %.4fs (%8.0f/s)" % (
+            name, len(held), elapsed, len(held) / elapsed)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -28,7 +28,9 @@ import mock
 from gevent.event import AsyncResult
 
 from calico.felix import actor
-from calico.felix.actor import actor_message, ResultOrExc, SplitBatchAndRetry
+from calico.felix.actor import (
+    actor_message, ResultOrExc, SplitBatchAndRetry, RetryWithoutMessage
+)
 from calico.felix.test.base import BaseTestCase, ExpectedException
 
 # Logger
@@ -108,6 +110,92 @@ class TestActor(BaseTestCase):
             ResultOrExc(result='b', exception=None),
         ])
 
+    def test_nowait(self):
+        """
+        Tests that nowait messages are batched with other messages but
+        don't allocate a result.
+        """
+        num_refs_at_start = len(actor._tracked_refs_by_idx)
+        self.assertEqual(self._actor.do_a(nowait=True), None)
+        self.assertEqual(len(actor._tracked_refs_by_idx), num_refs_at_start)
+        f_b = self._actor.do_b(async=True)
+        self.assertEqual(self._actor.do_a(nowait=True), None)
+        self.run_actor_loop()
+        self.assertEqual(self._actor.actions, ["sb", "a", "b", "a", "fb"])
+        self.assertEqual(f_b.get(), "b")
+        self.assertFalse(self._m_exit.called)
+
+    def test_nowait_exception(self):
+        """
+        Tests that an exception from a nowait message is reported to the
+        central handler, which kills the process.
+        """
+        self._actor.do_exc(nowait=True)
+        f_a = self._actor.do_a(async=True)
+        self.run_actor_loop()
+        self._m_exit.assert_called_once_with(1)
+        self._m_exit.reset_mock()
+        # Other messages in the batch still get their results.
+        self.assertEqual(f_a.get(), "a")
+
+    def test_nowait_and_async(self):
+        self.assertRaises(AssertionError, self._actor.do_a,
+                          async=True, nowait=True)
+
+    def test_stat_names_cached(self):
+        with mock.patch.object(actor._stats, "increment") as m_inc:
+            self._actor.do_a(nowait=True)
+            self._actor.do_a(nowait=True)
+            self._actor.do_a(async=True)
+        self.run_actor_loop()
+        stat_names = [c[1][0] for c in m_inc.mock_calls
+                      if "message" in c[1][0]]
+        self.assertEqual([n.split(" ")[0] for n in stat_names],
+                         ["NOWAIT", "NOWAIT", "ASYNC"])
+        self.assertTrue(all(n.endswith("--[do_a]-> ActorForTesting")
+                            for n in stat_names))
+        # Name should be formatted once and then reused.
+        self.assertTrue(stat_names[0] is stat_names[1])
+
+    def test_coalesce(self):
+        """
+        Tests that a queued message is superseded by a later message with
+        the same coalesce key and that all callers get the later result.
+        """
+        f_1 = self._actor.do_update("k1", 1, async=True)
+        f_2 = self._actor.do_update("k2", 1, async=True)
+        f_a = self._actor.do_a(async=True)
+        f_3 = self._actor.do_update("k1", 2, async=True)
+        self._actor.do_update("k1", 3, nowait=True)
+        self.run_actor_loop()
+        self.assertEqual(self._actor.actions,
+                         ["sb", "k2=1", "a", "k1=3", "fb"])
+        self.assertEqual(f_1.get(), "k1=3")
+        self.assertEqual(f_2.get(), "k2=1")
+        self.assertEqual(f_a.get(), "a")
+        self.assertEqual(f_3.get(), "k1=3")
+        self.assertEqual(self._actor._coalescable_msgs, {})
+
+    def test_coalesce_exception(self):
+        f_1 = self._actor.do_update("k1", EXPECTED_EXCEPTION, async=True)
+        f_2 = self._actor.do_update("k1", EXPECTED_EXCEPTION, async=True)
+        self.run_actor_loop()
+        self.assertEqual(self._actor.actions, ["sb", "fb"])
+        self.assertRaises(ExpectedException, f_1.get)
+        self.assertRaises(ExpectedException, f_2.get)
+
+    def test_no_coalesce_after_dequeue(self):
+        """
+        Tests that messages are only coalesced while they're still on the
+        queue.
+        """
+        self._actor.do_update("k1", 1, async=True)
+        self.run_actor_loop()
+        self._actor.do_update("k1", 2, async=True)
+        self.run_actor_loop()
+        self.assertEqual(self._actor.batches,
+                         [["sb", "k1=1", "fb"], ["sb", "k1=2", "fb"]])
+
     def test_split_batch(self):
         """
         Tests an exception raised by an event method is returned to the
@@ -146,6 +234,27 @@ class TestActor(BaseTestCase):
             ["sb", "b", "a", "fb"],
         ])
 
+    def test_retry_without_message(self):
+        """
+        Tests that a message that the actor blames for a failure gets the
+        given result and the rest of the batch is retried as one.
+        """
+        f_a1 = self._actor.do_a(async=True)
+        f_b = self._actor.do_b(async=True)
+        f_a2 = self._actor.do_a(async=True)
+        self._actor._finish_side_effects = iter([
+            RetryWithoutMessage(1, ResultOrExc(None, EXPECTED_EXCEPTION)),
+            None,
+        ])
+        self.run_actor_loop()
+        self.assertEqual(self._actor.batches, [
+            ["sb", "a", "b", "a", "fb"],
+            ["sb", "a", "a", "fb"],
+        ])
+        self.assertRaises(ExpectedException, f_b.get)
+        self.assertEqual(f_a1.get(), "a")
+        self.assertEqual(f_a2.get(), "a")
+
     def test_split_batch_exc(self):
         f_a = self._actor.do_a(async=True)
         f_exc = self._actor.do_exc(async=True)
@@ -334,6 +443,14 @@ class ActorForTesting(actor.Actor):
     def do_c2(self):
         return "c2"
 
+    @actor_message(coalesce_key=lambda key, value: key)
+    def do_update(self, key, value):
+        if isinstance(value, Exception):
+            raise value
+        action = "%s=%s" % (key, value)
+        self._batch_actions.append(action)
+        return action
+
     @actor_message(needs_own_batch=True)
     def do_own_batch(self):
         self._batch_actions.append("own")
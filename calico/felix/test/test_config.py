@@ -118,6 +118,15 @@ class TestConfig(unittest.TestCase):
                                      "Invalid field value"):
             config = Config("calico/felix/test/data/felix_invalid_action.cfg")
 
+    def test_dataplane_backend(self):
+        env_dict = {"FELIX_DATAPLANEBACKEND": "nftables"}
+        conf = load_config("felix_default.cfg", env_dict=env_dict)
+        self.assertEqual(conf.DATAPLANE_BACKEND, "nftables")
+        env_dict = {"FELIX_DATAPLANEBACKEND": "ebpf"}
+        with self.assertRaisesRegexp(ConfigException,
+                                     "Invalid field value"):
+            load_config("felix_default.cfg", env_dict=env_dict)
+
     def test_etcd_endpoints(self):
         env_dict = { "FELIX_ETCDENDPOINTS": "http://localhost:1, http://localhost:2,http://localhost:3 "}
         conf = load_config("felix_default.cfg", env_dict=env_dict)
@@ -536,3 +545,33 @@ class TestConfig(unittest.TestCase):
             config.report_etcd_config({}, cfg_dict)
 
         self.assertEqual(config.MAX_IPSET_SIZE, 2**20)
+
+    def test_default_iptables_txn_lines(self):
+        """
+        Test that the iptables transaction size is defaulted if negative.
+        """
+        with mock.patch('calico.common.complete_logging'):
+            config = Config("calico/felix/test/data/felix_missing.cfg")
+        cfg_dict = {
+            "InterfacePrefix": "blah",
+            "IptablesMaxTransactionLines": "-1",
+        }
+        with mock.patch('calico.common.complete_logging'):
+            config.report_etcd_config({}, cfg_dict)
+
+        self.assertEqual(config.MAX_IPTABLES_TXN_LINES, 10000)
+
+    def test_default_rule_fragment_cache_size(self):
+        """
+        Test that the rule fragment cache size is defaulted if negative.
+        """
+        with mock.patch('calico.common.complete_logging'):
+            config = Config("calico/felix/test/data/felix_missing.cfg")
+        cfg_dict = {
+            "InterfacePrefix": "blah",
+            "RuleFragmentCacheSize": "-1",
+        }
+        with mock.patch('calico.common.complete_logging'):
+            config.report_etcd_config({}, cfg_dict)
+
+        self.assertEqual(config.RULE_FRAGMENT_CACHE_SIZE, 10000)
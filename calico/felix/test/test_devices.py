@@ -257,6 +257,82 @@ class TestDevices(unittest.TestCase):
                 self.assertEqual(futils.check_call.call_count, len(calls))
                 futils.check_call.assert_has_calls(calls, any_order=True)
 
+    def test_load_route_inventory(self):
+        routes = futils.CommandOutput(
+            "default via 172.17.0.1 dev eth0\n"
+            "10.65.0.2 dev tapabcdef scope link\n"
+            "10.65.0.3 dev tapabcdef proto static scope link\n"
+            "10.65.0.4 dev tap123456 scope link\n"
+            "172.17.0.0/16 dev eth0 proto kernel scope link\n", "")
+        neighs = futils.CommandOutput(
+            "10.65.0.2 dev tapabcdef lladdr AA:BB:CC:DD:EE:FF PERMANENT\n",
+            "")
+        with mock.patch('calico.felix.futils.check_call',
+                        side_effect=iter([routes, neighs])) as m_check_call:
+            devices.load_route_inventory(futils.IPV4)
+        self.addCleanup(devices.discard_route_inventory)
+        self.assertEqual(m_check_call.mock_calls, [
+            mock.call(["ip", "route", "list"]),
+            mock.call(["ip", "neigh", "show", "nud", "permanent"]),
+        ])
+
+        # First call for each interface uses the inventory.  The ARP entry
+        # for 10.65.0.2 is already correct.
+        interface = "tapabcdef"
+        mac = "aa:bb:cc:dd:ee:ff"
+        with mock.patch('calico.felix.futils.check_call') as m_check_call:
+            devices.set_routes(futils.IPV4, set(["10.65.0.2", "10.65.0.5"]),
+                               interface, mac, reset_arp=True)
+        self.assertEqual(
+            sorted(m_check_call.mock_calls),
+            sorted([
+                mock.call(['arp', '-d', "10.65.0.3", '-i', interface]),
+                mock.call(["ip", "route", "del", "10.65.0.3", "dev",
+                           interface]),
+                mock.call(['arp', '-s', "10.65.0.5", mac, '-i', interface]),
+                mock.call(["ip", "route", "replace", "10.65.0.5", "dev",
+                           interface]),
+            ])
+        )
+
+        # Subsequent calls list the routes as normal.
+        with mock.patch('calico.felix.devices.list_interface_route_ips',
+                        return_value=set()) as m_list:
+            with mock.patch('calico.felix.futils.check_call'):
+                devices.set_routes(futils.IPV4, set(), interface)
+        m_list.assert_called_once_with(futils.IPV4, interface)
+
+        # Interfaces with no routes are known to have none.
+        with mock.patch('calico.felix.futils.check_call') as m_check_call:
+            devices.set_routes(futils.IPV4, set(), "tapnoroutes")
+        self.assertFalse(m_check_call.called)
+
+        # If the interface goes down, the inventory is discarded for it.
+        devices.discard_route_inventory("tap123456")
+        with mock.patch('calico.felix.devices.list_interface_route_ips',
+                        return_value=set()) as m_list:
+            devices.set_routes(futils.IPV4, set(), "tap123456")
+        m_list.assert_called_once_with(futils.IPV4, "tap123456")
+
+    def test_load_route_inventory_v6(self):
+        routes = futils.CommandOutput(
+            "2001::1 dev tapabcdef metric 1024\n"
+            "fe80::/64 dev eth0 proto kernel metric 256\n", "")
+        with mock.patch('calico.felix.futils.check_call',
+                        return_value=routes) as m_check_call:
+            devices.load_route_inventory(futils.IPV6)
+        self.addCleanup(devices.discard_route_inventory)
+        m_check_call.assert_called_once_with(["ip", "-6", "route", "list"])
+        with mock.patch('calico.felix.futils.check_call') as m_check_call:
+            devices.set_routes(futils.IPV6, set(["2001::1"]), "tapabcdef",
+                               "aa:bb:cc:dd:ee:ff")
+        self.assertFalse(m_check_call.called)
+        # IPv4 inventory not loaded.
+        with mock.patch('calico.felix.devices.list_interface_route_ips',
+                        return_value=set()) as m_list:
+            devices.set_routes(futils.IPV4, set(), "tapabcdef")
+        m_list.assert_called_once_with(futils.IPV4, "tapabcdef")
+
     def test_list_interface_no_ips(self):
         retcode = futils.CommandOutput(
             "7: tunl0@NONE: <NOARP,UP,LOWER_UP> mtu 1440 qdisc noqueue "
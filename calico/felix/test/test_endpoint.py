@@ -32,6 +32,7 @@ from calico.felix.fiptables import IptablesUpdater
 from calico.felix.dispatch import DispatchChains
 from calico.felix.futils import FailedSystemCall
 from calico.felix.profilerules import RulesManager
+from calico.felix.policylists import PolicyListManager, policy_list_id
 from calico.felix.fipmanager import FloatingIPManager
 
 import mock
@@ -59,10 +60,12 @@ class TestEndpointManager(BaseTestCase):
         self.m_updater = Mock(spec=IptablesUpdater)
         self.m_dispatch = Mock(spec=DispatchChains)
         self.m_rules_mgr = Mock(spec=RulesManager)
+        self.m_pol_list_mgr = Mock(spec=PolicyListManager)
         self.m_fip_manager = Mock(spec=FloatingIPManager)
         self.m_status_reporter = Mock(spec=EtcdStatusReporter)
         self.mgr = EndpointManager(self.config, "IPv4", self.m_updater,
                                    self.m_dispatch, self.m_rules_mgr,
+                                   self.m_pol_list_mgr,
                                    self.m_fip_manager, self.m_status_reporter)
         self.mgr.get_and_incref = Mock()
         self.mgr.decref = Mock()
@@ -139,8 +142,9 @@ class TestEndpointManager(BaseTestCase):
                                            10, async=True)
         self.step_actor(self.mgr)
         # Since we haven't set the tier ID yet, the policy won't get applied...
+        # and the subsequent no-op updates are suppressed.
         self.assertEqual(m_endpoint.on_tiered_policy_update.mock_calls,
-                         [mock.call(OrderedDict(), async=True)] * 5)
+                         [mock.call(OrderedDict(), async=True)])
         m_endpoint.on_tiered_policy_update.reset_mock()
 
         # Adding a tier should trigger an update, adding the tier and policy.
@@ -192,9 +196,10 @@ class TestEndpointManager(BaseTestCase):
         self.step_actor(self.mgr)
         tiers = OrderedDict()
         tiers["a"] = [pol_id_a]
+        # Removing the tier changes the list; removing the policy doesn't.
         self.assertEqual(
             m_endpoint.on_tiered_policy_update.mock_calls,
-            [mock.call(tiers, async=True)] * 2  # One for policy, one for tier.
+            [mock.call(tiers, async=True)]
         )
         m_endpoint.on_tiered_policy_update.reset_mock()
 
@@ -217,6 +222,81 @@ class TestEndpointManager(BaseTestCase):
                              (expected_call, actual_call))
         m_endpoint.on_tiered_policy_update.reset_mock()
 
+    def test_incremental_policy_ordering(self):
+        """
+        Check that order changes only refresh the endpoints whose policy
+        list changes.
+        """
+        self.mgr.on_datamodel_in_sync(async=True)
+        self.mgr.on_endpoint_update(ENDPOINT_ID,
+                                    {"name": "tap12345",
+                                     "labels": {"a": "a"}},
+                                    async=True)
+        self.mgr.on_endpoint_update(ENDPOINT_ID_2,
+                                    {"name": "tap23456"},
+                                    async=True)
+        self.step_actor(self.mgr)
+        m_ep_1 = Mock(spec=LocalEndpoint)
+        m_ep_2 = Mock(spec=LocalEndpoint)
+        self.mgr.objects_by_id[ENDPOINT_ID] = m_ep_1
+        self.mgr.objects_by_id[ENDPOINT_ID_2] = m_ep_2
+        self.mgr._is_starting_or_live = Mock(return_value=True)
+
+        pol_a1 = TieredPolicyId("a", "a1")
+        pol_a2 = TieredPolicyId("a", "a2")
+        pol_b1 = TieredPolicyId("b", "b1")
+        self.mgr.on_tier_data_update("a", {"order": 1}, async=True)
+        self.mgr.on_tier_data_update("b", {"order": 2}, async=True)
+        self.mgr.on_policy_selector_update(pol_a1, parse_selector("has(a)"),
+                                           10, async=True)
+        self.mgr.on_policy_selector_update(pol_a2, parse_selector("has(a)"),
+                                           20, async=True)
+        self.mgr.on_policy_selector_update(pol_b1, parse_selector("all()"),
+                                           10, async=True)
+        self.step_actor(self.mgr)
+        self.assertEqual([p for _, p in self.mgr.sorted_pols],
+                         [pol_a1, pol_a2, pol_b1])
+        m_ep_1.reset_mock()
+        m_ep_2.reset_mock()
+
+        # Changing the order without passing another policy is a no-op.
+        self.mgr.on_policy_selector_update(pol_a1, parse_selector("has(a)"),
+                                           15, async=True)
+        self.mgr.on_tier_data_update("b", {"order": 3}, async=True)
+        self.step_actor(self.mgr)
+        self.assertEqual(self.mgr.endpoints_with_dirty_policy, set())
+        self.assertFalse(m_ep_1.on_tiered_policy_update.called)
+        self.assertFalse(m_ep_2.on_tiered_policy_update.called)
+
+        # Reordering within tier a only affects the endpoint using it.
+        self.mgr.on_policy_selector_update(pol_a1, parse_selector("has(a)"),
+                                           25, async=True)
+        self.step_actor(self.mgr)
+        tiers = OrderedDict([("a", [pol_a2, pol_a1]), ("b", [pol_b1])])
+        self.assertEqual(m_ep_1.on_tiered_policy_update.mock_calls,
+                         [mock.call(tiers, async=True)])
+        self.assertFalse(m_ep_2.on_tiered_policy_update.called)
+        m_ep_1.reset_mock()
+
+        # Moving tier b to the front refreshes both endpoints but the
+        # second endpoint's list doesn't change so it gets no update.
+        with mock.patch.object(self.mgr, "_update_tiered_policy",
+                               wraps=self.mgr._update_tiered_policy) as m_upd:
+            self.mgr.on_tier_data_update("b", {"order": 0}, async=True)
+            self.step_actor(self.mgr)
+        self.assertEqual(set(c[1][0] for c in m_upd.mock_calls),
+                         set([ENDPOINT_ID, ENDPOINT_ID_2]))
+        tiers = OrderedDict([("b", [pol_b1]), ("a", [pol_a2, pol_a1])])
+        self.assertEqual(m_ep_1.on_tiered_policy_update.mock_calls,
+                         [mock.call(tiers, async=True)])
+        self.assertFalse(m_ep_2.on_tiered_policy_update.called)
+
+        # Removing a tier takes its policies out of the ordering.
+        self.mgr.on_tier_data_update("a", None, async=True)
+        self.step_actor(self.mgr)
+        self.assertEqual([p for _, p in self.mgr.sorted_pols], [pol_b1])
+        self.assertFalse(m_ep_2.on_tiered_policy_update.called)
+
     def test_label_inheritance(self):
         # Make sure we have an endpoint so that we can check that it gets
         # put in the dirty set.  These have no labels at all so we test
@@ -253,6 +333,23 @@ class TestEndpointManager(BaseTestCase):
             self.step_actor(self.mgr)
         self.assertFalse(m_sol.called)
 
+    def test_local_endpoint_updates(self):
+        with mock.patch.object(self.mgr,
+                               "_on_local_endpoint_update") as m_upd:
+            with mock.patch.object(self.mgr,
+                                   "_update_dirty_policy") as m_dirty:
+                self.mgr.on_local_endpoint_updates(
+                    [(ENDPOINT_ID, {"name": "tap1234"}),
+                     (ENDPOINT_ID_2, None)],
+                    async=True
+                )
+                self.step_actor(self.mgr)
+        self.assertEqual(m_upd.mock_calls,
+                         [mock.call(ENDPOINT_ID, {"name": "tap1234"}),
+                          mock.call(ENDPOINT_ID_2, None)])
+        # Policy is only recalculated once for the whole batch.
+        self.assertEqual(m_dirty.mock_calls, [mock.call()])
+
     def test_endpoint_live_obj(self):
         ep = {"name": "tap1234"}
         # First send in an update to trigger creation.
@@ -325,12 +422,21 @@ class TestLocalEndpoint(BaseTestCase):
         self.m_ipt_gen = Mock(spec=FelixIptablesGenerator)
         self.m_ipt_gen.endpoint_updates.return_value = {}, {}
         self.m_iptables_updater = Mock(spec=IptablesUpdater)
+        # By default, complete iptables updates immediately.
+        self.m_iptables_updater.rewrite_chains.side_effect = \
+            self._complete_ipt_update
+        self.m_iptables_updater.delete_chains.side_effect = \
+            self._complete_ipt_update
         self.m_dispatch_chains = Mock(spec=DispatchChains)
         self.m_rules_mgr = Mock(spec=RulesManager)
+        self.m_pol_list_mgr = Mock(spec=PolicyListManager)
         self.m_manager = Mock(spec=EndpointManager)
         self.m_fip_manager = Mock(spec=FloatingIPManager)
         self.m_status_rep = Mock(spec=EtcdStatusReporter)
 
+    def _complete_ipt_update(self, *args, **kwargs):
+        kwargs["callback"](None)
+
     def get_local_endpoint(self, combined_id, ip_type):
         local_endpoint = endpoint.LocalEndpoint(self.config,
                                                 combined_id,
@@ -338,6 +444,7 @@ class TestLocalEndpoint(BaseTestCase):
                                                 self.m_iptables_updater,
                                                 self.m_dispatch_chains,
                                                 self.m_rules_mgr,
+                                                self.m_pol_list_mgr,
                                                 self.m_fip_manager,
                                                 self.m_status_rep)
         local_endpoint._manager = self.m_manager
@@ -509,8 +616,10 @@ class TestLocalEndpoint(BaseTestCase):
             m_set_routes.side_effect = FailedSystemCall("", [], 1, "", "")
             local_ep.on_endpoint_update(None, async=True)
             self.step_actor(local_ep)
-            m_set_routes.assert_called_once_with(ip_type, set(),
-                                                 data["name"], None)
+            # The failure is retried when the iptables callback arrives.
+            self.assertEqual(m_set_routes.mock_calls,
+                             [mock.call(ip_type, set(), data["name"],
+                                        None)] * 2)
             # Should clean up conntrack entries for all IPs.
             m_rem_conntrack.assert_called_once_with(
                 set(['1.2.3.4']), 4
@@ -781,6 +890,163 @@ class TestLocalEndpoint(BaseTestCase):
                     self.step_actor(local_ep)
                     self.assertFalse(local_ep._device_in_sync)
 
+    @mock.patch("calico.felix.endpoint.devices", autospec=True)
+    def test_iptables_failure(self, m_devices):
+        self.config.REPORT_ENDPOINT_STATUS = True
+        callbacks = []
+        def record_callback(*args, **kwargs):
+            callbacks.append(kwargs["callback"])
+        self.m_iptables_updater.rewrite_chains.side_effect = record_callback
+        self.m_iptables_updater.delete_chains.side_effect = record_callback
+        m_devices.interface_exists.return_value = True
+        m_devices.interface_up.return_value = True
+        ep = self.get_local_endpoint(ENDPOINT_ID, futils.IPV4)
+        data = {
+            'state': "active",
+            'endpoint': "endpoint_id",
+            'mac': stub_utils.get_mac(),
+            'name': "tap1234",
+            'ipv4_nets': ["10.0.0.1"],
+            'profile_ids': ["prof1"]
+        }
+        ep.on_endpoint_update(data, async=True)
+        self.step_actor(ep)
+        self.assertEqual(self.m_iptables_updater.rewrite_chains.call_count,
+                         1)
+        # Status isn't reported until the update completes.
+        self.assertFalse(self.m_status_rep.on_endpoint_status_changed.called)
+
+        # Fail the update, should try to remove the chains.
+        callbacks.pop()(FailedSystemCall("", [], 1, "", ""))
+        self.step_actor(ep)
+        self.assertEqual(self.m_iptables_updater.delete_chains.call_count, 1)
+        callbacks.pop()(None)
+        self.step_actor(ep)
+        self.m_fip_manager.update_endpoint.assert_called_once_with(
+            ENDPOINT_ID, None, async=True
+        )
+        self.assertFalse(ep._iptables_in_sync)
+        self.assertFalse(ep._chains_programmed)
+        self.m_status_rep.on_endpoint_status_changed.assert_called_once_with(
+            ENDPOINT_ID, futils.IPV4, {"status": "error"}, async=True
+        )
+        # Shouldn't retry until we get another update.
+        self.assertEqual(self.m_iptables_updater.rewrite_chains.call_count,
+                         1)
+        self.assertEqual(callbacks, [])
+
+        ep.on_endpoint_update(data, force_reprogram=True, async=True)
+        self.step_actor(ep)
+        self.assertEqual(self.m_iptables_updater.rewrite_chains.call_count,
+                         2)
+        callbacks.pop()(None)
+        self.step_actor(ep)
+        self.assertTrue(ep._iptables_in_sync)
+        self.assertTrue(ep._chains_programmed)
+        self.m_status_rep.on_endpoint_status_changed.assert_called_with(
+            ENDPOINT_ID, futils.IPV4, {"status": "up"}, async=True
+        )
+
+    @mock.patch("calico.felix.endpoint.devices", autospec=True)
+    def test_policy_list_refs(self, m_devices):
+        callbacks = []
+        def record_callback(*args, **kwargs):
+            callbacks.append(kwargs["callback"])
+        self.m_iptables_updater.rewrite_chains.side_effect = record_callback
+        self.m_iptables_updater.delete_chains.side_effect = record_callback
+        def acquire(obj_id, callback=None, async=None):
+            callback(obj_id, Mock())
+        self.m_pol_list_mgr.get_and_incref.side_effect = acquire
+        ep = self.get_local_endpoint(ENDPOINT_ID, futils.IPV4)
+        data = {
+            'state': "active",
+            'endpoint': "endpoint_id",
+            'mac': stub_utils.get_mac(),
+            'name': "tap1234",
+            'ipv4_nets': ["10.0.0.1"],
+            'profile_ids': ["prof1"]
+        }
+        ep.on_endpoint_update(data, async=True)
+        self.step_actor(ep)
+        pl_1 = policy_list_id(OrderedDict(), ["prof1"])
+        self.m_pol_list_mgr.get_and_incref.assert_called_once_with(
+            pl_1, callback=mock.ANY, async=True
+        )
+        callbacks.pop()(None)
+        self.step_actor(ep)
+
+        # Changing the profiles moves us to a new policy list but we keep
+        # the old one until our chains stop referencing it.
+        data = data.copy()
+        data["profile_ids"] = ["prof2"]
+        ep.on_endpoint_update(data, async=True)
+        self.step_actor(ep)
+        pl_2 = policy_list_id(OrderedDict(), ["prof2"])
+        self.m_pol_list_mgr.get_and_incref.assert_called_with(
+            pl_2, callback=mock.ANY, async=True
+        )
+        self.assertFalse(self.m_pol_list_mgr.decref.called)
+        callbacks.pop()(None)
+        self.step_actor(ep)
+        self.m_pol_list_mgr.decref.assert_called_once_with(pl_1, async=True)
+
+        # Removing our chains releases the policy list.
+        ep.on_endpoint_update(None, async=True)
+        self.step_actor(ep)
+        self.assertEqual(self.m_pol_list_mgr.decref.call_count, 1)
+        callbacks.pop()(None)
+        self.step_actor(ep)
+        self.m_pol_list_mgr.decref.assert_called_with(pl_2, async=True)
+
+    @mock.patch("gevent.subprocess.check_output", autospec=True,
+                return_value="")
+    @mock.patch("calico.felix.endpoint.devices", autospec=True)
+    def test_pod_burst(self, m_devices, m_check_output):
+        """
+        Tests that a burst of new endpoints doesn't serialise on
+        iptables: they all queue their chains before any are applied and
+        the IptablesUpdater applies them in one iptables-restore.
+        """
+        m_devices.interface_exists.return_value = True
+        m_devices.interface_up.return_value = True
+        self.config.REPORT_ENDPOINT_STATUS = True
+        ipt = IptablesUpdater("filter", self.config, 4)
+        self.m_iptables_updater = ipt
+        eps = []
+        for ii in xrange(20):
+            combined_id = EndpointId("hostname", "k8s", "pod%s" % ii, "eth0")
+            ep = self.get_local_endpoint(combined_id, futils.IPV4)
+            ep.on_endpoint_update(
+                {
+                    'state': "active",
+                    'endpoint': "eth0",
+                    'mac': stub_utils.get_mac(),
+                    'name': "tap%s" % ii,
+                    'ipv4_nets': ["10.0.0.%s" % ii],
+                    'profile_ids': ["prof1"]
+                },
+                async=True)
+            self.step_actor(ep)
+            self.assertTrue(ep._iptables_in_flight)
+            eps.append(ep)
+        self.assertFalse(self.m_status_rep.on_endpoint_status_changed.called)
+
+        with mock.patch.object(ipt, "_execute_iptables") as m_exec:
+            self.step_actor(ipt)
+        self.assertEqual(m_exec.call_count, 1)
+        input_lines = m_exec.call_args[0][0]
+        ipt_gen = self.config.plugins["iptables_generator"]
+        for ep in eps:
+            for chain in ipt_gen.endpoint_chain_names(ep._suffix):
+                self.assertTrue("--flush %s" % chain in input_lines)
+            self.step_actor(ep)
+            self.assertFalse(ep._iptables_in_flight)
+            self.assertTrue(ep._iptables_in_sync)
+            self.assertTrue(ep._chains_programmed)
+            self.m_status_rep.on_endpoint_status_changed.assert_called_with(
+                ep.combined_id, futils.IPV4, {"status": "up"}, async=True
+            )
+
     def test_profile_id_update_triggers_iptables(self):
         combined_id = EndpointId("host_id", "orchestrator_id",
                                  "workload_id", "endpoint_id")
@@ -25,6 +25,7 @@ import sys
 
 import calico.felix.test.stub_etcd as stub_etcd
 import calico.felix.felix as felix
+from calico.felix.futils import IPV4, IPV6
 from calico.felix.test.base import BaseTestCase, load_config
 
 # Logger
@@ -51,6 +52,7 @@ class TestBasic(BaseTestCase):
     @mock.patch("calico.felix.felix.load_nf_conntrack", autospec=True)
     @mock.patch("os.path.exists", autospec=True, return_value=True)
     @mock.patch("calico.felix.devices.list_interface_ips", autospec=True)
+    @mock.patch("calico.felix.devices.load_route_inventory", autospec=True)
     @mock.patch("calico.felix.devices.configure_global_kernel_config",
                 autospec=True)
     @mock.patch("calico.felix.devices.interface_up",
@@ -58,19 +60,23 @@ class TestBasic(BaseTestCase):
     @mock.patch("calico.felix.devices.interface_exists",
                 return_value=False, autospec=True)
     @mock.patch("calico.felix.futils.check_call", autospec=True)
-    @mock.patch("calico.felix.frules.HOSTS_IPSET_V4", autospec=True)
+    @mock.patch("calico.felix.felix.IPSET_INVENTORY", autospec=True)
+    @mock.patch("calico.felix.dataplane.HOSTS_IPSET_V4", autospec=True)
     @mock.patch("calico.felix.fetcd.EtcdAPI.load_config")
     @mock.patch("gevent.Greenlet.start", autospec=True)
     @mock.patch("calico.felix.felix.UpdateSplitter", autospec=True)
-    @mock.patch("calico.felix.felix.IptablesUpdater", autospec=True)
-    @mock.patch("calico.felix.felix.MasqueradeManager", autospec=True)
+    @mock.patch("calico.felix.dataplane.IptablesBackend.updater_cls",
+                autospec=True)
+    @mock.patch("calico.felix.dataplane.MasqueradeManager", autospec=True)
     @mock.patch("gevent.iwait", autospec=True, side_effect=TestException())
     def test_main_greenlet(self, m_iwait, m_MasqueradeManager,
                            m_IptablesUpdater, m_UpdateSplitter,
                            m_start, m_load,
-                           m_ipset_4, m_check_call, m_iface_exists,
+                           m_ipset_4, m_inventory, m_check_call,
+                           m_iface_exists,
                            m_iface_up, m_configure_global_kernel_config,
-                           m_list_interface_ips, m_path_exists, m_conntrack):
+                           m_load_routes, m_list_interface_ips,
+                           m_path_exists, m_conntrack):
         m_IptablesUpdater.return_value.greenlet = mock.Mock()
         m_MasqueradeManager.return_value.greenlet = mock.Mock()
         m_UpdateSplitter.return_value.greenlet = mock.Mock()
@@ -98,28 +104,35 @@ class TestBasic(BaseTestCase):
         m_iface_exists.assert_called_once_with("tunl0")
         m_iface_up.assert_called_once_with("tunl0")
         m_configure_global_kernel_config.assert_called_once_with()
+        m_inventory.refresh.assert_called_once_with()
+        self.assertEqual(m_load_routes.mock_calls,
+                         [mock.call(IPV4), mock.call(IPV6)])
         m_conntrack.assert_called_once_with()
 
     @mock.patch("calico.felix.felix.load_nf_conntrack", autospec=True)
     @mock.patch("calico.felix.felix.install_global_rules", autospec=True)
     @mock.patch("os.path.exists", autospec=True, return_value=False)
     @mock.patch("calico.felix.devices.list_interface_ips", autospec=True)
+    @mock.patch("calico.felix.devices.load_route_inventory", autospec=True)
     @mock.patch("calico.felix.devices.configure_global_kernel_config",
                 autospec=True)
     @mock.patch("calico.felix.futils.check_call", autospec=True)
-    @mock.patch("calico.felix.frules.HOSTS_IPSET_V4", autospec=True)
+    @mock.patch("calico.felix.felix.IPSET_INVENTORY", autospec=True)
+    @mock.patch("calico.felix.dataplane.HOSTS_IPSET_V4", autospec=True)
     @mock.patch("calico.felix.fetcd.EtcdAPI.load_config")
     @mock.patch("gevent.Greenlet.start", autospec=True)
     @mock.patch("calico.felix.felix.UpdateSplitter", autospec=True)
-    @mock.patch("calico.felix.felix.IptablesUpdater", autospec=True)
-    @mock.patch("calico.felix.felix.MasqueradeManager", autospec=True)
+    @mock.patch("calico.felix.dataplane.IptablesBackend.updater_cls",
+                autospec=True)
+    @mock.patch("calico.felix.dataplane.MasqueradeManager", autospec=True)
     @mock.patch("gevent.iwait", autospec=True, side_effect=TestException())
     def test_main_greenlet_no_ipv6(self, m_iwait, m_MasqueradeManager,
                                    m_IptablesUpdater, m_UpdateSplitter,
                                    m_start, m_load,
-                                   m_ipset_4, m_check_call,
+                                   m_ipset_4, m_inventory, m_check_call,
                                    m_configure_global_kernel_config,
-                                   m_list_interface_ips, m_path_exists,
+                                   m_load_routes, m_list_interface_ips,
+                                   m_path_exists,
                                    m_install_globals, m_conntrack):
         m_IptablesUpdater.return_value.greenlet = mock.Mock()
         m_MasqueradeManager.return_value.greenlet = mock.Mock()
@@ -147,6 +160,8 @@ class TestBasic(BaseTestCase):
         m_load.assert_called_once_with(async=False)
         m_configure_global_kernel_config.assert_called_once_with()
         m_install_globals.assert_called_once_with(mock.ANY, mock.ANY, mock.ANY,
-                                                  ip_version=4)
+                                                  ip_version=4,
+                                                  hosts_ipset=mock.ANY)
+        m_load_routes.assert_called_once_with(IPV4)
         m_conntrack.assert_called_once_with()
 
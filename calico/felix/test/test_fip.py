@@ -17,7 +17,7 @@ import collections
 import mock
 
 from calico.felix.test.base import BaseTestCase
-from calico.felix.fipmanager import FloatingIPManager
+from calico.felix.fipmanager import FloatingIPManager, _bucket, _bucket_chain
 from calico.felix.frules import CHAIN_FIP_DNAT, CHAIN_FIP_SNAT
 
 Config = collections.namedtuple('Config', ['IFACE_PREFIX', 'METADATA_IP',
@@ -40,28 +40,91 @@ class TestFloatingIPs(BaseTestCase):
     def _run_fip_manager_loop(self, ip_version, runs):
         self.config = Config('tap', '127.0.0.1', 8775)
         f = self.get_floating_ip_manager(ip_version)
+        bucket = _bucket('endpoint_id')
+        dnat_chain = _bucket_chain(CHAIN_FIP_DNAT, bucket)
+        snat_chain = _bucket_chain(CHAIN_FIP_SNAT, bucket)
 
         for maps, expected_dnat, expected_snat in runs:
             f.update_endpoint('endpoint_id', maps, async=True)
             self.step_actor(f)
 
             actual_calls = self.iptables_updater.rewrite_chains.mock_calls
-            expected_calls = [
-                mock.call({CHAIN_FIP_DNAT: expected_dnat,
-                           CHAIN_FIP_SNAT: expected_snat}, {}, async=True)
-            ]
+            if maps:
+                expected_calls = [
+                    mock.call(
+                        {CHAIN_FIP_DNAT: ['--append %s --jump %s' %
+                                          (CHAIN_FIP_DNAT, dnat_chain)],
+                         CHAIN_FIP_SNAT: ['--append %s --jump %s' %
+                                          (CHAIN_FIP_SNAT, snat_chain)],
+                         dnat_chain: [r % dnat_chain for r in expected_dnat],
+                         snat_chain: [r % snat_chain for r in expected_snat]},
+                        {CHAIN_FIP_DNAT: set([dnat_chain]),
+                         CHAIN_FIP_SNAT: set([snat_chain])},
+                        async=True
+                    )
+                ]
+                expected_deletes = []
+            else:
+                expected_calls = [
+                    mock.call({CHAIN_FIP_DNAT: [], CHAIN_FIP_SNAT: []},
+                              {CHAIN_FIP_DNAT: set(), CHAIN_FIP_SNAT: set()},
+                              async=True)
+                ]
+                expected_deletes = [
+                    mock.call([dnat_chain, snat_chain], async=True)
+                ]
 
             self.assertEqual(actual_calls, expected_calls)
+            self.assertEqual(self.iptables_updater.delete_chains.mock_calls,
+                             expected_deletes)
             self.iptables_updater.rewrite_chains.reset_mock()
+            self.iptables_updater.delete_chains.reset_mock()
+
+    def test_update_rewrites_one_bucket(self):
+        """
+        Tests that changing an endpoint's floating IPs only rewrites its own
+        bucket when the bucket was already in use.
+        """
+        f = self.get_floating_ip_manager(4)
+        endpoints = ['ep%d' % ii for ii in xrange(200)]
+        f.apply_snapshot(dict(
+            (ep, [{'int_ip': '10.0.%d.%d' % divmod(ii, 256),
+                   'ext_ip': '192.168.%d.%d' % divmod(ii, 256)}])
+            for ii, ep in enumerate(endpoints)
+        ), async=True)
+        self.step_actor(f)
+        self.iptables_updater.rewrite_chains.reset_mock()
+
+        # Find an endpoint that shares its bucket with another.
+        buckets = [_bucket(ep) for ep in endpoints]
+        ep = next(ep for ep, b in zip(endpoints, buckets)
+                  if buckets.count(b) > 1)
+        bucket = _bucket(ep)
+        f.update_endpoint(ep, [{'int_ip': '10.1.0.1',
+                                'ext_ip': '192.168.100.1'}], async=True)
+        self.step_actor(f)
+
+        updates, deps = \
+            self.iptables_updater.rewrite_chains.call_args[0]
+        self.assertEqual(set(updates.keys()),
+                         set([_bucket_chain(CHAIN_FIP_DNAT, bucket),
+                              _bucket_chain(CHAIN_FIP_SNAT, bucket)]))
+        self.assertEqual(deps, {})
+        self.assertTrue(
+            '--append %s -d 192.168.100.1 -j DNAT --to-destination 10.1.0.1' %
+            _bucket_chain(CHAIN_FIP_DNAT, bucket) in
+            updates[_bucket_chain(CHAIN_FIP_DNAT, bucket)]
+        )
+        self.assertFalse(self.iptables_updater.delete_chains.called)
 
 
     def test_fip_manager_ipv4(self):
         maps = [{'int_ip': '10.0.0.1', 'ext_ip': '192.168.0.1'}]
         expected_dnat = [
-            '--append %s -d 192.168.0.1 -j DNAT --to-destination 10.0.0.1' % CHAIN_FIP_DNAT,
+            '--append %s -d 192.168.0.1 -j DNAT --to-destination 10.0.0.1',
         ]
         expected_snat = [
-            '--append %s -s 10.0.0.1 -d 10.0.0.1 -j SNAT --to-source 192.168.0.1' % CHAIN_FIP_SNAT,
+            '--append %s -s 10.0.0.1 -d 10.0.0.1 -j SNAT --to-source 192.168.0.1',
         ]
 
         self._run_fip_manager_loop(4, [
@@ -75,12 +138,11 @@ class TestFloatingIPs(BaseTestCase):
         maps = [{'int_ip': '1000:0000:0000:0000:0000:0001', 'ext_ip': 'ffff:0000:0000:0000:0000:0001'}]
         expected_dnat = [
             '--append %s -d ffff:0000:0000:0000:0000:0001 -j DNAT --to-destination '
-                '1000:0000:0000:0000:0000:0001' % CHAIN_FIP_DNAT,
+                '1000:0000:0000:0000:0000:0001',
         ]
         expected_snat = [
             '--append %s -s 1000:0000:0000:0000:0000:0001 -d '
-            '1000:0000:0000:0000:0000:0001 -j SNAT --to-source ffff:0000:0000:0000:0000:0001' %
-            CHAIN_FIP_SNAT
+            '1000:0000:0000:0000:0000:0001 -j SNAT --to-source ffff:0000:0000:0000:0000:0001'
         ]
 
         self._run_fip_manager_loop(6, [
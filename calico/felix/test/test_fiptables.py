@@ -33,34 +33,28 @@ _log = logging.getLogger(__name__)
 
 patch.object = getattr(patch, "object")  # Keep PyCharm linter happy.
 
-EXTRACT_UNREF_TESTS = [
-("""Chain INPUT (policy DROP)
-target     prot opt source               destination
-felix-INPUT  all  --  anywhere             anywhere
-ACCEPT     tcp  --  anywhere             anywhere             tcp dpt:domain
-
-Chain FORWARD (policy DROP)
-target     prot opt source               destination
-felix-FORWARD  all  --  anywhere             anywhere
-ufw-track-forward  all  --  anywhere             anywhere
-
-Chain DOCKER (1 references)
-target     prot opt source               destination
-
-Chain felix-FORWARD (1 references)
-target     prot opt source               destination
-felix-FROM-ENDPOINT  all  --  anywhere             anywhere
-felix-TO-ENDPOINT  all  --  anywhere             anywhere
-Chain-with-bad-name   all  --  anywhere             anywhere
-ACCEPT     all  --  anywhere             anywhere
-
-Chain felix-temp (0 references)
-target     prot opt source               destination
-felix-FROM-ENDPOINT  all  --  anywhere             anywhere
-ACCEPT     all  --  anywhere             anywhere
-""",
-set(["felix-temp"])),
-]
+EXTRACT_GRAPH_INPUT = """# Generated by iptables-save v1.4.21
+*nat
+:PREROUTING ACCEPT [0:0]
+:felix-PREROUTING - [0:0]
+-A PREROUTING -j felix-PREROUTING
+COMMIT
+*filter
+:INPUT DROP [10:505]
+:FORWARD DROP [0:0]
+:DOCKER - [0:0]
+:felix-FORWARD - [0:0]
+:felix-temp - [0:0]
+:felix-loop - [0:0]
+-A INPUT -i lxcbr0 -p tcp -m tcp --dport 53 -j ACCEPT
+-A FORWARD -j felix-FORWARD
+-A felix-FORWARD -i tap+ -g felix-FROM-ENDPOINT
+-A felix-FORWARD -m comment --comment "felix-hash:0123" -j DOCKER
+-A felix-temp -j felix-loop
+-A felix-loop -j felix-temp
+-A felix-loop -j DROP
+COMMIT
+"""
 
 # Define this as a function so that we can override it in plugin tests
 def drop_rules(chain_name):
@@ -73,6 +67,15 @@ def drop_rules(chain_name):
 STANDARD_ACTIONS = ("MARK", "ACCEPT", "DROP", "RETURN")
 
 
+def programmed(chain_name, rules):
+    """
+    :returns the contents of the given chain once IptablesUpdater has
+             programmed it with the given rules.
+    """
+    updates = ["--flush %s" % chain_name] + rules
+    return fiptables._add_chain_hash(updates)[1:]
+
+
 class TestIptablesUpdater(BaseTestCase):
 
     def setUp(self):
@@ -91,9 +94,6 @@ class TestIptablesUpdater(BaseTestCase):
         _log.info("Stubbing out call to %s", cmd)
         if cmd == ["iptables-save", "--table", "filter"]:
             return self.stub.generate_iptables_save()
-        elif cmd == ['iptables', '--wait', '--list', '--numeric',
-                     '--table', 'filter']:
-            return self.stub.generate_iptables_list()
         else:
             raise AssertionError("Unexpected call %r" % cmd)
 
@@ -112,7 +112,7 @@ class TestIptablesUpdater(BaseTestCase):
         )
         self.step_actor(self.ipt)
         self.assertEqual(self.stub.chains_contents,
-            {"foo": ["--append foo --jump bar"],
+            {"foo": programmed("foo", ["--append foo --jump bar"]),
              'bar': drop_rules("bar")})
 
     def test_rewrite_chains_cover(self):
@@ -129,6 +129,366 @@ class TestIptablesUpdater(BaseTestCase):
         self.step_actor(self.ipt)
         cb.assert_called_once_with(None)
 
+    def test_rewrite_chains_failure_callback(self):
+        """
+        Tests that a failure is reported to the callback, if there is one,
+        rather than via the result.
+        """
+        with patch.object(self.ipt, "_execute_iptables") as m_exec:
+            m_exec.side_effect = FailedSystemCall("Message", [], 1, "", "")
+            cb = Mock()
+            f = self.ipt.rewrite_chains(
+                {"foo": ["--append foo --jump ACCEPT"]}, {},
+                async=True,
+                callback=cb,
+            )
+            self.step_actor(self.ipt)
+            self.assertEqual(cb.mock_calls, [call(m_exec.side_effect)])
+            self.assertEqual(f.get(), None)
+
+            f = self.ipt.rewrite_chains(
+                {"foo": ["--append foo --jump ACCEPT"]}, {},
+                async=True,
+            )
+            self.step_actor(self.ipt)
+            self.assertRaises(FailedSystemCall, f.get)
+
+    def fail_on_bad_rule(self, lines, **kwargs):
+        """
+        Stub for _execute_iptables() that fails on any rule that jumps to
+        "BAD" or, if self.unattributed_failure is set, fails without
+        reporting a line.  If self.commit_failure is set, the failure is
+        reported at the COMMIT line, as for a rule that the kernel rejects.
+        """
+        self.num_restores += 1
+        for ii, line in enumerate(lines):
+            if "--jump BAD" in line:
+                if self.unattributed_failure:
+                    err = "iptables-restore: unknown error"
+                elif self.commit_failure:
+                    err = "iptables-restore: line %s failed" % len(lines)
+                else:
+                    err = "iptables-restore: line %s failed" % (ii + 1)
+                raise FailedSystemCall("Message", [], 1, "", err)
+        self.stub.apply_iptables_restore(lines, **kwargs)
+
+    def rewrite_with_bad_chain(self):
+        self.num_restores = 0
+        self.ipt._execute_iptables = self.fail_on_bad_rule
+        callbacks = [Mock(), Mock(), Mock(), Mock()]
+        for ii, cb in enumerate(callbacks):
+            target = "BAD" if ii == 1 else "ACCEPT"
+            chain = "chain%s" % ii
+            self.ipt.rewrite_chains(
+                {chain: ["--append %s --jump %s" % (chain, target)]}, {},
+                async=True,
+                callback=cb,
+            )
+        self.step_actor(self.ipt)
+        self.assertEqual(callbacks[0].mock_calls, [call(None)])
+        self.assertEqual(len(callbacks[1].mock_calls), 1)
+        self.assertTrue(isinstance(callbacks[1].call_args[0][0],
+                                   FailedSystemCall))
+        self.assertEqual(callbacks[2].mock_calls, [call(None)])
+        self.assertEqual(callbacks[3].mock_calls, [call(None)])
+        self.assertEqual(sorted(self.stub.chains_contents.keys()),
+                         ["chain0", "chain2", "chain3"])
+        self.assertEqual(
+            self.ipt._stats.stats["Restores to resolve failed batches"],
+            self.num_restores
+        )
+
+    def test_failure_attributed_to_message(self):
+        """
+        Tests that a failure in a combined batch is attributed to the
+        message that rewrote the failing chain and that the rest of the
+        batch is retried in one go.
+        """
+        self.unattributed_failure = False
+        self.commit_failure = False
+        self.rewrite_with_bad_chain()
+        # One failure and then one retry.
+        self.assertEqual(self.num_restores, 2)
+        self.assertEqual(
+            self.ipt._stats.stats["Failures attributed to a message"], 1
+        )
+
+    def test_unattributed_failure_splits_batch(self):
+        self.unattributed_failure = True
+        self.commit_failure = False
+        self.rewrite_with_bad_chain()
+        # [0, 1, 2, 3] fails, [0, 1] fails, [0] OK, [1, 2, 3] fails,
+        # [1] fails, [2, 3] OK.
+        self.assertEqual(self.num_restores, 6)
+        self.assertEqual(self.ipt._stats.stats["Split batch due to error"],
+                         3)
+
+    def test_partial_batch_failure_updates_indexes(self):
+        """
+        Tests that, if a batch fails after some of its transactions have
+        committed, the committed chains are recorded in our indexes.
+        """
+        self.ipt.rewrite_chains({"b": ["--append b --jump DROP"]}, {},
+                                async=True)
+        self.step_actor(self.ipt)
+        self.unattributed_failure = False
+        self.commit_failure = False
+        self.num_restores = 0
+        self.ipt._execute_iptables = self.fail_on_bad_rule
+        # One chain per transaction; "b" is written first, then "a" fails.
+        self.ipt.max_txn_lines = 5
+        callback = Mock()
+        self.ipt.rewrite_chains({"a": ["--append a --jump BAD"],
+                                 "b": ["--append b --jump ACCEPT"]},
+                                {"a": set(["b"])}, async=True,
+                                callback=callback)
+        self.step_actor(self.ipt)
+        self.assertTrue(isinstance(callback.call_args[0][0],
+                                   FailedSystemCall))
+        self.assertEqual(self.stub.chains_contents["b"],
+                         programmed("b", ["--append b --jump ACCEPT"]))
+        self.assertEqual(self.ipt._programmed_chain_contents["b"],
+                         ["--flush b", "--append b --jump ACCEPT"])
+        self.assertFalse("a" in self.ipt._programmed_chain_contents)
+        self.assertFalse("b" in self.ipt._requiring_chains)
+        # So rewriting "b" back to its old contents isn't skipped.
+        self.ipt.rewrite_chains({"b": ["--append b --jump DROP"]}, {},
+                                async=True)
+        self.step_actor(self.ipt)
+        self.assertEqual(self.stub.chains_contents["b"],
+                         programmed("b", ["--append b --jump DROP"]))
+
+    def test_commit_failure_attributed_by_transaction(self):
+        """
+        Tests that a COMMIT failure is attributed to a message if all the
+        chains in the failed transaction were written by that message.
+        """
+        self.unattributed_failure = False
+        self.commit_failure = True
+        # One chain per transaction.
+        self.ipt.max_txn_lines = 5
+        self.rewrite_with_bad_chain()
+        self.assertEqual(
+            self.ipt._stats.stats["Failures attributed to a message"], 1
+        )
+        self.assertFalse("Split batch due to error" in self.ipt._stats.stats)
+
+    def test_commit_failure_in_combined_transaction_splits_batch(self):
+        self.unattributed_failure = False
+        self.commit_failure = True
+        self.rewrite_with_bad_chain()
+        # Same as an unattributed failure.
+        self.assertEqual(self.num_restores, 6)
+
+    @patch("gevent.sleep", autospec=True)
+    @patch("calico.felix.futils.check_call", autospec=True)
+    def test_transient_commit_failures(self, m_check_call, m_sleep):
+        ipt = IptablesUpdater("filter", self.config, 4)
+        m_check_call.side_effect = [
+            FailedSystemCall("", [], 1, "", "line 2 failed")
+        ] * 3 + [None]
+        ipt._execute_iptables(["*filter", "COMMIT"])
+        self.assertEqual(m_check_call.call_count, 4)
+        self.assertEqual(m_sleep.call_count, 3)
+
+    @patch("gevent.sleep", autospec=True)
+    @patch("calico.felix.futils.check_call", autospec=True)
+    def test_persistent_commit_failure(self, m_check_call, m_sleep):
+        ipt = IptablesUpdater("filter", self.config, 4)
+        m_check_call.side_effect = FailedSystemCall("", [], 1, "",
+                                                    "line 2 failed")
+        self.assertRaises(FailedSystemCall, ipt._execute_iptables,
+                          ["*filter", "COMMIT"])
+        # Retried with backoff until out of retries.
+        self.assertEqual(m_check_call.call_count, fiptables.MAX_IPT_RETRIES)
+        self.assertEqual(m_sleep.call_count, fiptables.MAX_IPT_RETRIES - 1)
+        self.assertEqual(
+            ipt._stats.stats["iptables commit failure (out of retries)"], 1
+        )
+
+    def test_parse_ipt_restore_failed_chain(self):
+        lines = ["*filter", ":foo -", "--flush foo", "--append foo -j BAD",
+                 "COMMIT"]
+        for err, chain in [("line 2 failed", "foo"),
+                           ("line 3 failed", "foo"),
+                           ("line 4 failed", "foo"),
+                           ("line 1 failed", None),
+                           ("line 5 failed", None),
+                           ("line 10 failed", None),
+                           ("Unknown error", None)]:
+            self.assertEqual(
+                fiptables._parse_ipt_restore_failed_chain(lines, err),
+                chain
+            )
+
+    def test_large_batch_split_in_dependency_order(self):
+        """
+        Tests that a batch that is too big for one transaction is split,
+        with jump targets written before the chains that jump to them.
+        """
+        self.ipt.max_txn_lines = 6
+        restores = []
+
+        def record_restore(lines, **kwargs):
+            restores.append(lines)
+            self.stub.apply_iptables_restore(lines, **kwargs)
+        self.ipt._execute_iptables = record_restore
+
+        self.ipt.rewrite_chains(
+            {"a": ["--append a --jump b"],
+             "b": ["--append b --jump c", "--append b --jump DROP"]},
+            {"a": set(["b"]), "b": set(["c"])},
+            async=True,
+        )
+        self.step_actor(self.ipt)
+        self.assertEqual([[l for l in r if l.startswith(":")]
+                          for r in restores],
+                         [[":c -"], [":b -"], [":a -"]])
+        self.assertEqual(self.stub.chains_contents,
+            {"a": programmed("a", ["--append a --jump b"]),
+             "b": programmed("b", ["--append b --jump c",
+                                   "--append b --jump DROP"]),
+             "c": drop_rules("c")})
+        self.assertEqual(
+            self.ipt._stats.stats["Batches split into several transactions"],
+            1
+        )
+
+    def test_no_transaction_limit(self):
+        self.ipt.max_txn_lines = 0
+        with patch.object(self.ipt, "_execute_iptables") as m_exec:
+            self.ipt.rewrite_chains(
+                {"a": ["--append a --jump b"] * 10,
+                 "b": ["--append b --jump DROP"] * 10},
+                {"a": set(["b"])},
+                async=True,
+            )
+            self.step_actor(self.ipt)
+        self.assertEqual(m_exec.call_count, 1)
+
+    @patch("calico.felix.fiptables.monotonic_time", autospec=True)
+    @patch("gevent.sleep", autospec=True)
+    @patch("calico.felix.futils.check_call", autospec=True)
+    def test_lock_times_recorded(self, m_check_call, m_sleep, m_time):
+        ipt = IptablesUpdater("filter", self.config, 4)
+        m_time.side_effect = [10.0, 10.5, 11.0, 11.25]
+        m_check_call.side_effect = [
+            FailedSystemCall("", [], 1, "", "line 2 failed"),
+            None,
+        ]
+        ipt._execute_iptables(["*filter", "COMMIT"])
+        # First attempt failed at COMMIT so counts as waiting for the lock.
+        self.assertEqual(ipt._stats.stats["Transactions"], 1)
+        self.assertEqual(ipt._stats.stats["Total lock wait time (ms)"], 1000)
+        self.assertEqual(ipt._stats.stats["Total lock hold time (ms)"], 250)
+        self.assertEqual(ipt._stats.stats["Max lock hold time (ms)"], 250)
+
+    def test_rewrite_unchanged_chain_skipped(self):
+        """
+        Tests that rewriting a chain with its current contents doesn't
+        reprogram it, unless a refresh is pending.
+        """
+        for _ in xrange(2):
+            self.ipt.rewrite_chains(
+                {"foo": ["--append foo --jump bar"]},
+                {"foo": set(["bar"])},
+                async=True,
+            )
+            self.step_actor(self.ipt)
+        with patch.object(self.ipt, "_execute_iptables") as m_exec:
+            cb = Mock()
+            self.ipt.rewrite_chains(
+                {"foo": ["--append foo --jump bar"]},
+                {"foo": set(["bar"])},
+                async=True,
+                callback=cb,
+            )
+            self.step_actor(self.ipt)
+            self.assertFalse(m_exec.called)
+            cb.assert_called_once_with(None)
+            self.assertEqual(
+                self.ipt._stats.stats["Unchanged chain rewrites skipped"], 2
+            )
+
+            # With a refresh pending, the chain should be rewritten.
+            self.ipt.refresh_iptables(async=True)
+            self.ipt.rewrite_chains(
+                {"foo": ["--append foo --jump bar"]},
+                {"foo": set(["bar"])},
+                async=True,
+            )
+            self.step_actor(self.ipt)
+            self.assertEqual(m_exec.call_count, 1)
+
+    def test_restart_adopts_unchanged_chains(self):
+        """
+        Tests that, after a restart, chains that are already programmed
+        with the right contents are not rewritten.
+        """
+        chains = {"felix-foo": ["--append felix-foo --jump felix-bar"],
+                  "felix-bar": ["--append felix-bar --jump ACCEPT"]}
+        deps = {"felix-foo": set(["felix-bar"]), "felix-bar": set()}
+        self.ipt.rewrite_chains(chains, deps, async=True)
+        self.step_actor(self.ipt)
+
+        # Simulate a restart with the same dataplane.
+        self.ipt = IptablesUpdater("filter", self.config, 4)
+        self.ipt._execute_iptables = Mock(
+            side_effect=self.stub.apply_iptables_restore
+        )
+        self.step_actor(self.ipt)
+        with patch("calico.felix.fiptables.RECONCILIATION_STATS") as m_stats:
+            self.ipt.rewrite_chains(
+                {"felix-foo": chains["felix-foo"],
+                 "felix-bar": ["--append felix-bar --jump DROP"]},
+                deps, async=True
+            )
+            self.step_actor(self.ipt)
+        m_stats.increment.assert_called_once_with(
+            "iptables chain rewrites avoided"
+        )
+        # Only the changed chain was programmed.
+        self.assertEqual(self.ipt._execute_iptables.call_count, 1)
+        self.assertEqual(
+            self.ipt._execute_iptables.call_args[0][0][:4],
+            ["*filter", ":felix-bar -", "--flush felix-bar"] +
+            programmed("felix-bar", ["--append felix-bar --jump DROP"])
+        )
+        self.stub.assert_chain_contents({
+            "felix-foo": programmed("felix-foo", chains["felix-foo"]),
+            "felix-bar": programmed("felix-bar",
+                                    ["--append felix-bar --jump DROP"]),
+        })
+        # The adopted chain is now tracked as normal.
+        self.assertEqual(self.ipt._programmed_chain_contents["felix-foo"],
+                         ["--flush felix-foo"] + chains["felix-foo"])
+        self.assertEqual(self.ipt._required_chains["felix-foo"],
+                         set(["felix-bar"]))
+
+    def test_no_adoption_after_grace_period(self):
+        self.ipt.rewrite_chains(
+            {"felix-foo": ["--append felix-foo --jump ACCEPT"]}, {},
+            async=True
+        )
+        self.step_actor(self.ipt)
+        # Keep the chain alive through the cleanup.
+        self.stub.apply_iptables_restore(["*filter",
+                                          "--append INPUT --jump felix-foo"])
+        self.ipt = IptablesUpdater("filter", self.config, 4)
+        self.ipt._execute_iptables = Mock(
+            side_effect=self.stub.apply_iptables_restore
+        )
+        self.ipt.cleanup(async=True)
+        self.step_actor(self.ipt)
+        self.assertFalse(self.ipt._execute_iptables.called)
+        self.ipt.rewrite_chains(
+            {"felix-foo": ["--append felix-foo --jump ACCEPT"]}, {},
+            async=True
+        )
+        self.step_actor(self.ipt)
+        # Chain reprogrammed, even though the cleanup didn't remove it.
+        self.assertEqual(self.ipt._execute_iptables.call_count, 1)
+
     def test_delete_required_chain_stub(self):
         """
         Tests that deleting a required chain stubs it out instead.
@@ -147,14 +507,14 @@ class TestIptablesUpdater(BaseTestCase):
         self.step_actor(self.ipt)
         # Both chains should be programmed as normal.
         self.assertEqual(self.stub.chains_contents,
-            {"foo": ["--append foo --jump bar"],
-             'bar': ["--append bar --jump ACCEPT"] })
+            {"foo": programmed("foo", ["--append foo --jump bar"]),
+             'bar': programmed("bar", ["--append bar --jump ACCEPT"])})
 
         # Deleting bar should stub it out instead.
         self.ipt.delete_chains(["bar"], async=True)
         self.step_actor(self.ipt)
         self.assertEqual(self.stub.chains_contents,
-            {"foo": ["--append foo --jump bar"],
+            {"foo": programmed("foo", ["--append foo --jump bar"]),
              'bar': drop_rules("bar") })
 
     def test_cleanup_with_dependencies(self):
@@ -210,10 +570,12 @@ class TestIptablesUpdater(BaseTestCase):
             "OUTPUT": [],
             "ignore-me": ["--append ignore-me --jump ignore-me-too"],
             "ignore-me-too": ["--append ignore-me-too --jump DROP"],
-            "felix-foo": ["--append felix-foo --jump felix-bar",
-                          "--append felix-foo --jump felix-baz",
-                          "--append felix-foo --jump felix-boff"],
-            "felix-bar": ["--append felix-bar --jump ACCEPT"],
+            "felix-foo": programmed("felix-foo",
+                                    ["--append felix-foo --jump felix-bar",
+                                     "--append felix-foo --jump felix-baz",
+                                     "--append felix-foo --jump felix-boff"]),
+            "felix-bar": programmed("felix-bar",
+                                    ["--append felix-bar --jump ACCEPT"]),
             "felix-baz": ["--append felix-baz --src 10.0.0.2/32 "
                           "--jump felix-biff"],
             "felix-boff": drop_rules("felix-boff"),
@@ -234,10 +596,12 @@ class TestIptablesUpdater(BaseTestCase):
             "ignore-me": ["--append ignore-me --jump ignore-me-too"],
             "ignore-me-too": ["--append ignore-me-too --jump DROP"],
             # Explicitly-programmed chains programmed.
-            "felix-foo": ["--append felix-foo --jump felix-bar",
-                          "--append felix-foo --jump felix-baz",
-                          "--append felix-foo --jump felix-boff"],
-            "felix-bar": ["--append felix-bar --jump ACCEPT"],
+            "felix-foo": programmed("felix-foo",
+                                    ["--append felix-foo --jump felix-bar",
+                                     "--append felix-foo --jump felix-baz",
+                                     "--append felix-foo --jump felix-boff"]),
+            "felix-bar": programmed("felix-bar",
+                                    ["--append felix-bar --jump ACCEPT"]),
             # All required but unknown chains stubbed.
             "felix-baz": drop_rules("felix-baz"),
             "felix-boff": drop_rules("felix-boff"),
@@ -245,6 +609,47 @@ class TestIptablesUpdater(BaseTestCase):
             # before.
         })
 
+    def test_cleanup_unreachable_loop(self):
+        """
+        Tests that cleanup deletes chains that only reference each other
+        in one transaction, reading iptables-save once before and once
+        after.
+        """
+        self.stub.apply_iptables_restore("""
+        *filter
+        :INPUT DROP [10:505]
+        :felix-INPUT -
+        :felix-a -
+        :felix-b -
+        :felix-c -
+        --append INPUT --jump felix-INPUT
+        --append felix-a --jump felix-b
+        --append felix-b --jump felix-a
+        --append felix-b --jump felix-c
+        """.splitlines())
+        self.ipt._execute_iptables = Mock(
+            side_effect=self.stub.apply_iptables_restore
+        )
+        self.step_actor(self.ipt)
+        self.m_check_output.reset_mock()
+        self.ipt.cleanup(async=True)
+        self.step_actor(self.ipt)
+        self.stub.assert_chain_contents({
+            "INPUT": ["--append INPUT --jump felix-INPUT"],
+            "felix-INPUT": [],
+        })
+        self.assertEqual(self.ipt._execute_iptables.call_count, 1)
+        self.assertEqual(
+            [l for l in self.ipt._execute_iptables.call_args[0][0]
+             if l.startswith("--delete-chain")],
+            ["--delete-chain felix-a", "--delete-chain felix-b",
+             "--delete-chain felix-c"]
+        )
+        self.assertEqual(
+            self.m_check_output.mock_calls,
+            [call(["iptables-save", "--table", "filter"])] * 2
+        )
+
     def test_delete_during_grace_period(self):
         """
         Test explicit deletion of a referenced chain during the grace period.
@@ -281,9 +686,12 @@ class TestIptablesUpdater(BaseTestCase):
 
         # Dataplane should now have all the new chains in place.
         self.stub.assert_chain_contents({
-            "felix-foo": ["--append felix-foo --jump felix-bar"],
-            "felix-bar": ["--append felix-bar --jump ACCEPT"],
-            "felix-baz": ["--append felix-baz --jump ACCEPT"],
+            "felix-foo": programmed("felix-foo",
+                                    ["--append felix-foo --jump felix-bar"]),
+            "felix-bar": programmed("felix-bar",
+                                    ["--append felix-bar --jump ACCEPT"]),
+            "felix-baz": programmed("felix-baz",
+                                    ["--append felix-baz --jump ACCEPT"]),
         })
 
         # Then delete bar and baz.  The former should be stubbed because it
@@ -291,7 +699,8 @@ class TestIptablesUpdater(BaseTestCase):
         self.ipt.delete_chains(["felix-bar", "felix-baz"], async=True)
         self.step_actor(self.ipt)
         self.stub.assert_chain_contents({
-            "felix-foo": ["--append felix-foo --jump felix-bar"],
+            "felix-foo": programmed("felix-foo",
+                                    ["--append felix-foo --jump felix-bar"]),
             "felix-bar": drop_rules("felix-bar"),
         })
 
@@ -304,7 +713,8 @@ class TestIptablesUpdater(BaseTestCase):
         )
         self.step_actor(self.ipt)
         self.stub.assert_chain_contents({
-            "felix-foo": ["--append felix-foo --jump felix-boff"],
+            "felix-foo": programmed("felix-foo",
+                                    ["--append felix-foo --jump felix-boff"]),
             "felix-boff": drop_rules("felix-boff"),
         })
 
@@ -336,7 +746,9 @@ class TestIptablesUpdater(BaseTestCase):
                 set(["felix-foo", "felix-boff"])
             )
             self.stub.assert_chain_contents({
-                "felix-foo": ["--append felix-foo --jump felix-boff"],
+                "felix-foo": programmed(
+                    "felix-foo", ["--append felix-foo --jump felix-boff"]
+                ),
                 "felix-boff": drop_rules("felix-boff"),
             })
 
@@ -508,11 +920,89 @@ class TestIptablesStub(BaseTestCase):
 
 class TestUtilityFunctions(BaseTestCase):
 
-    def test_extract_unreffed_chains(self):
-        for inp, exp in EXTRACT_UNREF_TESTS:
-            output = fiptables._extract_our_unreffed_chains(inp)
-            self.assertEqual(exp, output, "Expected\n\n%s\n\nTo parse as: %s\n"
-                                          "but got: %s" % (inp, exp, output))
+    def test_extract_chain_graph(self):
+        chains, refs = fiptables._extract_chain_graph("filter",
+                                                      EXTRACT_GRAPH_INPUT)
+        self.assertEqual(chains, set(["INPUT", "FORWARD", "DOCKER",
+                                      "felix-FORWARD", "felix-temp",
+                                      "felix-loop"]))
+        self.assertEqual(refs, {
+            "INPUT": set(),
+            "FORWARD": set(["felix-FORWARD"]),
+            # felix-FROM-ENDPOINT doesn't exist so it isn't a reference.
+            "felix-FORWARD": set(["DOCKER"]),
+            "felix-temp": set(["felix-loop"]),
+            "felix-loop": set(["felix-temp"]),
+        })
+
+    def test_unreachable_chains(self):
+        chains, refs = fiptables._extract_chain_graph("filter",
+                                                      EXTRACT_GRAPH_INPUT)
+        roots = set(["INPUT", "FORWARD", "DOCKER"])
+        # The loop keeps both its chains referenced but neither is reachable.
+        self.assertEqual(fiptables._unreachable_chains(chains, refs, roots),
+                         set(["felix-temp", "felix-loop"]))
+        self.assertEqual(
+            fiptables._unreachable_chains(chains, refs,
+                                          roots | set(["felix-loop"])),
+            set()
+        )
+
+
+    def test_dependency_order(self):
+        self.assertEqual(
+            fiptables._dependency_order(
+                ["a", "b", "c", "d"],
+                {"a": set(["c", "x"]), "c": set(["d", "b"]),
+                 "d": set(["b"])}
+            ),
+            ["b", "d", "c", "a"]
+        )
+
+    def test_dependency_order_loop(self):
+        self.assertEqual(
+            fiptables._dependency_order(
+                ["a", "b"], {"a": set(["b"]), "b": set(["a"])}
+            ),
+            ["b", "a"]
+        )
+
+    def test_extract_chain_hashes(self):
+        output = (
+            "*nat\n"
+            ":felix-nat - [0:0]\n"
+            "-A felix-nat -j DROP -m comment --comment felix-hash:0123\n"
+            "COMMIT\n"
+            "*filter\n"
+            ":felix-foo - [0:0]\n"
+            ":felix-bar - [0:0]\n"
+            ":felix-baz - [0:0]\n"
+            ":other - [0:0]\n"
+            "-A felix-foo -j ACCEPT\n"
+            "-A felix-foo -m comment --comment \"Default DROP\" "
+            "-m comment --comment felix-hash:abcd -j DROP\n"
+            "-A felix-bar -m mark --mark 0x1/0x1 "
+            "-m comment --comment \"felix-hash:abcd\" -j RETURN\n"
+            "-A felix-baz -m comment --comment felix-hash:abcd -j ACCEPT\n"
+            "-A felix-baz -j DROP\n"
+            "-A other -m comment --comment felix-hash:abcd -j DROP\n"
+            "COMMIT\n"
+        )
+        self.assertEqual(fiptables._extract_chain_hashes("filter", output),
+                         {"felix-foo": ("abcd", 2),
+                          "felix-bar": ("abcd", 1)})
+
+    def test_add_chain_hash(self):
+        updates = ["--flush felix-foo", "--append felix-foo --jump DROP"]
+        self.assertEqual(
+            fiptables._add_chain_hash(updates),
+            ["--flush felix-foo",
+             '--append felix-foo --jump DROP --match comment '
+             '--comment "felix-hash:%s"' % fiptables._chain_hash(updates)]
+        )
+        # No extra rule is added, even for empty chains.
+        self.assertEqual(fiptables._add_chain_hash(["--flush felix-foo"]),
+                         ["--flush felix-foo"])
 
 
 class IptablesStub(object):
@@ -561,8 +1051,13 @@ class IptablesStub(object):
                 "target     prot opt source               destination"]
             for rule in entries:
                 m = re.search(r'(?:--jump|-j|--goto|-g)\s+(\S+)', rule)
-                assert m, "Failed to generate listing for %r" % rule
-                action = m.group(1)
+                if m:
+                    action = m.group(1)
+                else:
+                    # Rule with no target, such as a comment.
+                    assert "--comment" in rule, \
+                        "Failed to generate listing for %r" % rule
+                    action = ""
                 chain_lines.append(action + " dummy -- anywhere anywhere")
             chunks.append("\n".join(chain_lines))
         return "\n\n".join(chunks) + "\n"
@@ -654,7 +1149,7 @@ class IptablesStub(object):
                                  (ipt_op, chain))
 
     def _handle_commit(self):
-        for chain, deps in self.chain_dependencies.iteritems():
+        for chain, deps in self.new_dependencies.iteritems():
             for dep in deps:
                 if dep not in self.new_contents:
                     raise AssertionError("Chain %s depends on %s but that "
@@ -774,6 +1269,22 @@ class TestTransaction(BaseTestCase):
                          {"felix-b": set(["felix-a"]),
                           "felix-stub": set(["felix-a"])})
 
+    def test_rewrite_is_noop(self):
+        self.assertTrue(self.txn.rewrite_is_noop("felix-c", [], set()))
+        self.assertTrue(self.txn.rewrite_is_noop(
+            "felix-a", [], set(["felix-b", "felix-stub"])))
+        # Different contents.
+        self.assertFalse(self.txn.rewrite_is_noop("felix-c", ["foo"], set()))
+        # Different dependencies.
+        self.assertFalse(self.txn.rewrite_is_noop("felix-a", [], set()))
+        # Not programmed.
+        self.assertFalse(self.txn.rewrite_is_noop("felix-stub", [], set()))
+        self.txn.store_delete("felix-c")
+        self.assertFalse(self.txn.rewrite_is_noop("felix-c", [], set()))
+        # Refresh pending.
+        self.txn.store_refresh()
+        self.assertFalse(self.txn.rewrite_is_noop("felix-b", [], set()))
+
     def test_cache_invalidation(self):
         self.assert_cache_dropped()
         self.assert_properties_cached()
@@ -27,6 +27,8 @@ from mock import Mock
 
 from calico.datamodel_v1 import TieredPolicyId
 from calico.felix.fiptables import IptablesUpdater
+from calico.felix.ipsets import NetSetId
+from calico.felix.policylists import policy_list_id
 from calico.felix.profilerules import UnsupportedICMPType
 from calico.felix.test.base import BaseTestCase, load_config
 
@@ -235,6 +237,8 @@ RULES_TESTS = [
     },
 ]
 
+POLICY_LIST_CHAIN_PREFIX = "felix-pl-5e2bf00b4180466c"
+
 FROM_ENDPOINT_CHAIN = [
     # Always start with a 0 MARK.
     '--append felix-from-abcd --jump MARK --set-mark 0/0x1000000',
@@ -242,109 +246,123 @@ FROM_ENDPOINT_CHAIN = [
     '--append felix-from-abcd --match mac ! --mac-source aa:22:33:44:55:66 '
                '--jump DROP -m comment --comment '
                '"Incorrect source MAC"',
+    # Then jumps to the shared chain for its policies and profiles.
+    '--append felix-from-abcd --jump felix-pl-5e2bf00b4180466c-o',
+    # Return if the policy list accepted the packet.
+    '--append felix-from-abcd --match mark --mark 0x1000000/0x1000000 '
+               '--match comment --comment "Policy accepted packet" '
+               '--jump RETURN',
+    # Drop the packet if nothing matched.
+    '--append felix-from-abcd --jump DROP -m comment --comment '
+               '"Packet did not match any profile (endpoint e1)"'
+]
+
+TO_ENDPOINT_CHAIN = [
+    # Always start with a 0 MARK.
+    '--append felix-to-abcd --jump MARK --set-mark 0/0x1000000',
+    '--append felix-to-abcd --jump felix-pl-5e2bf00b4180466c-i',
+    '--append felix-to-abcd --match mark --mark 0x1000000/0x1000000 '
+             '--match comment --comment "Policy accepted packet" '
+             '--jump RETURN',
+    # Drop anything that doesn't match.
+    '--append felix-to-abcd --jump DROP -m comment --comment '
+             '"Packet did not match any profile (endpoint e1)"'
+]
 
-    # Now the tiered policies.  For each tier we reset the "next tier" mark.
-    '--append felix-from-abcd --jump MARK --set-mark 0/0x2000000 '
+POLICY_LIST_OUTBOUND_CHAIN = [
+    # The tiered policies.  For each tier we reset the "next tier" mark.
+    '--append felix-pl-5e2bf00b4180466c-o --jump MARK --set-mark 0/0x2000000 '
               '--match comment --comment "Start of tier tier_1"',
     # Then, for each policies, we jump to the policies, and check if it set the
     # accept mark, which immediately accepts.
-    '--append felix-from-abcd '
+    '--append felix-pl-5e2bf00b4180466c-o '
               '--match mark --mark 0/0x2000000 --jump felix-p-t1p1-o',
-    '--append felix-from-abcd '
+    '--append felix-pl-5e2bf00b4180466c-o '
               '--match mark --mark 0x1000000/0x1000000 '
               '--match comment --comment "Return if policy accepted" '
               '--jump RETURN',
 
-    '--append felix-from-abcd '
+    '--append felix-pl-5e2bf00b4180466c-o '
               '--match mark --mark 0/0x2000000 --jump felix-p-t1p2-o',
-    '--append felix-from-abcd '
+    '--append felix-pl-5e2bf00b4180466c-o '
               '--match mark --mark 0x1000000/0x1000000 '
               '--match comment --comment "Return if policy accepted" '
               '--jump RETURN',
     # Then, at the end of the tier, drop if nothing in the tier did a
     # "next-tier"
-    '--append felix-from-abcd '
+    '--append felix-pl-5e2bf00b4180466c-o '
               '--match mark --mark 0/0x2000000 '
               '--match comment --comment "Drop if no policy in tier passed" '
               '--jump DROP',
 
     # Now the second tier...
-    '--append felix-from-abcd '
+    '--append felix-pl-5e2bf00b4180466c-o '
               '--jump MARK --set-mark 0/0x2000000 --match comment '
               '--comment "Start of tier tier_2"',
-    '--append felix-from-abcd '
+    '--append felix-pl-5e2bf00b4180466c-o '
               '--match mark --mark 0/0x2000000 --jump felix-p-t2p1-o',
-    '--append felix-from-abcd '
+    '--append felix-pl-5e2bf00b4180466c-o '
               '--match mark --mark 0x1000000/0x1000000 --match comment '
               '--comment "Return if policy accepted" --jump RETURN',
-    '--append felix-from-abcd '
+    '--append felix-pl-5e2bf00b4180466c-o '
               '--match mark --mark 0/0x2000000 --match comment '
               '--comment "Drop if no policy in tier passed" --jump DROP',
 
     # Jump to the first profile.
-    '--append felix-from-abcd --jump felix-p-prof-1-o',
+    '--append felix-pl-5e2bf00b4180466c-o --jump felix-p-prof-1-o',
     # Short-circuit: return if the first profile matched.
-    '--append felix-from-abcd --match mark --mark 0x1000000/0x1000000 '
+    '--append felix-pl-5e2bf00b4180466c-o --match mark --mark 0x1000000/0x1000000 '
                '--match comment --comment "Profile accepted packet" '
                '--jump RETURN',
 
     # Jump to second profile.
-    '--append felix-from-abcd --jump felix-p-prof-2-o',
+    '--append felix-pl-5e2bf00b4180466c-o --jump felix-p-prof-2-o',
     # Return if the second profile matched.
-    '--append felix-from-abcd --match mark --mark 0x1000000/0x1000000 '
+    '--append felix-pl-5e2bf00b4180466c-o --match mark --mark 0x1000000/0x1000000 '
                '--match comment --comment "Profile accepted packet" '
                '--jump RETURN',
 
-    # Drop the packet if nothing matched.
-    '--append felix-from-abcd --jump DROP -m comment --comment '
-               '"Packet did not match any profile (endpoint e1)"'
 ]
 
-TO_ENDPOINT_CHAIN = [
-    # Always start with a 0 MARK.
-    '--append felix-to-abcd --jump MARK --set-mark 0/0x1000000',
-
+POLICY_LIST_INBOUND_CHAIN = [
     # Then do the tiered policies in order.  Tier 1:
-    '--append felix-to-abcd --jump MARK --set-mark 0/0x2000000 '
+    '--append felix-pl-5e2bf00b4180466c-i --jump MARK --set-mark 0/0x2000000 '
             '--match comment --comment "Start of tier tier_1"',
-    '--append felix-to-abcd --match mark --mark 0/0x2000000 '
+    '--append felix-pl-5e2bf00b4180466c-i --match mark --mark 0/0x2000000 '
             '--jump felix-p-t1p1-i',
-    '--append felix-to-abcd --match mark --mark 0x1000000/0x1000000 '
+    '--append felix-pl-5e2bf00b4180466c-i --match mark --mark 0x1000000/0x1000000 '
             '--match comment --comment "Return if policy accepted" --jump RETURN',
-    '--append felix-to-abcd --match mark --mark 0/0x2000000 '
+    '--append felix-pl-5e2bf00b4180466c-i --match mark --mark 0/0x2000000 '
             '--jump felix-p-t1p2-i',
-    '--append felix-to-abcd --match mark --mark 0x1000000/0x1000000 '
+    '--append felix-pl-5e2bf00b4180466c-i --match mark --mark 0x1000000/0x1000000 '
             '--match comment --comment "Return if policy accepted" --jump RETURN',
-    '--append felix-to-abcd --match mark --mark 0/0x2000000 '
+    '--append felix-pl-5e2bf00b4180466c-i --match mark --mark 0/0x2000000 '
             '--match comment --comment "Drop if no policy in tier passed" '
             '--jump DROP',
     # Tier 2:
-    '--append felix-to-abcd --jump MARK --set-mark 0/0x2000000 '
+    '--append felix-pl-5e2bf00b4180466c-i --jump MARK --set-mark 0/0x2000000 '
             '--match comment --comment "Start of tier tier_2"',
-    '--append felix-to-abcd --match mark --mark 0/0x2000000 '
+    '--append felix-pl-5e2bf00b4180466c-i --match mark --mark 0/0x2000000 '
             '--jump felix-p-t2p1-i',
-    '--append felix-to-abcd --match mark --mark 0x1000000/0x1000000 '
+    '--append felix-pl-5e2bf00b4180466c-i --match mark --mark 0x1000000/0x1000000 '
             '--match comment --comment "Return if policy accepted" '
             '--jump RETURN',
-    '--append felix-to-abcd --match mark --mark 0/0x2000000 '
+    '--append felix-pl-5e2bf00b4180466c-i --match mark --mark 0/0x2000000 '
             '--match comment --comment "Drop if no policy in tier passed" '
             '--jump DROP',
 
     # Jump to first profile and return iff it matched.
-    '--append felix-to-abcd --jump felix-p-prof-1-i',
-    '--append felix-to-abcd --match mark --mark 0x1000000/0x1000000 '
+    '--append felix-pl-5e2bf00b4180466c-i --jump felix-p-prof-1-i',
+    '--append felix-pl-5e2bf00b4180466c-i --match mark --mark 0x1000000/0x1000000 '
              '--match comment --comment "Profile accepted packet" '
              '--jump RETURN',
 
     # Jump to second profile and return iff it matched.
-    '--append felix-to-abcd --jump felix-p-prof-2-i',
-    '--append felix-to-abcd --match mark --mark 0x1000000/0x1000000 '
+    '--append felix-pl-5e2bf00b4180466c-i --jump felix-p-prof-2-i',
+    '--append felix-pl-5e2bf00b4180466c-i --match mark --mark 0x1000000/0x1000000 '
              '--match comment --comment "Profile accepted packet" '
              '--jump RETURN',
 
-    # Drop anything that doesn't match.
-    '--append felix-to-abcd --jump DROP -m comment --comment '
-             '"Packet did not match any profile (endpoint e1)"'
 ]
 
 
@@ -435,6 +453,149 @@ class TestRules(BaseTestCase):
              ['16', '17']]
         )
 
+    def test_collapse_rules(self):
+        rules = [{"action": "deny", "src_net": "10.0.%s.0/24" % ii}
+                 for ii in xrange(4)]
+        rules += [{"action": "allow", "src_net": "11.0.0.0/8"}]
+        net_set = NetSetId("hash:net",
+                           frozenset("10.0.%s.0/24" % ii for ii in xrange(4)))
+        self.assertEqual(
+            self.iptables_generator._collapse_rules(rules, 4),
+            [({"action": "deny"}, ("src", net_set)),
+             ({"action": "allow", "src_net": "11.0.0.0/8"}, None)]
+        )
+        self.assertEqual(
+            self.iptables_generator.profile_net_sets(
+                {"inbound_rules": rules}, 4
+            ),
+            set([net_set])
+        )
+        # Nothing to collapse for IPv6.
+        self.assertEqual(
+            self.iptables_generator.profile_net_sets(
+                {"inbound_rules": rules}, 6
+            ),
+            set()
+        )
+
+    def test_collapse_rules_short_or_broken_runs(self):
+        rules = [
+            {"src_net": "10.0.0.0/24"},
+            {"src_net": "10.0.1.0/24"},
+            {"dst_net": "10.0.2.0/24"},
+            {"src_net": "10.0.3.0/24"},
+            {"src_net": "10.0.4.0/24"},
+            {"src_net": "0.0.0.0/0"},
+            {"src_net": "10.0.5.0/24", "dst_net": "10.0.6.0/24"},
+            {"src_net": "10.0.7.0/24"},
+            {"src_net": "10.0.8.0/24", "protocol": "tcp"},
+        ]
+        self.assertEqual(self.iptables_generator._collapse_rules(rules, 4),
+                         [(r, None) for r in rules])
+
+    def test_collapse_rules_with_ports(self):
+        rules = [{"protocol": "tcp",
+                  "dst_net": "10.0.%s.0/24" % ii,
+                  "dst_ports": [80, 443]} for ii in xrange(4)]
+        # Port ranges aren't put in the ipset, so the run is split on them.
+        rules += [{"protocol": "tcp",
+                   "dst_net": "10.1.%s.0/24" % ii,
+                   "dst_ports": ["1000:2000"]} for ii in xrange(4)]
+        collapsed = self.iptables_generator._collapse_rules(rules, 4)
+        self.assertEqual(collapsed, [
+            ({"protocol": "tcp"},
+             ("dst", NetSetId("hash:net,port",
+                              frozenset("10.0.%s.0/24,tcp:%s" % (ii, p)
+                                        for ii in xrange(4)
+                                        for p in (80, 443))))),
+            ({"protocol": "tcp", "dst_ports": ["1000:2000"]},
+             ("dst", NetSetId("hash:net",
+                              frozenset("10.1.%s.0/24" % ii
+                                        for ii in xrange(4))))),
+        ])
+
+    def test_collapse_rules_max_ipset_size(self):
+        self.iptables_generator.MAX_IPSET_SIZE = 3
+        rules = [{"src_net": "10.0.%s.0/24" % ii} for ii in xrange(4)]
+        self.assertEqual(self.iptables_generator._collapse_rules(rules, 4),
+                         [(r, None) for r in rules])
+
+    def test_profile_updates_collapsed(self):
+        profile = {
+            "inbound_rules": [
+                {"protocol": "tcp",
+                 "src_net": "10.0.%s.0/24" % ii,
+                 "src_ports": [80]} for ii in xrange(4)
+            ] + [
+                {"action": "deny", "src_net": "10.1.%s.0/24" % ii}
+                for ii in xrange(4)
+            ],
+        }
+        net_sets = self.iptables_generator.profile_net_sets(profile, 4)
+        self.assertEqual(len(net_sets), 2)
+        net_set_to_ipset = dict((n, "ipset-" + n.ipset_type)
+                                for n in net_sets)
+        updates, deps = self.iptables_generator.profile_updates(
+            "prof1", profile, 4, {}, {}, on_allow="RETURN",
+            net_set_to_ipset=net_set_to_ipset
+        )
+        self.assertEqual(updates["felix-p-prof1-i"], [
+            DEFAULT_MARK % "felix-p-prof1-i",
+            '--append felix-p-prof1-i --protocol tcp --match set '
+            '--match-set ipset-hash:net,port src,src --jump RETURN',
+            '--append felix-p-prof1-i --match set '
+            '--match-set ipset-hash:net src --jump DROP',
+            DEFAULT_UNMARK % "felix-p-prof1-i",
+        ])
+        # Without the ipsets, the rules are left alone.
+        updates, deps = self.iptables_generator.profile_updates(
+            "prof1", profile, 4, {}, {}, on_allow="RETURN"
+        )
+        self.assertEqual(len(updates["felix-p-prof1-i"]), 10)
+
+    def test_fragment_cache(self):
+        cache = self.iptables_generator._fragment_cache
+        self.assertEqual(cache.max_size, 10000)
+        profile = {"inbound_rules": [{"src_tag": "tag1"},
+                                     {"protocol": "tcp", "dst_ports": [80]}]}
+        updates, _ = self.iptables_generator.profile_updates(
+            "prof1", profile, 4, {"tag1": "ipset-1"}, {}
+        )
+        self.assertEqual((cache.hits, cache.misses), (0, 2))
+        # Same rules again, all hits.
+        updates_2, _ = self.iptables_generator.profile_updates(
+            "prof1", profile, 4, {"tag1": "ipset-1"}, {}
+        )
+        self.assertEqual(updates_2, updates)
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+        # The resolved ipset name, IP version and chain are all part of the
+        # key.
+        updates_3, _ = self.iptables_generator.profile_updates(
+            "prof1", profile, 4, {"tag1": "ipset-2"}, {}
+        )
+        self.assertEqual(updates_3["felix-p-prof1-i"][1],
+                         "--append felix-p-prof1-i --match set "
+                         "--match-set ipset-2 src --jump ACCEPT")
+        self.assertEqual((cache.hits, cache.misses), (3, 3))
+        self.iptables_generator.profile_updates(
+            "prof1", profile, 6, {"tag1": "ipset-1"}, {}
+        )
+        self.iptables_generator.profile_updates(
+            "prof2", profile, 4, {"tag1": "ipset-1"}, {}
+        )
+        self.assertEqual((cache.hits, cache.misses), (3, 7))
+
+    def test_fragment_cache_disabled(self):
+        config = load_config("felix_default.cfg",
+                             host_dict={"RuleFragmentCacheSize": "0"})
+        generator = config.plugins["iptables_generator"]
+        rule = {"src_net": "10.0.0.0/8"}
+        self.assertEqual(
+            generator._rule_to_iptables_fragments("chain", rule, 4, {}, {}),
+            ["--append chain --source 10.0.0.0/8 --jump ACCEPT"]
+        )
+        self.assertEqual(len(generator._fragment_cache), 0)
+
     def test_rules_generation(self):
         for test in RULES_TESTS:
             updates, deps = self.iptables_generator.profile_updates(
@@ -525,18 +686,9 @@ class TestEndpoint(BaseTestCase):
                 'felix-to-abcd': TO_ENDPOINT_CHAIN
             },
             {
-                # From chain depends on the outbound profiles.
-                'felix-from-abcd': set(['felix-p-prof-1-o',
-                                        'felix-p-prof-2-o',
-                                        'felix-p-t1p1-o',
-                                        'felix-p-t1p2-o',
-                                        'felix-p-t2p1-o',]),
-                # To chain depends on the inbound profiles.
-                'felix-to-abcd': set(['felix-p-prof-1-i',
-                                      'felix-p-prof-2-i',
-                                      'felix-p-t1p1-i',
-                                      'felix-p-t1p2-i',
-                                      'felix-p-t2p1-i',])
+                # Endpoint chains only depend on the policy list.
+                'felix-from-abcd': set([POLICY_LIST_CHAIN_PREFIX + "-o"]),
+                'felix-to-abcd': set([POLICY_LIST_CHAIN_PREFIX + "-i"]),
             }
         )
         tiered_policies = OrderedDict()
@@ -551,5 +703,54 @@ class TestEndpoint(BaseTestCase):
         self.maxDiff = None
         self.assertEqual(result, expected_result)
 
+    def test_get_policy_list_rules(self):
+        expected_result = (
+            {
+                POLICY_LIST_CHAIN_PREFIX + "-o": POLICY_LIST_OUTBOUND_CHAIN,
+                POLICY_LIST_CHAIN_PREFIX + "-i": POLICY_LIST_INBOUND_CHAIN,
+            },
+            {
+                # Outbound chain depends on the outbound profiles.
+                POLICY_LIST_CHAIN_PREFIX + "-o": set(['felix-p-prof-1-o',
+                                                      'felix-p-prof-2-o',
+                                                      'felix-p-t1p1-o',
+                                                      'felix-p-t1p2-o',
+                                                      'felix-p-t2p1-o']),
+                # Inbound chain depends on the inbound profiles.
+                POLICY_LIST_CHAIN_PREFIX + "-i": set(['felix-p-prof-1-i',
+                                                      'felix-p-prof-2-i',
+                                                      'felix-p-t1p1-i',
+                                                      'felix-p-t1p2-i',
+                                                      'felix-p-t2p1-i']),
+            }
+        )
+        tiered_policies = OrderedDict()
+        tiered_policies["tier_1"] = ["t1p1", "t1p2"]
+        tiered_policies["tier_2"] = ["t2p1"]
+        pol_list_id = policy_list_id(tiered_policies, ["prof-1", "prof-2"])
+        result = self.iptables_generator.policy_list_updates(pol_list_id)
 
+        self.maxDiff = None
+        self.assertEqual(result, expected_result)
+        self.assertEqual(
+            self.iptables_generator.policy_list_chain_names(pol_list_id),
+            set(expected_result[0].keys())
+        )
 
+    def test_policy_list_names(self):
+        """
+        Tests that policy list chain names depend on the order of the
+        policies and profiles but not on the type of the strings.
+        """
+        tiers = OrderedDict([("t1", ["p1", "p2"])])
+        utiers = OrderedDict([(u"t1", [u"p1", u"p2"])])
+        rtiers = OrderedDict([("t1", ["p2", "p1"])])
+        names = self.iptables_generator.policy_list_chain_names
+        self.assertEqual(names(policy_list_id(tiers, ["a", "b"])),
+                         names(policy_list_id(utiers, [u"a", u"b"])))
+        self.assertNotEqual(names(policy_list_id(tiers, ["a", "b"])),
+                            names(policy_list_id(tiers, ["b", "a"])))
+        self.assertNotEqual(names(policy_list_id(tiers, ["a", "b"])),
+                            names(policy_list_id(rtiers, ["a", "b"])))
+        for name in names(policy_list_id(tiers, ["a", "b"])):
+            self.assertTrue(len(name) <= 28)
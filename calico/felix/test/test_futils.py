@@ -121,6 +121,21 @@ class TestFutils(unittest2.TestCase):
                                           "%r but got %r" %
                                           (inp, length, exp, output))
 
+    def test_ip_to_int(self):
+        self.assertEqual(futils.ip_to_int(futils.IPV4, "10.0.0.1"),
+                         0x0a000001)
+        self.assertEqual(futils.ip_to_int(futils.IPV6, "dead:beef::1"),
+                         0xdeadbeef << 96 | 1)
+        for ip_type, ip in [(futils.IPV4, "0.0.0.0"),
+                            (futils.IPV4, "255.255.255.255"),
+                            (futils.IPV4, "10.0.0.1"),
+                            (futils.IPV6, "::"),
+                            (futils.IPV6, "dead:beef::1")]:
+            self.assertEqual(
+                futils.int_to_ip(ip_type, futils.ip_to_int(ip_type, ip)),
+                ip
+            )
+
     def test_safe_truncate(self):
         self.assert_safe_truncate("foobarbazb", 10, "foobarbazb")
         # Yes, this gets longer, which is silly.  However, there's no point
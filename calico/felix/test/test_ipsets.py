@@ -28,10 +28,13 @@ from mock import *
 from netaddr import IPAddress
 
 from calico.datamodel_v1 import EndpointId
-from calico.felix.futils import IPV4, FailedSystemCall, CommandOutput
+from calico.felix.futils import (IPV4, FailedSystemCall, CommandOutput,
+                                 ip_to_int, int_to_ip)
 from calico.felix.ipsets import (EndpointData, IpsetManager, IpsetActor,
                                  RefCountedIpsetActor, EMPTY_ENDPOINT_DATA, Ipset,
-                                 list_ipset_names)
+                                 list_ipset_names, NetSetId, AliasIpsetActor,
+                                 SharedIpsetActor, TagMembershipIndex,
+                                 PackedIpset, IpsetInventory)
 from calico.felix.refcount import CREATED
 from calico.felix.test.base import BaseTestCase
 
@@ -60,7 +63,17 @@ EP_1_1_LABELS_NEW_IP = {
         "a": "a1",
     }
 }
-EP_DATA_1_1 = EndpointData(["prof1", "prof2"], ["10.0.0.1"])
+
+
+def ip(ip_str):
+    return ip_to_int(IPV4, ip_str)
+
+
+def ips(*ip_strs):
+    return set(ip(i) for i in ip_strs)
+
+
+EP_DATA_1_1 = EndpointData(["prof1", "prof2"], [ip("10.0.0.1")])
 EP_1_1_NEW_IP = {
     "profile_ids": ["prof1", "prof2"],
     "ipv4_nets": ["10.0.0.2/32", "10.0.0.3/32"],
@@ -82,26 +95,20 @@ EP_2_1_IPV6 = {
     "profile_ids": ["prof1"],
     "ipv6_nets": ["dead:beef::/128"],
 }
-EP_DATA_2_1 = EndpointData(["prof1"], ["10.0.0.1"])
-
-IPSET_LIST_OUTPUT = """Name: felix-v4-calico_net
-Type: hash:ip
-Revision: 2
-Header: family inet hashsize 1024 maxelem 1048576
-Size in memory: 16728
-References: 1
-Members:
-10.1.0.28
-10.1.0.29
-10.1.0.19
-
-Name: felix-v6-calico_net
-Type: hash:ip
-Revision: 2
-Header: family inet6 hashsize 1024 maxelem 1048576
-Size in memory: 16504
-References: 1
-Members:
+EP_DATA_2_1 = EndpointData(["prof1"], [ip("10.0.0.1")])
+
+IPSET_LIST_NAME_OUTPUT = """felix-v4-calico_net
+felix-v6-calico_net
+"""
+
+IPSET_SAVE_OUTPUT = """create felix-v4-foo hash:ip family inet hashsize 1024 maxelem 1234
+add felix-v4-foo 10.0.0.1
+add felix-v4-foo 10.0.0.2
+create felix-v4-l:bar list:set size 8
+add felix-v4-l:bar felix-v4-foo
+create felix-v6-foo hash:ip family inet6 hashsize 1024 maxelem 1234 counters
+add felix-v6-foo dead:beef::1 packets 0 bytes 0
+create felix-v4-empty hash:ip family inet hashsize 1024 maxelem 1234
 """
 
 
@@ -120,22 +127,38 @@ class TestIpsetManager(BaseTestCase):
                              side_effect = self.m_create)
         self.real_create = self.mgr._create
         self.mgr._create = self.m_create
+        self.created_shared = []
+        shared_patch = patch("calico.felix.ipsets.SharedIpsetActor",
+                             side_effect=self.m_create_shared)
+        shared_patch.start()
+        self.addCleanup(shared_patch.stop)
+        # An empty dataplane, so shared ipset names are allocated from 0.
+        self.inventory = IpsetInventory()
+        self.inventory.loaded = True
+        inventory_patch = patch("calico.felix.ipsets.IPSET_INVENTORY",
+                                self.inventory)
+        inventory_patch.start()
+        self.addCleanup(inventory_patch.stop)
 
     def m_create(self, tag_or_sel):
         _log.info("Creating ipset %s", tag_or_sel)
 
         # Do the real creation, to kick off selector indexing, for example.
         with patch("calico.felix.ipsets.RefCountedIpsetActor", autospec=True):
-            self.real_create(tag_or_sel)
+            with patch("calico.felix.ipsets.AliasIpsetActor", autospec=True):
+                self.real_create(tag_or_sel)
 
         # But return a mock...
-        ipset = Mock(spec=RefCountedIpsetActor)
+        if isinstance(tag_or_sel, NetSetId):
+            ipset = Mock(spec=RefCountedIpsetActor)
+        else:
+            ipset = Mock(spec=AliasIpsetActor)
 
         ipset._manager = None
         ipset._id = None
         ipset.ref_mgmt_state = CREATED
         ipset.ref_count = 0
-        if isinstance(tag_or_sel, SelectorExpression):
+        if isinstance(tag_or_sel, (SelectorExpression, NetSetId)):
             name_stem = tag_or_sel.unique_id[:8]
         else:
             name_stem = tag_or_sel
@@ -145,16 +168,66 @@ class TestIpsetManager(BaseTestCase):
         self.created_refs[tag_or_sel].append(ipset)
         return ipset
 
+    def m_create_shared(self, manager, name_stem, ip_type, max_elem):
+        self.assertEqual(manager, self.mgr)
+        self.assertEqual(max_elem, 1234)
+        shared = Mock(spec=SharedIpsetActor)
+        shared.ipset_name = "felix-v4-" + name_stem
+        shared.owned_ipset_names.return_value = set([
+            "felix-v4-" + name_stem, "felix-tmp-v4-" + name_stem
+        ])
+        self.created_shared.append(shared)
+        return shared
+
     def test_create(self):
         with patch("calico.felix.ipsets.Ipset") as m_Ipset:
             mgr = IpsetManager(IPV4, self.config)
             tag_ipset = mgr._create("tagid")
-        self.assertEqual(tag_ipset.name_stem, "tagid")
-        m_Ipset.assert_called_once_with('felix-v4-tagid',
-                                        'felix-tmp-v4-tagid',
-                                        'inet', 'hash:ip',
+        self.assertTrue(isinstance(tag_ipset, AliasIpsetActor))
+        self.assertEqual(tag_ipset.name_stem, "l:tagid")
+        m_Ipset.assert_called_once_with('felix-v4-l:tagid',
+                                        'felix-tmp-v4-l:tagid',
+                                        'inet', 'list:set',
+                                        max_elem=8)
+
+    def test_create_net_set(self):
+        net_set = NetSetId("hash:net,port",
+                           frozenset(["10.0.0.0/8,tcp:80"]))
+        with patch("calico.felix.ipsets.Ipset") as m_Ipset:
+            mgr = IpsetManager(IPV4, self.config)
+            net_ipset = mgr._create(net_set)
+        name_stem = net_ipset.name_stem
+        self.assertEqual(len(name_stem), 16)
+        m_Ipset.assert_called_once_with('felix-v4-' + name_stem,
+                                        'felix-tmp-v4-' + name_stem,
+                                        'inet', 'hash:net,port',
                                         max_elem=1234)
 
+    def test_net_set_unique_id(self):
+        net_set = NetSetId("hash:net", frozenset(["10.0.0.0/8",
+                                                  "11.0.0.0/8"]))
+        self.assertEqual(
+            net_set.unique_id,
+            NetSetId("hash:net", frozenset(["11.0.0.0/8",
+                                            "10.0.0.0/8"])).unique_id
+        )
+        self.assertNotEqual(
+            net_set.unique_id,
+            NetSetId("hash:net", frozenset(["10.0.0.0/8"])).unique_id
+        )
+
+    def test_net_set_started_with_fixed_members(self):
+        net_set = NetSetId("hash:net", frozenset(["10.0.0.0/8",
+                                                  "11.0.0.0/8"]))
+        self.mgr.on_datamodel_in_sync(async=True)
+        self.mgr.get_and_incref(net_set, callback=self.on_ref_acquired,
+                                async=True)
+        self.step_mgr()
+        ipset = self.created_refs[net_set][0]
+        self.assertEqual(ipset.replace_members.mock_calls,
+                         [call(frozenset(["10.0.0.0/8", "11.0.0.0/8"]),
+                               async=True)])
+
     def test_maybe_start_gates_on_in_sync(self):
         with patch("calico.felix.refcount.ReferenceManager."
                    "_maybe_start") as m_maybe_start:
@@ -188,6 +261,14 @@ class TestIpsetManager(BaseTestCase):
         self.step_mgr()
         self.assert_one_ep_one_tag()
 
+    def test_endpoint_updates_batch(self):
+        self.mgr.on_tags_update("prof1", ["tag1"], async=True)
+        self.mgr.on_endpoint_updates([(EP_ID_2_1, EP_2_1),
+                                      (EP_ID_1_1, EP_1_1),
+                                      (EP_ID_2_1, None)], async=True)
+        self.step_mgr()
+        self.assert_one_ep_one_tag()
+
     def test_endpoint_then_tag_idempotent(self):
         for _ in xrange(3):
             # Send in the messages.
@@ -201,7 +282,7 @@ class TestIpsetManager(BaseTestCase):
         self.assertEqual(self.mgr.endpoint_data_by_ep_id, {
             EP_ID_1_1: EP_DATA_1_1,
         })
-        self.assertEqual(self.mgr.tag_membership_index.ip_owners_by_tag, {
+        self.assertEqual(self.index_contents(), {
             "tag1": {
                 "10.0.0.1": ("prof1", EP_ID_1_1),
             }
@@ -260,7 +341,7 @@ class TestIpsetManager(BaseTestCase):
         self.step_mgr()
 
         # Should be no match yet.
-        self.assertEqual(self.mgr.tag_membership_index.ip_owners_by_tag, {})
+        self.assertEqual(self.index_contents(), {})
 
         # Now fire in a parent label.
         self.mgr.on_prof_labels_set("prof1", {"p": "p1"}, async=True)
@@ -272,7 +353,7 @@ class TestIpsetManager(BaseTestCase):
         # Undo our messages to check that the index is correctly updated.
         self.mgr.on_prof_labels_set("prof1", None, async=True)
         self.step_mgr()
-        self.assertEqual(self.mgr.tag_membership_index.ip_owners_by_tag, {})
+        self.assertEqual(self.index_contents(), {})
         self.mgr.decref(selector, async=True)
         self.mgr.on_endpoint_update(EP_ID_1_1, None, async=True)
         self.step_mgr()
@@ -300,7 +381,7 @@ class TestIpsetManager(BaseTestCase):
                                     async=True)
         self.step_mgr()
 
-        self.assertEqual(self.mgr.tag_membership_index.ip_owners_by_tag, {
+        self.assertEqual(self.index_contents(), {
             selector: {
                 "10.0.0.2": ("dummy", EP_ID_1_1),
             }
@@ -316,7 +397,7 @@ class TestIpsetManager(BaseTestCase):
         self.assertEqual(self.mgr.endpoint_data_by_ep_id, {
             EP_ID_1_1: EP_DATA_1_1,
         })
-        self.assertEqual(self.mgr.tag_membership_index.ip_owners_by_tag, {
+        self.assertEqual(self.index_contents(), {
             selector: {
                 "10.0.0.1": ("dummy", EP_ID_1_1),
             }
@@ -324,7 +405,7 @@ class TestIpsetManager(BaseTestCase):
 
     def assert_index_empty(self):
         self.assertEqual(self.mgr.endpoint_data_by_ep_id, {})
-        self.assertEqual(self.mgr.tag_membership_index.ip_owners_by_tag, {})
+        self.assertEqual(self.index_contents(), {})
 
     def test_change_ip(self):
         # Initial set-up.
@@ -335,7 +416,7 @@ class TestIpsetManager(BaseTestCase):
         self.mgr.on_endpoint_update(EP_ID_1_1, EP_1_1_NEW_IP, async=True)
         self.step_mgr()
 
-        self.assertEqual(self.mgr.tag_membership_index.ip_owners_by_tag, {
+        self.assertEqual(self.index_contents(), {
             "tag1": {
                 "10.0.0.2": ("prof1", EP_ID_1_1),
                 "10.0.0.3": ("prof1", EP_ID_1_1),
@@ -351,7 +432,7 @@ class TestIpsetManager(BaseTestCase):
         # Add a tag, keep a tag.
         self.mgr.on_tags_update("prof1", ["tag1", "tag2"], async=True)
         self.step_mgr()
-        self.assertEqual(self.mgr.tag_membership_index.ip_owners_by_tag, {
+        self.assertEqual(self.index_contents(), {
             "tag1": {
                 "10.0.0.1": ("prof1", EP_ID_1_1),
             },
@@ -364,7 +445,7 @@ class TestIpsetManager(BaseTestCase):
         # Remove a tag.
         self.mgr.on_tags_update("prof1", ["tag2"], async=True)
         self.step_mgr()
-        self.assertEqual(self.mgr.tag_membership_index.ip_owners_by_tag, {
+        self.assertEqual(self.index_contents(), {
             "tag2": {
                 "10.0.0.1": ("prof1", EP_ID_1_1),
             }
@@ -373,7 +454,7 @@ class TestIpsetManager(BaseTestCase):
         # Delete the tags:
         self.mgr.on_tags_update("prof1", None, async=True)
         self.step_mgr()
-        self.assertEqual(self.mgr.tag_membership_index.ip_owners_by_tag, {})
+        self.assertEqual(self.index_contents(), {})
         self.assertEqual(self.mgr.tags_by_prof_id, {})
 
     def step_mgr(self):
@@ -389,7 +470,7 @@ class TestIpsetManager(BaseTestCase):
         self.mgr.on_endpoint_update(EP_ID_1_1, EP_1_1_NEW_PROF_IP, async=True)
         self.step_mgr()
 
-        self.assertEqual(self.mgr.tag_membership_index.ip_owners_by_tag, {
+        self.assertEqual(self.index_contents(), {
             "tag3": {
                 "10.0.0.3": ("prof3", EP_ID_1_1)
             }
@@ -437,7 +518,7 @@ class TestIpsetManager(BaseTestCase):
             EP_ID_1_1: EP_DATA_1_1,
             EP_ID_2_1: EP_DATA_2_1,
         })
-        self.assertEqual(self.mgr.tag_membership_index.ip_owners_by_tag, {
+        self.assertEqual(self.index_contents(), {
             "tag1": {
                 "10.0.0.1": set([
                     ("prof1", EP_ID_1_1),
@@ -449,7 +530,7 @@ class TestIpsetManager(BaseTestCase):
         # Second profile tags arrive:
         self.mgr.on_tags_update("prof2", ["tag1", "tag2"], async=True)
         self.step_mgr()
-        self.assertEqual(self.mgr.tag_membership_index.ip_owners_by_tag, {
+        self.assertEqual(self.index_contents(), {
             "tag1": {
                 "10.0.0.1": set([
                     ("prof1", EP_ID_1_1),
@@ -468,7 +549,7 @@ class TestIpsetManager(BaseTestCase):
         self.assertEqual(self.mgr.endpoint_data_by_ep_id, {
             EP_ID_1_1: EP_DATA_1_1,
         })
-        self.assertEqual(self.mgr.tag_membership_index.ip_owners_by_tag, {
+        self.assertEqual(self.index_contents(), {
             "tag1": {
                 "10.0.0.1": set([
                     ("prof1", EP_ID_1_1),
@@ -484,9 +565,25 @@ class TestIpsetManager(BaseTestCase):
         self.mgr.on_endpoint_update(EP_ID_1_1, None, async=True)
         self.step_mgr()
         self.assertEqual(self.mgr.endpoint_data_by_ep_id, {})
-        self.assertEqual(self.mgr.tag_membership_index.ip_owners_by_tag, {},
+        self.assertEqual(self.index_contents(), {},
                          "ip_owners_by_tag should be empty, not %s" %
-                         pformat(self.mgr.tag_membership_index.ip_owners_by_tag))
+                         pformat(self.index_contents()))
+
+    def index_contents(self):
+        """
+        :returns the contents of the tag membership index in the form
+                 {tag: {ip_str: owner or set of owners}}.
+        """
+        index = self.mgr.tag_membership_index
+        contents = {}
+        for tag_id, ip_owners in index.ip_owners_by_tag.iteritems():
+            contents[tag_id] = {}
+            for ip_int in ip_owners:
+                owners = index.owners(tag_id, ip_int)
+                if len(owners) == 1:
+                    owners = owners.pop()
+                contents[tag_id][int_to_ip(IPV4, ip_int)] = owners
+        return contents
 
     def on_ref_acquired(self, tag_id, ipset):
         self.acquired_refs[tag_id] = ipset
@@ -517,6 +614,9 @@ class TestIpsetManager(BaseTestCase):
             {"bar": set(self.created_refs["bar"])}
         )
 
+        # Both tags are empty so they share a single ipset.
+        self.assertEqual(len(self.created_shared), 1)
+
         # Return mix of expected and unexpected ipsets.
         m_list_ipsets.return_value = [
             "not-felix-foo",
@@ -526,11 +626,16 @@ class TestIpsetManager(BaseTestCase):
             "felix-v4-bar",
             "felix-v4-baz",
             "felix-v4-biff",
+            "felix-v4-s:0",
+            "felix-v4-s:9",
+            "felix-v4-l:old",
         ]
         m_check_call.side_effect = iter([
             # Exception on any individual call should be ignored.
             FailedSystemCall("Dummy", [], None, None, None),
             None,
+            None,
+            None,
         ])
         self.mgr.cleanup(async=True)
         self.step_mgr()
@@ -541,29 +646,152 @@ class TestIpsetManager(BaseTestCase):
                          sorted([
                              call(["ipset", "destroy", "felix-v4-biff"]),
                              call(["ipset", "destroy", "felix-v4-baz"]),
+                             call(["ipset", "destroy", "felix-v4-s:9"]),
+                             call(["ipset", "destroy", "felix-v4-l:old"]),
                          ]))
+        # Aliases must be deleted before the ipsets that they contain.
+        self.assertEqual(m_check_call.mock_calls[0],
+                         call(["ipset", "destroy", "felix-v4-l:old"]))
+
+    def _start_tags(self, tags):
+        self.mgr.on_datamodel_in_sync(async=True)
+        for tag in tags:
+            self.mgr.get_and_incref(tag, callback=self.on_ref_acquired,
+                                    async=True)
+        self.step_mgr()
+        return [self.created_refs[tag][0] for tag in tags]
+
+    def test_identical_tags_share_ipset(self):
+        self.mgr.on_endpoint_update(EP_ID_1_1, EP_1_1, async=True)
+        self.mgr.on_tags_update("prof1", ["tag1", "tag2"], async=True)
+        alias1, alias2 = self._start_tags(["tag1", "tag2"])
+
+        # One shared ipset, populated with the common members.
+        self.assertEqual(len(self.created_shared), 1)
+        shared = self.created_shared[0]
+        self.assertEqual(shared.start.mock_calls, [call()])
+        self.assertEqual(shared.replace_members.mock_calls,
+                         [call([ip("10.0.0.1")], async=True)])
+        # The aliases are only programmed once the shared ipset exists.
+        self.assertFalse(alias1.replace_members.called)
+        self.assertFalse(alias2.replace_members.called)
+        self.mgr.on_shared_ipset_ready(shared, async=True)
+        self.step_mgr()
+        self.assertEqual(alias1.replace_members.mock_calls,
+                         [call(["felix-v4-s:0"], async=True)])
+        self.assertEqual(alias2.replace_members.mock_calls,
+                         [call(["felix-v4-s:0"], async=True)])
+
+    def test_shared_names_skip_existing_ipsets(self):
+        # The previous run's shared ipsets are still in the dataplane.
+        self.inventory.on_created("felix-v4-s:0", "hash:ip", {})
+        self.inventory.on_created("felix-v4-s:1", "hash:ip", {})
+        self.mgr.on_endpoint_update(EP_ID_1_1, EP_1_1, async=True)
+        self.mgr.on_tags_update("prof1", ["tag1"], async=True)
+        alias, = self._start_tags(["tag1"])
+        shared, = self.created_shared
+        self.mgr.on_shared_ipset_ready(shared, async=True)
+        self.step_mgr()
+        self.assertEqual(alias.replace_members.mock_calls,
+                         [call(["felix-v4-s:2"], async=True)])
+
+    @patch("calico.felix.ipsets.list_ipset_names", autospec=True)
+    def test_shared_names_skip_listed_ipsets(self, m_list_ipsets):
+        # Inventory not loaded, falls back to listing the ipsets once.
+        self.inventory.loaded = False
+        m_list_ipsets.return_value = ["felix-v4-s:0", "felix-v4-s:2"]
+        self.mgr.on_endpoint_update(EP_ID_1_1, EP_1_1, async=True)
+        self.mgr.on_tags_update("prof1", ["tag1"], async=True)
+        # tag2 is empty, so it needs its own shared ipset.
+        self.mgr.on_tags_update("prof3", ["tag2"], async=True)
+        self._start_tags(["tag1", "tag2"])
+        self.assertEqual([s.ipset_name for s in self.created_shared],
+                         ["felix-v4-s:1", "felix-v4-s:3"])
+        self.assertEqual(m_list_ipsets.mock_calls, [call()])
 
     def test_update_dirty(self):
-        self.mgr._datamodel_in_sync = True
-        m_ipset = Mock(spec=RefCountedIpsetActor)
-        self.mgr.objects_by_id["tag-123"] = m_ipset
-        with patch.object(self.mgr, "_is_starting_or_live",
-                          autospec=True) as m_sol:
-            m_sol.return_value = True
-            with patch.object(self.mgr.tag_membership_index,
-                              "get_and_reset_changes_by_tag",
-                              autospec=True) as m_get_and_reset:
-                m_get_and_reset.return_value = ({"tag-123": set(["10.0.0.1"])},
-                                                {"tag-123": set(["10.0.0.2"])})
-                self.mgr._update_dirty_active_ipsets()
-                self.assertEqual(
-                    m_ipset.add_members.mock_calls,
-                    [call(set(["10.0.0.1"]), async=True)]
-                )
-                self.assertEqual(
-                    m_ipset.remove_members.mock_calls,
-                    [call(set(["10.0.0.2"]), async=True)]
-                )
+        self.mgr.on_endpoint_update(EP_ID_1_1, EP_1_1, async=True)
+        self.mgr.on_tags_update("prof1", ["tag1", "tag2"], async=True)
+        self._start_tags(["tag1", "tag2"])
+        shared = self.created_shared[0]
+
+        # Both tags change in the same way so the shared ipset is updated
+        # in place.
+        self.mgr.on_endpoint_update(EP_ID_1_1, EP_1_1_NEW_IP, async=True)
+        self.step_mgr()
+        self.assertEqual(len(self.created_shared), 1)
+        self.assertEqual(
+            shared.add_members.mock_calls,
+            [call(ips("10.0.0.2", "10.0.0.3"), async=True)]
+        )
+        self.assertEqual(
+            shared.remove_members.mock_calls,
+            [call(ips("10.0.0.1"), async=True)]
+        )
+
+    def test_diverge_and_converge(self):
+        self.mgr.on_endpoint_update(EP_ID_1_1, EP_1_1, async=True)
+        self.mgr.on_tags_update("prof1", ["tag1", "tag2"], async=True)
+        alias1, alias2 = self._start_tags(["tag1", "tag2"])
+        shared = self.created_shared[0]
+        self.mgr.on_shared_ipset_ready(shared, async=True)
+        self.step_mgr()
+        alias1.reset_mock()
+        alias2.reset_mock()
+
+        # Add an IP to tag2 only, it should get its own copy.
+        self.mgr.on_endpoint_update(EP_ID_1_2, EP_1_1_NEW_PROF_IP,
+                                    async=True)
+        self.mgr.on_tags_update("prof3", ["tag2"], async=True)
+        self.step_mgr()
+        self.assertEqual(len(self.created_shared), 2)
+        copy = self.created_shared[1]
+        self.assertEqual(
+            [set(c[1][0]) for c in copy.replace_members.mock_calls],
+            [ips("10.0.0.1", "10.0.0.3")]
+        )
+        # The original is untouched since tag1 is still using it.
+        self.assertFalse(shared.add_members.called)
+        self.assertFalse(shared.remove_members.called)
+        self.assertFalse(alias2.replace_members.called)
+        self.mgr.on_shared_ipset_ready(copy, async=True)
+        self.step_mgr()
+        self.assertFalse(alias1.replace_members.called)
+        self.assertEqual(alias2.replace_members.mock_calls,
+                         [call(["felix-v4-s:1"], async=True)])
+        self.mgr.on_alias_programmed(alias2, frozenset(["felix-v4-s:1"]),
+                                     async=True)
+        self.step_mgr()
+        alias2.reset_mock()
+
+        # Remove the IP again, tag2 should move back to the original.
+        self.mgr.on_tags_update("prof3", None, async=True)
+        self.step_mgr()
+        self.assertEqual(alias2.replace_members.mock_calls,
+                         [call(["felix-v4-s:0"], async=True)])
+        self.assertFalse(copy.remove_members.called)
+        # The copy can't be deleted until alias2 has stopped using it.
+        self.assertFalse(copy.on_unreferenced.called)
+        self.mgr.on_alias_programmed(alias2, frozenset(["felix-v4-s:0"]),
+                                     async=True)
+        self.step_mgr()
+        self.assertEqual(copy.on_unreferenced.mock_calls,
+                         [call(async=True)])
+
+        # Finally, remove both tags.
+        self.mgr.decref("tag1", async=True)
+        self.mgr.decref("tag2", async=True)
+        self.step_mgr()
+        self.mgr.on_alias_programmed(alias1, frozenset(), async=True)
+        self.step_mgr()
+        self.assertFalse(shared.on_unreferenced.called)
+        self.mgr.on_alias_programmed(alias2, frozenset(), async=True)
+        self.step_mgr()
+        self.assertEqual(shared.on_unreferenced.mock_calls,
+                         [call(async=True)])
+        self.assertEqual(self.mgr._hash_by_shared, {})
+        self.assertEqual(self.mgr._shared_by_alias, {})
+        self.assertEqual(self.mgr._pointers_by_shared, {})
 
     def _notify_ready(self, tags):
         for tag in tags:
@@ -572,10 +800,140 @@ class TestIpsetManager(BaseTestCase):
         self.step_mgr()
 
 
+class TestTagMembershipIndex(BaseTestCase):
+    def test_content_hash(self):
+        index = TagMembershipIndex()
+        self.assertEqual(index.content_hash("tag1"), 0)
+        index.add_mapping("tag1", "prof1", EP_ID_1_1, ip("10.0.0.1"))
+        index.add_mapping("tag1", "prof1", EP_ID_1_1, ip("10.0.0.2"))
+        index.add_mapping("tag2", "prof2", EP_ID_2_1, ip("10.0.0.2"))
+        self.assertNotEqual(index.content_hash("tag1"),
+                            index.content_hash("tag2"))
+        # Order of addition doesn't matter and extra owners of an IP
+        # don't change the members.
+        index.add_mapping("tag2", "prof2", EP_ID_2_1, ip("10.0.0.1"))
+        index.add_mapping("tag2", "prof3", EP_ID_2_1, ip("10.0.0.1"))
+        self.assertEqual(index.content_hash("tag1"),
+                         index.content_hash("tag2"))
+        index.remove_mapping("tag2", "prof3", EP_ID_2_1, ip("10.0.0.1"))
+        self.assertEqual(index.content_hash("tag1"),
+                         index.content_hash("tag2"))
+        index.remove_mapping("tag2", "prof2", EP_ID_2_1, ip("10.0.0.1"))
+        index.remove_mapping("tag2", "prof2", EP_ID_2_1, ip("10.0.0.2"))
+        self.assertEqual(index.content_hash("tag2"), 0)
+        self.assertEqual(index.content_hash_by_tag.keys(), ["tag1"])
+
+
+    def test_owner_interning(self):
+        index = TagMembershipIndex()
+        index.add_mapping("tag1", "prof1", EP_ID_1_1, ip("10.0.0.1"))
+        index.add_mapping("tag2", "prof1", EP_ID_1_1, ip("10.0.0.1"))
+        index.add_mapping("tag1", "prof1", EP_ID_2_1, ip("10.0.0.1"))
+        # Owners are shared between tags and IPs.
+        self.assertEqual(index.ip_owners_by_tag,
+                         {"tag1": {ip("10.0.0.1"): set([0, 1])},
+                          "tag2": {ip("10.0.0.1"): 0}})
+        self.assertEqual(index.owners("tag1", ip("10.0.0.1")),
+                         set([("prof1", EP_ID_1_1), ("prof1", EP_ID_2_1)]))
+        self.assertEqual(index.owners("tag3", ip("10.0.0.1")), set())
+        # Adding a mapping twice is a no-op.
+        index.add_mapping("tag2", "prof1", EP_ID_1_1, ip("10.0.0.1"))
+        index.remove_mapping("tag1", "prof1", EP_ID_1_1, ip("10.0.0.1"))
+        index.remove_mapping("tag2", "prof1", EP_ID_1_1, ip("10.0.0.1"))
+        # Owner IDs are freed when no longer used and then reused.
+        self.assertEqual(index._owners_by_id, {1: ("prof1", EP_ID_2_1)})
+        index.add_mapping("tag2", "prof2", EP_ID_1_1, ip("10.0.0.1"))
+        self.assertEqual(index.ip_owners_by_tag["tag2"],
+                         {ip("10.0.0.1"): 0})
+
+
+class TestIpsetInventory(BaseTestCase):
+    def setUp(self):
+        super(TestIpsetInventory, self).setUp()
+        self.inventory = IpsetInventory()
+
+    def test_not_loaded(self):
+        self.assertEqual(self.inventory.exists("felix-v4-foo"), None)
+        self.assertEqual(self.inventory.names(), None)
+        self.assertEqual(self.inventory.take_members("felix-v4-foo",
+                                                     "hash:ip", {}), None)
+        self.inventory.on_created("felix-v4-foo", "hash:ip", {})
+        self.assertEqual(self.inventory.exists("felix-v4-foo"), None)
+
+    @patch("calico.felix.futils.check_call", autospec=True)
+    def test_refresh(self, m_check_call):
+        m_check_call.return_value = CommandOutput(IPSET_SAVE_OUTPUT, "")
+        self.inventory.refresh()
+        m_check_call.assert_called_once_with(["ipset", "save"])
+        self.assertEqual(self.inventory.names(),
+                         set(["felix-v4-foo", "felix-v4-l:bar",
+                              "felix-v6-foo", "felix-v4-empty"]))
+        self.assertTrue(self.inventory.exists("felix-v4-foo"))
+        self.assertFalse(self.inventory.exists("felix-v4-bar"))
+        # Type and options must match.
+        self.assertEqual(
+            self.inventory.take_members("felix-v4-foo", "hash:net",
+                                        {"maxelem": "1234"}),
+            None
+        )
+        self.assertEqual(
+            self.inventory.take_members("felix-v6-foo", "hash:ip",
+                                        {"family": "inet6",
+                                         "maxelem": "1234"}),
+            set(["dead:beef::1"])
+        )
+        self.assertEqual(
+            self.inventory.take_members("felix-v4-empty", "hash:ip",
+                                        {"family": "inet"}),
+            set()
+        )
+
+    def test_parse_options(self):
+        # Newer versions of ipset include bucketsize and initval.
+        self.assertEqual(
+            self.inventory._parse_options(
+                "family inet hashsize 1024 maxelem 65536 bucketsize 12 "
+                "initval 0x5e0aa3b6 comment counters".split()
+            ),
+            {"family": "inet", "hashsize": "1024", "maxelem": "65536",
+             "bucketsize": "12", "initval": "0x5e0aa3b6", "comment": True,
+             "counters": True}
+        )
+        self.assertEqual(
+            self.inventory._parse_options(
+                "range 10.0.0.0-10.0.255.255 timeout 60".split()
+            ),
+            {"range": "10.0.0.0-10.0.255.255", "timeout": "60"}
+        )
+
+    @patch("calico.felix.futils.check_call", autospec=True)
+    def test_updates(self, m_check_call):
+        m_check_call.return_value = CommandOutput(IPSET_SAVE_OUTPUT, "")
+        self.inventory.refresh()
+        self.inventory.on_destroyed("felix-v4-foo")
+        self.assertFalse(self.inventory.exists("felix-v4-foo"))
+        self.inventory.on_created("felix-v4-foo", "hash:ip",
+                                  {"family": "inet"})
+        self.assertTrue(self.inventory.exists("felix-v4-foo"))
+        # Newly-created sets have unknown members.
+        self.assertEqual(
+            self.inventory.take_members("felix-v4-foo", "hash:ip",
+                                        {"family": "inet"}),
+            None
+        )
+        self.inventory.forget("felix-v4-foo")
+        self.assertEqual(self.inventory.exists("felix-v4-foo"), None)
+        self.inventory.discard_members()
+        self.assertEqual(
+            self.inventory.take_members("felix-v4-l:bar", "list:set", {}),
+            None
+        )
+
+
 class TestEndpointData(BaseTestCase):
     def test_repr(self):
         self.assertEqual(repr(EP_DATA_1_1),
-                         "EndpointData(('prof1', 'prof2'),('10.0.0.1',))")
+                         "EndpointData(('prof1', 'prof2'),(167772161,))")
 
     def test_equals(self):
         self.assertEqual(EP_DATA_1_1, EP_DATA_1_1)
@@ -610,6 +968,7 @@ class TestIpsetActor(BaseTestCase):
         super(TestIpsetActor, self).setUp()
         self.ipset = Mock(spec=Ipset)
         self.ipset.max_elem = 1234
+        self.ipset.take_existing_members.return_value = None
         self.ipset.set_name = "felix-a_set_name"
         self.ipset.temp_set_name = "felix-a_set_name-tmp"
         self.actor = IpsetActor(self.ipset)
@@ -687,6 +1046,51 @@ class TestIpsetActor(BaseTestCase):
         self.assertFalse(self.actor._force_reprogram)
         self.ipset.reset_mock()
 
+    def test_no_deltas(self):
+        self.ipset.supports_deltas = False
+        self.actor.replace_members(["10.0.0.0/8"], async=True)
+        self.step_actor(self.actor)
+        self.ipset.reset_mock()
+        # Changes are applied by rewriting the set.
+        self.actor.add_members(["10.1.0.0/16"], async=True)
+        self.actor.remove_members(["10.0.0.0/8"], async=True)
+        self.step_actor(self.actor)
+        self.assertFalse(self.ipset.apply_changes.called)
+        self.assertEqual(self.ipset.replace_members.mock_calls,
+                         [call(set(["10.1.0.0/16"]))])
+        self.assertFalse(self.actor._force_reprogram)
+
+    def test_reconcile_existing(self):
+        self.ipset.take_existing_members.return_value = set(["1.2.3.4",
+                                                             "9.9.9.9"])
+        self.actor.replace_members(["1.2.3.4", "2.3.4.5"], async=True)
+        with patch("calico.felix.ipsets.RECONCILIATION_STATS") as m_stats:
+            self.step_actor(self.actor)
+        self.assertEqual(m_stats.increment.mock_calls, [
+            call("ipset rewrites avoided"),
+            call("ipset entries not rewritten", by=1),
+        ])
+        # Existing set updated in place.
+        self.assertEqual(self.ipset.apply_changes.mock_calls,
+                         [call(set(["2.3.4.5"]), set(["9.9.9.9"]))])
+        self.assertFalse(self.ipset.replace_members.called)
+        self.assertFalse(self.actor._force_reprogram)
+        # Only done on the first sync.
+        self.actor.replace_members(["1.2.3.4"], async=True)
+        self.step_actor(self.actor)
+        self.assertEqual(self.ipset.take_existing_members.call_count, 1)
+        self.ipset.replace_members.assert_called_once_with(set(["1.2.3.4"]))
+
+    def test_reconcile_existing_fails(self):
+        self.ipset.take_existing_members.return_value = set(["1.2.3.4"])
+        self.ipset.apply_changes.side_effect = FailedSystemCall(
+            "", [], 1, "", ""
+        )
+        self.actor.replace_members(["2.3.4.5"], async=True)
+        self.step_actor(self.actor)
+        # Falls back to a rewrite.
+        self.ipset.replace_members.assert_called_once_with(set(["2.3.4.5"]))
+
     def test_members_too_big(self):
         members = set([str(IPAddress(x)) for x in range(2000)])
         self.actor.replace_members(members, async=True)
@@ -704,6 +1108,7 @@ class TestTagIpsetActor(BaseTestCase):
         super(TestTagIpsetActor, self).setUp()
         self.m_ipset = Mock(spec=Ipset)
         self.m_ipset.max_elem = 1234
+        self.m_ipset.take_existing_members.return_value = None
         self.m_ipset.set_name = "felix-a_set_name"
         self.m_ipset.temp_set_name = "felix-a_set_name-tmp"
         self.tag_ipset = RefCountedIpsetActor("tag-123", "IPv4", max_elem=1024)
@@ -727,6 +1132,69 @@ class TestTagIpsetActor(BaseTestCase):
         )
 
 
+class TestAliasIpsetActor(BaseTestCase):
+    def setUp(self):
+        super(TestAliasIpsetActor, self).setUp()
+        self.alias = AliasIpsetActor("tag-123", "IPv4")
+        self.m_ipset = Mock(spec=Ipset)
+        self.m_ipset.max_elem = 8
+        self.m_ipset.take_existing_members.return_value = None
+        self.alias._ipset = self.m_ipset
+        self.m_mgr = Mock()
+        self.alias._manager = self.m_mgr
+        self.alias._id = "tag-123"
+
+    def test_lifecycle(self):
+        self.assertEqual(self.alias.name_stem, "l:tag-123")
+        self.alias.replace_members(["felix-v4-s:0"], async=True)
+        self.step_actor(self.alias)
+        self.m_ipset.replace_members.assert_called_once_with(
+            set(["felix-v4-s:0"])
+        )
+        self.assertEqual(
+            self.m_mgr.on_alias_programmed.mock_calls,
+            [call(self.alias, frozenset(["felix-v4-s:0"]), async=True)]
+        )
+        # No change, no report.
+        self.alias.replace_members(["felix-v4-s:0"], async=True)
+        self.step_actor(self.alias)
+        self.assertEqual(len(self.m_mgr.on_alias_programmed.mock_calls), 1)
+
+        self.alias.on_unreferenced(async=True)
+        self.step_actor(self.alias)
+        self.assertTrue(self.m_ipset.delete.called)
+        self.assertEqual(
+            self.m_mgr.on_alias_programmed.mock_calls[-1],
+            call(self.alias, frozenset(), async=True)
+        )
+        self.assertEqual(
+            self.m_mgr.on_object_cleanup_complete.mock_calls,
+            [call("tag-123", self.alias, async=True)]
+        )
+
+
+class TestSharedIpsetActor(BaseTestCase):
+    def test_lifecycle(self):
+        m_mgr = Mock()
+        with patch("calico.felix.ipsets.PackedIpset",
+                   autospec=True) as m_Ipset:
+            shared = SharedIpsetActor(m_mgr, "s:1", "IPv4", max_elem=1234)
+        m_Ipset.assert_called_once_with("felix-v4-s:1", "felix-tmp-v4-s:1",
+                                        "IPv4", max_elem=1234)
+        m_ipset = m_Ipset.return_value
+        m_ipset.max_elem = 1234
+        m_ipset.take_existing_members.return_value = None
+        shared.replace_members([ip("10.0.0.1")], async=True)
+        self.step_actor(shared)
+        m_ipset.replace_members.assert_called_once_with(ips("10.0.0.1"))
+        self.assertEqual(m_mgr.on_shared_ipset_ready.mock_calls,
+                         [call(shared, async=True)])
+        shared.on_unreferenced(async=True)
+        self.step_actor(shared)
+        self.assertTrue(m_ipset.delete.called)
+        self.assertEqual(len(m_mgr.on_shared_ipset_ready.mock_calls), 1)
+
+
 class TestIpset(BaseTestCase):
     def setUp(self):
         super(TestIpset, self).setUp()
@@ -774,6 +1242,96 @@ class TestIpset(BaseTestCase):
         ]
         self.assertEqual(m_check_call.mock_calls, exp_calls)
 
+    @patch("calico.felix.futils.check_call", autospec=True)
+    def test_replace_members_with_inventory(self, m_check_call):
+        inventory = IpsetInventory()
+        m_check_call.return_value = CommandOutput("", "")
+        inventory.refresh()
+        m_check_call.reset_mock()
+        with patch("calico.felix.ipsets.IPSET_INVENTORY", inventory):
+            self.ipset.replace_members(set(["10.0.0.1"]))
+            # The inventory tells us that neither set exists so we skip
+            # straight to the restore.
+            self.assertEqual(m_check_call.mock_calls, [
+                call(
+                    ["ipset", "restore"],
+                    input_str='create foo hash:ip family inet '
+                              'maxelem 1048576 --exist\n'
+                              'create foo-tmp hash:ip family inet '
+                              'maxelem 1048576 --exist\n'
+                              'flush foo-tmp\n'
+                              'add foo-tmp 10.0.0.1\n'
+                              'swap foo foo-tmp\n'
+                              'destroy foo-tmp\n'
+                              'COMMIT\n'
+                )
+            ])
+            self.assertTrue(inventory.exists("foo"))
+            self.assertFalse(inventory.exists("foo-tmp"))
+            # Now that it exists, ensure_exists() is a no-op.
+            m_check_call.reset_mock()
+            self.ipset.ensure_exists()
+            self.assertFalse(m_check_call.called)
+
+    @patch("calico.felix.futils.check_call", autospec=True)
+    def test_replace_members_inventory_out_of_date(self, m_check_call):
+        inventory = IpsetInventory()
+        m_check_call.return_value = CommandOutput(
+            "create foo hash:ip family inet maxelem 1048576\n", ""
+        )
+        inventory.refresh()
+        m_check_call.reset_mock()
+        m_check_call.side_effect = iter([
+            # Swap fails because the set was deleted behind our back.
+            FailedSystemCall("Blah", [], 1, None, "err"),
+            None,
+            FailedSystemCall("Blah", [], 1, None, "does not exist"),
+            None,
+        ])
+        with patch("calico.felix.ipsets.IPSET_INVENTORY", inventory):
+            self.ipset.replace_members(set(["10.0.0.1"]))
+        self.assertEqual(m_check_call.mock_calls[1:3], [
+            # Retry checks the dataplane.
+            call(["ipset", "destroy", "foo-tmp"]),
+            call(["ipset", "list", "foo"]),
+        ])
+        self.assertTrue(m_check_call.mock_calls[-1][2]["input_str"]
+                        .startswith("create foo hash:ip"))
+        self.assertTrue(inventory.exists("foo"))
+
+    @patch("calico.felix.futils.check_call", autospec=True)
+    def test_take_existing_members(self, m_check_call):
+        inventory = IpsetInventory()
+        m_check_call.return_value = CommandOutput(IPSET_SAVE_OUTPUT, "")
+        inventory.refresh()
+        with patch("calico.felix.ipsets.IPSET_INVENTORY", inventory):
+            # Wrong maxelem.
+            self.assertEqual(
+                Ipset("felix-v4-foo", "tmp", "inet").take_existing_members(),
+                None
+            )
+            self.assertEqual(
+                PackedIpset("felix-v4-empty", "tmp", IPV4,
+                            max_elem=1234).take_existing_members(),
+                set()
+            )
+            self.assertEqual(
+                PackedIpset("felix-v6-foo", "tmp", "IPv6",
+                            max_elem=1234).take_existing_members(),
+                set([ip_to_int("IPv6", "dead:beef::1")])
+            )
+            self.assertEqual(
+                Ipset("felix-v4-l:bar", "tmp", "inet", "list:set",
+                      max_elem=8).take_existing_members(),
+                set(["felix-v4-foo"])
+            )
+            # Members are only available once.
+            self.assertEqual(
+                Ipset("felix-v4-l:bar", "tmp", "inet", "list:set",
+                      max_elem=8).take_existing_members(),
+                None
+            )
+
     @patch("calico.felix.futils.check_call", autospec=True)
     def test_apply_changes(self, m_check_call):
         added = set(["10.0.0.2"])
@@ -806,6 +1364,28 @@ class TestIpset(BaseTestCase):
                       'COMMIT\n'
         )
 
+    @patch("calico.felix.futils.check_call", autospec=True)
+    def test_ensure_exists_list_set(self, m_check_call):
+        ipset = Ipset("foo", "foo-tmp", "inet", "list:set", max_elem=8)
+        ipset.ensure_exists()
+        m_check_call.assert_called_once_with(
+            ["ipset", "restore"],
+            input_str='create foo list:set size 8 --exist\n'
+                      'COMMIT\n'
+        )
+
+    @patch("calico.felix.futils.check_call", autospec=True)
+    def test_packed_ipset_apply_changes(self, m_check_call):
+        ipset = PackedIpset("foo", "foo-tmp", IPV4)
+        ipset.apply_changes(ips("10.0.0.2"), ips("10.0.0.1"))
+        self.assertEqual(
+            m_check_call.mock_calls,
+            [call(["ipset", "restore"],
+                  input_str='del foo 10.0.0.1\n'
+                            'add foo 10.0.0.2\n'
+                            'COMMIT\n')]
+        )
+
     @patch("calico.felix.futils.call_silent", autospec=True)
     def test_delete(self, m_call_silent):
         self.ipset.delete()
@@ -819,6 +1399,7 @@ class TestIpset(BaseTestCase):
 
     @patch("calico.felix.futils.check_call", autospec=True)
     def test_list_ipset_names(self, m_check_call):
-        m_check_call.return_value = CommandOutput(IPSET_LIST_OUTPUT, "")
+        m_check_call.return_value = CommandOutput(IPSET_LIST_NAME_OUTPUT, "")
         self.assertEqual(list_ipset_names(),
                          ['felix-v4-calico_net', 'felix-v6-calico_net'])
+        m_check_call.assert_called_once_with(["ipset", "list", "-name"])
@@ -25,7 +25,7 @@ import unittest2
 from mock import Mock, call, patch
 
 from calico.felix.labels import LinearScanLabelIndex, LabelValueIndex, \
-    LabelInheritanceIndex
+    LabelInheritanceIndex, InheritedLabels
 from calico.felix.selectors import parse_selector
 from calico.felix.test.base import BaseTestCase
 
@@ -251,6 +251,58 @@ class _LabelTestBase(unittest2.TestCase):
         self.assert_remove("e3", "item_3")
         self.assert_remove("e2", "item_3")
 
+    def test_inheritance_index_multiple_parents(self):
+        ii = LabelInheritanceIndex(self.index)
+        ii.on_parent_labels_update("parent_1", {"a": "p1", "b": "p1"})
+        ii.on_parent_labels_update("parent_2", {"a": "p2"})
+        ii.on_item_update("item_1", {}, ["parent_1", "parent_2"])
+        ii.on_item_update("item_2", {"b": "i2"}, ["parent_1"])
+
+        self.index.on_expression_update("e1", parse_selector("a == 'p1'"))
+        self.index.on_expression_update("e2", parse_selector("b == 'p1'"))
+        self.index.on_expression_update("e3", parse_selector("has(c)"))
+        self.index.on_expression_update("e4",
+                                        parse_selector("a in {'p1', 'p2'}"))
+        self.assert_add("e2", "item_1")
+        self.assert_add("e4", "item_1")
+        self.assert_add("e1", "item_2")
+        self.assert_add("e4", "item_2")
+        self.assert_no_updates()
+
+        # Later parent overrides the earlier one so item_1 is unaffected by
+        # this change to "a"; item_2 only has parent_1.
+        ii.on_parent_labels_update("parent_1", {"a": "p2", "b": "p1",
+                                                "c": "p1"})
+        self.assert_add("e3", "item_1")
+        self.assert_remove("e1", "item_2")
+        self.assert_add("e3", "item_2")
+        self.assert_no_updates()
+
+        # Removing the overriding parent's label exposes parent_1's.
+        ii.on_parent_labels_update("parent_1", {"a": "p1", "b": "p1",
+                                                "c": "p1"})
+        self.assert_add("e1", "item_2")
+        ii.on_parent_labels_update("parent_2", None)
+        self.assert_add("e1", "item_1")
+        self.assert_no_updates()
+
+        # Per-item labels still override after parent updates.
+        ii.on_parent_labels_update("parent_1", {"a": "p1"})
+        self.assert_remove("e2", "item_1")
+        self.assert_remove("e3", "item_1")
+        self.assert_remove("e3", "item_2")
+        self.assert_no_updates()
+
+        ii.on_item_update("item_1", None, None)
+        ii.on_item_update("item_2", None, None)
+        self.assert_remove("e1", "item_1")
+        self.assert_remove("e4", "item_1")
+        self.assert_remove("e1", "item_2")
+        self.assert_remove("e4", "item_2")
+        for expr_id in ["e1", "e2", "e3", "e4"]:
+            self.index.on_expression_update(expr_id, None)
+        self.assert_indexes_empty()
+
     def assert_indexes_empty(self):
         raise NotImplementedError()
 
@@ -290,3 +342,51 @@ class TestLabelValueIndex(TestLinearScanLabelIndex):
         self.assertFalse(self.index.item_ids_by_key_value)
         self.assertFalse(self.index.literal_exprs_by_kv)
         self.assertFalse(self.index.non_kv_expressions_by_id)
+        self.assertFalse(self.index.non_kv_expr_ids_by_label_name)
+
+    def test_parent_update_only_evaluates_affected_exprs(self):
+        ii = LabelInheritanceIndex(self.index)
+        ii.on_parent_labels_update("parent", {"a": "a1", "b": "b1"})
+        for ii_num in xrange(10):
+            ii.on_item_update("item_%s" % ii_num, {}, ["parent"])
+        self.index.on_expression_update("e1", parse_selector("has(a)"))
+        self.index.on_expression_update("e2", parse_selector("b != 'b1'"))
+        self.index.on_expression_update("e3", parse_selector("b == 'b2'"))
+        for ii_num in xrange(10):
+            self.assert_add("e1", "item_%s" % ii_num)
+        with patch.object(self.index, "_update_matches",
+                          wraps=self.index._update_matches) as m_update:
+            ii.on_parent_labels_update("parent", {"a": "a1", "b": "b2"})
+        for ii_num in xrange(10):
+            self.assert_add("e2", "item_%s" % ii_num)
+            self.assert_add("e3", "item_%s" % ii_num)
+        # Only the expressions that mention "b" are re-evaluated.
+        self.assertEqual(
+            set(c[1][0] for c in m_update.mock_calls),
+            set(["e2", "e3"])
+        )
+        self.assertEqual(len(m_update.mock_calls), 20)
+        # And the value index is updated.
+        self.assertEqual(self.index.item_ids_by_key_value.num_items(
+            ("b", "b1")), 0)
+        self.assertEqual(self.index.item_ids_by_key_value.num_items(
+            ("b", "b2")), 10)
+
+
+class TestInheritedLabels(unittest2.TestCase):
+    def test_lookup(self):
+        labels_by_parent_id = {"p1": {"a": "p1", "b": "p1"},
+                               "p2": {"a": "p2"}}
+        view = InheritedLabels({"c": "i"}, ["p1", "p2", "p3"],
+                               labels_by_parent_id)
+        self.assertEqual(view["a"], "p2")
+        self.assertEqual(view.get("b"), "p1")
+        self.assertEqual(view.get("d"), None)
+        self.assertTrue("c" in view)
+        self.assertFalse("d" in view)
+        self.assertRaises(KeyError, lambda: view["d"])
+        self.assertEqual(view, {"a": "p2", "b": "p1", "c": "i"})
+        self.assertEqual(len(view), 3)
+        # The view tracks updates to the parents.
+        labels_by_parent_id["p2"] = {"c": "p2"}
+        self.assertEqual(view, {"a": "p1", "b": "p1", "c": "i"})
@@ -0,0 +1,511 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+felix.test.test_nftables
+~~~~~~~~~~~~~~~~~~~~~~~~
+
+Tests of the nftables dataplane backend.
+"""
+from collections import OrderedDict
+import logging
+import re
+
+from mock import patch, Mock, call
+
+from calico.felix import nftables
+from calico.felix.dataplane import (
+    load_backend, IptablesBackend, NftablesBackend
+)
+from calico.felix.frules import POSTROUTING_LOCAL_NAT_FRAGMENT
+from calico.felix.futils import FailedSystemCall, IPV4, ip_to_int
+from calico.felix.ipsets import IpsetManager, RefCountedIpsetActor
+from calico.felix.nftables import (
+    translate_fragment, UnsupportedRule, VerdictMapRule, NftablesUpdater,
+    NftablesDispatchChains, NftSet, STUB_RULES
+)
+from calico.felix.test.base import BaseTestCase, load_config
+
+_log = logging.getLogger(__name__)
+
+TRANSLATION_TESTS = [
+    ("--append foo --jump ACCEPT", "filter", 4, ("foo", "accept")),
+    ("--append felix-FROM-ENDPOINT --in-interface tap+ --goto felix-from-1",
+     "filter", 4,
+     ("felix-FROM-ENDPOINT", 'iifname "tap*" goto felix-from-1')),
+    ("--append foo --match conntrack --ctstate RELATED,ESTABLISHED "
+     "--jump ACCEPT", "filter", 4,
+     ("foo", "ct state related,established accept")),
+    ("--append foo --protocol tcp --match multiport --destination-ports "
+     "80,8080:8090 --source 10.0.0.0/8 --jump RETURN", "filter", 4,
+     ("foo", "meta l4proto tcp tcp dport { 80, 8080-8090 } "
+             "ip saddr 10.0.0.0/8 return")),
+    ("--append foo --match set ! --match-set felix-v6-bar src --jump DROP "
+     '--match comment --comment "Drop it"', "filter", 6,
+     ("foo", 'ip6 saddr != @felix-v6-bar drop comment "Drop it"')),
+    ("--append foo --match set --match-set nabc dst,dst --jump DROP",
+     "filter", 4,
+     ("foo", "ip daddr . meta l4proto . th dport @nabc drop")),
+    ("--append foo --match mark --mark 0x1/0x1 --jump RETURN", "filter", 4,
+     ("foo", "meta mark & 0x1 == 0x1 return")),
+    ("--append foo --jump MARK --set-mark 0x1/0x1", "filter", 4,
+     ("foo", "meta mark set meta mark & 0xfffffffe | 0x1")),
+    ("--append foo --protocol icmp --match icmp --icmp-type 8/0 "
+     "--jump ACCEPT", "filter", 4,
+     ("foo", "meta l4proto icmp icmp type 8 icmp code 0 accept")),
+    ("--append foo --protocol ipv6-icmp --match icmp6 --icmpv6-type 130 "
+     "--jump ACCEPT", "filter", 6,
+     ("foo", "meta l4proto ipv6-icmp icmpv6 type 130 accept")),
+    ("--append foo --match mac ! --mac-source AA:BB:CC:DD:EE:FF "
+     "--jump DROP", "filter", 4,
+     ("foo", "ether saddr != aa:bb:cc:dd:ee:ff drop")),
+    ("--append felix-PREROUTING --destination 169.254.169.254/32 "
+     "--protocol tcp --dport 80 --jump DNAT --to-destination 10.0.0.1:8775",
+     "nat", 4,
+     ("felix-PREROUTING", "ip daddr 169.254.169.254/32 meta l4proto tcp "
+                          "tcp dport 80 dnat to 10.0.0.1:8775")),
+    (POSTROUTING_LOCAL_NAT_FRAGMENT, "nat", 4,
+     ("POSTROUTING", 'oifname "tunl0" fib saddr . oif type != local '
+                     'fib saddr type local masquerade')),
+    ("PREROUTING --in-interface tap+ --match rpfilter --invert "
+     "--jump felix-PREROUTING", "raw", 6,
+     ("PREROUTING", 'iifname "tap*" fib saddr . iif oif missing '
+                    'jump raw-felix-PREROUTING')),
+]
+
+UNSUPPORTED_TESTS = [
+    "--append foo --jump LOG",
+    "--append foo --match foobar --jump DROP",
+    "--append foo --dport 80 --jump DROP",
+    "--append foo --jump DNAT",
+    "--append",
+    "--append foo --comment \"unterminated",
+]
+
+
+class TestTranslation(BaseTestCase):
+    def test_translate_fragment(self):
+        for fragment, table, ip_version, expected in TRANSLATION_TESTS:
+            self.assertEqual(translate_fragment(fragment, table, ip_version),
+                             expected,
+                             "Unexpected translation of %r" % fragment)
+
+    def test_unsupported(self):
+        for fragment in UNSUPPORTED_TESTS:
+            self.assertRaises(UnsupportedRule, translate_fragment, fragment,
+                              "filter", 4)
+
+    def test_verdict_map_rule(self):
+        rule = VerdictMapRule("felix-TO-ENDPOINT", "oifname",
+                              (("tap1", "felix-to-1"), ("tap2", "felix-to-2")))
+        self.assertEqual(
+            translate_fragment(rule, "filter", 4),
+            ("felix-TO-ENDPOINT",
+             'oifname vmap { "tap1" : goto felix-to-1, '
+             '"tap2" : goto felix-to-2 }')
+        )
+
+    def test_generated_chains_translate(self):
+        """
+        Tests that everything that the default rules generator produces can
+        be translated.
+        """
+        config = load_config("felix_default.cfg", env_dict={
+            "FELIX_IPINIPENABLED": "true",
+            "FELIX_METADATAADDR": "10.0.0.1",
+        })
+        gen = config.plugins["iptables_generator"]
+        profile = {
+            "inbound_rules": [
+                {"action": "allow", "protocol": "tcp", "src_net": net,
+                 "dst_ports": [80, "1000:2000"]}
+                for net in ["10.0.1.0/24", "10.0.2.0/24", "10.0.3.0/24"]
+            ] + [
+                {"action": "deny", "protocol": "icmp", "icmp_type": 8,
+                 "icmp_code": 0, "ip_version": 4},
+                {"action": "allow", "src_tag": "tag1", "dst_net":
+                 "10.0.0.0/8"},
+            ],
+            "outbound_rules": [
+                {"action": "allow", "protocol": "udp", "src_ports": [53],
+                 "dst_selector": "a == 'b'"},
+                {"action": "next-tier"},
+            ],
+        }
+        for ip_version in (4, 6):
+            chains = []
+            if ip_version == 6:
+                chains.append(("raw",
+                               gen.raw_rpfilter_failed_chain(ip_version)))
+            chains.append(("nat", gen.nat_prerouting_chain(ip_version)))
+            chains.append(("nat", gen.nat_postrouting_chain(ip_version)))
+            chains.append(("filter", gen.filter_input_chain(ip_version,
+                                                            "hosts")))
+            chains.append(("filter", gen.filter_forward_chain(ip_version)))
+            for table, (updates, _) in chains:
+                for fragment in updates:
+                    translate_fragment(fragment, table, ip_version)
+            tiers = OrderedDict([("t1", ["p1"])])
+            for updates in [
+                    gen.endpoint_updates(ip_version, "e1", "abcd",
+                                         "aa:bb:cc:dd:ee:ff", ["prof"],
+                                         tiers)[0],
+                    gen.policy_list_updates((tiers.items(), ("prof",)))[0],
+                    gen.profile_updates("prof", profile, ip_version,
+                                        {"tag1": "ipset-tag1"},
+                                        {"a == 'b'": "ipset-sel"},
+                                        on_allow="RETURN")[0]]:
+                for fragments in updates.values():
+                    for fragment in fragments:
+                        translate_fragment(fragment, "filter", ip_version)
+
+
+class NftStub(object):
+    """
+    Stub for the nft command, tracks the chains and sets in our table and
+    checks that the chains and sets that rules refer to exist.
+    """
+    def __init__(self):
+        self.chains = {}
+        self.sets = {}
+        self.scripts = []
+
+    def execute(self, lines):
+        self.scripts.append(lines)
+        chains = dict((k, list(v)) for k, v in self.chains.iteritems())
+        sets = dict((k, set(v)) for k, v in self.sets.iteritems())
+        for line in lines:
+            self._apply_line(line, chains, sets)
+        # All good, commit the transaction.
+        self.chains = chains
+        self.sets = sets
+
+    def _apply_line(self, line, chains, sets):
+        m = re.match(r'(\w+) (\w+) (ip6?) calico(?: (\S+))?(?: (.*))?$',
+                     line)
+        assert m, "Unexpected line %r" % line
+        verb, obj, _, name, rest = m.groups()
+        if obj == "table":
+            return
+        if obj == "chain":
+            if verb == "add":
+                chains.setdefault(name, [])
+            elif verb == "flush":
+                self._check(name in chains, "No chain %s" % name)
+                chains[name] = []
+            else:
+                self._check(name in chains, "No chain %s" % name)
+                for rules in chains.values():
+                    for rule in rules:
+                        self._check(name not in nftables._rule_targets(rule),
+                                    "Chain %s in use" % name)
+                del chains[name]
+        elif obj == "rule":
+            self._check(name in chains, "No chain %s" % name)
+            for target in nftables._rule_targets(rest):
+                self._check(target in chains, "No chain %s" % target)
+            for set_name in re.findall(r'@(\S+)', rest):
+                self._check(set_name in sets, "No set %s" % set_name)
+            chains[name].append(rest)
+        elif obj == "set":
+            if verb == "add":
+                sets.setdefault(name, set())
+            else:
+                self._check(name in sets, "No set %s" % name)
+                if verb == "flush":
+                    sets[name] = set()
+                else:
+                    del sets[name]
+        else:
+            assert obj == "element"
+            self._check(name in sets, "No set %s" % name)
+            members = set(rest.strip("{} ").split(", "))
+            if verb == "add":
+                sets[name] |= members
+            else:
+                sets[name] -= members
+
+    def _check(self, condition, msg):
+        if not condition:
+            raise FailedSystemCall("Error: " + msg, ["nft"], 1, "", msg)
+
+    def list_table(self, family):
+        if not self.chains and not self.sets:
+            return None
+        lines = ["table %s calico {" % family]
+        lines += ["\tset %s {\n\t}" % s for s in sorted(self.sets)]
+        lines += ["\tchain %s {\n\t}" % c for c in sorted(self.chains)]
+        lines.append("}")
+        return "\n".join(lines)
+
+
+class NftStubTestCase(BaseTestCase):
+    def setUp(self):
+        super(NftStubTestCase, self).setUp()
+        self.stub = NftStub()
+        self.exec_patch = patch("calico.felix.nftables._execute_nft",
+                                side_effect=self.stub.execute)
+        self.m_exec = self.exec_patch.start()
+        self.list_patch = patch("calico.felix.nftables._list_table",
+                                side_effect=self.stub.list_table)
+        self.list_patch.start()
+
+    def tearDown(self):
+        self.list_patch.stop()
+        self.exec_patch.stop()
+        super(NftStubTestCase, self).tearDown()
+
+
+class TestNftablesUpdater(NftStubTestCase):
+    def setUp(self):
+        super(TestNftablesUpdater, self).setUp()
+        env_dict = {"FELIX_REFRESHINTERVAL": "0"}
+        self.config = load_config("felix_default.cfg", env_dict=env_dict)
+        self.nft = NftablesUpdater("filter", self.config, 4)
+        self.step_actor(self.nft)
+
+    def test_rewrite_chains_stub(self):
+        """
+        Tests that referencing a chain causes it to get stubbed out.
+        """
+        cb = Mock()
+        self.nft.rewrite_chains({"foo": ["--append foo --jump bar"]},
+                                {"foo": set(["bar"])},
+                                callback=cb, async=True)
+        self.step_actor(self.nft)
+        self.assertEqual(self.stub.chains,
+                         {"foo": ["jump bar"], "bar": STUB_RULES})
+        cb.assert_called_once_with(None)
+        # Programming the chain replaces the stub.
+        self.nft.rewrite_chains({"bar": ["--append bar --jump ACCEPT"]}, {},
+                                async=True)
+        self.step_actor(self.nft)
+        self.assertEqual(self.stub.chains,
+                         {"foo": ["jump bar"], "bar": ["accept"]})
+
+    def test_rewrite_unchanged_chain_skipped(self):
+        for _ in xrange(2):
+            self.nft.rewrite_chains({"foo": ["--append foo --jump ACCEPT"]},
+                                    {}, async=True)
+            self.step_actor(self.nft)
+        self.assertEqual(len(self.stub.scripts), 1)
+
+    def test_rewrite_chains_failure_callback(self):
+        self.m_exec.side_effect = FailedSystemCall("Message", [], 1, "", "")
+        cb = Mock()
+        f = self.nft.rewrite_chains({"foo": ["--append foo --jump ACCEPT"]},
+                                    {}, callback=cb, async=True)
+        self.step_actor(self.nft)
+        self.assertEqual(cb.mock_calls, [call(self.m_exec.side_effect)])
+        self.assertEqual(f.get(), None)
+
+        f = self.nft.rewrite_chains({"foo": ["--append foo --jump ACCEPT"]},
+                                    {}, async=True)
+        self.step_actor(self.nft)
+        self.assertRaises(FailedSystemCall, f.get)
+        self.assertEqual(self.nft._programmed_chains, {})
+
+    def test_untranslatable_rewrite(self):
+        cb = Mock()
+        self.nft.rewrite_chains({"foo": ["--append foo --jump LOG"]},
+                                {}, callback=cb, async=True)
+        self.step_actor(self.nft)
+        self.assertTrue(isinstance(cb.call_args[0][0], UnsupportedRule))
+        self.assertEqual(self.stub.scripts, [])
+
+    def test_delete_chains(self):
+        self.nft.rewrite_chains({"foo": ["--append foo --jump bar"],
+                                 "bar": ["--append bar --jump ACCEPT"],
+                                 "baz": ["--append baz --jump DROP"]},
+                                {}, async=True)
+        self.step_actor(self.nft)
+        cb = Mock()
+        self.nft.delete_chains(["bar", "baz"], callback=cb, async=True)
+        self.step_actor(self.nft)
+        # bar is still required so it gets stubbed rather than deleted.
+        self.assertEqual(self.stub.chains,
+                         {"foo": ["jump bar"], "bar": STUB_RULES})
+        cb.assert_called_once_with(None)
+        self.nft.delete_chains(["foo"], async=True)
+        self.step_actor(self.nft)
+        self.assertEqual(self.stub.chains, {})
+        self.assertEqual(self.nft._stub_chains, set())
+
+    def test_ensure_rule_inserted_and_removed(self):
+        self.nft.rewrite_chains({"felix-INPUT": ["--append felix-INPUT "
+                                                 "--jump ACCEPT"]},
+                                {}, async=True)
+        self.nft.ensure_rule_inserted("INPUT --jump felix-INPUT", async=True)
+        self.step_actor(self.nft)
+        self.assertEqual(self.stub.chains["INPUT"], ["jump felix-INPUT"])
+        self.assertTrue(
+            "add chain ip calico INPUT { type filter hook input priority 0; "
+            "policy accept; }" in self.stub.scripts[-1]
+        )
+        self.nft.ensure_rule_inserted("INPUT --jump DROP", async=True)
+        self.step_actor(self.nft)
+        self.assertEqual(self.stub.chains["INPUT"],
+                         ["drop", "jump felix-INPUT"])
+        self.nft.ensure_rule_removed("INPUT --jump felix-INPUT", async=True)
+        self.step_actor(self.nft)
+        self.assertEqual(self.stub.chains["INPUT"], ["drop"])
+
+    def test_insert_into_unknown_chain(self):
+        f = self.nft.ensure_rule_inserted("FOO --jump DROP", async=True)
+        self.step_actor(self.nft)
+        self.assertRaises(UnsupportedRule, f.get)
+
+    def test_nat_table(self):
+        nat = NftablesUpdater("nat", self.config, 4)
+        self.step_actor(nat)
+        nat.rewrite_chains({"felix-POSTROUTING": [
+            "--append felix-POSTROUTING --out-interface tap+ "
+            "--jump MASQUERADE"]}, {}, async=True)
+        nat.ensure_rule_inserted("POSTROUTING --jump felix-POSTROUTING",
+                                 async=True)
+        self.step_actor(nat)
+        self.assertEqual(self.stub.chains, {
+            "nat-felix-POSTROUTING": ['oifname "tap*" masquerade'],
+            "nat-POSTROUTING": ["jump nat-felix-POSTROUTING"],
+        })
+
+    def test_cleanup(self):
+        self.stub.chains = {"felix-old": ["jump felix-old-2"],
+                            "felix-old-2": [],
+                            "other": [],
+                            "nat-felix-PREROUTING": []}
+        self.nft.rewrite_chains({"felix-foo": ["--append felix-foo "
+                                               "--jump ACCEPT"]},
+                                {}, async=True)
+        self.nft.cleanup(async=True)
+        self.step_actor(self.nft)
+        self.assertEqual(self.stub.chains, {"felix-foo": ["accept"],
+                                            "other": [],
+                                            "nat-felix-PREROUTING": []})
+
+    def test_cleanup_refreshes_missing_chains(self):
+        self.nft.rewrite_chains({"felix-foo": ["--append felix-foo "
+                                               "--jump ACCEPT"]},
+                                {}, async=True)
+        self.step_actor(self.nft)
+        # Someone else deletes our chain.
+        self.stub.chains = {}
+        self.nft.cleanup(async=True)
+        self.step_actor(self.nft)
+        self.assertEqual(self.stub.chains, {"felix-foo": ["accept"]})
+
+    def test_failed_delete_retried_per_chain(self):
+        self.stub.chains = {"felix-old": [], "felix-old-2": [],
+                            "other": ["jump felix-old"]}
+        self.nft.cleanup(async=True)
+        self.step_actor(self.nft)
+        self.assertEqual(self.stub.chains,
+                         {"felix-old": [], "other": ["jump felix-old"]})
+
+    def test_refresh(self):
+        self.nft.rewrite_chains({"foo": ["--append foo --jump bar"]}, {},
+                                async=True)
+        self.step_actor(self.nft)
+        self.stub.chains = {}
+        self.nft.refresh_iptables(async=True)
+        self.step_actor(self.nft)
+        self.assertEqual(self.stub.chains,
+                         {"foo": ["jump bar"], "bar": STUB_RULES})
+
+
+class TestNftablesDispatchChains(BaseTestCase):
+    def test_calculate_update(self):
+        config = load_config("felix_default.cfg")
+        dispatch = NftablesDispatchChains(config, 4, Mock())
+        to_delete, deps, updates, leaves = dispatch._calculate_update(
+            set(["tapa", "tapb"])
+        )
+        self.assertEqual(to_delete, set())
+        self.assertEqual(leaves, set())
+        self.assertEqual(updates["felix-FROM-ENDPOINT"], [
+            VerdictMapRule("felix-FROM-ENDPOINT", "iifname",
+                           (("tapa", "felix-from-a"),
+                            ("tapb", "felix-from-b"))),
+            '--append felix-FROM-ENDPOINT --jump DROP -m comment '
+            '--comment "From unknown endpoint"',
+        ])
+        self.assertEqual(deps["felix-TO-ENDPOINT"],
+                         set(["felix-to-a", "felix-to-b"]))
+        # No interfaces, no map.
+        _, deps, updates, _ = dispatch._calculate_update(set())
+        self.assertEqual(len(updates["felix-TO-ENDPOINT"]), 1)
+        self.assertEqual(deps["felix-TO-ENDPOINT"], set())
+
+
+class TestNftSet(NftStubTestCase):
+    def test_replace_and_apply_changes(self):
+        nft_set = NftSet("felix-v4-foo", "felix-tmp-v4-foo", "inet")
+        nft_set.replace_members(["10.0.0.1", ip_to_int(IPV4, "10.0.0.2")])
+        self.assertEqual(self.stub.sets["felix-v4-foo"],
+                         set(["10.0.0.1", "10.0.0.2"]))
+        self.assertTrue(nft_set.exists())
+        nft_set.apply_changes(["10.0.0.3"], ["10.0.0.1"])
+        self.assertEqual(self.stub.sets["felix-v4-foo"],
+                         set(["10.0.0.2", "10.0.0.3"]))
+        self.assertEqual(NftSet.list_names(IPV4), ["felix-v4-foo"])
+        nft_set.delete()
+        self.assertEqual(self.stub.sets, {})
+        self.assertFalse(nft_set.exists())
+        # Second delete is ignored.
+        nft_set.delete()
+
+    def test_net_port_set(self):
+        nft_set = NftSet("nabc", "nabc-tmp", "inet", "hash:net,port")
+        nft_set.replace_members(["10.0.0.0/24,tcp:80"])
+        self.assertEqual(self.stub.sets["nabc"],
+                         set(["10.0.0.0/24 . tcp . 80"]))
+        self.assertTrue("flags interval" in self.stub.scripts[-1][1])
+        self.assertTrue(nft_set.supports_deltas)
+
+    def test_net_set_no_deltas(self):
+        # Overlapping CIDRs get merged so they can't be deleted one by one.
+        nft_set = NftSet("nabc", "nabc-tmp", "inet", "hash:net")
+        self.assertFalse(nft_set.supports_deltas)
+        self.assertRaises(AssertionError, nft_set.apply_changes,
+                          ["10.0.0.0/8"], [])
+        self.assertTrue(NftSet("nabc", "nabc-tmp", "inet").supports_deltas)
+
+    def test_element_chunking(self):
+        nft_set = NftSet("felix-v4-foo", "felix-tmp-v4-foo", "inet")
+        nft_set.ensure_exists()
+        nft_set.apply_changes(range(1, 2501), [])
+        self.assertEqual(len(self.stub.scripts[-1]), 3)
+        self.assertEqual(len(self.stub.sets["felix-v4-foo"]), 2500)
+
+    def test_unsupported_type(self):
+        self.assertRaises(ValueError, NftSet, "foo", "foo-tmp", "inet",
+                          "list:set")
+
+
+class TestBackends(BaseTestCase):
+    def test_load_backend(self):
+        config = load_config("felix_default.cfg")
+        self.assertTrue(isinstance(load_backend(config), IptablesBackend))
+        config = load_config("felix_default.cfg",
+                             env_dict={"FELIX_DATAPLANEBACKEND": "nftables"})
+        backend = load_backend(config)
+        self.assertTrue(isinstance(backend, NftablesBackend))
+        self.assertTrue(isinstance(backend.hosts_ipset_v4, NftSet))
+
+    def test_unshared_ipsets(self):
+        config = load_config("felix_default.cfg")
+        mgr = IpsetManager(IPV4, config, ipset_cls=NftSet)
+        actor = mgr._create("tag1")
+        self.assertEqual(type(actor), RefCountedIpsetActor)
+        self.assertTrue(isinstance(actor._ipset, NftSet))
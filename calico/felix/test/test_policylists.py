@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+test_policylists
+~~~~~~~~~~~~~~~~
+
+Tests for the policylists module.
+"""
+
+import logging
+from collections import OrderedDict
+
+from mock import Mock, call, ANY, patch
+
+from calico.datamodel_v1 import TieredPolicyId
+from calico.felix.fiptables import IptablesUpdater
+from calico.felix.futils import FailedSystemCall
+from calico.felix.policylists import (
+    PolicyListManager, PolicyListChains, policy_list_id
+)
+from calico.felix.test.base import BaseTestCase, load_config
+
+_log = logging.getLogger(__name__)
+
+TIERS = OrderedDict([("t1", [TieredPolicyId("t1", "p1"),
+                             TieredPolicyId("t1", "p2")])])
+POL_LIST_ID = policy_list_id(TIERS, ["prof1"])
+
+
+class TestPolicyListId(BaseTestCase):
+    def test_policy_list_id(self):
+        self.assertEqual(
+            POL_LIST_ID,
+            ((("t1", (TieredPolicyId("t1", "p1"),
+                      TieredPolicyId("t1", "p2"))),),
+             ("prof1",))
+        )
+        # Hashable.
+        self.assertEqual(set([POL_LIST_ID]),
+                         set([policy_list_id(TIERS, ["prof1"])]))
+        self.assertNotEqual(POL_LIST_ID, policy_list_id(TIERS, []))
+
+
+class TestPolicyListManager(BaseTestCase):
+    def setUp(self):
+        super(TestPolicyListManager, self).setUp()
+        self.config = load_config("felix_default.cfg")
+        self.m_updater = Mock(spec=IptablesUpdater)
+        self.mgr = PolicyListManager(self.config, 4, self.m_updater)
+
+    def test_create(self):
+        pl = self.mgr._create(POL_LIST_ID)
+        self.assertEqual(pl.id, POL_LIST_ID)
+        self.assertEqual(pl.ip_version, 4)
+        self.assertEqual(pl._iptables_updater, self.m_updater)
+
+    def test_on_object_started(self):
+        m_pl = Mock(spec=PolicyListChains)
+        self.mgr._on_object_started(POL_LIST_ID, m_pl)
+        self.assertEqual(m_pl.program_chains.mock_calls,
+                         [call(async=True)])
+
+
+class TestPolicyListChains(BaseTestCase):
+    def setUp(self):
+        super(TestPolicyListChains, self).setUp()
+        self.config = load_config("felix_default.cfg")
+        self.ipt_gen = self.config.plugins["iptables_generator"]
+        self.m_mgr = Mock(spec=PolicyListManager)
+        self.m_updater = Mock(spec=IptablesUpdater)
+        self.pl = PolicyListChains(self.ipt_gen, POL_LIST_ID, 4,
+                                   self.m_updater)
+        self.pl._manager = self.m_mgr
+        self.pl._id = POL_LIST_ID
+
+    def test_program_chains(self):
+        self.pl.program_chains(async=True)
+        self.step_actor(self.pl)
+        updates, deps = self.ipt_gen.policy_list_updates(POL_LIST_ID)
+        self.m_updater.rewrite_chains.assert_called_once_with(
+            updates, deps, callback=ANY, nowait=True
+        )
+        self.m_mgr.on_object_startup_complete.assert_called_once_with(
+            POL_LIST_ID, self.pl, async=True
+        )
+        callback = self.m_updater.rewrite_chains.call_args[1]["callback"]
+        callback(None)
+        self.step_actor(self.pl)
+        self.assertEqual(self.m_updater.rewrite_chains.call_count, 1)
+
+    @patch("gevent.spawn_later", autospec=True)
+    def test_program_chains_retry(self, m_spawn_later):
+        self.pl.program_chains(async=True)
+        self.step_actor(self.pl)
+        updates, deps = self.ipt_gen.policy_list_updates(POL_LIST_ID)
+        # The first rewrite fails, so a retry gets scheduled.
+        callback = self.m_updater.rewrite_chains.call_args[1]["callback"]
+        callback(FailedSystemCall("fail", [], 1, "", ""))
+        self.step_actor(self.pl)
+        self.assertEqual(m_spawn_later.mock_calls,
+                         [call(ANY, self.pl._on_retry_timer, async=True)])
+        self.assertTrue(0.9 <= m_spawn_later.call_args[0][0] <= 1.1)
+        # When the timer pops, the chains are programmed again.
+        self.pl._on_retry_timer(async=True)
+        self.step_actor(self.pl)
+        self.assertEqual(self.m_updater.rewrite_chains.mock_calls,
+                         [call(updates, deps, callback=ANY, nowait=True)] * 2)
+        callback = self.m_updater.rewrite_chains.call_args[1]["callback"]
+        callback(None)
+        self.step_actor(self.pl)
+        self.assertFalse(self.pl._dirty)
+        self.assertEqual(m_spawn_later.call_count, 1)
+
+    @patch("gevent.spawn_later", autospec=True)
+    def test_no_retry_after_unreferenced(self, m_spawn_later):
+        self.pl.program_chains(async=True)
+        self.step_actor(self.pl)
+        callback = self.m_updater.rewrite_chains.call_args[1]["callback"]
+        callback(FailedSystemCall("fail", [], 1, "", ""))
+        self.step_actor(self.pl)
+        self.pl.on_unreferenced(async=True)
+        self.step_actor(self.pl)
+        self.pl._on_retry_timer(async=True)
+        self.step_actor(self.pl)
+        self.assertEqual(self.m_updater.rewrite_chains.call_count, 1)
+
+    def test_unreferenced(self):
+        self.pl.on_unreferenced(async=True)
+        self.step_actor(self.pl)
+        self.m_updater.delete_chains.assert_called_once_with(
+            self.ipt_gen.policy_list_chain_names(POL_LIST_ID),
+            callback=ANY, nowait=True
+        )
+        # Cleanup only completes once the chains are gone.
+        self.assertFalse(self.m_mgr.on_object_cleanup_complete.called)
+        callback = self.m_updater.delete_chains.call_args[1]["callback"]
+        callback(None)
+        self.step_actor(self.pl)
+        self.m_mgr.on_object_cleanup_complete.assert_called_once_with(
+            POL_LIST_ID, self.pl, async=True
+        )
+
+    def test_unreferenced_delete_fails(self):
+        self.pl.on_unreferenced(async=True)
+        self.step_actor(self.pl)
+        callback = self.m_updater.delete_chains.call_args[1]["callback"]
+        callback(FailedSystemCall("fail", [], 1, "", ""))
+        self.step_actor(self.pl)
+        self.m_mgr.on_object_cleanup_complete.assert_called_once_with(
+            POL_LIST_ID, self.pl, async=True
+        )
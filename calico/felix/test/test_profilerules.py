@@ -22,11 +22,11 @@ Tests for the profilerules module.
 import logging
 
 from calico.felix.selectors import parse_selector, SelectorExpression
-from mock import Mock, call, patch
+from mock import Mock, call, patch, ANY
 from calico.felix import refcount
 from calico.felix.fiptables import IptablesUpdater
 from calico.felix.futils import FailedSystemCall
-from calico.felix.ipsets import IpsetManager, RefCountedIpsetActor
+from calico.felix.ipsets import IpsetManager, RefCountedIpsetActor, NetSetId
 from calico.felix.profilerules import ProfileRules, RulesManager
 
 from calico.felix.test.base import BaseTestCase, load_config
@@ -221,6 +221,9 @@ class TestProfileRules(BaseTestCase):
 
         self.m_mgr = Mock(spec=RulesManager)
         self.m_ipt_updater = Mock(spec=IptablesUpdater)
+        self.m_ipt_updater.rewrite_chains.side_effect = self._record_ipt_cb
+        self.m_ipt_updater.delete_chains.side_effect = self._record_ipt_cb
+        self.ipt_callbacks = []
         self.m_ips_mgr = Mock(spec=IpsetManager)
         self.rules = ProfileRules(self.config.plugins["iptables_generator"],
                                   "prof1", 4, self.m_ipt_updater,
@@ -246,7 +249,12 @@ class TestProfileRules(BaseTestCase):
         # Got all the tags, should no longer be dirty.
         self.assertFalse(self.rules._dirty)
         self.m_ipt_updater.rewrite_chains.assert_called_once_with(
-            RULES_1_CHAINS, {}, async=False)
+            RULES_1_CHAINS, {}, callback=ANY, nowait=True)
+        self.assertTrue(self.rules._iptables_in_flight)
+        self._complete_ipt_updates()
+        self.assertFalse(self.rules._iptables_in_flight)
+        self.assertEqual(self.rules._ipset_refs.required_refs,
+                         expected_tags)
         # Should have called back to the manager.
         self.m_mgr.on_object_startup_complete("prof1",
                                               self.rules,
@@ -263,8 +271,9 @@ class TestProfileRules(BaseTestCase):
         self.step_actor(self.rules)
         expected_tags = set(["src-tag", "dst-tag"])
         self._process_ipset_refs(expected_tags)
+        self._complete_ipt_updates()
         self.m_ipt_updater.rewrite_chains.assert_called_once_with(
-            RULES_1_CHAINS, {}, async=False)
+            RULES_1_CHAINS, {}, callback=ANY, nowait=True)
         # Should have called back to the manager.
         self.m_mgr.on_object_startup_complete("prof1",
                                               self.rules,
@@ -278,13 +287,14 @@ class TestProfileRules(BaseTestCase):
         self.rules.on_profile_update(RULES_1, async=True)
         self.step_actor(self.rules)
         self._process_ipset_refs(set(["src-tag", "dst-tag"]))
+        self._complete_ipt_updates()
 
         self.rules.on_profile_update(RULES_1, async=True)
         self.step_actor(self.rules)
         self._process_ipset_refs(set([]))
 
         self.m_ipt_updater.rewrite_chains.assert_called_once_with(
-            RULES_1_CHAINS, {}, async=False)
+            RULES_1_CHAINS, {}, callback=ANY, nowait=True)
 
     def test_idempotent_update_transient_ipt_error(self):
         """
@@ -292,24 +302,25 @@ class TestProfileRules(BaseTestCase):
         updates that would normally be squashed trigger a reprogram.
         """
         # First update fails.
-        self.m_ipt_updater.rewrite_chains.side_effect = \
-            FailedSystemCall("fail", ["foo"], 1, "", "")
         self.rules.on_profile_update(RULES_1, async=True)
         self.step_actor(self.rules)
         self._process_ipset_refs(set(["src-tag", "dst-tag"])) # Steps actor.
+        self._complete_ipt_updates(FailedSystemCall("fail", ["foo"], 1, "",
+                                                    ""))
+        # Failure should leave ProfileRules dirty but it shouldn't retry
+        # until it gets another update.
         self.m_ipt_updater.rewrite_chains.assert_called_once_with(
-            RULES_1_CHAINS, {}, async=False)
-        # Failure should leave ProfileRules dirty.
+            RULES_1_CHAINS, {}, callback=ANY, nowait=True)
         self.assertTrue(self.rules._dirty)
 
         # Second update should trigger retry.
         self.m_ipt_updater.reset_mock()
-        self.m_ipt_updater.rewrite_chains.side_effect = None
         self.rules.on_profile_update(RULES_1, async=True)
         self.step_actor(self.rules)
         self._process_ipset_refs(set([]))
         self.m_ipt_updater.rewrite_chains.assert_called_once_with(
-            RULES_1_CHAINS, {}, async=False)
+            RULES_1_CHAINS, {}, callback=ANY, nowait=True)
+        self._complete_ipt_updates()
         # Success clears dirty flag.
         self.assertFalse(self.rules._dirty)
 
@@ -318,37 +329,34 @@ class TestProfileRules(BaseTestCase):
         Test that the dirty flag is left set if a delete fails.  Future
         deletes that would normally be squashed trigger a retry.
         """
-        # First delete fails.
         self.rules.on_profile_update(RULES_1, async=True)
         self.step_actor(self.rules)
         self._process_ipset_refs(set(["dst-tag", "src-tag"]))
-        self.m_ipt_updater.delete_chains.side_effect = \
-            FailedSystemCall("fail", ["foo"], 1, "", "")
+        self._complete_ipt_updates()
+
+        # First delete fails.
         self.rules.on_profile_update(None, async=True)
-        real_discard_all = self.rules._ipset_refs.discard_all
-        with patch.object(self.rules._ipset_refs, "discard_all",
-                          wraps=real_discard_all) as m_discard:
-            self.step_actor(self.rules)
-        # Failure should prevent freeing of ipset refs.
-        self.assertEqual(m_discard.mock_calls, [])
-        self._process_ipset_refs(set([]))
+        self.step_actor(self.rules)
         self.m_ipt_updater.delete_chains.assert_called_once_with(
-            set(RULES_1_CHAINS.keys()), async=False)
+            set(RULES_1_CHAINS.keys()), callback=ANY, nowait=True)
+        self._complete_ipt_updates(FailedSystemCall("fail", ["foo"], 1, "",
+                                                    ""))
+        # Failure should prevent freeing of ipset refs.
+        self.assertEqual(self.rules._ipset_refs.required_refs,
+                         set(["dst-tag", "src-tag"]))
         # Failure should leave ProfileRules dirty.
         self.assertTrue(self.rules._dirty)
 
         # Update should trigger retry even though there was no change
         # of data.
         self.m_ipt_updater.reset_mock()
-        self.m_ipt_updater.delete_chains.side_effect = None
         self.rules.on_profile_update(None, async=True)
-        with patch.object(self.rules._ipset_refs, "discard_all",
-                          wraps=real_discard_all) as m_discard:
-            self.step_actor(self.rules)
-        self.assertEqual(m_discard.mock_calls, [call()])
-        self._process_ipset_refs(set([]))
+        self.step_actor(self.rules)
         self.m_ipt_updater.delete_chains.assert_called_once_with(
-            set(RULES_1_CHAINS.keys()), async=False)
+            set(RULES_1_CHAINS.keys()), callback=ANY, nowait=True)
+        self._complete_ipt_updates()
+        self.assertEqual(self.rules._ipset_refs.required_refs, set())
+        self._process_ipset_refs(set([]))
         # Successful delete leaves profile clean.
         self.assertFalse(self.rules._dirty)
 
@@ -369,13 +377,68 @@ class TestProfileRules(BaseTestCase):
         # But the ref helper will already have sent an incref for "src-tag".
         self._process_ipset_refs(expected_tags | set(["src-tag"]))
         self.m_ipt_updater.rewrite_chains.assert_called_once_with(
-            RULES_2_CHAINS, {}, async=False)
-        # Processing the ipset refs triggers iptables update, which triggers
-        # tag to be freed.
+            RULES_2_CHAINS, {}, callback=ANY, nowait=True)
+        self.assertEqual(self.rules._ipset_refs.required_refs,
+                         expected_tags)
+        # Completing the iptables update triggers tag to be freed.
+        self._complete_ipt_updates()
         expected_tags = set(["src-tag-added", "dst-tag", SELECTOR_1])
         self.assertEqual(self.rules._ipset_refs.required_refs,
                          expected_tags)
 
+    def test_update_while_in_flight(self):
+        """
+        Test that an update received while iptables is being programmed is
+        held back until the first update completes and that the ipsets
+        needed by both stay referenced.
+        """
+        self.rules.on_profile_update(RULES_1, async=True)
+        self.step_actor(self.rules)
+        self._process_ipset_refs(set(["src-tag", "dst-tag"]))
+        self.m_ipt_updater.rewrite_chains.assert_called_once_with(
+            RULES_1_CHAINS, {}, callback=ANY, nowait=True)
+
+        self.m_ipt_updater.reset_mock()
+        self.rules.on_profile_update(RULES_2, async=True)
+        self.step_actor(self.rules)
+        self._process_ipset_refs(set(["src-tag-added", SELECTOR_1]))
+        self.assertFalse(self.m_ipt_updater.rewrite_chains.called)
+
+        # Completing the first update releases nothing since "src-tag" is
+        # still in the dataplane, then sends the second update.
+        self._complete_ipt_updates()
+        self.assertEqual(self.rules._ipset_refs.required_refs,
+                         set(["src-tag", "src-tag-added", "dst-tag",
+                              SELECTOR_1]))
+        self.m_ipt_updater.rewrite_chains.assert_called_once_with(
+            RULES_2_CHAINS, {}, callback=ANY, nowait=True)
+        self._complete_ipt_updates()
+        self.assertEqual(self.rules._ipset_refs.required_refs,
+                         set(["src-tag-added", "dst-tag", SELECTOR_1]))
+        self.assertFalse(self.rules._dirty)
+
+    def test_collapsed_rules(self):
+        """
+        Test that the ipsets used to collapse runs of similar rules are
+        acquired and used to program the chains.
+        """
+        profile = {
+            "inbound_rules": [{"src_net": "10.0.%s.0/24" % ii}
+                              for ii in xrange(4)],
+        }
+        net_set = NetSetId("hash:net",
+                           frozenset("10.0.%s.0/24" % ii for ii in xrange(4)))
+        self.rules.on_profile_update(profile, async=True)
+        self.step_actor(self.rules)
+        self._process_ipset_refs(set([net_set]))
+        updates = self.m_ipt_updater.rewrite_chains.call_args[0][0]
+        self.assertEqual(updates["felix-p-prof1-i"][1],
+                         "--append felix-p-prof1-i --match set "
+                         "--match-set net-set-name src --jump RETURN")
+        self._complete_ipt_updates()
+        self.assertEqual(self.rules._ipset_refs.required_refs,
+                         set([net_set]))
+
     def test_early_unreferenced(self):
         """
         Test shutdown with tag references in flight.
@@ -384,15 +447,20 @@ class TestProfileRules(BaseTestCase):
         self.rules.on_profile_update(RULES_1, async=True)
         self.rules.on_unreferenced(async=True)
         self.step_actor(self.rules)
+        self.m_ipt_updater.delete_chains.assert_called_once_with(
+            set(['felix-p-prof1-i', 'felix-p-prof1-o']), callback=ANY,
+            nowait=True
+        )
+        # Shouldn't clean up until the chains are gone.
+        self.assertFalse(self.rules._cleaned_up)
+        self._complete_ipt_updates()
+        self.assertTrue(self.rules._cleaned_up)
         self.assertTrue(self.rules._ipset_refs is None)
         self.assertEqual(ref_helper.required_refs, set())
         # Early on_unreferenced should have prevented any ipset requests.
         self._process_ipset_refs(set([]))
         self.assertFalse(self.m_ips_mgr.decref.called)
         self.assertTrue(self.rules._dead)
-        self.m_ipt_updater.delete_chains.assert_called_once_with(
-            set(['felix-p-prof1-i', 'felix-p-prof1-o']), async=False
-        )
         # Further calls should be ignored
         self.m_ipt_updater.reset_mock()
         self.rules.on_unreferenced(async=True)
@@ -409,9 +477,17 @@ class TestProfileRules(BaseTestCase):
         # Tag updates come in before unreferenced.
         self._process_ipset_refs(set(["src-tag", "dst-tag"]))
 
-        # Then simulate a deletion.
+        # Then simulate a deletion while the update is in flight.
         self.rules.on_unreferenced(async=True)
         self.step_actor(self.rules)
+        self.assertFalse(self.m_ipt_updater.delete_chains.called)
+        self._complete_ipt_updates()
+        self.m_ipt_updater.delete_chains.assert_called_once_with(
+            set(['felix-p-prof1-i', 'felix-p-prof1-o']), callback=ANY,
+            nowait=True
+        )
+        self.assertFalse(self.m_ips_mgr.decref.called)
+        self._complete_ipt_updates()
 
         self.assertTrue(self.rules._ipset_refs is None)
         self.assertEqual(ref_helper.required_refs, set())
@@ -420,9 +496,6 @@ class TestProfileRules(BaseTestCase):
             [call("src-tag", async=True), call("dst-tag", async=True)],
             any_order=True
         )
-        self.m_ipt_updater.delete_chains.assert_called_once_with(
-            set(['felix-p-prof1-i', 'felix-p-prof1-o']), async=False
-        )
 
     def test_immediate_deletion(self):
         """
@@ -432,13 +505,15 @@ class TestProfileRules(BaseTestCase):
         self.rules.on_profile_update(None, async=True)
         self.rules.on_unreferenced(async=True)
         self.step_actor(self.rules)
+        self._complete_ipt_updates()
         self.assertTrue(self.rules._ipset_refs is None)
         self.assertEqual(ref_helper.required_refs, set())
         # Should never have acquired any refs.
         self._process_ipset_refs(set())
         self.assertTrue(self.rules._dead)
         self.m_ipt_updater.delete_chains.assert_called_once_with(
-            set(['felix-p-prof1-i', 'felix-p-prof1-o']), async=False
+            set(['felix-p-prof1-i', 'felix-p-prof1-o']), callback=ANY,
+            nowait=True
         )
 
     def test_update_chains_no_pending(self):
@@ -449,6 +524,22 @@ class TestProfileRules(BaseTestCase):
                                      "called with no _pending_profile"):
             self.rules._update_chains()
 
+    def _record_ipt_cb(self, *args, **kwargs):
+        self.ipt_callbacks.append(kwargs["callback"])
+
+    def _complete_ipt_updates(self, error=None):
+        """
+        Calls back the ProfileRules for each iptables update it has sent,
+        as the IptablesUpdater would once they've been applied.
+
+        Steps the actor as a side-effect.
+        """
+        callbacks = self.ipt_callbacks
+        self.ipt_callbacks = []
+        for callback in callbacks:
+            callback(error)
+        self.step_actor(self.rules)
+
     def _process_ipset_refs(self, expected_tags):
         """
         Issues callbacks for all the mock calls to the mock ipset manager's
@@ -466,6 +557,8 @@ class TestProfileRules(BaseTestCase):
             m_ipset = Mock(spec=RefCountedIpsetActor)
             if obj_id == SELECTOR_1:
                 m_ipset.ipset_name = "selector-1-name"
+            elif isinstance(obj_id, NetSetId):
+                m_ipset.ipset_name = "net-set-name"
             else:
                 m_ipset.ipset_name = obj_id + "-name"
             callback(obj_id, m_ipset)
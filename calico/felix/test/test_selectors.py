@@ -19,19 +19,113 @@ test_selectors
 Tests for the label selectors.
 """
 
+import gc
 import logging
 import re
+from weakref import WeakValueDictionary
 
 from hypothesis import given
 from hypothesis.strategies import text, lists, sampled_from
+from mock import patch
 from nose.tools import *
-from calico.felix.selectors import (parse_selector, SelectorExpression,
-                                    BadSelector, ExprNode)
+from pyparsing import (QuotedString, Word, Forward, Suppress,
+                       StringEnd, delimitedList, ParseBaseException,
+                       ZeroOrMore, Keyword)
+
+from calico.calcollections import LRUCache
+from calico.datamodel_v1 import LABEL_CHARS
+from calico.felix.selectors import (
+    parse_selector, SelectorExpression, BadSelector, ExprNode, LabelNode,
+    HasNode, LiteralNode, SetLiteralNode, LabelToLiteralEqualityNode,
+    InequalityNode, LabelInSetLiteralNode, NotInNode, AndNode, OrNode, ALL_OP,
+    _parse_no_cache
+)
 from calico.test.utils import fail_if_time_exceeds
 
 _log = logging.getLogger(__name__)
 
 
+def _define_reference_grammar():
+    """
+    Creates the pyparsing grammar that the selector parser replaced.  Used
+    to check that the parser produces the same trees.
+    """
+    def simplify(node_cls):
+        def parse_action(tokens):
+            if len(tokens) == 1:
+                return tokens[0]
+            return node_cls(tokens.asList())
+        return parse_action
+
+    expr = Forward()
+
+    label_name = Word(LABEL_CHARS)
+    label_name.setParseAction(lambda t: LabelNode(t[0]))
+
+    string_literal = QuotedString('"') | QuotedString("'")
+    string_literal.setParseAction(lambda t: LiteralNode(t[0]))
+
+    set_literal = (Suppress("{") +
+                   delimitedList(QuotedString('"') | QuotedString("'"), ",") +
+                   Suppress("}"))
+    set_literal.setParseAction(lambda t: SetLiteralNode(t))
+
+    eq_comparison = label_name + Suppress("==") + string_literal
+    eq_comparison.setParseAction(
+        lambda t: LabelToLiteralEqualityNode(t[0].label_name, t[1].value)
+    )
+
+    not_eq_comparison = label_name + Suppress("!=") + string_literal
+    not_eq_comparison.setParseAction(lambda t: InequalityNode(t[0], t[1]))
+
+    in_comparison = label_name + Suppress(Keyword("in")) + set_literal
+    in_comparison.setParseAction(
+        lambda t: LabelInSetLiteralNode(t[0].label_name, t[1].value)
+    )
+
+    not_in = Suppress(Keyword("not") + Keyword("in"))
+    not_in_comparison = label_name + not_in + set_literal
+    not_in_comparison.setParseAction(lambda t: NotInNode(t[0], t[1]))
+
+    has_check = (Suppress("has(") +
+                 Word(LABEL_CHARS) +
+                 Suppress(")"))
+    has_check.setParseAction(lambda t: HasNode(t[0]))
+
+    comparison = (eq_comparison |
+                  not_eq_comparison |
+                  in_comparison |
+                  not_in_comparison |
+                  has_check)
+
+    paren_expr = (Suppress("(") + expr + Suppress(")"))
+
+    value = comparison | paren_expr
+
+    and_expr = value + ZeroOrMore(Suppress("&&") + value)
+    and_expr.setParseAction(simplify(AndNode))
+
+    or_expr = and_expr + ZeroOrMore(Suppress("||") + and_expr)
+    or_expr.setParseAction(simplify(OrNode))
+
+    expr << or_expr
+
+    return expr + StringEnd()
+
+
+_reference_grammar = _define_reference_grammar()
+
+
+def _reference_parse(expr_str):
+    if expr_str.strip() in ("", "all()"):
+        return SelectorExpression(ALL_OP)
+    try:
+        [expr_op] = _reference_grammar.parseString(expr_str)
+    except ParseBaseException:
+        raise BadSelector(expr_str)
+    return SelectorExpression(expr_op)
+
+
 # These tests use nose's test generator feature to generate a set of tests that
 # can each pass or fail independently.
 
@@ -96,6 +190,18 @@ def test_prereq_values():
     yield check_prereqs, "a == 'a1' || a == 'a1'", [("a", "a1")]
 
 
+def test_label_names():
+    yield check_label_names, "a == 'a1'", ["a"]
+    yield check_label_names, "a != 'a1'", ["a"]
+    yield check_label_names, 'a in {"a1", "b1"}', ["a"]
+    yield check_label_names, 'a not in {"a1", "b1"}', ["a"]
+    yield check_label_names, 'has(a)', ["a"]
+    yield check_label_names, 'all()', []
+    yield check_label_names, "a == 'a1' && has(b)", ["a", "b"]
+    yield check_label_names, "(a == 'a1' || b != 'b1') && c in {'c'}", \
+        ["a", "b", "c"]
+
+
 def test_unique_id():
     seen_ids = {}
 
@@ -172,6 +278,62 @@ def test_plausible_garbage(l):
         expr.evaluate({})
 
 
+def test_same_as_reference():
+    for sel in ["a == 'b'", "a=='b'", "a\t==\t'b'", "a == 'b\tc'",
+                "a == 'b\\tc\\nd\\fe\\rf\\g'", 'a == "b\'c"',
+                "a == 'b\nc'", "a != ''", "a in {'b'}", "a in{'b' , \"c\"}",
+                "a in {}", "a in {'b',}", "a inx {'b'}", "a in_ {'b'}",
+                "a not in {'b'}", "a not-in {'b'}", "a not.in {'b'}",
+                "a notin {'b'}", "a not in$ {'b'}", "in == 'a'",
+                "not not in {'a'}", "has(a)", "has( a )", "has (a)",
+                "has == 'a'", "has(a) == 'b'", "hasx(a)", "a.b/c-d == 'e'",
+                "(a == 'b')", "((a == 'b') && c == 'd') && e == 'f'",
+                "a == 'b' && c == 'd' || e == 'f' && (g == 'h' || has(i))",
+                "a == 'b' &&", "|| a == 'b'", "a == 'b' & c == 'd'",
+                "(a == 'b'", "a == 'b')", "  all()  ", "all() && a == 'b'",
+                "\x0b", "a == 'b'\x0b", u"a == 'b\u00e9'", u"a\u00e9 == 'b'"]:
+        yield check_same_as_reference, sel
+
+
+@given(text(max_size=20))
+def test_same_as_reference_random(s):
+    check_same_as_reference(s)
+
+
+@given(lists(sampled_from(["a", '"a"', "'b\\t'", "b", "||", "&&", "(", ")",
+                           "has(", "has", "==", "!=", "in", "not", "{", "}",
+                           '{"a","b"}', ",", " ", "\t", "-", "&", "$"])))
+def test_plausible_garbage_same_as_reference(l):
+    check_same_as_reference("".join(l))
+
+
+def check_same_as_reference(selector):
+    try:
+        expected = _reference_parse(selector)
+    except BadSelector:
+        assert_raises(BadSelector, _parse_no_cache, selector)
+    else:
+        expr = _parse_no_cache(selector)
+        assert_equal(expr, expected)
+        assert_equal(repr(expr), repr(expected))
+        assert_equal(expr.unique_id, expected.unique_id)
+
+
+def test_parse_cache():
+    with patch("calico.felix.selectors._parse_cache", LRUCache(1)), \
+            patch("calico.felix.selectors._live_selectors",
+                  WeakValueDictionary()):
+        expr_id = id(parse_selector("a == 'b'"))
+        gc.collect()
+        # Held by the LRU cache even though nothing else references it.
+        assert_equal(id(parse_selector("a == 'b'")), expr_id)
+        expr = parse_selector("a == 'b'")
+        # Evicts the first selector from the LRU cache but it's still live
+        # so we get the same object back.
+        parse_selector("c == 'd'")
+        assert_true(parse_selector("a == 'b'") is expr)
+
+
 def check_match(selector, labels):
     expr = parse_selector(selector)
     assert_true(expr.evaluate(labels),
@@ -206,6 +368,11 @@ def check_bad_selector(selector):
     assert_raises(BadSelector, parse_selector, selector)
 
 
+def check_label_names(selector, expected):
+    expr = parse_selector(selector)
+    assert_equal(expr.label_names, frozenset(expected))
+
+
 def check_prereqs(selector, expected):
     expr = parse_selector(selector)
     assert_equal(expr.required_kvs, set(expected))
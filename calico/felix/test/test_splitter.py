@@ -23,6 +23,7 @@ import logging
 
 import mock
 
+from calico.datamodel_v1 import EndpointId
 from calico.felix.test.base import BaseTestCase, load_config
 from calico.felix.splitter import UpdateSplitter, CleanupManager
 
@@ -39,20 +40,30 @@ class TestUpdateSplitter(BaseTestCase):
         # construct a dummy manager class with a matching method for each one.
         self.mgrs_by_method = {}
         mgrs = []
-        for attr_name in UpdateSplitter.__dict__:
-            if attr_name.startswith("on_"):
-                class Mgr(object):
-                    locals()[attr_name] = mock.Mock()
-                mgr = Mgr()
-                self.mgrs_by_method[attr_name] = mgr
-                mgrs.append(mgr)
-        self.splitter = UpdateSplitter(mgrs)
+        # Endpoint updates are batched so the managers receive them via
+        # different methods.
+        method_names = [n for n in UpdateSplitter.__dict__
+                        if n.startswith("on_") and n != "on_endpoint_update"]
+        method_names += ["on_endpoint_updates", "on_local_endpoint_updates"]
+        for attr_name in method_names:
+            class Mgr(object):
+                locals()[attr_name] = mock.Mock()
+            mgr = Mgr()
+            self.mgrs_by_method[attr_name] = mgr
+            mgrs.append(mgr)
+        self.splitter = UpdateSplitter(mgrs, "localhost")
+        self.local_id = EndpointId("localhost", "orch", "wl", "ep1")
+        self.local_id_2 = EndpointId("localhost", "orch", "wl", "ep2")
+        self.remote_id = EndpointId("remotehost", "orch", "wl", "ep1")
 
     def test_pass_through(self):
         """
         Test that the update splitter fans out requests to the correct methods.
         """
         for meth_name, mgr in self.mgrs_by_method.iteritems():
+            if meth_name in ("on_endpoint_updates",
+                             "on_local_endpoint_updates"):
+                continue
             _log.info("Checking that method %s is passed through to relevant"
                       "managers", meth_name)
             # Extract the splitter's copy of the method and generate some
@@ -68,15 +79,82 @@ class TestUpdateSplitter(BaseTestCase):
             except:
                 raise AttributeError(dir(mgr))
             try:
-                # Method should be passed though with additional async=True
+                # Method should be passed though with additional nowait=True
                 # flag.
                 self.assertEqual(m_mgr_meth.mock_calls,
-                                 [mock.call(*m_args, async=True)])
+                                 [mock.call(*m_args, nowait=True)])
             except:
                 _log.exception("Failure while checking pass-through of %s",
                                meth_name)
                 raise
 
+    def test_endpoint_updates_batched(self):
+        """
+        Test that endpoint updates are buffered until flushed, that only the
+        latest update for each endpoint is sent and that remote endpoints
+        don't go to the local endpoint managers.
+        """
+        all_mgr = self.mgrs_by_method["on_endpoint_updates"]
+        local_mgr = self.mgrs_by_method["on_local_endpoint_updates"]
+        self.splitter.on_endpoint_update(self.local_id, {"a": 1})
+        self.splitter.on_endpoint_update(self.remote_id, {"b": 1})
+        self.splitter.on_endpoint_update(self.local_id_2, {"c": 1})
+        self.splitter.on_endpoint_update(self.local_id, None)
+        self.assertFalse(all_mgr.on_endpoint_updates.called)
+        self.assertFalse(local_mgr.on_local_endpoint_updates.called)
+        self.splitter.flush()
+        self.assertEqual(all_mgr.on_endpoint_updates.mock_calls, [
+            mock.call([(self.remote_id, {"b": 1}),
+                       (self.local_id_2, {"c": 1}),
+                       (self.local_id, None)], nowait=True)
+        ])
+        self.assertEqual(local_mgr.on_local_endpoint_updates.mock_calls, [
+            mock.call([(self.local_id_2, {"c": 1}),
+                       (self.local_id, None)], nowait=True)
+        ])
+        # Nothing left to send.
+        self.splitter.flush()
+        self.assertEqual(len(all_mgr.on_endpoint_updates.mock_calls), 1)
+
+    def test_remote_only_updates(self):
+        all_mgr = self.mgrs_by_method["on_endpoint_updates"]
+        local_mgr = self.mgrs_by_method["on_local_endpoint_updates"]
+        self.splitter.on_endpoint_update(self.remote_id, {"b": 1})
+        self.splitter.flush()
+        self.assertEqual(all_mgr.on_endpoint_updates.mock_calls, [
+            mock.call([(self.remote_id, {"b": 1})], nowait=True)
+        ])
+        self.assertFalse(local_mgr.on_local_endpoint_updates.called)
+
+    def test_other_updates_flush(self):
+        """
+        Test that buffered endpoint updates are sent before any other
+        update so that ordering is preserved.
+        """
+        m_parent = mock.Mock()
+        local_mgr = self.mgrs_by_method["on_local_endpoint_updates"]
+        in_sync_mgr = self.mgrs_by_method["on_datamodel_in_sync"]
+        m_parent.attach_mock(local_mgr.on_local_endpoint_updates, "ep")
+        m_parent.attach_mock(in_sync_mgr.on_datamodel_in_sync, "in_sync")
+        self.splitter.on_endpoint_update(self.local_id, {"a": 1})
+        self.splitter.on_datamodel_in_sync()
+        self.assertEqual(m_parent.mock_calls, [
+            mock.call.ep([(self.local_id, {"a": 1})], nowait=True),
+            mock.call.in_sync(nowait=True),
+        ])
+
+    def test_stats(self):
+        with mock.patch("calico.felix.splitter._stats") as m_stats:
+            self.splitter.on_endpoint_update(self.local_id, {"a": 1})
+            self.splitter.on_endpoint_update(self.local_id, {"a": 2})
+            self.splitter.on_endpoint_update(self.remote_id, {"b": 1})
+            self.splitter.flush()
+        # Three updates would previously have been sent to both managers.
+        self.assertEqual(m_stats.increment.mock_calls, [
+            mock.call("Endpoint update messages saved", by=4),
+            mock.call("Endpoint update messages sent", by=2),
+        ])
+
 
 class TestCleanupManager(BaseTestCase):
     def setUp(self):
@@ -116,6 +194,22 @@ class TestCleanupManager(BaseTestCase):
                 mock.call.m_ips_mgr.cleanup(async=False),
             ]
         )
+
+    def test_restart_stats_reported(self):
+        with mock.patch("gevent.spawn_later", autospec=True) as m_spawn_later:
+            self.mgr.on_datamodel_in_sync(async=True)
+            self.step_actor(self.mgr)
+        with mock.patch("calico.felix.devices.discard_route_inventory",
+                        autospec=True) as m_discard, \
+                mock.patch("calico.felix.splitter.RECONCILIATION_STATS") \
+                as m_stats, \
+                mock.patch("calico.felix.splitter._log") as m_log:
+            m_stats.stats = {"Route listings avoided": 3}
+            m_spawn_later.call_args[0][1]()
+            self.step_actor(self.mgr)
+        m_discard.assert_called_once_with()
+        m_log.info.assert_any_call("Start-of-day reconciliation: %s: %s",
+                                   "Route listings avoided", 3)
         # Finally, check that subsequent in-sync calls are ignored.
         with mock.patch("gevent.spawn_later", autospec=True) as m_spawn_later:
             self.mgr.on_datamodel_in_sync(async=True)
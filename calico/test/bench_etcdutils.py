@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+# Copyright 2015 Metaswitch Networks
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+calico.test.bench_etcdutils
+~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Microbenchmark for PathDispatcher.handle_event().
+
+Registers the same paths as Felix and dispatches a realistic mix of keys,
+dominated by endpoint updates, with some keys that don't match any path.
+
+Run with: python -m calico.test.bench_etcdutils [num_events]
+"""
+import sys
+import time
+
+from calico.etcdutils import PathDispatcher, EtcdEvent
+from calico.felix.fetcd import (
+    TAGS_KEY, RULES_KEY, PROFILE_LABELS_KEY, TIER_DATA, TIERED_PROFILE,
+    HOST_IP_KEY, PER_ENDPOINT_KEY, CIDR_V4_KEY, CONFIG_PARAM_KEY,
+    PER_HOST_CONFIG_PARAM_KEY
+)
+
+PATHS = [TAGS_KEY, RULES_KEY, PROFILE_LABELS_KEY, TIER_DATA, TIERED_PROFILE,
+         HOST_IP_KEY, PER_ENDPOINT_KEY, CIDR_V4_KEY, CONFIG_PARAM_KEY,
+         PER_HOST_CONFIG_PARAM_KEY]
+
+# (weight, key template) pairs.
+KEY_MIX = [
+    (70, "/calico/v1/host/host%(n)s/workload/k8s/wl%(n)s/endpoint/ep%(n)s"),
+    (5, "/calico/v1/policy/profile/prof%(n)s/rules"),
+    (5, "/calico/v1/policy/profile/prof%(n)s/tags"),
+    (5, "/calico/v1/policy/profile/prof%(n)s/labels"),
+    (5, "/calico/v1/policy/tier/tier%(n)s/policy/pol%(n)s"),
+    (2, "/calico/v1/policy/tier/tier%(n)s/metadata"),
+    (2, "/calico/v1/host/host%(n)s/bird_ip"),
+    (2, "/calico/v1/ipam/v4/pool/10.%(n)s.0.0-16"),
+    (1, "/calico/v1/config/Param%(n)s"),
+    (1, "/calico/v1/host/host%(n)s/config/Param%(n)s"),
+    # Keys that we don't handle.
+    (1, "/calico/v1/Ready"),
+    (1, "/calico/v1/host/host%(n)s/metadata"),
+]
+
+
+def _handler(response, **captures):
+    pass
+
+
+def make_events(num_events):
+    keys = []
+    for weight, template in KEY_MIX:
+        keys.extend([template] * weight)
+    events = []
+    for ii in xrange(num_events):
+        key = keys[ii % len(keys)] % {"n": ii % 1000}
+        action = "delete" if ii % 10 == 0 else "set"
+        events.append(EtcdEvent(action, key, "value"))
+    return events
+
+
+def main(argv):
+    num_events = int(argv[1]) if len(argv) > 1 else 500000
+    dispatcher = PathDispatcher()
+    for path in PATHS:
+        dispatcher.register(path, on_set=_handler, on_del=_handler)
+    events = make_events(num_events)
+    handle_event = dispatcher.handle_event
+    start = time.time()
+    for event in events:
+        handle_event(event)
+    elapsed = time.time() - start
+    print "Dispatched %d events in %.3fs: %.0f events/s" % (
+        num_events, elapsed, num_events / elapsed
+    )
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -22,7 +22,7 @@ Test for collections library.
 import logging
 from mock import Mock, call, patch
 
-from calico.calcollections import SetDelta, MultiDict
+from calico.calcollections import SetDelta, MultiDict, LRUCache
 from unittest2 import TestCase
 
 _log = logging.getLogger(__name__)
@@ -130,3 +130,45 @@ class TestMultiDict(TestCase):
         self.assertTrue(self.index.contains("k", "v3"))
         self.index.discard("k", "v3")
         self.assertEqual(self.index._index, {})
+
+
+class TestLRUCache(TestCase):
+    def setUp(self):
+        self.cache = LRUCache(2)
+
+    def test_get_put(self):
+        self.assertEqual(self.cache.get("a"), None)
+        self.assertEqual(self.cache.get("a", "default"), "default")
+        self.cache.put("a", 1)
+        self.assertEqual(self.cache.get("a"), 1)
+        self.assertIn("a", self.cache)
+        self.assertEqual(len(self.cache), 1)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 2))
+
+    def test_evicts_least_recently_used(self):
+        self.cache.put("a", 1)
+        self.cache.put("b", 2)
+        self.cache.get("a")  # "b" is now the least recently used.
+        self.cache.put("c", 3)
+        self.assertNotIn("b", self.cache)
+        self.assertIn("a", self.cache)
+        self.assertIn("c", self.cache)
+        self.assertEqual(self.cache.evictions, 1)
+        # Replacing a value refreshes it.
+        self.cache.put("a", 4)
+        self.cache.put("d", 5)
+        self.assertNotIn("c", self.cache)
+        self.assertEqual(self.cache.get("a"), 4)
+        self.assertEqual(str(self.cache),
+                         "LRUCache<size=2/2,hits=2,misses=0,evictions=2>")
+
+    def test_disabled(self):
+        cache = LRUCache(0)
+        cache.put("a", 1)
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.get("a"), None)
+
+    def test_clear(self):
+        self.cache.put("a", 1)
+        self.cache.clear()
+        self.assertEqual(len(self.cache), 0)
@@ -20,6 +20,7 @@ Tests for etcd utility function.
 """
 
 import logging
+import socket
 import types
 
 from etcd import EtcdException
@@ -28,7 +29,9 @@ from urllib3.exceptions import ReadTimeoutError
 
 from calico.etcdutils import (
     PathDispatcher, EtcdWatcher, delete_empty_parents,
-    EtcdClientOwner, ResyncRequired
+    EtcdClientOwner, ResyncRequired, EtcdConnectionFactory,
+    close_idle_connections, connection_factory, POOL_WATCH, POOL_SNAPSHOT,
+    POOL_STATUS
 )
 # Since other tests patch the module table, make sure we have the same etcd
 # module as the module under test.
@@ -193,6 +196,22 @@ class _TestPathDispatcherBase(BaseTestCase):
                             exp_handler="/a/<b>/d/<e>",
                             b="bval", e="eval")
 
+    def test_dispatch_trailing_slash(self):
+        self.assert_handled("/a/bval/d/", exp_handler="/a/<b>/d", b="bval")
+
+    def test_capture_takes_precedence(self):
+        # A fixed segment registered alongside a capture is shadowed by the
+        # capture.
+        self.register("/a/<b>/d/fixed")
+        self.assert_handled("/a/bval/d/fixed", exp_handler="/a/<b>/d/<e>",
+                            b="bval", e="fixed")
+
+    def test_register_after_dispatch(self):
+        self.assert_handled("/a/bval/c/fval", exp_handler=None)
+        self.register("/a/<b>/c/<f>")
+        self.assert_handled("/a/bval/c/fval", exp_handler="/a/<b>/c/<f>",
+                            b="bval", f="fval")
+
     def test_non_match(self):
         self.assert_handled("/a/bval/c/eval", exp_handler=None)
         self.assert_handled("/foo", exp_handler=None)
@@ -263,7 +282,12 @@ class TestEtcdClientOwner(BaseTestCase):
                                 etcd_ca="/path/to/ca")
         m_client = m_client_cls.return_value
         m_client.expected_cluster_id = "abcdef"
+        http = owner.client.http
         owner.reconnect()
+        # The client's connections are kept across the reconnect.
+        self.assertTrue(owner.client.http is http)
+        self.assertEqual(http.connection_pool_kw["cert_file"],
+                         "/path/to/cert")
         self.assertEqual(m_client_cls.mock_calls,
                          [call(host="localhost", port=1234,
                                expected_cluster_id=None,
@@ -297,6 +321,63 @@ class TestEtcdClientOwner(BaseTestCase):
         self.assertEqual(sorted(hosts), [("etcd1", 1234), ("etcd2", 2345)])
 
 
+class TestEtcdConnectionFactory(BaseTestCase):
+    def setUp(self):
+        super(TestEtcdConnectionFactory, self).setUp()
+        self.factory = EtcdConnectionFactory()
+
+    def test_pools_cached_per_use(self):
+        pool = self.factory.get_pool(POOL_WATCH, "http", "localhost", 2379)
+        self.assertEqual(pool.pool.maxsize, 1)
+        self.assertTrue(self.factory.get_pool(POOL_WATCH, "http",
+                                              "localhost", 2379) is pool)
+        snap_pool = self.factory.get_pool(POOL_SNAPSHOT, "http",
+                                          "localhost", 2379)
+        self.assertFalse(snap_pool is pool)
+        self.assertEqual(snap_pool.pool.maxsize, 2)
+        self.assertTrue((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1) in
+                        pool.conn_kw["socket_options"])
+
+    @patch("urllib3.connection.HTTPConnection.connect", autospec=True)
+    def test_handshakes_counted(self, m_connect):
+        pool = self.factory.get_pool(POOL_WATCH, "http", "localhost", 2379)
+        conn = pool._get_conn()
+        self.assertEqual(self.factory.handshakes.count, 0)
+        conn.connect()
+        self.assertEqual(self.factory.handshakes.count, 1)
+        self.assertEqual(m_connect.mock_calls, [call(conn)])
+
+        manager = self.factory.pool_manager(POOL_STATUS)
+        manager.connection_from_host("localhost", 2379)._get_conn().connect()
+        self.assertEqual(self.factory.handshakes.count, 2)
+
+    def test_close_idle_connections(self):
+        manager = self.factory.pool_manager(POOL_WATCH)
+        pool = manager.connection_from_host("localhost", 2379)
+        conn = pool._get_conn()
+        conn.close = Mock()
+        pool._put_conn(conn)
+        close_idle_connections(manager)
+        conn.close.assert_called_once_with()
+        # The pool is still usable and keeps its size.
+        self.assertEqual(pool.pool.qsize(), 1)
+        self.assertTrue(pool._get_conn() is conn)
+
+    def test_pool_manager_cert_without_key(self):
+        # As python-etcd allows, the key may be in the cert file.
+        factory = EtcdConnectionFactory(cert_file="/path/to/cert")
+        manager = factory.pool_manager(POOL_STATUS)
+        self.assertEqual(manager.connection_pool_kw["cert_file"],
+                         "/path/to/cert")
+        self.assertFalse("key_file" in manager.connection_pool_kw)
+
+    def test_shared_factory(self):
+        self.assertTrue(connection_factory("k", "c", "ca") is
+                        connection_factory("k", "c", "ca"))
+        self.assertFalse(connection_factory() is
+                         connection_factory("k", "c", "ca"))
+
+
 class TestEtcdWatcher(BaseTestCase):
     def setUp(self):
         super(TestEtcdWatcher, self).setUp()
@@ -406,9 +487,15 @@ class TestEtcdWatcher(BaseTestCase):
             m_resp,
         ]
         self.m_client.read.side_effect = iter(responses)
-        event = self.watcher.wait_for_etcd_event()
+        self.m_reconnect.reset_mock()
+        with patch("calico.etcdutils.close_idle_connections",
+                   autospec=True) as m_close:
+            event = self.watcher.wait_for_etcd_event()
         self.assertEqual(event, m_resp)
         self.assertEqual(m_sleep.mock_calls, [call(1)])
+        # The read timeout only discards the timed-out connection.
+        self.assertEqual(m_close.mock_calls, [call(self.m_client.http)])
+        self.assertEqual(self.m_reconnect.mock_calls, [call()])
 
     def test_wait_for_etcd_event_cluster_id_changed(self):
         self.watcher.next_etcd_index = 1